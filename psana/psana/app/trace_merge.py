@@ -0,0 +1,24 @@
+from psana.psexp.tracer import write_trace
+
+import argparse
+import os
+import sys
+
+def main():
+  """ Merges per-rank spans saved with PS_TRACE=<directory> (see
+  psexp/tracer.py) into a Chrome/Perfetto trace and a summary table. """
+
+  parser = argparse.ArgumentParser(description='Merges psana per-rank traces into trace.json and summary.txt')
+  parser.add_argument('trace_dir', help='directory given in PS_TRACE')
+  parser.add_argument('-j','--jobid', dest='jobid', help='job id (PS_PROMETHEUS_JOBID), default: the latest job')
+  args = parser.parse_args()
+
+  if not os.path.isdir(args.trace_dir):
+    print(f'Error: {args.trace_dir} is not a directory')
+    sys.exit(-1)
+
+  print(write_trace(args.trace_dir, jobid=args.jobid))
+  print(f'wrote {os.path.join(args.trace_dir, "trace.json")} (open in https://ui.perfetto.dev or chrome://tracing)')
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,41 @@
+from psana.psexp.ts_index import TimestampIndex
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+def main():
+  """ Builds timestamp index (see psexp/ts_index.py) for random access
+  into a run with Run.event, Run.events_at, and Run.events_between. """
+
+  parser = argparse.ArgumentParser(description='Builds timestamp -> offset index of xtc2 run files')
+  parser.add_argument('files', nargs='*', help='smd files of a run (*.smd.xtc2) or a bigdata xtc2 file')
+  parser.add_argument('-e','--exp', dest='exp', help='experiment name, used with --run instead of files')
+  parser.add_argument('-r','--run', dest='run', type=int, help='run number')
+  parser.add_argument('-x','--xtc-dir', dest='xtc_dir', help='xtc directory, default: $SIT_PSDM_DATA/<instrument>/<exp>/xtc')
+  parser.add_argument('-d','--index-dir', dest='index_dir', help='directory for the index file, default: directory of the files')
+  args = parser.parse_args()
+
+  files = args.files
+  if args.exp:
+    if args.run is None:
+      print('Error: --run is required with --exp')
+      sys.exit(-1)
+    xtc_dir = args.xtc_dir
+    if not xtc_dir:
+      xtc_dir = os.path.join(os.environ.get('SIT_PSDM_DATA', '/reg/d/psdm'), args.exp[:3], args.exp, 'xtc')
+    files = sorted(glob.glob(os.path.join(xtc_dir, 'smalldata', '*r%s-s*.smd.xtc2' % str(args.run).zfill(4))))
+  if not files:
+    parser.print_usage()
+    print('Error: no files found')
+    sys.exit(-1)
+
+  smd = all('.smd.' in os.path.basename(f) for f in files)
+  st = time.time()
+  idx = TimestampIndex.open(files, smd=smd, index_dir=args.index_dir)
+  print(f'indexed {len(idx)} dgrams of {len(files)} file(s) in {time.time()-st:.2f} s')
+
+if __name__ == '__main__':
+  main()
@@ -24,6 +24,7 @@ from psana.psexp.serial_ds     import SerialDataSource
 from psana.psexp.singlefile_ds import SingleFileDataSource
 from psana.psexp.shmem_ds      import ShmemDataSource
 from psana.psexp.legion_ds     import LegionDataSource
+from psana.psexp.local_ds      import LocalDataSource
 from psana.psexp.null_ds       import NullDataSource
 
 def DataSource(*args, **kwargs):
@@ -89,11 +90,14 @@ def DataSource(*args, **kwargs):
         elif mode == 'legion':
             return LegionDataSource(*args, **kwargs)
 
+        elif mode == 'local':
+            return LocalDataSource(*args, **kwargs)
+
         elif mode == 'none':
             return SerialDataSource(*args, **kwargs)
 
         else:
-            raise InvalidDataSource("Incorrect mode. DataSource mode only supports either mpi, legion, or none (non parallel mode).")
+            raise InvalidDataSource("Incorrect mode. DataSource mode only supports either mpi, legion, local (multi-core without MPI), or none (non parallel mode).")
     
     # ==== from XTC file(s) ====
     elif 'files' in kwargs: # an xtc file
@@ -31,6 +31,10 @@ Usage::
   #TBD init_interpolation_parameters(rows, cols, x, y, **kwa)
   #TBD img = img_interpolated(data, interpol_pars, **kwa)
 
+  plan = ImagePlan(rows, cols) # precomputed scatter of data pixels to image bins
+  img = plan.image(data, mapmode=2, fillholes=True, vbase=0, out=None, dtype=np.float32)
+  imgs = plan.images(stack_of_data, mapmode=2, fillholes=True, vbase=0, out=None, dtype=np.float32)
+
 2020-11-06 created by Mikhail Dubrovin
 """
 
@@ -340,5 +344,103 @@ def img_interpolated(data, interpol_pars, **kwa):
     """
     return interpol_pars # img_default(data)
 
+class ImagePlan:
+    """
+    Precomputed scatter plan of data pixels to image bins for
+    rows, cols index arrays shaped as data, e.g. (<nsegs>, 352, 384).
+
+    Made once per geometry, it keeps flat image indices for all data pixels:
+    - bins  - busy image bins and index of the last data pixel in each bin,
+    - multi - data pixels of bins with multiple entries (collision groups)
+              sorted by bin, with group starts and number of entries,
+    - holes - empty bins with four busy neighbor bins and their neighbors,
+    - interp- empty bins with at least two busy neighbor bins and their neighbors.
+    An image is then a few vectorized gathers/puts and reduceat-s.
+    """
+    def __init__(self, rows, cols):
+        assert isinstance(rows, np.ndarray)
+        assert isinstance(cols, np.ndarray)
+        assert rows.size == cols.size
+
+        t0_sec = time()
+        self.data_shape = rows.shape
+        self.npix = rows.size
+        self.img_shape = nrows, ncols = image_shape(rows, cols)
+        self.img_size = nrows * ncols
+        dst = rows.ravel().astype(np.intp) * ncols + cols.ravel().astype(np.intp)
+        self.entries = np.bincount(dst, minlength=self.img_size)
+
+        order = np.argsort(dst, kind='stable')
+        bins, starts, counts = np.unique(dst[order], return_index=True, return_counts=True)
+        self.bins = bins
+        self.bins_last = order[starts + counts - 1] # last data pixel in bin, like img[rows,cols]=data
+
+        multi = counts > 1
+        self.multi_bins = bins[multi]
+        self.multi_counts = counts[multi]
+        self.multi_pix = order[np.repeat(multi, counts)]
+        self.multi_starts = np.concatenate(([0], np.cumsum(self.multi_counts)[:-1])).astype(np.intp)
+
+        busy = (self.entries > 0).reshape(self.img_shape)
+        ir, ic = np.meshgrid(np.arange(nrows), np.arange(ncols), indexing='ij')
+        nbr_rc = ((ir-1, ic), (ir+1, ic), (ir, ic-1), (ir, ic+1))
+        nbr_ok = np.array([(r>=0) & (r<nrows) & (c>=0) & (c<ncols) for r,c in nbr_rc])
+        nbr_inds = np.array([np.clip(r,0,nrows-1) * ncols + np.clip(c,0,ncols-1) for r,c in nbr_rc])
+        nbr_busy = nbr_ok & busy.ravel()[nbr_inds]
+        nbusy = nbr_busy.sum(axis=0)
+        empty = ~busy
+
+        holes = (empty & (nbusy == 4)).ravel() # inside the image only
+        self.hole_bins = np.flatnonzero(holes)
+        self.hole_nbrs = nbr_inds.reshape(4, -1)[:, holes]
+
+        interp = (empty & (nbusy >= 2)).ravel()
+        self.interp_bins = np.flatnonzero(interp)
+        self.interp_nbrs = nbr_inds.reshape(4, -1)[:, interp]
+        w = nbr_busy.reshape(4, -1)[:, interp]
+        self.interp_weights = w / w.sum(axis=0)
+
+        logger.debug('ImagePlan for data shape %s image shape %s: %d busy bins, %d multiple entry bins, %d holes, time (sec) = %.6f'%\
+                     (str(self.data_shape), str(self.img_shape), self.bins.size, self.multi_bins.size, self.hole_bins.size, time()-t0_sec))
+
+
+    def images(self, data, mapmode=2, fillholes=True, vbase=0, out=None, dtype=np.float32):
+        """Returns images (N, nrows, ncols) for stack of data (N,)+data_shape.
+           mapmode 0/1/2/3/4: statistics of entries / last / max / mean pixel intensity / mean and interpolated empty bins
+           fillholes - fill holes with minimal intensity of four neighbor bins (for mapmode<4)
+           vbase - value of bins without data
+           out - optional preallocated output array of images
+        """
+        if mapmode==0:
+            return self.entries.reshape(self.img_shape).astype(np.uint16)
+
+        v = data.reshape(-1, self.npix)
+        nimgs = v.shape[0]
+        if out is None: out = np.empty((nimgs,) + self.img_shape, dtype=dtype)
+        img = out.reshape(nimgs, self.img_size)
+        img[:] = vbase
+
+        img[:, self.bins] = v[:, self.bins_last] # mapmode==1
+        if self.multi_bins.size:
+            if mapmode==2:
+                img[:, self.multi_bins] = np.maximum.reduceat(v[:, self.multi_pix], self.multi_starts, axis=1)
+            elif mapmode>2:
+                img[:, self.multi_bins] = np.add.reduceat(v[:, self.multi_pix], self.multi_starts, axis=1, dtype=np.float64) / self.multi_counts
+
+        if mapmode<4:
+            if fillholes and self.hole_bins.size:
+                img[:, self.hole_bins] = img[:, self.hole_nbrs].min(axis=1)
+        elif self.interp_bins.size:
+            img[:, self.interp_bins] = (img[:, self.interp_nbrs] * self.interp_weights).sum(axis=1)
+        return out
+
+
+    def image(self, data, mapmode=2, fillholes=True, vbase=0, out=None, dtype=np.float32):
+        """Returns image (nrows, ncols) for data shaped as data_shape, see images"""
+        if mapmode==0: return self.images(data, mapmode)
+        _out = None if out is None else out.reshape((1,) + self.img_shape)
+        img = self.images(data, mapmode, fillholes, vbase, _out, dtype)
+        return img[0] if out is None else out
+
 # EOF
 
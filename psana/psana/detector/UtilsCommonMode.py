@@ -14,6 +14,12 @@ Usage::
     ucm.common_mode_2d(arr, mask=None, cormax=None, npix_min=10)
     ucm.common_mode_rows_hsplit_nbanks(data, mask, nbanks=4, cormax=None)
     ucm.common_mode_2d_hsplit_nbanks(data, mask, nbanks=4, cormax=None)
+    cmode, npix = ucm.masked_median(arr, good=None, axes=-1)
+
+    All functions work in place on arrays of any number of leading
+    dimensions (e.g. segments, panel halves), e.g. common_mode_rows
+    with arr.shape=(<nsegs>, 352, 384) corrects all rows of all segments
+    in one call.
 
 This software was developed for the LCLS project.
 If you use all or part of it, please give an appropriate acknowledgment.
@@ -30,6 +36,59 @@ from math import fabs
 from psana.pyalgos.generic.NDArrUtils import info_ndarr, print_ndarr
 
 
+def masked_median(arr, good=None, axes=-1):
+    """Returns (cmode, npix): medians of arr over axes for good pixels and no. of good pixels.
+       Results are the same as of np.ma.median (np.median for good=None) for each 
+       group of pixels, but all groups (all other axes) are done at once: pixels
+       are copied to a work array with NaN for bad pixels, which is sorted along
+       the last axis (NaNs go to the end) and the middle element(s) of good pixels
+       are taken for each group. Medians of groups without good pixels are 0.
+       - arr (float) - n-d array
+       - good (bool or None) - the same shape array of good pixels
+       - axes (int or tuple) - axes to evaluate medians over
+    """
+    axes = (axes,) if isinstance(axes, int) else tuple(axes)
+    naxes = len(axes)
+    dst = tuple(range(-naxes, 0))
+    work = np.moveaxis(arr, axes, dst)
+    work = work.reshape(work.shape[:work.ndim-naxes] + (-1,))
+    if good is None:
+        npix = np.full(work.shape[:-1], work.shape[-1], dtype=np.int64)
+    else:
+        good = np.moveaxis(good, axes, dst)
+        good = good.reshape(good.shape[:good.ndim-naxes] + (-1,))
+        work = np.where(good, work, np.array(np.nan, dtype=arr.dtype))
+        npix = good.sum(axis=-1)
+    if work.shape[-1] == 0:
+        return np.zeros(work.shape[:-1], dtype=arr.dtype), npix
+
+    work = np.sort(work, axis=-1) # faster than np.partition with per group kth
+    h = npix // 2
+    l = np.where(npix % 2 == 1, h, h - 1).clip(0)
+    h = h.clip(None, work.shape[-1] - 1)
+    lo = np.take_along_axis(work, l[...,None], axis=-1)[...,0]
+    hi = np.take_along_axis(work, h[...,None], axis=-1)[...,0]
+    cmode = np.true_divide(lo + hi, 2.)
+    return np.where(npix==0, 0, cmode), npix
+
+
+def _apply_cmode(arr, cmode, mask):
+    """Subtracts cmode (broadcastable to arr) from arr in place for mask>0 pixels"""
+    if mask is None:
+        arr -= cmode
+    else:
+        np.subtract(arr, cmode, out=arr, where=mask>0)
+
+
+def _select_cmode(cmode, npix, mask, cormax, npix_min):
+    """Returns cmode set to 0 where it is not applied"""
+    if mask is not None:
+        cmode = np.where(npix>npix_min, cmode, 0)
+    if cormax is not None:
+        cmode = np.where(np.fabs(cmode) < cormax, cmode, 0)
+    return cmode
+
+
 def common_mode_rows(arr, mask=None, cormax=None, npix_min=10):
     """Defines and applys common mode correction to 2-d arr for rows.
        I/O parameters:
@@ -38,27 +97,10 @@ def common_mode_rows(arr, mask=None, cormax=None, npix_min=10):
        - cormax (float or None) - maximal allowed correction in ADU
        - npix_min (int) - minimal number of good pixels in row to evaluate and apply correction
     """
-    rows, cols = arr.shape
-    if mask is None:
-        cmode = np.median(arr,axis=1) # column of median values
-    else:
-        marr = np.ma.array(arr, mask=mask<1) # use boolean inverted mask (True for masked pixels)
-        cmode = np.ma.median(marr,axis=1) # column of median values for masked array
-        npix = mask.sum(axis=1) # count good pixels in each row
-        #print('npix', npix[:100])
-        cmode = np.select((npix>npix_min,), (cmode,), default=0)
-    
-    if cormax is not None:
-        cmode = np.select((np.fabs(cmode) < cormax,), (cmode,), default=0)
-    
-    #logger.debug(info_ndarr(cmode, 'cmode'))
-    _,m2 = np.meshgrid(np.zeros(cols, dtype=np.int16), cmode) # stack cmode 1-d column to 2-d matrix
-    if mask is None:
-        arr -= m2
-    else: 
-        bmask = mask>0
-        arr[bmask] -= m2[bmask]
-
+    cmode, _ = masked_median(arr, None if mask is None else ~(mask<1), axes=-1) # column of median values
+    npix = None if mask is None else mask.sum(axis=-1) # count good pixels in each row
+    cmode = _select_cmode(cmode, npix, mask, cormax, npix_min)
+    _apply_cmode(arr, cmode[...,None], mask)
 
 
 def common_mode_cols(arr, mask=None, cormax=None, npix_min=10):
@@ -69,79 +111,59 @@ def common_mode_cols(arr, mask=None, cormax=None, npix_min=10):
        - cormax (float or None) - maximal allowed correction in ADU
        - npix_min (int) - minimal number of good pixels in column to evaluate and apply correction
     """
-    rows, cols = arr.shape
-    if mask is None:
-        cmode = np.median(arr,axis=0)
-    else:
-        marr = np.ma.array(arr, mask=mask<1) # use boolean inverted mask (True for masked pixels)
-        cmode = np.ma.median(marr,axis=0) # row of median values for masked array
-        npix = mask.sum(axis=0) # count good pixels in each column
-        cmode = np.select((npix>npix_min,), (cmode,), default=0)
-
-    if cormax is not None:
-        cmode = np.select((np.fabs(cmode) < cormax,), (cmode,), default=0)
-
-    #logger.debug(info_ndarr(cmode, 'cmode'))
-    m1,_ = np.meshgrid(cmode, np.zeros(rows, dtype=np.int16)) # stack cmode 1-d row to 2-d matrix
-    if mask is None:
-        arr -= m1
-    else:
-        bmask = mask>0
-        arr[bmask] -= m1[bmask]
-
+    cmode, _ = masked_median(arr, None if mask is None else ~(mask<1), axes=-2) # row of median values
+    npix = None if mask is None else mask.sum(axis=-2) # count good pixels in each column
+    cmode = _select_cmode(cmode, npix, mask, cormax, npix_min)
+    _apply_cmode(arr, cmode[...,None,:], mask)
 
 
 def common_mode_2d(arr, mask=None, cormax=None, npix_min=10):
     """Defines and applys common mode correction to entire 2-d arr using the same shape mask. 
     """
-    if mask is None:
-        cmode = np.median(arr)
-        if cormax is None or fabs(cmode) < cormax:
-            arr -= cmode
-    else:
-        arr1 = np.ones_like(arr, dtype=np.int16)
-        bmask = mask>0
-        npix = arr1[bmask].sum()
-        if npix < npix_min: return
-        cmode = np.median(arr[bmask])
-        if cormax is None or fabs(cmode) < cormax:
-            arr[bmask] -= cmode
+    bmask = None if mask is None else mask>0
+    cmode, npix = masked_median(arr, bmask, axes=(-2,-1))
+    if mask is not None:
+        cmode = np.where(npix < npix_min, 0, cmode)
+    if cormax is not None:
+        cmode = np.where(np.fabs(cmode) < cormax, cmode, 0)
+    _apply_cmode(arr, cmode[...,None,None], mask)
+
 
+def _banks(arr, nbanks):
+    """Returns arr (..., rows, cols) reshaped to (..., rows, nbanks, cols/nbanks)"""
+    if arr is None: return None
+    assert arr.shape[-1] % nbanks == 0, 'array split does not result in an equal division'
+    return arr.reshape(arr.shape[:-1] + (nbanks, arr.shape[-1]//nbanks))
 
 
 def common_mode_rows_hsplit_nbanks(data, mask=None, nbanks=4, cormax=None, npix_min=10):
     """Works with 2-d data and mask numpy arrays,
-       hsplits them for banks (df. nbanks=4),
-       for each bank applies median common mode correction for pixels in rows,
-       hstack banks in array of original data shape and copy results in i/o data 
+       splits them for banks (df. nbanks=4) along columns,
+       for each bank applies median common mode correction for pixels in rows.
+       All banks (and leading dimensions) are done at once in place.
     """
-    bdata = np.hsplit(data, nbanks)
-
-    if mask is None:
-        for b in bdata:
-            common_mode_rows(b, None, cormax, npix_min)
-    else:
-        bmask = np.hsplit(mask, nbanks)
-        for b,m in zip(bdata,bmask):
-            common_mode_rows(b, m, cormax, npix_min)
-    data[:] = np.hstack(bdata)[:]    
-
+    bdata, bmask = _banks(data, nbanks), _banks(mask, nbanks)
+    cmode, _ = masked_median(bdata, None if mask is None else ~(bmask<1), axes=-1)
+    npix = None if mask is None else bmask.sum(axis=-1)
+    cmode = _select_cmode(cmode, npix, mask, cormax, npix_min) # shape (..., rows, nbanks)
+    _apply_cmode(data, np.repeat(cmode, data.shape[-1]//nbanks, axis=-1), mask)
 
 
 def common_mode_2d_hsplit_nbanks(data, mask=None, nbanks=4, cormax=None, npix_min=10):
     """Works with 2-d data and mask numpy arrays,
-       hsplits them for banks (df. nbanks=4),
-       for each bank applies median common mode correction for all pixels,
-       hstack banks in array of original data shape and copy results in i/o data 
+       splits them for banks (df. nbanks=4) along columns,
+       for each bank applies median common mode correction for all pixels
+       (for pixels in rows if mask is None).
+       All banks (and leading dimensions) are done at once in place.
     """
-    bdata = np.hsplit(data, nbanks)
     if mask is None:
-        for b in bdata:
-            common_mode_rows(b, None, cormax, npix_min)
-    else:
-        bmask = np.hsplit(mask, nbanks) if mask is not None else None
-        for b,m in zip(bdata,bmask):
-            common_mode_2d(b, m, cormax, npix_min)
-    data[:] = np.hstack(bdata)[:]    
+        common_mode_rows_hsplit_nbanks(data, None, nbanks, cormax, npix_min)
+        return
+    bdata, bmask = _banks(data, nbanks), _banks(mask>0, nbanks)
+    cmode, npix = masked_median(bdata, bmask, axes=(-3,-1))
+    cmode = np.where(npix < npix_min, 0, cmode)
+    if cormax is not None:
+        cmode = np.where(np.fabs(cmode) < cormax, cmode, 0) # shape (..., nbanks)
+    _apply_cmode(data, np.repeat(cmode, data.shape[-1]//nbanks, axis=-1)[...,None,:], mask)
 
 # EOF
@@ -29,6 +29,11 @@ Usage::
     calib = calib_epix10ka_any(det_raw, evt, cmpars=(7,2,100,10),\
                             mbits=0o7, mask=None, edge_rows=10, edge_cols=10, center_rows=5, center_cols=5)
 
+    o = epix10ka_calib_for_det_raw(det_raw) # per-detector Epix10kaCalib
+    calib = o.calib_raw(raw, cmpars=None, out=None, **kwa)   # raw shape (<nsegs>, 352, 384) or (N, <nsegs>, 352, 384)
+    calibs = o.calib(evts, cmpars=None, out=None, **kwa)     # shape (N, <nsegs>, 352, 384)
+    grinds = o.gain_range_index(raw)
+
 This software was developed for the LCLS project.
 If you use all or part of it, please give an appropriate acknowledgment.
 
@@ -42,7 +47,7 @@ from time import time
 import logging
 logger = logging.getLogger(__name__)
 
-from psana.pyalgos.generic.NDArrUtils import info_ndarr, divide_protected
+from psana.pyalgos.generic.NDArrUtils import info_ndarr
 from psana.detector.UtilsMask import merge_masks, DTYPE_MASK
 from psana.detector.UtilsCommonMode import common_mode_cols,\
   common_mode_rows_hsplit_nbanks, common_mode_2d_hsplit_nbanks
@@ -58,15 +63,23 @@ M14 =  0x3fff # 16383 or (1<<14)-1 - 14-bit mask
 
 #----
 
-class Storage:
-    def __init__(self):
-        self.arr1 = None
-        self.gfac = None
-        self.mask = None
-        self.dcfg = None
-        self.counter = -1
-
-store = Storage() # singleton
+def gain_range_index_lut():
+    """Returns array of 64 gain range indices (0-6 as in GAIN_MODES, 7 for undefined)
+       for all values of 6-bit pixel control bits (see gain_maps_epix10ka_any).
+    """
+    lut = np.full(64, 7, dtype=np.uint8)
+    for cbits in range(63, -1, -1):
+        m60, m28, m12 = cbits & 60, cbits & 28, cbits & 12
+        lut[cbits] = 0 if m28 == 28 else\
+                     1 if m28 == 12 else\
+                     2 if m12 ==  8 else\
+                     3 if m60 == 16 else\
+                     4 if m60 ==  0 else\
+                     5 if m60 == 48 else\
+                     6 if m60 == 32 else 7
+    return lut
+
+GAIN_RANGE_INDEX_LUT = gain_range_index_lut()
 
 #----
 
@@ -370,6 +383,172 @@ def find_gain_mode(dcfg, data=None):
     #return GAIN_MODES[ind] if ind<len(grp_prob) else None
 
 
+class Epix10kaCalib:
+    """
+    Calibration of epix10ka data for one detector (det.raw).
+
+    Owns its cached constants, built on first use and rebuilt if
+    det_raw returns other pedestals or gains (calibconst changed):
+    - config control bits (<nsegs>, 352, 384) - data bit 14 is added per frame
+    - pedestal and gain factor tables (8, <nsegs>, 352, 384), contiguous,
+      with the 7 gain ranges of calibration constants and a last entry
+      (pedestal 0, gain factor 1) for pixels with undefined gain range
+    - mask
+    Per frame, the gain range index of each pixel is found once with 
+    a look-up table of control bits (GAIN_RANGE_INDEX_LUT) and pedestals 
+    and gain factors are gathered from the tables with this index.
+    """
+    def __init__(self, det_raw):
+        self.det_raw = det_raw
+        self.dcfg = None
+        self.cbits_cfg = None
+        self.peds_tab = None
+        self.gfac_tab = None
+        self.cons_src = None # (peds, gain) the tables are made of
+        self.mask = None
+        self.counter = -1
+
+
+    def _config_cbits(self):
+        if self.cbits_cfg is None:
+            if self.dcfg is None: self.dcfg = config_object_epix10ka_raw(self.det_raw)
+            self.cbits_cfg = cbits_config_epix10ka_any(self.dcfg).astype(np.uint16)
+        return self.cbits_cfg
+
+
+    def _constants(self, raw, **kwa):
+        """Builds pedestal and gain factor tables and mask, returns False if constants are missing."""
+        gain = self.det_raw._gain()      # - 4d gains  (7, <nsegs>, 352, 384)
+        peds = self.det_raw._pedestals() # - 4d pedestals
+        if gain is None: return False
+        if peds is None: return False
+        if self.peds_tab is not None and self.cons_src[0] is peds and self.cons_src[1] is gain: return True
+        self.cons_src = peds, gain
+
+        logger.debug(info_ndarr(raw,  '\n  raw ')\
+                    +info_ndarr(gain, '\n  gain')\
+                    +info_ndarr(peds, '\n  peds'))
+
+        gfac = self.det_raw._gain_factor() # cached 1/gain
+        dtype = np.result_type(np.float32, peds.dtype, gfac.dtype)
+        self.peds_tab = np.zeros((8,) + peds.shape[1:], dtype=dtype)
+        self.peds_tab[:7] = peds
+        self.gfac_tab = np.ones((8,) + gfac.shape[1:], dtype=dtype)
+        self.gfac_tab[:7] = gfac
+        self.npix = int(np.prod(peds.shape[1:]))
+        self.pix_index = np.arange(self.npix, dtype=np.intp).reshape(peds.shape[1:])
+
+        logger.debug(info_ndarr(gfac,  '\n  gfac '))
+
+        mbits = kwa.pop('mbits',1) # 1-mask from status, etc.
+        mask = self.det_raw._mask_comb(mbits=mbits, **kwa) if mbits > 0 else None
+        mask_opt = kwa.get('mask',None) # mask optional parameter in det_raw.calib(...,mask=...)
+        mask = mask if mask_opt is None else mask_opt if mask is None else merge_masks(mask,mask_opt)
+        self.mask = mask if mask is not None else np.ones(peds.shape[1:], dtype=DTYPE_MASK)
+        return True
+
+
+    def gain_range_index(self, raw):
+        """Returns array (shaped as raw) of per pixel gain range indices, 0-6 or 7 for undefined."""
+        cbits = np.bitwise_and(raw, B14)
+        np.right_shift(cbits, 9, out=cbits) # 040000 -> 040
+        np.bitwise_or(cbits, self._config_cbits(), out=cbits)
+        return GAIN_RANGE_INDEX_LUT[cbits]
+
+
+    def _calib_frame(self, raw, out, cmpars):
+        """Calibrates one frame (<nsegs>, 352, 384) into out."""
+        grind = self.gain_range_index(raw)
+        ind = grind.astype(np.intp)
+        ind *= self.npix
+        ind += self.pix_index
+
+        self.counter += 1
+        if not self.counter%100:
+            gmaps = tuple(grind == i for i in range(7))
+            logger.debug(info_gain_mode_arrays(gmaps))
+            logger.debug(info_pixel_gain_mode_statistics(gmaps))
+
+        np.subtract(raw & M14, np.take(self.peds_tab, ind), out=out)
+
+        if cmpars is not None:
+          alg, mode, cormax = int(cmpars[0]), int(cmpars[1]), cmpars[2]
+          npixmin = cmpars[3] if len(cmpars)>3 else 10
+          if mode>0:
+            t0_sec_cm = time()
+            # alg 7: common mode only from pixels in gain ranges 'FH','FM','AHL-H','AML-M'
+            gmask = np.bitwise_and((grind==0)|(grind==1)|(grind==3)|(grind==4), self.mask) if alg==7 else self.mask
+            logger.debug(info_ndarr(gmask, 'gmask')\
+                         + '\n  per panel statistics of cm-corrected pixels: %s' % str(np.sum(gmask, axis=(1,2), dtype=np.uint32)))
+
+            #sh = (nsegs, 352, 384), all segments and panel halves are corrected at once
+            nsegs, rows, cols = out.shape
+            hrows = 176 # int(352/2)
+            out_h = out.reshape(nsegs, 2, hrows, cols) # view on out
+            gmask_h = gmask.reshape(nsegs, 2, hrows, cols)
+
+            if mode & 4: # in banks: (352/2,384/8)=(176,48) pixels
+                common_mode_2d_hsplit_nbanks(out_h, mask=gmask_h, nbanks=8, cormax=cormax, npix_min=npixmin)
+
+            if mode & 1: # in rows per bank: 384/8 = 48 pixels
+                common_mode_rows_hsplit_nbanks(out, mask=gmask, nbanks=8, cormax=cormax, npix_min=npixmin)
+
+            if mode & 2: # in cols per bank: 352/2 = 176 pixels
+                common_mode_cols(out_h, mask=gmask_h, cormax=cormax, npix_min=npixmin)
+
+            logger.debug('TIME common-mode correction = %.6f sec for cmp=%s' % (time()-t0_sec_cm, str(cmpars)))
+
+        out *= np.take(self.gfac_tab, ind) # gain correction
+        out *= self.mask
+        return out
+
+
+    def calib_raw(self, raw, cmpars=None, out=None, **kwa):
+        """
+        Returns calibrated data for raw data of one frame (<nsegs>, 352, 384)
+        or of N frames (N, <nsegs>, 352, 384), None if constants are missing.
+        out (optional) - preallocated output array shaped as raw.
+        See calib_epix10ka_any for cmpars and **kwa.
+        """
+        if not self._constants(raw, **kwa): return None
+        _cmpars = self.det_raw._common_mode() if cmpars is None else cmpars
+        logger.debug('common-mode correction pars cmp: %s' % str(_cmpars))
+
+        frame_shape = self.peds_tab.shape[1:]
+        raws = raw.reshape((-1,) + frame_shape)
+        if out is None: out = np.empty(raw.shape, dtype=self.peds_tab.dtype)
+        outs = out.reshape((-1,) + frame_shape)
+        for raw_frame, out_frame in zip(raws, outs):
+            self._calib_frame(raw_frame, out_frame, _cmpars)
+        return out
+
+
+    def calib(self, evts, cmpars=None, out=None, **kwa):
+        """
+        Returns calibrated data of N events in one array (N, <nsegs>, 352, 384).
+        Frames of events without raw data are set to NaN.
+        out (optional) - preallocated output array.
+        """
+        raws = [self.det_raw.raw(evt) for evt in evts]
+        raw0 = next((raw for raw in raws if raw is not None), None)
+        if raw0 is None or not self._constants(raw0, **kwa): return None
+        if out is None: out = np.empty((len(raws),) + self.peds_tab.shape[1:], dtype=self.peds_tab.dtype)
+        for raw, out_frame in zip(raws, out):
+            if raw is None:
+                out_frame.fill(np.nan)
+            else:
+                self.calib_raw(raw, cmpars=cmpars, out=out_frame, **kwa)
+        return out
+
+
+def epix10ka_calib_for_det_raw(det_raw):
+    """Returns Epix10kaCalib object owned by det_raw (created on first call)."""
+    o = getattr(det_raw, '_epix10ka_calib', None)
+    if o is None:
+        o = det_raw._epix10ka_calib = Epix10kaCalib(det_raw)
+    return o
+
+
 def calib_epix10ka_any(det_raw, evt, cmpars=None, **kwa): #cmpars=(7,2,100)):
     """
     Returns calibrated epix10ka data
@@ -404,116 +583,22 @@ def calib_epix10ka_any(det_raw, evt, cmpars=None, **kwa): #cmpars=(7,2,100)):
     raw = det_raw.raw(evt) if nda_raw is None else nda_raw # shape:(352, 384) or suppose to be later (<nsegs>, 352, 384) dtype:uint16
     if raw is None: return None
 
-    _cmpars  = det_raw._common_mode() if cmpars is None else cmpars
-
-    gain = det_raw._gain()      # - 4d gains  (7, <nsegs>, 352, 384)
-    peds = det_raw._pedestals() # - 4d pedestals
-    if gain is None: return None # gain = np.ones_like(peds)  # - 4d gains
-    if peds is None: return None # peds = np.zeros_like(peds) # - 4d gains
-
-    if store.gfac is None: 
-        # do ONCE this initialization 
-        logger.debug(info_ndarr(raw,  '\n  raw ')\
-                    +info_ndarr(gain, '\n  gain')\
-                    +info_ndarr(peds, '\n  peds'))
-
-        store.gfac = divide_protected(np.ones_like(gain), gain)
-        store.arr1 = np.ones_like(raw, dtype=np.int8)
-
-        logger.debug(info_ndarr(store.gfac,  '\n  gfac '))
-
-        # 'FH','FM','FL','AHL-H','AML-M','AHL-L','AML-L'
-        #store.gf4 = np.ones_like(raw, dtype=np.int32) * 0.25 # 0.3333 # M - perefierial
-        #store.gf6 = np.ones_like(raw, dtype=np.int32) * 1    # L - center
-
-    gfac = store.gfac
-
-    if store.dcfg is None: store.dcfg = config_object_epix10ka_raw(det_raw)
-
-    gmaps = gain_maps_epix10ka_any(store.dcfg, raw)
-    if gmaps is None: return None
-    gr0, gr1, gr2, gr3, gr4, gr5, gr6 = gmaps
-
-    factor = np.select(gmaps,\
-                       (gfac[0,:], gfac[1,:], gfac[2,:], gfac[3,:],\
-                        gfac[4,:], gfac[5,:], gfac[6,:]), default=1) # 2msec
-
-    pedest = np.select(gmaps,\
-                       (peds[0,:], peds[1,:], peds[2,:], peds[3,:],\
-                        peds[4,:], peds[5,:], peds[6,:]), default=0)
-
-    store.counter += 1
-    if not store.counter%100:
-        logger.debug(info_gain_mode_arrays(gmaps))
-        logger.debug(info_pixel_gain_mode_statistics(gmaps))
+    calib = epix10ka_calib_for_det_raw(det_raw).calib_raw(raw, cmpars=cmpars, **kwa)
 
     logger.debug('TOTAL consumed time (sec) = %.6f' % (time()-t0_sec_tot))
-    logger.debug(info_ndarr(factor, 'calib_epix10ka factor'))
-    logger.debug(info_ndarr(pedest, 'calib_epix10ka pedest'))
-
-    arrf = np.array(raw & M14, dtype=np.float32) - pedest
-
-    logger.debug('common-mode correction pars cmp: %s' % str(_cmpars))
-
-    if store.mask is None:
-        mbits = kwa.pop('mbits',1) # 1-mask from status, etc.
-        mask = det_raw._mask_comb(mbits=mbits, **kwa) if mbits > 0 else None
-        mask_opt = kwa.get('mask',None) # mask optional parameter in det_raw.calib(...,mask=...)
-        store.mask = mask if mask_opt is None else mask_opt if mask is None else merge_masks(mask,mask_opt)
-
-    mask = store.mask if store.mask is not None else np.ones_like(raw, dtype=DTYPE_MASK)
-
-    if _cmpars is not None:
-      alg, mode, cormax = int(_cmpars[0]), int(_cmpars[1]), _cmpars[2]
-      npixmin = _cmpars[3] if len(_cmpars)>3 else 10
-      if mode>0:
-        t0_sec_cm = time()
-        #t2_sec_cm = time()
-        arr1 = store.arr1 # np.ones_like(mask, dtype=np.uint8)
-        grhm = np.select((gr0,  gr1,  gr3,  gr4), (arr1, arr1, arr1, arr1), default=0) if alg==7 else arr1
-        gmask = np.bitwise_and(grhm, mask) if mask is not None else grhm
-        #logger.debug(info_ndarr(arr1, '\n  arr1'))
-        #logger.debug(info_ndarr(grhm, 'XXXX grhm'))
-        #logger.debug(info_ndarr(gmask, 'XXXX gmask'))
-        #logger.debug('common-mode mask massaging (sec) = %.6f' % (time()-t2_sec_cm)) # 5msec
-        logger.debug(info_ndarr(gmask, 'gmask')\
-                     + '\n  per panel statistics of cm-corrected pixels: %s' % str(np.sum(gmask, axis=(1,2), dtype=np.uint32)))
-
-        #sh = (nsegs, 352, 384)
-        hrows = 176 # int(352/2)
-        for s in range(arrf.shape[0]):
-
-          if mode & 4: # in banks: (352/2,384/8)=(176,48) pixels
-            common_mode_2d_hsplit_nbanks(arrf[s,:hrows,:], mask=gmask[s,:hrows,:], nbanks=8, cormax=cormax, npix_min=npixmin)
-            common_mode_2d_hsplit_nbanks(arrf[s,hrows:,:], mask=gmask[s,hrows:,:], nbanks=8, cormax=cormax, npix_min=npixmin)
-
-          if mode & 1: # in rows per bank: 384/8 = 48 pixels # 190ms
-            common_mode_rows_hsplit_nbanks(arrf[s,], mask=gmask[s,], nbanks=8, cormax=cormax, npix_min=npixmin)
-
-          if mode & 2: # in cols per bank: 352/2 = 176 pixels # 150ms
-            common_mode_cols(arrf[s,:hrows,:], mask=gmask[s,:hrows,:], cormax=cormax, npix_min=npixmin)
-            common_mode_cols(arrf[s,hrows:,:], mask=gmask[s,hrows:,:], cormax=cormax, npix_min=npixmin)
-
-        logger.debug('TIME common-mode correction = %.6f sec for cmp=%s' % (time()-t0_sec_cm, str(_cmpars)))
-
-    return arrf * factor if mask is None else arrf * factor * mask # gain correction
+    return calib
 
 
 def map_gain_range_index(det_raw, evt, **kwa):
     """
     Returns array of epix10ka per pixel gain range indices [0:6]
     """
-    if store.dcfg is None: store.dcfg = config_object_epix10ka_raw(det_raw)
-
     nda_raw = kwa.get('nda_raw', None)
     raw = det_raw.raw(evt) if nda_raw is None else nda_raw # shape:(352, 384) or suppose to be later (<nsegs>, 352, 384) dtype:uint16
     if raw is None: return None
 
-    gmaps = gain_maps_epix10ka_any(store.dcfg, raw)
-    if gmaps is None: return None
-    #gr0, gr1, gr2, gr3, gr4, gr5, gr6 = gmaps
-
-    return np.select(gmaps, (0, 1, 2, 3, 4, 5, 6), default=10)
+    grind = epix10ka_calib_for_det_raw(det_raw).gain_range_index(raw)
+    return np.where(grind < 7, grind, 10)
 
 #--------------------
 
@@ -13,8 +13,12 @@ Usage::
   a = o._det_calibconst()
   a = o._calibcons_and_meta_for_ctype(ctype='pedestals')
   a = o._cached_array(p, ctype='pedestals')
+  a = o._cached(key, ctypes, func) # lazy, cached until calibconst[ctype] for ctypes change
+  d = o._calib_cache_stats() # {'hits':..., 'misses':..., 'size':...}
   a = o._pedestals()
+  a = o._pedestals_float32() # read-only
   a = o._gain()
+  a = o._gain_factor() # read-only 1/gain, 0 for 0 gain
   a = o._rms()
   a = o._status()
   a = o._mask_calib()
@@ -24,6 +28,7 @@ Usage::
   a = o._pixel_coord_indexes(pix_scale_size_um=None, xy0_off_pix=None, do_tilt=True, cframe=0, **kwa)
   a = o._pixel_coords(do_tilt=True, cframe=0, **kwa)
   a = o._cached_pixel_coord_indexes(evt, **kwa) # **kwa - the same as above
+  p = o._image_plan(evt, **kwa) # cached ImagePlan for segments in evt and geometry **kwa
 
   a = o._shape_as_daq()
   a = o._number_of_segments_total()
@@ -32,12 +37,13 @@ Usage::
   m = o._mask_from_status()
   m = o._mask_edges(edge_rows=1, edge_cols=1, dtype=DTYPE_MASK, **kwa)
   m = o._mask(calib=False, status=False, edges=False, dtype=DTYPE_MASK, **kwa) # TBD: neighbors=False
-  m = o._mask_comb(mbits=0o377, **kwa)
+  m = o._mask_comb(mbits=0o377, **kwa) # read-only, cached for hashable kwa
 
   a = o.calib(evt, cmpars=(7,2,100,10),\
                             mbits=0o7, mask=None, edge_rows=10, edge_cols=10, center_rows=5, center_cols=5)
   a = o.calib(evt, **kwa)
   a = o.image(self, evt, nda=None, **kwa)
+  a = o.images(self, evt, nda, **kwa) # nda - stack of N calibrated frames of the same segments as in evt
 
 2020-11-06 created by Mikhail Dubrovin
 """
@@ -50,33 +56,33 @@ logger = logging.getLogger(__name__)
 import numpy as np
 
 from psana.pscalib.geometry.GeometryAccess import GeometryAccess #, img_from_pixel_arrays
-from psana.pyalgos.generic.NDArrUtils import info_ndarr, reshape_to_3d # print_ndarr,shape_as_2d, shape_as_3d, reshape_to_2d
-from psana.detector.UtilsAreaDetector import dict_from_arr3d, arr3d_from_dict,\
-        img_from_pixel_arrays, statistics_of_pixel_arrays, img_multipixel_max, img_multipixel_mean,\
-        img_interpolated, init_interpolation_parameters, statistics_of_holes, fill_holes
+from psana.pyalgos.generic.NDArrUtils import info_ndarr, reshape_to_3d, divide_protected # print_ndarr,shape_as_2d, shape_as_3d, reshape_to_2d
+from psana.detector.UtilsAreaDetector import dict_from_arr3d, arr3d_from_dict, ImagePlan
 from psana.detector.UtilsMask import CC, DTYPE_MASK, DTYPE_STATUS, mask_edges, merge_masks
 
 from amitypes import Array2d, Array3d
 
 #----
 
+MASK_CTYPES = ('pixel_mask', 'pixel_status', 'pedestals') # calibconst types combined mask depends on
+
+def read_only(a):
+    """Returns numpy array a protected from modification (shared between callers)"""
+    if isinstance(a, np.ndarray): a.flags.writeable = False
+    return a
+
+#----
+
 class AreaDetector(DetectorImpl):
 
     def __init__(self, *args, **kwargs):
         logger.debug('AreaDetector.__init__') #  self.__class__.__name__
         DetectorImpl.__init__(self, *args, **kwargs)
         # caching
-        self._geo_ = None
         self._pix_rc_ = None, None
-        self._pix_xyz_ = None, None, None
-        self._interpol_pars_ = None
-        self._pedestals_ = None
-        self._gain_ = None
-        self._rms_ = None
-        self._status_ = None
-        self._common_mode_ = None
-        self._mask_calib_ = None
-        self._mask_ = None
+        self._calib_cache_ = {} # key: (calibconst entries the value is made of, value)
+        self._calib_cache_hits = 0
+        self._calib_cache_misses = 0
         #logger.info('XXX dir(self):\n' + str(dir(self)))
         #logger.info('XXX self._segments:\n' + str(self._segments))
 
@@ -133,19 +139,58 @@ class AreaDetector(DetectorImpl):
         return cons_and_meta
 
 
+    def _cached(self, key, ctypes, func):
+        """Returns func() evaluated on first call and cached under key
+           until any of calibconst[ctype] entries for ctypes is changed
+           (calibconst of the next run or re-assigned entry).
+        """
+        cc = self._calibconst
+        token = tuple(None if cc is None else cc.get(ctype, None) for ctype in ctypes)
+        item = self._calib_cache_.get(key, None)
+        if item is not None and all(a is b for a,b in zip(item[0], token)):
+            self._calib_cache_hits += 1
+            return item[1]
+        self._calib_cache_misses += 1
+        logger.debug('AreaDetector._cached: evaluate %s' % str(key))
+        v = func()
+        self._calib_cache_[key] = (token, v)
+        return v
+
+
+    def _calib_cache_stats(self):
+        return {'hits': self._calib_cache_hits, 'misses': self._calib_cache_misses, 'size': len(self._calib_cache_)}
+
+
     def _cached_array(self, p, ctype='pedestals'):
-        """cached array
+        """cached array of calibration constants for ctype, p (if not None) is returned as is
         """
-        if p is None: p = self._calibcons_and_meta_for_ctype(ctype)[0] # 0-data/1-metadata
-        return p
+        if p is not None: return p
+        cons_and_meta = self._cached(ctype, (ctype,), lambda: self._calibcons_and_meta_for_ctype(ctype))
+        return None if cons_and_meta is None else cons_and_meta[0] # 0-data/1-metadata
+
+
+    def _pedestals(self): return self._cached_array(None, 'pedestals')
+    def _gain(self):      return self._cached_array(None, 'pixel_gain')
+    def _rms(self):       return self._cached_array(None, 'pixel_rms')
+    def _status(self):    return self._cached_array(None, 'pixel_status')
+    def _mask_calib(self):return self._cached_array(None, 'pixel_mask')
+    def _common_mode(self):return self._cached_array(None, 'common_mode')
+
+
+    def _pedestals_float32(self):
+        """read-only float32 pedestals or None"""
+        def func():
+            peds = self._pedestals()
+            return None if peds is None else read_only(peds.astype(np.float32))
+        return self._cached('pedestals_float32', ('pedestals',), func)
 
 
-    def _pedestals(self): return self._cached_array(self._pedestals_, 'pedestals')
-    def _gain(self):      return self._cached_array(self._gain_, 'pixel_gain')
-    def _rms(self):       return self._cached_array(self._rms_, 'pixel_rms')
-    def _status(self):    return self._cached_array(self._status_, 'pixel_status')
-    def _mask_calib(self):return self._cached_array(self._mask_calib_, 'pixel_mask')
-    def _common_mode(self):return self._cached_array(self._common_mode_, 'common_mode')
+    def _gain_factor(self):
+        """read-only gain factors 1/gain (0 for 0 gain) or None"""
+        def func():
+            gain = self._gain()
+            return None if gain is None else read_only(divide_protected(np.ones_like(gain), gain))
+        return self._cached('gain_factor', ('pixel_gain',), func)
 
 
     def _det_geotxt_and_meta(self):
@@ -162,14 +207,15 @@ class AreaDetector(DetectorImpl):
     def _det_geo(self):
         """
         """
-        if self._geo_ is None:
+        def func():
             geotxt, meta = self._det_geotxt_and_meta()
             if geotxt is None:
                 logger.debug('_det_geo geotxt is None')
                 return None            
-            self._geo_ = GeometryAccess()
-            self._geo_.load_pars_from_str(geotxt)
-        return self._geo_
+            geo = GeometryAccess()
+            geo.load_pars_from_str(geotxt)
+            return geo
+        return self._cached('geo', ('geometry',), func)
         
 
     def _pixel_coord_indexes(self, **kwa):
@@ -221,35 +267,22 @@ class AreaDetector(DetectorImpl):
         s = 'evaluate_pixel_coord_indexes:'
         for i,a in enumerate(self._pix_rc_): s += info_ndarr(a, '\n  %s '%('rows','cols')[i], last=3)
         logger.info(s)
+        return rows, cols
 
-        mapmode = kwa.get('mapmode',2)
-        if mapmode <4:
-          self.img_entries, self.dmulti_pix_to_img_idx, self.dmulti_imgidx_numentries=\
-            statistics_of_pixel_arrays(rows, cols)
-
-        if mapmode==4:
-            rsp = self._pixel_coords(**kwa)
-            if rsp is None: return None
-            x,y,z = self._pix_xyz_ = [reshape_to_3d(a)[segs,:,:] for a in rsp]
-            self._interpol_pars_ = init_interpolation_parameters(rows, cols, x, y)
-
-        if mapmode <4 and kwa.get('fillholes',True):
-            self.img_pix_ascend_ind, self.img_holes, self.hole_rows, self.hole_cols, self.hole_inds1d =\
-               statistics_of_holes(rows, cols, **kwa)
-
-        # TBD parameters for image interpolation
-        if False:
-            t0_sec = time()
-            self.imgind_to_seg_row_col = image_of_pixel_seg_row_col(img_pix_ascend_ind, arr_shape)
-            logger.debug('statistics_of_holes.imgind_to_seg_row_col time (sec) = %.6f' % (time()-t0_sec)) # 47ms
-            logger.debug(info_ndarr(self.imgind_to_seg_row_col, ' imgind_to_seg_row_col '))
-    
-            if False:
-                s = ' imgind_to_seg_row_col '
-                # (n,352,384)
-                first = (352+5)*384 + 380
-                for i in range(first,first+10): s += '\n    s:%02d r:%03d c:%03d' % tuple(imgind_to_seg_row_col[i])
-                logger.debug(s)
+
+    def _image_plan(self, evt, **kwa):
+        """Returns ImagePlan for segments in evt and geometry parameters in kwa,
+           evaluated once and cached until geometry constants change.
+        """
+        segs = self._segment_numbers(evt)
+        if segs is None: return None
+        geokwa = tuple(kwa.get(k, None) for k in ('pix_scale_size_um', 'xy0_off_pix', 'do_tilt', 'cframe'))
+        key = ('image_plan', tuple(segs.tolist())) + tuple(v if v is None or np.isscalar(v) else tuple(v) for v in geokwa)
+
+        def func():
+            rc = self._cached_pixel_coord_indexes(evt, **kwa)
+            return None if rc is None else ImagePlan(*rc)
+        return self._cached(key, ('geometry',), func)
 
 
     def calib(self, evt, **kwa) -> Array3d:
@@ -280,7 +313,8 @@ class AreaDetector(DetectorImpl):
 
         mapmode: int, optional, default: 2
             control on overlapping pixels on image map.
-            0/1/2/3/4: statistics of entries / last / max / mean pixel intensity / interpolated (TBD) - ascending data index.
+            0/1/2/3/4: statistics of entries / last / max / mean pixel intensity /
+            mean with empty bins interpolated from their busy neighbor bins.
 
         fillholes: bool, optional, default: True
             control on map bins inside the panel with 0 entries from data.
@@ -289,21 +323,20 @@ class AreaDetector(DetectorImpl):
         vbase: float, optional, default: 0
             value substituted for all image map bins without entry from data.  
 
+        out: np.array, optional, default: None
+            preallocated image array to fill (reused between events).
+
         Returns
         -------
         image: np.array, ndim=2
         
         """
         logger.debug('in AreaDretector.image')
-        if any(v is None for v in self._pix_rc_):
-            self._cached_pixel_coord_indexes(evt, **kwa)
-            if any(v is None for v in self._pix_rc_): return None
+        plan = self._image_plan(evt, **kwa)
+        if plan is None: return None
 
-        vbase     = kwa.get('vbase',0)
-        mapmode   = kwa.get('mapmode',2)
-        fillholes = kwa.get('fillholes',True)
-
-        if mapmode==0: return self.img_entries
+        mapmode = kwa.get('mapmode',2)
+        if mapmode==0: return plan.image(None, mapmode=0)
 
         data = self.calib(evt) if nda is None else nda
         if data is None:
@@ -311,17 +344,21 @@ class AreaDetector(DetectorImpl):
             return None
             
         #logger.debug(info_ndarr(data, 'data ', last=3))
+        return plan.image(data, mapmode=mapmode, fillholes=kwa.get('fillholes',True),\
+                          vbase=kwa.get('vbase',0), out=kwa.get('out',None))
 
-        rows, cols = self._pix_rc_
-        img = img_from_pixel_arrays(rows, cols, weight=data, vbase=vbase) # mapmode==1
-        if   mapmode==2: img_multipixel_max(img, data, self.dmulti_pix_to_img_idx)
-        elif mapmode==3: img_multipixel_mean(img, data, self.dmulti_pix_to_img_idx, self.dmulti_imgidx_numentries)
-
-        if mapmode<4 and fillholes: fill_holes(img, self.hole_rows, self.hole_cols)
 
-        return img if mapmode<4 else\
-               img_interpolated(data, self._interpol_pars_) if mapmode==4 else\
-               self.img_entries
+    def images(self, evt, nda, **kwa):
+        """
+        Create 2-d images for stack of calibrated frames nda shaped as (N,)+calib(evt).shape,
+        evt - any event with the same segments as in frames. 
+        Returns np.array, ndim=3, shape: (N, <image-rows>, <image-cols>).
+        Other parameters are the same as in image(...).
+        """
+        plan = self._image_plan(evt, **kwa)
+        if plan is None or nda is None: return None
+        return plan.images(nda, mapmode=kwa.get('mapmode',2), fillholes=kwa.get('fillholes',True),\
+                           vbase=kwa.get('vbase',0), out=kwa.get('out',None))
 
 
     def _shape_as_daq(self):
@@ -367,7 +404,7 @@ class AreaDetector(DetectorImpl):
 
 
     def _mask_edges(self, **kwa): # -> Array3d:
-        mask = self._mask_default(self, dtype=DTYPE_MASK)
+        mask = self._mask_default(dtype=DTYPE_MASK)
         return None if mask is None else\
           mask_edges(mask,\
             edge_rows=kwa.get('edge_rows', 1),\
@@ -408,13 +445,19 @@ class AreaDetector(DetectorImpl):
 
 
     def _mask_comb(self, **kwa):
+        """Returns combined mask for mbits (see _mask), read-only and cached if all kwa values are hashable.
+        """
         mbits=kwa.get('mbits', 1)      
-        return self._mask(\
+        func = lambda: self._mask(\
           calib     = mbits & 1,\
           status    = mbits & 2,\
           edges     = mbits & 4,\
           neighbors = mbits & 8,\
           **kwa)
+        key = ('mask_comb',) + tuple(sorted(kwa.items()))
+        try: hash(key)
+        except TypeError: return func() # e.g. mask=<np.array>
+        return self._cached(key, MASK_CTYPES, lambda: read_only(func()))
 
 #----
 
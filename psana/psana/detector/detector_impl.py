@@ -53,15 +53,15 @@ class DetectorImpl(object):
         Look in the event to find all the dgrams for our detector/drp_class
         e.g. (xppcspad,raw) or (xppcspad,fex)
         """
-        key = (self._det_name,self._drp_class_name)
-        if key in evt._det_segments:
+        segs = evt._get_det_segments(self._det_name,self._drp_class_name)
+        if segs is not None:
             # check that all promised segments have been received
-            evt_segments = list(evt._det_segments[key].keys())
+            evt_segments = list(segs.keys())
             evt_segments.sort()
             if evt_segments != self._sorted_segment_ids:
                 return None
             else:
-                return evt._det_segments[key]
+                return segs
         else:
             return None
 
@@ -26,7 +26,7 @@ def print_det_raw_attrs(det):
     print('dir(det.raw):', dir(r))
     print('r._add_fields:', r._add_fields)
     print('r._calibconst:', r._calibconst)
-    print('r._common_mode_:', r._common_mode_)
+    print('r._common_mode():', r._common_mode())
     print('r._configs:', r._configs)
     print('r._det_name:', r._det_name)
     print('r._dettype:', r._dettype)
@@ -1,4 +1,5 @@
 import numpy as np
+from operator import itemgetter
 from psana.detector.detector_impl import DetectorImpl
 from amitypes import Array1d
 
@@ -18,6 +19,7 @@ class tt_raw_2_0_0(DetectorImpl):
 class ttdet_ttalg_0_0_1(DetectorImpl):
     def __init__(self, *args):
         super(ttdet_ttalg_0_0_1, self).__init__(*args)
+        self._frame_layouts = {} # {frame nbytes: EventBuilderFrameLayout}
 
     def _image(self,evt):
         # check for missing data
@@ -34,11 +36,16 @@ class ttdet_ttalg_0_0_1(DetectorImpl):
         return segments[0].data[:16]
     
     def parsed_frame(self,evt):
-        pFrame = timeToolParser()
-        p = self._segments(evt)[0].data.tobytes()
-        pFrame._parseData(p)
-
-        return pFrame
+        segments = self._segments(evt)
+        if segments is None: return None
+        data = segments[0].data
+        # frames of the same size usually have the same layout, re-parse only if it is changed
+        layouts = self._frame_layouts
+        layout = layouts.get(data.nbytes, None)
+        if layout is None or not layout.matches(data):
+            if len(layouts) >= 8: layouts.clear()
+            layout = layouts[data.nbytes] = EventBuilderFrameLayout(data)
+        return TimeToolFrame(data, layout)
 
     def image(self, evt) -> Array1d:
         parsed_frame_object = self.parsed_frame(evt)
@@ -48,6 +55,116 @@ class ttdet_ttalg_0_0_1(DetectorImpl):
     #def edge_uncertainty(self,evt):        #needs _(underscore) to hide things AMI doesn't need to see.
     #
 
+# size trailer which follows each subframe: uint16 size at byte 0 and tdest at byte 4
+_TRAILER_WIDTH = 16
+
+class EventBuilderFrameLayout():
+    """Positions of subframes in the event builder frame, the same as eventBuilderParser finds,
+       without copying frame data. Subframes are parsed from the end of the frame by size trailers,
+       subframes with the same first 2 bytes as the frame header are full frames and parsed recursively.
+       Layout can be re-used for the next frame if matches(data) - sizes, tdest-s and
+       header bytes of full frames are the same.
+    """
+    def __init__(self, data):
+        a = _as_uint8(data)
+        self.nbytes = a.size
+        self._check_pos = [] # positions of bytes which define the layout
+        self._pairs = [] # (frame start, header start, is full frame)
+        mv = a.data
+        self.frame = self._parse(mv, 0, a.size)
+        self._check = itemgetter(*self._check_pos)
+        self._check_val = self._check(mv)
+        self._pair_check = itemgetter(*[p for start, begin, _ in self._pairs for p in (start, start+1, begin, begin+1)])\
+                           if self._pairs else None
+        self._pair_eq = [full for _, _, full in self._pairs]
+
+    def _parse(self, mv, begin, end):
+        """Returns dict of frame mv[begin:end] with list of subframes (start, stop, tdest, frame or None)
+           in reversed order and dict {tdest: index of the first subframe with tdest}.
+        """
+        nbytes = end - begin
+        if nbytes < 2*_TRAILER_WIDTH:
+            raise ValueError('event builder frame of %d bytes is too short' % nbytes)
+        header_width = 2**((mv[begin] >> 4) + 1)
+        self._check_pos.append(begin)
+        subframes, first = [], {}
+        sizes_sum = 0
+        stop = end - _TRAILER_WIDTH
+        while True:
+            size = mv[stop] | (mv[stop+1] << 8)
+            start = stop - size
+            if start < begin:
+                raise ValueError('event builder subframe size %d exceeds frame at %d' % (size, stop))
+            tdest = mv[stop+4]
+            self._check_pos += [stop, stop+1, stop+4]
+            full = size >= 2
+            if full:
+                full = mv[start] == mv[begin] and mv[start+1] == mv[begin+1]
+                self._pairs.append((start, begin, full))
+            first.setdefault(tdest, len(subframes))
+            subframes.append((start, stop, tdest, self._parse(mv, start, stop) if full else None))
+            sizes_sum += size
+            if nbytes < sizes_sum + (len(subframes)+2)*header_width: break
+            stop = start - _TRAILER_WIDTH
+        return {'header_width': header_width, 'subframes': subframes, 'first': first}
+
+    def matches(self, data):
+        """Returns True if data frame has the same layout"""
+        a = _as_uint8(data)
+        if a.size != self.nbytes: return False
+        mv = a.data
+        if self._check(mv) != self._check_val: return False
+        if self._pair_check is None: return True
+        v = self._pair_check(mv)
+        return all((v[i] == v[i+2] and v[i+1] == v[i+3]) == full for i, full in zip(range(0, len(v), 4), self._pair_eq))
+
+
+def _as_uint8(data):
+    """Returns contiguous 1-d uint8 view of data array or buffer"""
+    if not isinstance(data, np.ndarray): return np.frombuffer(data, dtype=np.uint8)
+    if data.dtype == np.uint8 and data.ndim == 1 and data.flags.c_contiguous: return data
+    return np.ascontiguousarray(data).reshape(-1).view(np.uint8)
+
+
+class TimeToolFrame():
+    """Timetool frame fields as in timeToolParser (sequence_count, edge_position,
+       background_frame, prescaled_frame, _timing_bus, _tdest and print_info()).
+       Unlike timeToolParser, which copied the frame to bytes, background_frame and
+       _timing_bus are uint8 array views of data (bytes(x) gives the old type) and
+       prescaled_frame is an int8 view, so they are only valid as long as the event data.
+    """
+    def __init__(self, data, layout):
+        a = _as_uint8(data)
+        frame = layout.frame
+
+        self.sequence_count = int(a[1])
+        self._tdest = [tdest for _, _, tdest, _ in frame['subframes']]
+
+        self._timing_bus = _subframe_data(a, frame, 0) # timing bus always has tdest of 0
+
+        idx = frame['first'][1]
+        sub = frame['subframes'][idx][3]
+        edge = _subframe_data(a, sub, 0)
+        self.edge_position = int(edge[0]) + int(edge[1])*256
+        self.background_frame = _subframe_data(a, sub, 1)
+
+        prescaled_frame = _subframe_data(a, frame, 2)
+        self.prescaled_frame = None if prescaled_frame is None else prescaled_frame.view(np.int8)
+
+    def print_info(self):
+        for k, v in self.__dict__.items():
+            print(k, " = ", v)
+
+
+def _subframe_data(a, frame, tdest):
+    """Returns view of data of the first subframe with tdest or None"""
+    idx = frame['first'].get(tdest, None)
+    if idx is None: return None
+    start, stop, _, _ = frame['subframes'][idx]
+    return a[start:stop]
+
+
+# reference parser, see EventBuilderFrameLayout and TimeToolFrame used by ttdet_ttalg_0_0_1
 class eventBuilderParser():
     def __init__(self):        
         return
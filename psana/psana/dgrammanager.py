@@ -2,6 +2,8 @@ import sys, os
 import time
 import getopt
 import pprint
+import weakref
+import threading
 
 try:
     # doesn't exist on macos
@@ -14,6 +16,9 @@ from psana.detector import detectors
 from psana.psexp.event_manager import TransitionId
 import numpy as np
 
+import logging
+logger = logging.getLogger(__name__)
+
 def dumpDict(dict,indent):
     for k in sorted(dict.keys()):
         if hasattr(dict[k],'__dict__'):
@@ -39,17 +44,88 @@ def _dgSize(view):
     txSize = 3 * 4              # sizeof(XtcData::TransitionBase)
     return txSize + np.array(view, copy=False).view(dtype=np.uint32)[iExt]
 
+class ShmemBuffers(object):
+    """ Turns buffers from the shmem client into dgram views.
+
+    In copy mode (default) the dgram is copied out and the buffer is freed
+    right away. With zerocopy (PS_SHMEM_ZEROCOPY=1), L1Accepts are used in
+    place and their buffer is freed when it is garbage-collected,
+    i.e. when the last Dgram, Event or array referencing it is gone, or
+    when the event is released (Event.release). At most max_held buffers
+    (PS_SHMEM_MAX_HELD) are held at a time - L1Accepts are copied when
+    more are in use so applications that keep events (e.g. AMI's pickN)
+    can't starve the server of buffers. Such applications should keep a
+    copy of the event (Event.copy) instead. Transitions are always copied.
+
+    The held count is guarded by a lock: buffers are freed by a weakref
+    finalizer, which runs in whichever thread drops the last reference.
+    """
+    def __init__(self, shmem_cli, zerocopy=None, max_held=None):
+        self.shmem_cli = shmem_cli
+        if zerocopy is None:
+            zerocopy = bool(int(os.environ.get('PS_SHMEM_ZEROCOPY', '0')))
+        if max_held is None:
+            max_held = int(os.environ.get('PS_SHMEM_MAX_HELD', '4'))
+        self.zerocopy = zerocopy
+        self.max_held = max_held
+        self.n_held = 0
+        self.n_held_max = 0
+        self.n_zerocopy = 0
+        self.n_copied = 0
+        self.n_released = 0
+        self._lock = threading.Lock()
+
+    def view(self, buf, index, size):
+        """ Returns view of the dgram in the shmem buffer (ShmemBuffer from
+        PyShmemClient.get_buffer) and the function that frees the buffer
+        (None if the dgram was copied). """
+        view = memoryview(buf)
+        view = view[:_dgSize(view)]
+        hold = False
+        if self.zerocopy and _service(view) == TransitionId.L1Accept:
+            with self._lock:
+                hold = self.n_held < self.max_held
+                if hold:
+                    self.n_held += 1
+                    self.n_held_max = max(self.n_held_max, self.n_held)
+                    self.n_zerocopy += 1
+                else:
+                    logger.debug(f'shmem: {self.n_held} buffers held, copying dgram of buffer {index}')
+
+        if not hold:
+            barray = bytes(view)
+            view.release()
+            self.shmem_cli.freeByIndex(index, size)
+            self.n_copied += 1
+            return memoryview(barray), None
+
+        return view, weakref.finalize(buf, self._free, index, size)
+
+    def _free(self, index, size):
+        self.shmem_cli.freeByIndex(index, size)
+        with self._lock:
+            self.n_held -= 1
+            self.n_released += 1
+
+    def stats(self):
+        with self._lock:
+            return {'held': self.n_held, 'held_max': self.n_held_max, 'zerocopy': self.n_zerocopy,
+                    'copied': self.n_copied, 'released': self.n_released}
+
 class DgramManager(object):
 
-    def __init__(self, xtc_files, configs=[], fds=[], tag=None, run=None, max_retries=0):
+    def __init__(self, xtc_files, configs=[], fds=[], tag=None, run=None, max_retries=0,
+            shmem_zerocopy=None, shmem_max_held=None):
         """ Opens xtc_files and stores configs.
         If file descriptors (fds) is given, reuse the given file descriptors.
         """
         self.xtc_files = []
         self.shmem_cli = None
+        self.shmem_buffers = None
         self.shmem_kwargs = {'index':-1,'size':0,'cli_cptr':None}
         self.configs = []
-        self._timestamps = [] # built when iterating
+        self._timestamps = np.zeros(64, dtype=np.uint64) # built when iterating, grown by doubling
+        self._n_timestamps = 0
         self._run = run
         self.found_endrun = True
         self.buffered_beginruns = []
@@ -65,18 +141,13 @@ class DgramManager(object):
                     status = int(self.shmem_cli.connect(tag,0))
                     assert not status,'shmem connect failure %d' % status
                     #wait for first configure datagram - blocking
-                    view = self.shmem_cli.get(self.shmem_kwargs)
+                    self.shmem_buffers = ShmemBuffers(self.shmem_cli,
+                            zerocopy=shmem_zerocopy, max_held=shmem_max_held)
+                    view = self.shmem_cli.get_buffer(self.shmem_kwargs)
                     assert view
-                    # Release shmem buffer after copying Transition data
-                    # cpo: copy L1Accepts too because some shmem
-                    # applications like AMI's pickN can hold references
-                    # to dgrams for a long time, consuming the shmem buffers
-                    # and creating a deadlock situation. could revisit this
-                    # later and only deep-copy arrays inside pickN, for example
-                    # but would be more fragile.
-                    barray = bytes(view[:_dgSize(view)])
-                    self.shmem_cli.freeByIndex(self.shmem_kwargs['index'], self.shmem_kwargs['size'])
-                    view = memoryview(barray)
+                    # Transitions are always copied and their buffer released
+                    view, _ = self.shmem_buffers.view(view, 
+                            self.shmem_kwargs['index'], self.shmem_kwargs['size'])
                     d = dgram.Dgram(view=view)
                     self.configs += [d]
                 else:
@@ -108,8 +179,9 @@ class DgramManager(object):
     def _check_missing_endrun(self, beginruns=None):
         fake_endruns = None
         if not self.found_endrun: # there's no previous EndRun
-            sec = (self._timestamps[-1] >> 32) & 0xffffffff
-            usec = int((self._timestamps[-1] & 0xffffffff) * 1e3 + 1)
+            last_timestamp = int(self._timestamps[self._n_timestamps - 1])
+            sec = (last_timestamp >> 32) & 0xffffffff
+            usec = int((last_timestamp & 0xffffffff) * 1e3 + 1)
             if beginruns:
                 self.buffered_beginruns = [dgram.Dgram(config=config,
                         view=d, offset=0, size=d._size)      
@@ -127,23 +199,20 @@ class DgramManager(object):
         if self.buffered_beginruns:
             self.found_endrun = False
             evt = Event(self.buffered_beginruns, run=self.run())
-            self._timestamps += [evt.timestamp]
+            self._add_timestamp(evt.timestamp)
             self.buffered_beginruns = []
             return evt
 
         if self.shmem_cli:
-            view = self.shmem_cli.get(self.shmem_kwargs)
+            view = self.shmem_cli.get_buffer(self.shmem_kwargs)
             if view:
-                # Release shmem buffer after copying Transition data
-                # cpo: copy L1Accepts too because some shmem
+                # cpo: L1Accepts are copied too by default because some shmem
                 # applications like AMI's pickN can hold references
                 # to dgrams for a long time, consuming the shmem buffers
-                # and creating a deadlock situation. could revisit this
-                # later and only deep-copy arrays inside pickN, for example
-                # but would be more fragile.
-                barray = bytes(view[:_dgSize(view)])
-                self.shmem_cli.freeByIndex(self.shmem_kwargs['index'], self.shmem_kwargs['size'])
-                view = memoryview(barray)
+                # and creating a deadlock situation. In zerocopy mode the
+                # number of held buffers is capped instead (see ShmemBuffers).
+                view, shmem_release = self.shmem_buffers.view(view, 
+                        self.shmem_kwargs['index'], self.shmem_kwargs['size'])
                 # use the most recent configure datagram
                 config = self.configs[len(self.configs)-1]
                 d = dgram.Dgram(config=config,view=view)
@@ -172,9 +241,23 @@ class DgramManager(object):
             self.found_endrun = True
 
         evt = Event(dgrams, run=self.get_run())
-        self._timestamps += [evt.timestamp]
+        if self.shmem_cli:
+            evt._shmem_release = shmem_release
+        self._add_timestamp(evt.timestamp)
         return evt
 
+    def shmem_stats(self):
+        """ Returns counters of shmem buffers (see ShmemBuffers) or None. """
+        return self.shmem_buffers.stats() if self.shmem_buffers else None
+
+    def _add_timestamp(self, timestamp):
+        if self._n_timestamps == self._timestamps.shape[0]:
+            timestamps = np.zeros(2 * self._n_timestamps, dtype=np.uint64)
+            timestamps[:self._n_timestamps] = self._timestamps
+            self._timestamps = timestamps
+        self._timestamps[self._n_timestamps] = timestamp
+        self._n_timestamps += 1
+
     def jumps(self, dgram_i, offset, size):
         if offset == 0 and size == 0:
             d = None
@@ -200,7 +283,7 @@ class DgramManager(object):
         return evt
 
     def get_timestamps(self):
-        return np.asarray(self._timestamps, dtype=np.uint64) # return numpy array for easy search later
+        return self._timestamps[:self._n_timestamps] # numpy array for easy search later
 
     def set_run(self, run):
         self._run = run
@@ -24,9 +24,10 @@ class Event():
     def __init__(self, dgrams, run=None):
         self._dgrams = dgrams
         self._size = len(dgrams)
+        self._run = run
         self._complete()
         self._position = 0
-        self._run = run
+        self._shmem_release = None # frees the shmem buffer (see dgrammanager.ShmemBuffers)
 
     def __iter__(self):
         return self
@@ -45,6 +46,31 @@ class Event():
     def _replace(self, pos, d):
         assert pos < self._size
         self._dgrams[pos] = d
+        self._complete()
+
+    def copy(self):
+        """ Returns the event with its own copy of the dgrams.
+
+        Events from shared memory in zerocopy mode hold a shmem buffer
+        (see dgrammanager.ShmemBuffers). Keep a copy of the event instead
+        when it's needed for longer than the next few events. Events that
+        don't hold a shmem buffer are returned as is.
+        """
+        if self._shmem_release is None: return self
+        dgrams = [dgram.Dgram(config=config, view=bytearray(d)) if d else None
+                for d, config in zip(self._dgrams, self._run.configs)]
+        return Event(dgrams, run=self._run)
+
+    def release(self):
+        """ Frees the shmem buffer of the event now instead of when the
+        event is garbage-collected. The event and arrays from it must not
+        be used afterwards. Does nothing for events not from shared memory.
+        """
+        if self._shmem_release is None: return
+        self._dgrams = [None] * self._size
+        self._complete()
+        self._shmem_release()
+        self._shmem_release = None
 
     def _to_bytes(self):
         event_bytes = bytearray()
@@ -101,9 +127,10 @@ class Event():
 
     def _assign_det_segments(self):
         """
+        Builds segments of all detectors (see _det_segments)
         """
 
-        self._det_segments = {}
+        self._all_det_segments = {}
         for evt_dgram in self._dgrams:
 
             if evt_dgram: # dgram can be None (missing) in an event
@@ -118,9 +145,9 @@ class Event():
                         for drp_class_name, drp_class in det.__dict__.items():
                             class_identifier = (det_name,drp_class_name)
                         
-                            if class_identifier not in self._det_segments.keys():
-                                self._det_segments[class_identifier] = {}
-                            segs = self._det_segments[class_identifier]
+                            if class_identifier not in self._all_det_segments.keys():
+                                self._all_det_segments[class_identifier] = {}
+                            segs = self._all_det_segments[class_identifier]
 
                             if det_name not in ['runinfo','smdinfo'] :
                                 msg = f'Found duplicate segment: {segment} in {segs} for {class_identifier}'
@@ -129,10 +156,60 @@ class Event():
 
         return
 
+    @property
+    def _det_segments(self):
+        """
+        Maps (det_name, drp_class_name) to {segment: drp_class} for all 
+        detectors in the event. Detector interfaces look up only their 
+        own key with _get_det_segments instead.
+        """
+        if self._all_det_segments is None:
+            self._assign_det_segments()
+        return self._all_det_segments
+
+    def _get_det_segments(self, det_name, drp_class_name):
+        """
+        Returns {segment: drp_class} of one detector/drp class (e.g. 
+        xppcspad/raw) or None if the event doesn't have it. Only dgrams 
+        that can have the detector (see Run._det_dgram_indices) are
+        looked at and the result is cached in the event.
+        """
+        key = (det_name, drp_class_name)
+        if key in self._key_segments:
+            return self._key_segments[key]
+
+        dgram_indices = None
+        configs = getattr(self._run, 'configs', None)
+        if configs and len(configs) == self._size:
+            dgram_indices = self._run._det_dgram_indices.get(det_name)
+        if dgram_indices is None:
+            dgram_indices = range(self._size)
+
+        segs = None
+        for i in dgram_indices:
+            evt_dgram = self._dgrams[i]
+            if not evt_dgram: continue # dgram can be None (missing) in an event
+            segment_dict = evt_dgram.__dict__.get(det_name)
+            if segment_dict is None: continue
+            for segment, det in segment_dict.items():
+                drp_class = det.__dict__.get(drp_class_name)
+                if drp_class is None: continue
+                if segs is None: 
+                    segs = {}
+                if det_name not in ['runinfo','smdinfo'] :
+                    msg = f'Found duplicate segment: {segment} in {segs} for {key}'
+                    assert segment not in segs, msg 
+                segs[segment] = drp_class
+
+        self._key_segments[key] = segs
+        return segs
+
     # this routine is called when all the dgrams have been inserted into
-    # the event (e.g. by the eventbuilder calling _replace())
+    # the event (e.g. by the eventbuilder calling _replace()).
+    # Detector segments are found lazily (see _get_det_segments).
     def _complete(self):
-        self._assign_det_segments()
+        self._all_det_segments = None
+        self._key_segments = {}
 
     @property
     def _has_offset(self):
@@ -5,6 +5,7 @@ from cpython cimport array
 import array
 import numpy as np
 from cpython.buffer cimport PyObject_GetBuffer, PyBuffer_Release, PyBUF_ANY_CONTIGUOUS, PyBUF_SIMPLE
+from cpython.bytearray cimport PyByteArray_FromStringAndSize, PyByteArray_AS_STRING
 
 from dgramlite cimport Xtc, Sequence, Dgram
 
@@ -15,29 +16,80 @@ from libc.stdint cimport uint32_t, uint64_t
 from psana.event import Event
 import time
 
+
+# Min-heap of (timestamp, smd id) kept in two plain c arrays.
+# Ties are broken by smd id so that the merge order is deterministic.
+cdef inline bint _heap_less(uint64_t* ts, int* ids, int a, int b):
+    return ts[a] < ts[b] or (ts[a] == ts[b] and ids[a] < ids[b])
+
+cdef inline void _heap_swap(uint64_t* ts, int* ids, int a, int b):
+    cdef uint64_t tmp_ts = ts[a]
+    cdef int tmp_id = ids[a]
+    ts[a] = ts[b]
+    ids[a] = ids[b]
+    ts[b] = tmp_ts
+    ids[b] = tmp_id
+
+cdef inline void _heap_push(uint64_t* ts, int* ids, int* n, uint64_t new_ts, int new_id):
+    cdef int i = n[0]
+    cdef int parent
+    ts[i] = new_ts
+    ids[i] = new_id
+    n[0] += 1
+    while i > 0:
+        parent = (i - 1) >> 1
+        if not _heap_less(ts, ids, i, parent):
+            break
+        _heap_swap(ts, ids, i, parent)
+        i = parent
+
+cdef inline int _heap_pop(uint64_t* ts, int* ids, int* n):
+    cdef int top = ids[0]
+    cdef int i = 0
+    cdef int child
+    n[0] -= 1
+    ts[0] = ts[n[0]]
+    ids[0] = ids[n[0]]
+    while True:
+        child = 2 * i + 1
+        if child >= n[0]:
+            break
+        if child + 1 < n[0] and _heap_less(ts, ids, child + 1, child):
+            child += 1
+        if not _heap_less(ts, ids, child, i):
+            break
+        _heap_swap(ts, ids, i, child)
+        i = child
+    return top
+
+
 cdef class EventBuilder:
     """Builds a batch of events
     Takes memoryslice 'views' and identifies matching timestamp
     dgrams as an event. Returns list of events (size=batch_size)
     as another memoryslice 'batch'.
-    
+
     Input: views
     EventBuilder receives a views from SmdCore. Each views consists
     of 1 or more chunks of small data.
-    
+
     Output: list of batches
     Without destination call back the build fn returns a batch of events (size = batch_size) at index 0. With destination call back, this fn returns list of batches. Each batch has the same destination rank.
-    
+
+    Events are found with a k-way merge: the head dgram of every view
+    sits in a timestamp min-heap and an event is made of all heads that
+    share the smallest timestamp. An event has at most one dgram of
+    each view: if a view has more dgrams with the same timestamp, the
+    next one goes to the next event (no dgram is dropped). Events are
+    recorded in an index table (offset and size of each dgram in its
+    view) and are only copied once, when each batch is gathered at the
+    end of build().
+
     Note that reading chunks inside a views or events inside a batch can be done
     using PacketFooter class."""
     cdef short nsmds
-    cdef array.array offsets 
+    cdef array.array offsets
     cdef array.array sizes
-    cdef array.array timestamps
-    cdef array.array dgram_sizes
-    cdef array.array dgram_timestamps
-    cdef array.array event_timestamps
-    cdef array.array services
     cdef list views
     cdef list configs
     cdef unsigned nevents
@@ -46,17 +98,23 @@ cdef class EventBuilder:
     cdef size_t XTC_SIZE
     cdef unsigned long min_ts
     cdef unsigned long max_ts
-    cdef unsigned L1Accept 
+    cdef unsigned L1Accept
+
+    # Index table of events found in the last build
+    cdef unsigned n_built
+    cdef object evt_offsets     # (capacity, nsmds) offset of each dgram in its view
+    cdef object evt_sizes       # (capacity, nsmds) size of each dgram (0 if missing)
+    cdef object evt_timestamps  # (capacity,)
+    cdef object evt_services    # (capacity,)
+
+    # Pinned buffers (valid during build only)
+    cdef Py_buffer* bufs
+    cdef char** view_ptrs
 
     def __init__(self, views, configs):
         self.nsmds              = len(views)
         self.offsets            = array.array('I', [0]*self.nsmds)
         self.sizes              = array.array('I', [memoryview(view).shape[0] for view in views])
-        self.timestamps         = array.array('L', [0]*self.nsmds)
-        self.dgram_sizes        = array.array('I', [0]*self.nsmds)
-        self.dgram_timestamps   = array.array('L', [0]*self.nsmds)
-        self.event_timestamps   = array.array('L', [0]*self.nsmds)
-        self.services           = array.array('i', [0]*self.nsmds)
         self.views              = views
         self.configs            = configs
         self.nevents            = 0
@@ -64,233 +122,248 @@ cdef class EventBuilder:
         self.DGRAM_SIZE         = sizeof(Dgram)
         self.XTC_SIZE           = sizeof(Xtc)
         self.L1Accept           = 12
-        
+        self.n_built            = 0
+        self._alloc_index(64)
+
+    def _alloc_index(self, capacity):
+        """Grows the index table to the given capacity keeping its content."""
+        evt_offsets     = np.zeros((capacity, self.nsmds), dtype=np.uint32)
+        evt_sizes       = np.zeros((capacity, self.nsmds), dtype=np.uint32)
+        evt_timestamps  = np.zeros(capacity, dtype=np.uint64)
+        evt_services    = np.zeros(capacity, dtype=np.uint32)
+        if self.n_built > 0:
+            evt_offsets[:self.n_built]      = self.evt_offsets[:self.n_built]
+            evt_sizes[:self.n_built]        = self.evt_sizes[:self.n_built]
+            evt_timestamps[:self.n_built]   = self.evt_timestamps[:self.n_built]
+            evt_services[:self.n_built]     = self.evt_services[:self.n_built]
+        self.evt_offsets    = evt_offsets
+        self.evt_sizes      = evt_sizes
+        self.evt_timestamps = evt_timestamps
+        self.evt_services   = evt_services
+
     def _has_more(self):
         for i in range(self.nsmds):
             if self.offsets[i] < self.sizes[i]:
                 return True
         return False
 
+    cdef inline uint64_t _head_ts(self, int smd_id):
+        cdef Dgram* d = <Dgram *>(self.view_ptrs[smd_id] + self.offsets.data.as_uints[smd_id])
+        return <uint64_t>d.seq.high << 32 | d.seq.low
+
+    cdef size_t _event_nbytes(self, unsigned i_evt):
+        """Size of an event (all its dgrams and the event footer)"""
+        cdef uint32_t[:, ::1] evt_sizes = self.evt_sizes
+        cdef size_t nbytes = sizeof(unsigned) * (self.nsmds + 1)
+        cdef int i_smd
+        for i_smd in range(self.nsmds):
+            nbytes += evt_sizes[i_evt, i_smd]
+        return nbytes
+
+    cdef size_t _copy_event(self, unsigned i_evt, char* dst):
+        """Copies dgrams and event footer of an event to dst.
+        Returns no. of bytes copied."""
+        cdef uint32_t[:, ::1] evt_offsets = self.evt_offsets
+        cdef uint32_t[:, ::1] evt_sizes = self.evt_sizes
+        cdef unsigned* footer
+        cdef size_t nbytes = 0
+        cdef int i_smd
+        for i_smd in range(self.nsmds):
+            if evt_sizes[i_evt, i_smd] > 0:
+                memcpy(dst + nbytes, self.view_ptrs[i_smd] + evt_offsets[i_evt, i_smd], evt_sizes[i_evt, i_smd])
+                nbytes += evt_sizes[i_evt, i_smd]
+        footer = <unsigned *>(dst + nbytes)
+        for i_smd in range(self.nsmds):
+            footer[i_smd] = evt_sizes[i_evt, i_smd]
+        footer[self.nsmds] = self.nsmds
+        return nbytes + sizeof(unsigned) * (self.nsmds + 1)
+
+    def _event_bytes(self, unsigned i_evt):
+        """Returns an event as bytearray (dgrams + event footer)"""
+        evt_bytes = PyByteArray_FromStringAndSize(NULL, self._event_nbytes(i_evt))
+        self._copy_event(i_evt, PyByteArray_AS_STRING(evt_bytes))
+        return evt_bytes
+
+    def _gather(self, list evt_ids):
+        """Returns (batch, evt_sizes) for the given events in one pass.
+        The batch is a bytearray with all events followed by the batch footer."""
+        cdef list evt_sizes = [self._event_nbytes(i_evt) for i_evt in evt_ids]
+        if not evt_sizes:
+            return bytearray(), evt_sizes
+
+        cdef size_t n_evts = len(evt_sizes)
+        cdef size_t footer_size = sizeof(unsigned) * (n_evts + 1)
+        batch = PyByteArray_FromStringAndSize(NULL, sum(evt_sizes) + footer_size)
+        cdef char* dst = PyByteArray_AS_STRING(batch)
+        cdef size_t nbytes = 0
+        cdef unsigned i_evt
+        for i_evt in evt_ids:
+            nbytes += self._copy_event(i_evt, dst + nbytes)
+
+        cdef unsigned* footer = <unsigned *>(dst + nbytes)
+        cdef size_t i
+        for i in range(n_evts):
+            footer[i] = evt_sizes[i]
+        footer[n_evts] = n_evts
+        return batch, evt_sizes
+
     def build(self, batch_size=1, filter_fn=0, destination=0, limit_ts=-1, prometheus_counter=None, run=None):
         """
         Builds a list of batches.
 
         Each batch is bytearray with this content:
         [ [[d0][d1][d2][evt_footer_view]] [[d0][d1][d2][evt_footer_view]] ][batch_footer_view]
-        | ---------- evt 0 -------------| |------------evt 1 -----------| 
+        | ---------- evt 0 -------------| |------------evt 1 -----------|
         evt_footer_view:    [sizeof(d0) | sizeof(d1) | sizeof(d2) | 3] (for 3 dgrams in 1 evt)
         batch_footer_view:  [sizeof(evt0) | sizeof(evt1) | 2] (for 2 evts in 1 batch)
 
         batch_size: no. of events in a batch
         filter_fn: takes an event and return True/False
         destination: takes an event and returns rank no.
+        limit_ts: stops after the first event with timestamp >= limit_ts
+        (-1 for no limit)
         """
-        cdef unsigned got = 0
-        cdef unsigned got_step = 0
-        batch_dict = {} # keeps list of batches (w/o destination callback, only one batch is returned at index 0)
-        step_dict = {}
         self.min_ts = 0
         self.max_ts = 0
-
-        # Storing python list of bytearray as c pointers
+        self.n_built = 0
+
+        # Pin all views for the whole build
+        self.bufs = <Py_buffer *>malloc(sizeof(Py_buffer) * self.nsmds)
+        self.view_ptrs = <char **>malloc(sizeof(char *) * self.nsmds)
+        cdef uint64_t* heap_ts = <uint64_t *>malloc(sizeof(uint64_t) * self.nsmds)
+        cdef int* heap_ids = <int *>malloc(sizeof(int) * self.nsmds)
+        cdef int* evt_smd_ids = <int *>malloc(sizeof(int) * self.nsmds)
+        cdef int n_pinned = 0
+        cdef int i
+        try:
+            for n_pinned in range(self.nsmds):
+                PyObject_GetBuffer(self.views[n_pinned], &self.bufs[n_pinned], PyBUF_SIMPLE | PyBUF_ANY_CONTIGUOUS)
+                self.view_ptrs[n_pinned] = <char *>self.bufs[n_pinned].buf
+            n_pinned = self.nsmds
+            return self._build(batch_size, filter_fn, destination, limit_ts, prometheus_counter, run,
+                    heap_ts, heap_ids, evt_smd_ids)
+        finally:
+            for i in range(n_pinned):
+                PyBuffer_Release(&self.bufs[i])
+            free(self.bufs)
+            free(self.view_ptrs)
+            free(heap_ts)
+            free(heap_ids)
+            free(evt_smd_ids)
+            self.bufs = NULL
+            self.view_ptrs = NULL
+
+    cdef _build(self, batch_size, filter_fn, destination, limit_ts, prometheus_counter, run,
+            uint64_t* heap_ts, int* heap_ids, int* evt_smd_ids):
+        cdef unsigned got = 0
+        cdef unsigned got_step = 0
+        cdef int heap_n = 0
+        cdef int n_evt_smds
+        cdef int i
+        cdef unsigned* offsets = self.offsets.data.as_uints
+        cdef unsigned* sizes = self.sizes.data.as_uints
+        cdef int smd_id
+        cdef uint64_t ts
         cdef Dgram* d
-        cdef size_t payload = 0
-        cdef char* view_ptr
-        cdef Py_buffer buf
-        cdef list raw_dgrams = [0] * self.nsmds
-        cdef list event_dgrams = [0] * self.nsmds
-
-        # Setup event footer and batch footer - see above comments for the content of batch_dict
-        cdef array.array int_array_template = array.array('I', [])
-        cdef array.array evt_footer = array.clone(int_array_template, self.nsmds + 1, zero=False)
-        cdef unsigned[:] evt_footer_view = evt_footer
-        cdef unsigned evt_footer_size = sizeof(unsigned) * (self.nsmds + 1)
-        evt_footer_view[-1] = self.nsmds
-        cdef array.array batch_footer= array.clone(int_array_template, batch_size + 1, zero=True)
-        cdef unsigned[:] batch_footer_view = batch_footer
-        cdef array.array step_batch_footer= array.clone(int_array_template, batch_size + 1, zero=True)
-        cdef unsigned[:] step_batch_footer_view = step_batch_footer
-        
-        # Use typed variables for performance
-        cdef unsigned evt_size = 0
-        cdef short dgram_idx = 0
-        cdef short view_idx = 0
-        cdef unsigned evt_idx = 0
-
-        cdef unsigned reach_limit_ts = 0
-        
-        # For checking step dgrams
+        cdef uint32_t dgram_size
         cdef unsigned service = 0
-
-        cdef int accept = 1 # for filter callback
-
-        while got < batch_size and self._has_more() and not reach_limit_ts:
-            array.zero(self.timestamps)
-            array.zero(self.dgram_sizes)
-            array.zero(self.services)
-            service = 0
-            
-            # Get dgrams for all smd files then
-            # collect their timestamps and sizes for sorting.
-            for view_idx in range(self.nsmds):
-                view = self.views[view_idx]
-                if self.offsets[view_idx] < self.sizes[view_idx]:
-                    # Fill buf with data from memoryview 'view'.
-                    PyObject_GetBuffer(view, &buf, PyBUF_SIMPLE | PyBUF_ANY_CONTIGUOUS)
-                    view_ptr = <char *>buf.buf
-                    view_ptr += self.offsets[view_idx]
-                    d = <Dgram *>(view_ptr)
-                    payload = d.xtc.extent - self.XTC_SIZE
-                    self.timestamps[view_idx] = <uint64_t>d.seq.high << 32 | d.seq.low
-                    self.dgram_sizes[view_idx] = self.DGRAM_SIZE + payload
-                    self.services[view_idx] = (d.env>>24)&0xf
-                    raw_dgrams[view_idx] = <char[:self.dgram_sizes[view_idx]]>view_ptr
-                    PyBuffer_Release(&buf)
-
-            sorted_smd_id = np.argsort(self.timestamps)
-
-            # Pick the oldest timestamp dgram as the first event
-            # then look for other dgrams (in the rest of smd views)
-            # for matching timestamps. An event is build (as bytearray)
-            # with packet_footer. All dgrams in an event have the same timestamp.
-            for smd_id in sorted_smd_id:
-                if self.timestamps[smd_id] == 0:
-                    continue
-
-                array.zero(self.event_timestamps)
-                self.event_timestamps[smd_id] = self.timestamps[smd_id]
-                self.offsets[smd_id] += self.dgram_sizes[smd_id]
-                event_dgrams[smd_id] = raw_dgrams[smd_id] # this is the selected dgram
-                service = self.services[smd_id]
-                
-                if self.min_ts == 0:
-                    self.min_ts = self.event_timestamps[smd_id] # records first timestamp
-
-                # In other smd views, find matching timestamp dgrams
-                for view_idx in range(self.nsmds):
-                    view = self.views[view_idx]
-                    if view_idx == smd_id or self.offsets[view_idx] >= self.sizes[view_idx]:
-                        continue
-                    
-                    event_dgrams[view_idx] = 0
-                    PyObject_GetBuffer(view, &buf, PyBUF_SIMPLE | PyBUF_ANY_CONTIGUOUS)
-                    view_ptr = <char *>buf.buf
-                    view_ptr += self.offsets[view_idx]
-                    d = <Dgram *>(view_ptr)
-                    self.max_ts = <unsigned long>d.seq.high << 32 | d.seq.low
-                    payload = d.xtc.extent - self.XTC_SIZE
-                    while self.max_ts <= self.event_timestamps[smd_id]:
-                        if self.max_ts == self.event_timestamps[smd_id]:
-                            self.event_timestamps[view_idx] = self.max_ts
-                            self.timestamps[view_idx] = 0
-                            event_dgrams[view_idx] = <char[:self.DGRAM_SIZE+payload]>view_ptr
-
-                        self.offsets[view_idx] += (self.DGRAM_SIZE + payload)
-
-                        if self.offsets[view_idx] == self.sizes[view_idx]:
-                            break
-
-                        view_ptr += (self.DGRAM_SIZE + payload)
-                        d = <Dgram *>(view_ptr)
-                        self.max_ts = <unsigned long>d.seq.high << 32 | d.seq.low
-                        payload = d.xtc.extent - self.XTC_SIZE
-                    
-                    PyBuffer_Release(&buf)
-                
-                
-                # Generate event as bytes from the dgrams
-                evt_size = 0
-                evt_bytes = bytearray()
-                for dgram_idx in range(self.nsmds):
-                    dgram = event_dgrams[dgram_idx]
-                    evt_footer_view[dgram_idx] = 0
-                    if dgram: 
-                        evt_footer_view[dgram_idx] = dgram.nbytes
-                        evt_bytes.extend(bytearray(dgram))
-                    evt_size += evt_footer_view[dgram_idx]
-                evt_bytes.extend(evt_footer_view)
-
-
-                # If destination() is not specifed, use batch 0.
-                dest_rank = 0
-                accept = 1
-                if (filter_fn or destination) and service == self.L1Accept:
-                    py_evt = Event._from_bytes(self.configs, evt_bytes, run=run) 
-                    py_evt._complete() 
-
-                    if filter_fn:
-                        st_filter = time.time()
-                        accept = filter_fn(py_evt)
-                        en_filter = time.time()
-                        if prometheus_counter is not None:
-                            prometheus_counter.labels('seconds', 'None').inc(en_filter - st_filter)
-                            prometheus_counter.labels('batches', 'None').inc()
-                    
-                    if destination:
-                        dest_rank = destination(py_evt)
-                
-                if batch_dict:
-                    if dest_rank not in batch_dict:
-                        batch_dict[dest_rank] = (bytearray(), []) # (events as bytes, event sizes)
-                else:
-                    batch_dict[dest_rank] = (bytearray(), [])
-                batch, evt_sizes = batch_dict[dest_rank]
-
-                if step_dict:
-                    if dest_rank not in step_dict:
-                        step_dict[dest_rank] = (bytearray(), [])
-                else:
-                    step_dict[dest_rank] = (bytearray(), [])
-                step_batch, step_sizes = step_dict[dest_rank] 
-
-                # Extend this batch bytearray to include this event and collect
-                # the size of this event for batch footer.
-                if accept == 1:
-                    batch.extend(evt_bytes)
-                    evt_sizes.append(evt_size + evt_footer_size)
-                    got += 1
-                    
-                    # Add step
-                    if service != self.L1Accept:
-                        step_batch.extend(evt_bytes)
-                        step_sizes.append(evt_size + evt_footer_size)
-                        got_step += 1
-
-                if limit_ts > -1:
-                    if self.max_ts >= limit_ts:
-                        reach_limit_ts = 1
-                        break
-
-                if got == batch_size:
+        cdef unsigned i_evt
+        cdef int accept
+        cdef bint first
+
+        cdef uint32_t[:, ::1] evt_offsets = self.evt_offsets
+        cdef uint32_t[:, ::1] evt_sizes = self.evt_sizes
+        cdef uint64_t[::1] evt_timestamps = self.evt_timestamps
+        cdef uint32_t[::1] evt_services = self.evt_services
+
+        # Event ids (rows of the index table) that go to each destination
+        batch_ids = {}
+        step_ids = {}
+
+        for smd_id in range(self.nsmds):
+            if offsets[smd_id] < sizes[smd_id]:
+                _heap_push(heap_ts, heap_ids, &heap_n, self._head_ts(smd_id), smd_id)
+
+        while got < batch_size and heap_n > 0:
+            if self.n_built == evt_offsets.shape[0]:
+                self._alloc_index(2 * self.n_built)
+                evt_offsets = self.evt_offsets
+                evt_sizes = self.evt_sizes
+                evt_timestamps = self.evt_timestamps
+                evt_services = self.evt_services
+
+            # All head dgrams with the smallest timestamp make an event
+            i_evt = self.n_built
+            evt_sizes[i_evt, :] = 0
+            ts = heap_ts[0]
+            first = 1
+            n_evt_smds = 0
+            while heap_n > 0 and heap_ts[0] == ts:
+                smd_id = _heap_pop(heap_ts, heap_ids, &heap_n)
+                d = <Dgram *>(self.view_ptrs[smd_id] + offsets[smd_id])
+                dgram_size = self.DGRAM_SIZE + d.xtc.extent - self.XTC_SIZE
+                if first:
+                    service = (d.env>>24)&0xf
+                    first = 0
+                evt_offsets[i_evt, smd_id] = offsets[smd_id]
+                evt_sizes[i_evt, smd_id] = dgram_size
+                offsets[smd_id] += dgram_size
+                evt_smd_ids[n_evt_smds] = smd_id
+                n_evt_smds += 1
+            # Next dgrams go back to the heap once the event is complete
+            for i in range(n_evt_smds):
+                smd_id = evt_smd_ids[i]
+                if offsets[smd_id] < sizes[smd_id]:
+                    _heap_push(heap_ts, heap_ids, &heap_n, self._head_ts(smd_id), smd_id)
+            evt_timestamps[i_evt] = ts
+            evt_services[i_evt] = service
+            self.n_built += 1
+
+            if self.min_ts == 0:
+                self.min_ts = ts # records first timestamp
+            self.max_ts = ts
+
+            # If destination() is not specifed, use batch 0.
+            dest_rank = 0
+            accept = 1
+            if (filter_fn or destination) and service == self.L1Accept:
+                py_evt = Event._from_bytes(self.configs, self._event_bytes(i_evt), run=run)
+                py_evt._complete()
+
+                if filter_fn:
+                    st_filter = time.time()
+                    accept = filter_fn(py_evt)
+                    en_filter = time.time()
+                    if prometheus_counter is not None:
+                        prometheus_counter.labels('seconds', 'None').inc(en_filter - st_filter)
+                        prometheus_counter.labels('batches', 'None').inc()
+
+                if destination:
+                    dest_rank = destination(py_evt)
+
+            if dest_rank not in batch_ids:
+                batch_ids[dest_rank] = []
+                step_ids[dest_rank] = []
+
+            if accept == 1:
+                batch_ids[dest_rank].append(i_evt)
+                got += 1
+
+                # Add step
+                if service != self.L1Accept:
+                    step_ids[dest_rank].append(i_evt)
+                    got_step += 1
+
+            if limit_ts > -1:
+                if self.max_ts >= limit_ts:
                     break
 
-        
         self.nevents = got
         self.nsteps = got_step
-        
-        # Add packet_footer for all events in each batch
-        for _, val in batch_dict.items():
-            batch, evt_sizes = val
-            
-            if memoryview(batch).nbytes == 0: continue
-
-            for evt_idx in range(len(evt_sizes)):
-                batch_footer_view[evt_idx] = evt_sizes[evt_idx]
-            batch_footer_view[-1] = evt_idx + 1
-            batch.extend(batch_footer_view[:evt_idx+1])
-            batch.extend(batch_footer_view[batch_size:]) # when convert to bytearray negative index doesn't work
-
-        for _, val in step_dict.items():
-            step_batch, step_sizes = val
-
-            if memoryview(step_batch).nbytes ==0: continue
-
-            for evt_idx in range(len(step_sizes)):
-                step_batch_footer_view[evt_idx] = step_sizes[evt_idx]
-            step_batch_footer_view[-1] = evt_idx + 1
-            step_batch.extend(step_batch_footer_view[:evt_idx+1])
-            step_batch.extend(step_batch_footer_view[batch_size:])
-        
+
+        # Gather events (and add packet_footer) for each batch
+        batch_dict = {dest_rank: self._gather(evt_ids) for dest_rank, evt_ids in batch_ids.items()}
+        step_dict = {dest_rank: self._gather(evt_ids) for dest_rank, evt_ids in step_ids.items()}
         return batch_dict, step_dict
 
     @property
@@ -307,9 +380,12 @@ cdef class EventBuilder:
 
     @property
     def max_ts(self):
+        """Timestamp of the last event built (accepted or not) in the
+        last build, 0 if none. Before the k-way merge this was the latest
+        dgram timestamp scanned in any view, which could be ahead of the
+        last event; limit_ts is compared against this value."""
         return self.max_ts
-    
+
     @property
     def offsets(self):
         return self.offsets
-
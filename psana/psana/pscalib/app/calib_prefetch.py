@@ -0,0 +1,102 @@
+#------------------------------
+"""
+Warms up on-disk cache of calibration constants (see MDBWebCache) for experiment,
+e.g. before running jobs with PS_CALIB_OFFLINE=1 or many jobs at once.
+"""
+#------------------------------
+
+import sys
+from time import time
+
+import logging
+logger = logging.getLogger(__name__)
+from psana.pyalgos.generic.logger import config_logger, STR_LEVEL_NAMES
+
+import psana.pscalib.calib.CalibConstants as cc
+
+#------------------------------
+
+def usage():
+    return '\nCommand: calib_prefetch -e <experiment> [-d <detectors>] [-r <runs>] [options]'\
+           '\n  caches documents and data in PS_CALIB_CACHE_DIR (default ~/.cache/psana/calib)'\
+           '\n  -r is needed for offline mode (PS_CALIB_OFFLINE=1), -d should be detector names'\
+           '\n  used by psana for calibration db (uniqueid of long detector names)\n'\
+           '\nExamples:\n'\
+           '  calib_prefetch -e tmoc00118\n'\
+           '  calib_prefetch -e tmoc00118 -d epix10ka_000001 -r 1-20,25\n'\
+           '  calib_prefetch -e tmoc00118 -r 100 --cachedir /cds/data/psdm/tmo/tmoc00118/scratch/calib_cache'
+
+#------------------------------
+
+def parse_runs(s):
+    """Returns list of runs for string like 1-20,25"""
+    if s is None: return None
+    runs = []
+    for rng in s.split(','):
+        first, _, last = rng.partition('-')
+        runs += list(range(int(first), int(last or first)+1))
+    return runs
+
+#------------------------------
+
+def input_option_parser():
+
+    from optparse import OptionParser
+
+    d_experiment = None
+    d_detectors  = None
+    d_runs       = None
+    d_cachedir   = None
+    d_url        = cc.URL
+    d_strloglev  = 'INFO'
+
+    h_experiment = 'experiment name, default = %s' % d_experiment
+    h_detectors  = 'comma-separated detector names, default = %s - all detectors in experiment db' % d_detectors
+    h_runs       = 'runs like 1-20,25, default = %s - all documents of experiment db' % d_runs
+    h_cachedir   = 'cache directory, default = %s - PS_CALIB_CACHE_DIR or ~/.cache/psana/calib' % d_cachedir
+    h_url        = 'web service url, default = %s' % d_url
+    h_strloglev  = 'logging level from list (%s), default = %s' % (STR_LEVEL_NAMES, d_strloglev)
+
+    parser = OptionParser(description='Warms up on-disk cache of calibration constants', usage=usage())
+    parser.add_option('-e', '--experiment', default=d_experiment, action='store', type='string', help=h_experiment)
+    parser.add_option('-d', '--detectors',  default=d_detectors,  action='store', type='string', help=h_detectors)
+    parser.add_option('-r', '--runs',       default=d_runs,       action='store', type='string', help=h_runs)
+    parser.add_option('-c', '--cachedir',   default=d_cachedir,   action='store', type='string', help=h_cachedir)
+    parser.add_option('-u', '--url',        default=d_url,        action='store', type='string', help=h_url)
+    parser.add_option('-l', '--strloglev',  default=d_strloglev,  action='store', type='string', help=h_strloglev)
+    return parser
+
+#------------------------------
+
+def do_main():
+
+    parser = input_option_parser()
+    (popts, pargs) = parser.parse_args()
+    if popts.experiment is None:
+        print(usage())
+        sys.exit('ERROR: experiment name is not specified')
+
+    config_logger(loglevel=popts.strloglev)
+
+    import psana.pscalib.calib.MDBWebCache as wc
+    import psana.pscalib.calib.MDBWebUtils as wu
+
+    if popts.cachedir is not None:
+        wc.set_calib_cache(wc.CalibCache(popts.cachedir, max_bytes=wc.max_bytes_from_env()))
+    cache = wc.calib_cache()
+    if cache is None: sys.exit('ERROR: calibration cache is disabled by PS_CALIB_CACHE_DIR')
+    cache.offline = False
+
+    t0_sec = time()
+    dets = None if popts.detectors is None else popts.detectors.split(',')
+    ndets = wu.prefetch_calib_constants(popts.experiment, dets=dets, runs=parse_runs(popts.runs), url=popts.url)
+    if ndets is None: sys.exit('ERROR: can not get detector names for experiment %s' % popts.experiment)
+    logger.info('cached constants of %d detectors in %s, time %.3f sec, cache: %s' %\
+                (ndets, cache.cachedir, time()-t0_sec, str(cache.stats())))
+
+#------------------------------
+
+if __name__ == "__main__":
+    do_main()
+
+#------------------------------
@@ -0,0 +1,267 @@
+"""
+On-disk cache of calibration documents and data fetched from the web service
+============================================================================
+
+Used by MDBWebUtils getters (find_docs, get_doc_for_docid, get_data_for_id,
+get_data_for_doc) to save web service requests at run start-up and to survive
+web service outages.
+
+Usage ::
+
+    import psana.pscalib.calib.MDBWebCache as wc
+
+    c = wc.calib_cache() # per-process cache configured from environment, None if disabled
+    wc.set_calib_cache(c) # set (or disable with None) per-process cache
+
+    c = wc.CalibCache(cachedir, max_bytes=2000<<20, offline=False)
+    docs = c.get_docs(dbname, colname, query_string) # None if not cached
+    c.put_docs(dbname, colname, query_string, docs)
+    doc = c.get_doc(dbname, colname, docid)
+    s = c.get_data(dbname, colname, doc) # data bytes, None if not cached or doc is changed
+    c.put_data(dbname, colname, doc, s)
+    s = c.get_data_for_id(dbname, dataid)
+    c.put_data_for_id(dbname, dataid, s)
+    c.evict()
+    d = c.stats() # {'hits':..., 'misses':..., 'nbytes':...}
+
+Cache directory layout:
+    <cachedir>/docs/<key>.json    - {"key": [dbname, colname, docid], "doc": {...}, "data": <sha256>}
+    <cachedir>/queries/<key>.json - {"key": [dbname, colname, query_string], "docs": [...]}
+    <cachedir>/ids/<key>.json     - {"key": [dbname, dataid], "data": <sha256>}
+    <cachedir>/data/<sha256>      - data bytes, content-addressed (shared by exp and det dbs)
+where <key> is sha1 of the key items. Cached data is valid for a document with
+the same _id, id_data and time stamps. Files are written atomically and all cache
+files (documents, queries, ids and data) are evicted in least recently used order
+above max_bytes. An evicted entry is a cache miss, i.e. it is fetched again.
+
+Environment:
+    PS_CALIB_CACHE_DIR - cache directory, default ~/.cache/psana/calib, "none" disables the cache
+    PS_CALIB_CACHE_MB  - cache size limit (MB), default 2000
+    PS_CALIB_OFFLINE   - 1: use cached documents and data only, no web service requests
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import json
+import hashlib
+import tempfile
+import threading
+
+DOC_VALIDATION_KEYS = ('_id', 'id_data', 'time_stamp', 'time_sec')
+CACHE_SUBDIRS = ('docs', 'queries', 'ids', 'data')
+
+
+def _key(*items):
+    return hashlib.sha1('\0'.join(str(v) for v in items).encode()).hexdigest()
+
+
+def _write_atomic(path, s):
+    """Writes bytes s to path through a temporary file in the same directory"""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f: f.write(s)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class CalibCache:
+
+    def __init__(self, cachedir, max_bytes=2000<<20, offline=False):
+        self.cachedir = cachedir
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        self._nbytes = None # total size of cache files, evaluated on first put
+        self._lock = threading.Lock()
+        for sub in CACHE_SUBDIRS:
+            os.makedirs(os.path.join(cachedir, sub), exist_ok=True)
+
+
+    def _path(self, sub, name):
+        return os.path.join(self.cachedir, sub, name)
+
+
+    def _count(self, hit):
+        with self._lock:
+            if hit: self.hits += 1
+            else:   self.misses += 1
+
+
+    def _read_json(self, sub, *key):
+        path = self._path(sub, _key(*key) + '.json')
+        try:
+            with open(path, 'rb') as f:
+                d = json.loads(f.read())
+            os.utime(path) # mark as recently used
+        except (OSError, ValueError):
+            return None
+        return d if d.get('key', None) == list(key) else None
+
+
+    def _write_json(self, sub, d, *key):
+        d['key'] = list(key)
+        path = self._path(sub, _key(*key) + '.json')
+        s = json.dumps(d).encode()
+        try:
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            _write_atomic(path, s)
+        except OSError as err:
+            logger.warning('CalibCache: can not write %s entry: %s' % (sub, err))
+            return
+        self._added(len(s) - old_size)
+
+
+    def _added(self, nbytes):
+        """Accounts for nbytes written to the cache and evicts if needed"""
+        with self._lock:
+            if self._nbytes is not None: self._nbytes += nbytes
+        self.evict()
+
+
+    def _read_data(self, sha):
+        path = self._path('data', sha)
+        try:
+            with open(path, 'rb') as f: s = f.read()
+            os.utime(path) # mark as recently used
+        except OSError:
+            return None
+        return s if hashlib.sha256(s).hexdigest() == sha else None
+
+
+    def _write_data(self, s):
+        """Saves data bytes under their sha256, returns sha256 or None"""
+        sha = hashlib.sha256(s).hexdigest()
+        path = self._path('data', sha)
+        if os.path.exists(path):
+            os.utime(path)
+            return sha
+        try:
+            _write_atomic(path, s)
+        except OSError as err:
+            logger.warning('CalibCache: can not write data: %s' % err)
+            return None
+        self._added(len(s))
+        return sha
+
+
+    def get_docs(self, dbname, colname, query_string):
+        d = self._read_json('queries', dbname, colname, query_string)
+        self._count(d is not None)
+        return None if d is None else d['docs']
+
+
+    def put_docs(self, dbname, colname, query_string, docs):
+        self._write_json('queries', {'docs': docs}, dbname, colname, query_string)
+
+
+    def get_doc(self, dbname, colname, docid):
+        d = self._read_json('docs', dbname, colname, docid)
+        self._count(d is not None)
+        return None if d is None else d['doc']
+
+
+    def get_data(self, dbname, colname, doc):
+        """Returns cached data bytes for doc, None if not cached or cached for other version of the doc"""
+        docid = doc.get('_id', None)
+        d = None if docid is None else self._read_json('docs', dbname, colname, docid)
+        s = None
+        if d is not None and d.get('data', None) is not None\
+        and all(d['doc'].get(k, None) == doc.get(k, None) for k in DOC_VALIDATION_KEYS):
+            s = self._read_data(d['data'])
+        self._count(s is not None)
+        return s
+
+
+    def put_data(self, dbname, colname, doc, s):
+        docid = doc.get('_id', None)
+        if docid is None or s is None: return
+        sha = self._write_data(s)
+        if sha is not None:
+            self._write_json('docs', {'doc': doc, 'data': sha}, dbname, colname, docid)
+
+
+    def get_data_for_id(self, dbname, dataid):
+        d = self._read_json('ids', dbname, dataid)
+        s = None if d is None else self._read_data(d['data'])
+        self._count(s is not None)
+        return s
+
+
+    def put_data_for_id(self, dbname, dataid, s):
+        if s is None: return
+        sha = self._write_data(s)
+        if sha is not None:
+            self._write_json('ids', {'data': sha}, dbname, dataid)
+
+
+    def _cache_files(self):
+        """Returns list of (mtime, size, path) of all cache files"""
+        files = []
+        for sub in CACHE_SUBDIRS:
+            with os.scandir(os.path.join(self.cachedir, sub)) as it:
+                for e in it:
+                    if e.name.startswith('.tmp-') or not e.is_file(): continue
+                    try: st = e.stat()
+                    except OSError: continue
+                    files.append((st.st_mtime, st.st_size, e.path))
+        return files
+
+
+    def evict(self):
+        """Removes least recently used cache files while their total size exceeds max_bytes"""
+        with self._lock:
+            if self._nbytes is not None and self._nbytes <= self.max_bytes: return
+            files = self._cache_files()
+            nbytes = sum(size for _, size, _ in files)
+            if nbytes > self.max_bytes:
+                for mtime, size, path in sorted(files):
+                    try: os.unlink(path)
+                    except OSError: continue
+                    nbytes -= size
+                    logger.debug('CalibCache: evicted %s size %d' % (path, size))
+                    if nbytes <= self.max_bytes: break
+            self._nbytes = nbytes
+
+
+    def stats(self):
+        with self._lock:
+            if self._nbytes is None:
+                self._nbytes = sum(size for _, size, _ in self._cache_files())
+            return {'hits': self.hits, 'misses': self.misses, 'nbytes': self._nbytes}
+
+
+def max_bytes_from_env():
+    return int(float(os.environ.get('PS_CALIB_CACHE_MB', 2000)) * (1<<20))
+
+
+_calib_cache = None
+_calib_cache_is_set = False
+
+def calib_cache():
+    """Returns per-process CalibCache configured from environment or None if it is disabled"""
+    global _calib_cache, _calib_cache_is_set
+    if not _calib_cache_is_set:
+        cachedir = os.environ.get('PS_CALIB_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'psana', 'calib'))
+        max_bytes = max_bytes_from_env()
+        offline = os.environ.get('PS_CALIB_OFFLINE', '0') not in ('', '0')
+        cache = None
+        if cachedir.lower() != 'none':
+            try:
+                cache = CalibCache(cachedir, max_bytes=max_bytes, offline=offline)
+            except OSError as err:
+                logger.warning('calib_cache: cache is disabled, can not create directory %s: %s' % (cachedir, err))
+        set_calib_cache(cache)
+    return _calib_cache
+
+
+def set_calib_cache(cache):
+    global _calib_cache, _calib_cache_is_set
+    _calib_cache = cache
+    _calib_cache_is_set = True
+
+# EOF
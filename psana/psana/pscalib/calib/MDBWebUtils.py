@@ -7,7 +7,9 @@ Usage ::
 
     resp = wu.check_kerberos_ticket(exit_if_invalid=True)
     q = wu.query_id_pro(query) # e.i., query={"_id":doc_id}
-    _ = wu.request(url, query=None)
+    _ = wu.request(url, query=None, timeout=None) # None for failed request, timeout default PS_CALIB_TIMEOUT
+    s = wu.session() # requests.Session
+    results = wu.map_concurrently(func, args_list, nthreads=None)
     _ = wu.database_names(url=cc.URL)
     _ = wu.collection_names(dbname, url=cc.URL)
     _ = wu.find_docs(dbname, colname, query={'ctype':'pedestals'}, url=cc.URL)
@@ -20,6 +22,10 @@ Usage ::
     data,doc = wu.calib_constants(det, exp=None, ctype='pedestals', run=None, time_sec=None, vers=None, url=cc.URL)
     d = wu.calib_constants_all_types(det, exp=None, run=None, time_sec=None, vers=None, url=cc.URL)
     d = {ctype:(data,doc),}
+    d = wu.calib_constants_all_dets(dets, exp=None, run=None, time_sec=None, vers=None, url=cc.URL)
+    d = {det:{ctype:(data,doc),},} # or {key:{ctype:(data,doc),},} for dets={key:[det, det_alt,...],}
+    d = wu.request_stats(reset=False) # {'nrequests':..., 'nfailed':..., 'time_sec':..., 'max_time_sec':...}
+    n = wu.prefetch_calib_constants(exp, dets=None, runs=None, url=cc.URL)
 
     id = wu.add_data_from_file(dbname, fname, sfx=None, url=cc.URL_KRB, krbheaders=cc.KRBHEADERS)
     id = wu.add_data(dbname, data, url=cc.URL_KRB, krbheaders=cc.KRBHEADERS)
@@ -36,6 +42,13 @@ Usage ::
     resp = wu.delete_data(dbname, data_id, url=cc.URL_KRB, krbheaders=cc.KRBHEADERS)
     resp = wu.delete_document_and_data(dbname, colname, doc_id, url=cc.URL_KRB, krbheaders=cc.KRBHEADERS)
 
+    Getters find_docs, get_doc_for_docid, get_data_for_id, get_data_for_doc
+    use on-disk cache of documents and data (see MDBWebCache, PS_CALIB_CACHE_DIR, PS_CALIB_OFFLINE).
+    Get requests reuse connections of per-process session(). Documents and data for all ctype-s
+    (and detectors in calib_constants_all_dets) are requested concurrently in a pool
+    of PS_CALIB_FETCH_THREADS (default 8) threads, 1 - sequential requests. Requests time out
+    in PS_CALIB_TIMEOUT (default 30) sec, failed requests fall back to the cache.
+
     s = wu.str_formatted_list(lst, ncols=5, width=24)
     s = wu.info_docs(dbname, colname, query={}, url=cc.URL, strlen=120)
     s = wu.info_webclient(**kwargs)
@@ -48,17 +61,23 @@ Usage ::
 import logging
 logger = logging.getLogger(__name__)
 
+import os
 import sys
 import numpy as np
 import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import psana.pscalib.calib.CalibConstants as cc
-from requests import get, post, delete #put
+from requests import get, post, delete, Session #put
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
 
 from time import time
 from numpy import fromstring
 #from psana.pscalib.calib.MDBUtils import dbnames_collection_query, object_from_data_string
 import psana.pscalib.calib.MDBUtils as mu
+from psana.pscalib.calib.MDBWebCache import calib_cache
 #from bson.objectid import ObjectId
 
 import psana.pyalgos.generic.Utils as gu
@@ -90,14 +109,73 @@ def query_id_pro(query):
 
 
 
-def request(url, query=None):
-    #t0_sec = time()
-    r = get(url, query)
-    #dt = time()-t0_sec # ~30msec
-    #logger.debug('CONSUMED TIME by request %.3f sec\n  for url=%s  query=%s' % (dt, url, str(query)))
-    if r.ok: return r
-    s = 'get url: %s query: %s\n  response status: %s status_code: %s reason: %s'%\
-        (url, str(query), r.ok, r.status_code, r.reason)
+PS_CALIB_FETCH_THREADS = int(os.environ.get('PS_CALIB_FETCH_THREADS', 8))
+PS_CALIB_TIMEOUT = float(os.environ.get('PS_CALIB_TIMEOUT', 30)) # sec, connect and read timeout of get requests
+
+_session_lock = threading.Lock()
+_session_pid = None
+_session_ = None
+
+def session():
+    """Returns per-process requests.Session with connection pool sized for PS_CALIB_FETCH_THREADS
+       concurrent requests (keep-alive connections are reused between requests).
+    """
+    global _session_pid, _session_
+    with _session_lock:
+        if _session_pid != os.getpid(): # do not share connections with parent process after fork
+            _session_ = Session()
+            adapter = HTTPAdapter(pool_maxsize=max(PS_CALIB_FETCH_THREADS, 1))
+            _session_.mount('http://', adapter)
+            _session_.mount('https://', adapter)
+            _session_pid = os.getpid()
+        return _session_
+
+
+_request_stats_lock = threading.Lock()
+_request_stats_ = {'nrequests': 0, 'nfailed': 0, 'time_sec': 0., 'max_time_sec': 0.}
+
+def request_stats(reset=False):
+    """Returns dict of counters of web service get requests:
+       {'nrequests':..., 'nfailed':..., 'time_sec':<total request time>, 'max_time_sec':...}
+    """
+    with _request_stats_lock:
+        d = dict(_request_stats_)
+        if reset:
+            _request_stats_.update(nrequests=0, nfailed=0, time_sec=0., max_time_sec=0.)
+    return d
+
+
+def map_concurrently(func, args_list, nthreads=None):
+    """Returns list of func(*args) for args in args_list evaluated in a pool of at most nthreads
+       (default PS_CALIB_FETCH_THREADS) threads.
+    """
+    n = min(PS_CALIB_FETCH_THREADS if nthreads is None else nthreads, len(args_list))
+    if n < 2: return [func(*args) for args in args_list]
+    with ThreadPoolExecutor(max_workers=n) as executor:
+        return list(executor.map(lambda args: func(*args), args_list))
+
+
+def request(url, query=None, timeout=None):
+    """Returns response of get request or None if request failed (error status, connection error
+       or no response in timeout, default PS_CALIB_TIMEOUT sec).
+    """
+    t0_sec = time()
+    try:
+        r = session().get(url, params=query, timeout=PS_CALIB_TIMEOUT if timeout is None else timeout)
+    except RequestException as err:
+        r, s = None, 'get url: %s query: %s\n  request failed: %s' % (url, str(query), repr(err))
+    dt = time()-t0_sec # ~30msec
+    ok = r is not None and r.ok
+    with _request_stats_lock:
+        _request_stats_['nrequests'] += 1
+        _request_stats_['nfailed'] += int(not ok)
+        _request_stats_['time_sec'] += dt
+        _request_stats_['max_time_sec'] = max(_request_stats_['max_time_sec'], dt)
+    logger.debug('CONSUMED TIME by request %.3f sec\n  for url=%s  query=%s' % (dt, url, str(query)))
+    if ok: return r
+    if r is not None:
+        s = 'get url: %s query: %s\n  response status: %s status_code: %s reason: %s'%\
+            (url, str(query), r.ok, r.status_code, r.reason)
     s += '\nTry command: curl -s "%s"' % url
     logger.warning(s)
     return None
@@ -132,15 +210,24 @@ def find_docs(dbname, colname, query={'ctype':'pedestals'}, url=cc.URL):
     uri = '%s/%s/%s'%(url,dbname,colname)
     query_string=str(query).replace("'",'"')
     logger.debug('find_docs uri: %s query: %s' % (uri, query_string))
+    cache = calib_cache()
+    if cache is not None and cache.offline:
+        return cache.get_docs(dbname, colname, query_string)
     r = request(uri, {"query_string": query_string})
-    if r is None: return None
+    if r is None:
+        docs = None if cache is None else cache.get_docs(dbname, colname, query_string)
+        if docs is not None:
+            logger.warning('find_docs: request failed, use cached documents for %s/%s query: %s' % (dbname, colname, query_string))
+        return docs
     try:
-        return r.json()
+        docs = r.json()
     except:
         msg = 'WARNING: find_docs responce: %s' % str(r)\
             + '\n     conversion to json failed, return None for query: %s' % str(query)
         logger.debug(msg)
         return None
+    if cache is not None: cache.put_docs(dbname, colname, query_string, docs)
+    return docs
 
 
 
@@ -185,8 +272,10 @@ def select_latest_doc(docs, query):
 def get_doc_for_docid(dbname, colname, docid, url=cc.URL):
     """Returns document for docid.
     """
-    r = request('%s/%s/%s/%s'%(url,dbname,colname,docid))
-    if r is None: return None
+    cache = calib_cache()
+    r = None if cache is not None and cache.offline else\
+        request('%s/%s/%s/%s'%(url,dbname,colname,docid))
+    if r is None: return None if cache is None else cache.get_doc(dbname, colname, docid)
     return r.json()
 
 
@@ -195,11 +284,15 @@ def get_doc_for_docid(dbname, colname, docid, url=cc.URL):
 def get_data_for_id(dbname, dataid, url=cc.URL):
     """Returns raw data from GridFS, at this level there is no info for parsing.
     """
+    cache = calib_cache()
+    s = None if cache is None else cache.get_data_for_id(dbname, dataid)
+    if s is not None or (cache is not None and cache.offline): return s
     r = request('%s/%s/gridfs/%s'%(url,dbname,dataid))
     if r is None: return None
     logger.debug('get_data_for_docid:'\
                 +'\n  r.status_code: %s\n  r.headers: %s\n  r.encoding: %s\n  r.content: %s...\n' % 
                  (str(r.status_code),  str(r.headers),  str(r.encoding),  str(r.content[:50])))
+    if cache is not None: cache.put_data_for_id(dbname, dataid, r.content)
     return r.content
 
 
@@ -223,9 +316,16 @@ def get_data_for_doc(dbname, colname, doc, url=cc.URL):
         logger.debug("get_data_for_doc: key 'id_data' is missing in selected document...")
         return None
 
-    r2 = request('%s/%s/gridfs/%s'%(url,dbname,idd))
-    if r2 is None: return None
-    s = r2.content
+    cache = calib_cache()
+    s = None if cache is None else cache.get_data(dbname, colname, doc)
+    if s is None:
+        if cache is not None and cache.offline:
+            logger.warning('get_data_for_doc: offline mode, data are not cached for doc: %s' % str(doc))
+            return None
+        r2 = request('%s/%s/gridfs/%s'%(url,dbname,idd))
+        if r2 is None: return None
+        s = r2.content
+        if cache is not None: cache.put_data(dbname, colname, doc, s)
 
     return mu.object_from_data_string(s, doc)
 
@@ -264,6 +364,24 @@ def calib_constants(det, exp=None, ctype='pedestals', run=None, time_sec=None, v
 
 
 
+def latest_docs_for_ctypes(docs, query, skip_ctypes=()):
+    """Returns dict {ctype: doc} of the latest documents for each ctype found in docs,
+       ctypes from skip_ctypes are ignored.
+    """
+    docs_for_type = {}
+    for d in docs:
+        ct = d.get('ctype',None)
+        if ct is None or ct in skip_ctypes: continue
+        docs_for_type.setdefault(ct, []).append(d)
+    logger.debug('latest_docs_for_ctypes - found ctypes: %s' % str(set(docs_for_type.keys())))
+    resp = {}
+    for ct, _docs in docs_for_type.items():
+        doc = select_latest_doc(_docs, query)
+        if doc is not None: resp[ct] = doc
+    return resp
+
+
+
 def calib_constants_of_missing_types(resp, det, time_sec=None, vers=None, url=cc.URL):
     """ try to add constants of missing types in resp using detector db
     """
@@ -276,20 +394,12 @@ def calib_constants_of_missing_types(resp, det, time_sec=None, vers=None, url=cc
     #logger.debug('find_docs: number of docs found: %d' % len(docs))
     if docs is None : return None
 
-    ctypes = set([d.get('ctype',None) for d in docs])
-    ctypes.discard(None)
-    logger.debug('calib_constants_missing_types - found ctypes: %s' % str(ctypes))
+    ctdocs = latest_docs_for_ctypes(docs, query, skip_ctypes=resp.keys())
+    logger.debug('calib_constants_missing_types - found additional ctypes: %s' % str(list(ctdocs.keys())))
 
-    ctypes_resp = resp.keys()
-    _ctypes = [ct for ct in ctypes if not(ct in ctypes_resp)]
-
-    logger.debug('calib_constants_missing_types - found additional ctypes: %s' % str(_ctypes))
-
-    for ct in _ctypes:
-        docs_for_type = [d for d in docs if d.get('ctype',None)==ct]
-        doc = select_latest_doc(docs_for_type, query)
-        if doc is None : continue
-        resp[ct] = (get_data_for_doc(dbname, colname, doc, url), doc)
+    data = map_concurrently(get_data_for_doc, [(dbname, colname, doc, url) for doc in ctdocs.values()])
+    for (ct, doc), d in zip(ctdocs.items(), data):
+        resp[ct] = (d, doc)
 
     return resp
 
@@ -298,32 +408,96 @@ def calib_constants_of_missing_types(resp, det, time_sec=None, vers=None, url=cc
 def calib_constants_all_types(det, exp=None, run=None, time_sec=None, vers=None, url=cc.URL):
     """ returns constants for all ctype-s
     """
-    ctype=None
-    db_det, db_exp, colname, query = dbnames_collection_query(det, exp, ctype, run, time_sec, vers)
+    return calib_constants_all_dets([det], exp, run, time_sec, vers, url)[det]
 
-    #print('YYYY db_det, db_exp, colname, query', db_det, db_exp, colname, query)
 
 
-    dbname = db_det if exp is None else db_exp
-    docs = find_docs(dbname, colname, query, url)
-    #logger.debug('find_docs: number of docs found: %d' % len(docs))
-    if docs is None : return None
-
-    ctypes = set([d.get('ctype',None) for d in docs])
-    ctypes.discard(None)
-    logger.debug('calib_constants_all_types - found ctypes: %s' % str(ctypes))
+def calib_constants_all_dets(dets, exp=None, run=None, time_sec=None, vers=None, url=cc.URL):
+    """Returns dict {det: {ctype:(data,doc),}} - constants of all ctype-s for list of detectors
+       as calib_constants_all_types returns for each det. Documents and then data of all detectors
+       are requested concurrently in a pool of PS_CALIB_FETCH_THREADS threads.
+       dets may be a dict {key: [det, det_alt,...]}, then returned dict has the same keys and
+       constants for key from the first det in the list which has non-empty constants.
+    """
+    if not isinstance(dets, dict):
+        return dict(zip(dets, _calib_constants_all_dets(dets, exp, run, time_sec, vers, url)))
 
+    t0_sec = time()
+    stats0 = request_stats()
     resp = {}
-    for ct in ctypes:
-        docs_for_type = [d for d in docs if d.get('ctype',None)==ct]
-        doc = select_latest_doc(docs_for_type, query)
-        if doc is None : continue
-        resp[ct] = (get_data_for_doc(dbname, colname, doc, url), doc)
+    pending = {key: list(names) for key, names in dets.items() if names}
+    while pending:
+        keys = list(pending.keys())
+        cons = _calib_constants_all_dets([pending[key].pop(0) for key in keys], exp, run, time_sec, vers, url)
+        resp.update(zip(keys, cons))
+        pending = {key: names for key, names in pending.items() if names and not resp[key]}
+
+    stats = request_stats()
+    logger.debug('calib_constants_all_dets for %d detectors time %.3f sec, %d requests, total request time %.3f sec' %\
+                 (len(dets), time()-t0_sec, stats['nrequests']-stats0['nrequests'], stats['time_sec']-stats0['time_sec']))
+    return resp
+
+
+
+def _calib_constants_all_dets(dets, exp=None, run=None, time_sec=None, vers=None, url=cc.URL):
+    """Returns list of calib_constants_all_types responses for list of detectors"""
+    # for each det: documents of exp (or det) db for run and documents of det db for missing types
+    queries = []
+    for det in dets:
+        db_det, db_exp, colname, query = dbnames_collection_query(det, exp, None, run, time_sec, vers)
+        db_det2, _, colname2, query2 = dbnames_collection_query(det, None, None, 9999, time_sec, vers)
+        queries.append(((db_det if exp is None else db_exp, colname, query), (db_det2, colname2, query2)))
+
+    docs = map_concurrently(find_docs, [q + (url,) for qq in queries for q in qq])
 
-    resp = calib_constants_of_missing_types(resp, det, time_sec, vers, url)
+    tasks = [] # (idet, ctype, dbname, colname, doc)
+    failed = set()
+    for idet, ((q, q2), docs1, docs2) in enumerate(zip(queries, docs[0::2], docs[1::2])):
+        if docs1 is None or docs2 is None:
+            failed.add(idet)
+            continue
+        ctdocs = latest_docs_for_ctypes(docs1, q[2])
+        ctdocs2 = latest_docs_for_ctypes(docs2, q2[2], skip_ctypes=ctdocs.keys())
+        tasks += [(idet, ct, q[0], q[1], doc) for ct, doc in ctdocs.items()]\
+               + [(idet, ct, q2[0], q2[1], doc) for ct, doc in ctdocs2.items()]
 
+    data = map_concurrently(get_data_for_doc, [(dbname, colname, doc, url) for _, _, dbname, colname, doc in tasks])
+
+    resp = [None if idet in failed else {} for idet in range(len(dets))]
+    for (idet, ct, _, _, doc), d in zip(tasks, data):
+        resp[idet][ct] = (d, doc)
     return resp
 
+
+
+def prefetch_calib_constants(exp, dets=None, runs=None, url=cc.URL):
+    """Warms up calib_cache with documents and data of experiment exp.
+       - dets - list of detector names, default - all detector collections of the experiment db,
+       - runs - list of runs to get constants for as psana does at run start-up
+                (only these queries are available in offline mode),
+                default - all documents of the experiment db collections
+                and the latest documents of detector db.
+       Returns number of processed detectors or None.
+    """
+    dbname = mu.db_prefixed_name(exp)
+    _dets = dets
+    if _dets is None:
+        _dets = collection_names(dbname, url)
+        if _dets is None: return None
+        _dets = [name for name in _dets if not name.startswith('fs.')] # skip gridfs collections
+
+    for det in _dets:
+        t0_sec = time()
+        if runs:
+            for run in runs: calib_constants_all_types(det, exp=exp, run=run, url=url)
+        else:
+            colname = pro_detector_name(det)
+            docs = find_docs(dbname, colname, query={}, url=url)
+            for doc in (docs or []): get_data_for_doc(dbname, colname, doc, url)
+            calib_constants_of_missing_types({}, det, url=url)
+        logger.info('prefetch_calib_constants for %s %s time %.3f sec' % (exp, det, time()-t0_sec))
+    return len(_dets)
+
 #------------------------------
 #-------- 2020-04-30 ----------
 #------------------------------
@@ -2,13 +2,15 @@ from .prometheus_manager import PrometheusManager
 from .packet_footer import PacketFooter
 from .smdreader_manager import SmdReaderManager 
 from .tools import run_from_id, RunHelper, mode
-from .event_manager import EventManager
 from .eventbuilder_manager import EventBuilderManager
 from .envstore import EnvStore
 from .envstore_manager import EnvStoreManager
 from .packet_footer import PacketFooter
 from .step import Step
 from . import TransitionId
+from .smd_batch import SmdBatch
+from .ts_index import TimestampIndex
+from .event_manager import EventManager
 from .events import Events
 from . import legion_node
 from .ds_base import DataSourceBase
@@ -0,0 +1,73 @@
+import os
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+class BatchSizeController(object):
+    """ Adjusts no. of events Smd0 puts in a chunk (smd0_n_events).
+
+    After each chunk is sent, update() is called with what was measured
+    for that chunk:
+    - eb_wait:      time (s) the EventBuilder spent waiting for Smd0
+    - smd0_wait:    time (s) Smd0 spent waiting for a request
+    - n_events and nbytes of the chunk (for bytes per event)
+
+    When EventBuilders wait on Smd0 longer than Smd0 waits on them, Smd0
+    is the bottleneck and chunks grow (fewer request round-trips). When
+    Smd0 mostly waits for requests, chunks shrink so that work is spread
+    more evenly (less idling at the end of a run and smaller chunks).
+    The result is always kept within [min_n_events, max_n_events] and
+    under max_chunk_bytes using the measured bytes per event.
+
+    Settings (env. variables):
+    PS_SMD_N_EVENTS_MIN     lower bound (default: 100)
+    PS_SMD_N_EVENTS_MAX     upper bound (default: 100000)
+    PS_SMD_ADAPT_FACTOR     multiplicative step (default: 2)
+    PS_SMD_ADAPT_LOG        csv file path for recording all decisions
+    """
+    def __init__(self, n_events, max_chunk_bytes, max_events=0):
+        self.min_n_events   = int(os.environ.get('PS_SMD_N_EVENTS_MIN', 100))
+        self.max_n_events   = int(os.environ.get('PS_SMD_N_EVENTS_MAX', 100000))
+        self.factor         = float(os.environ.get('PS_SMD_ADAPT_FACTOR', 2))
+        self.log_path       = os.environ.get('PS_SMD_ADAPT_LOG', None)
+        if max_events:
+            self.max_n_events = min(self.max_n_events, max_events)
+        self.min_n_events   = min(self.min_n_events, self.max_n_events)
+        self.max_chunk_bytes= max_chunk_bytes
+        self.n_events       = self._clamp(n_events, 0)
+
+        # Waits shorter than this (s) are treated as no wait at all
+        self.min_wait       = 1e-3
+        self.history        = [] # (time, n_events, nbytes, smd0_wait, eb_wait, new_n_events)
+
+    def _clamp(self, n_events, bytes_per_event):
+        n_events = max(self.min_n_events, min(self.max_n_events, int(n_events)))
+        if bytes_per_event > 0:
+            n_events = min(n_events, max(self.min_n_events, int(self.max_chunk_bytes / bytes_per_event)))
+        return n_events
+
+    def update(self, n_events, nbytes, smd0_wait, eb_wait):
+        """ Returns no. of events for the next chunk. """
+        bytes_per_event = nbytes / n_events if n_events > 0 else 0
+        new_n_events = self.n_events
+        if eb_wait > self.min_wait and eb_wait > smd0_wait:
+            new_n_events = self.n_events * self.factor
+        elif smd0_wait > self.min_wait and smd0_wait > eb_wait:
+            new_n_events = self.n_events / self.factor
+        new_n_events = self._clamp(new_n_events, bytes_per_event)
+
+        self.history.append((time.time(), n_events, nbytes, smd0_wait, eb_wait, new_n_events))
+        if new_n_events != self.n_events:
+            logger.debug(f'batch_size_controller: smd0_n_events {self.n_events} -> {new_n_events} (smd0_wait={smd0_wait:.5f}s eb_wait={eb_wait:.5f}s bytes/evt={bytes_per_event:.1f})')
+        self.n_events = new_n_events
+        return self.n_events
+
+    def dump(self):
+        """ Writes all decisions to PS_SMD_ADAPT_LOG (if set). """
+        if not self.log_path: return
+        with open(self.log_path, 'w') as f:
+            f.write('time,n_events,nbytes,smd0_wait,eb_wait,new_n_events\n')
+            for row in self.history:
+                f.write(','.join([str(val) for val in row]) + '\n')
+        logger.debug(f'batch_size_controller: wrote {len(self.history)} decisions to {self.log_path}')
@@ -151,10 +151,16 @@ class DataSourceBase(abc.ABC):
         self.smalldata_obj.setup_parms(**kwargs)
         return self.smalldata_obj
 
-    def _start_prometheus_client(self, mpi_rank=0):
+    def _start_prometheus_client(self, mpi_rank=0, aggregator=None):
+        """ Starts pushing metrics of this rank or, with aggregator (see
+        MetricsAggregator), of all ranks from smd0 only. """
         if not self.monitor:
             logger.debug('ds_base: RUN W/O PROMETHEUS CLENT')
+        elif aggregator and aggregator.role != 'smd0':
+            logger.debug('ds_base: METRICS AGGREGATED BY SMD0 (JOBID:%s RANK: %d)'%(self.prom_man.jobid, mpi_rank))
+            self.prom_man.aggregator = aggregator
         else:
+            self.prom_man.aggregator = aggregator
             logger.debug('ds_base: START PROMETHEUS CLIENT (JOBID:%s RANK: %d)'%(self.prom_man.jobid, mpi_rank))
             self.e = threading.Event()
             self.t = threading.Thread(name='PrometheusThread%s'%(mpi_rank),
@@ -164,7 +170,7 @@ class DataSourceBase(abc.ABC):
             self.t.start()
 
     def _end_prometheus_client(self, mpi_rank=0):
-        if not self.monitor:
+        if not self.monitor or not hasattr(self, 'e'):
             return
 
         logger.debug('ds_base: END PROMETHEUS CLIENT (JOBID:%s RANK: %d)'%(self.prom_man.jobid, mpi_rank))
@@ -345,24 +351,25 @@ class DataSourceBase(abc.ABC):
         expt, runnum, _ = runinfo
         
         self.dsparms.calibconst = {}
-        for det_name, configinfo in self.dsparms.configinfo_dict.items():
-            if expt: 
-                if expt == "cxid9114": # mona: hack for cctbx
-                    det_uniqueid = "cspad_0002"
-                elif expt == "xpptut15":
-                    det_uniqueid = "cspad_detnum1234"
-                else:
-                    det_uniqueid = configinfo.uniqueid
-                calib_const = wu.calib_constants_all_types(det_uniqueid, exp=expt, run=runnum)
-                
-                # mona - hopefully this will be removed once the calibconst
-                # db all use uniqueid as an identifier
-                if not calib_const:
-                    calib_const = wu.calib_constants_all_types(det_name, exp=expt, run=runnum)
-                self.dsparms.calibconst[det_name] = calib_const
-            else:
+        if not expt:
+            for det_name in self.dsparms.configinfo_dict:
                 print(f"ds_base: Warning: cannot access calibration constant (exp is None)")
                 self.dsparms.calibconst[det_name] = None
+            return
+
+        # all detectors and ctypes are fetched concurrently in one call
+        det_names = {}
+        for det_name, configinfo in self.dsparms.configinfo_dict.items():
+            if expt == "cxid9114": # mona: hack for cctbx
+                det_uniqueid = "cspad_0002"
+            elif expt == "xpptut15":
+                det_uniqueid = "cspad_detnum1234"
+            else:
+                det_uniqueid = configinfo.uniqueid
+            # mona - hopefully det_name will be removed once the calibconst
+            # db all use uniqueid as an identifier
+            det_names[det_name] = [det_uniqueid, det_name]
+        self.dsparms.calibconst = wu.calib_constants_all_dets(det_names, exp=expt, run=runnum)
     
     def _get_runinfo(self):
         if not self.beginruns : return
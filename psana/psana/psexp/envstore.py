@@ -15,10 +15,16 @@ class EnvManager(object):
         self.config     = config
         self.env_name   = env_name
         self.dgrams     = []
-        self.timestamps = []
+        self._timestamps= np.zeros(64, dtype=np.uint64) # grown by doubling
         self.n_items    = 0
+        self._var_locs  = {}    # var_name: (alg, segment_id) or None
+        self._columns   = {}    # (var_name, n_search_steps): [values, pos. of last dgram with alg]
         self._init_env_variables()
 
+    @property
+    def timestamps(self):
+        return self._timestamps[:self.n_items]
+
     def _init_env_variables(self):
         """ From the given config, build a list of variables from
         config.software.env_name.[alg].[] fields.
@@ -46,8 +52,12 @@ class EnvManager(object):
                     self.env_variables[alg] = {segment_id: env_vars}
 
     def add(self, d):
+        if self.n_items == self._timestamps.shape[0]:
+            timestamps = np.zeros(2 * self.n_items, dtype=np.uint64)
+            timestamps[:self.n_items] = self._timestamps
+            self._timestamps = timestamps
+        self._timestamps[self.n_items] = d.timestamp()
         self.dgrams.append(d)
-        self.timestamps.append(d.timestamp())
         self.n_items += 1
     
     def is_empty(self):
@@ -56,11 +66,41 @@ class EnvManager(object):
     def locate_variable(self, var_name):
         """ Returns algorithm name and segment_id from the given env variable
         specifically for this config."""
-        for alg, envs in self.env_variables.items():
-            for segment_id, var_dict in envs.items():
-                if var_name in var_dict:
-                    return alg, segment_id
-        return None
+        if var_name not in self._var_locs:
+            self._var_locs[var_name] = None
+            for alg, envs in self.env_variables.items():
+                for segment_id, var_dict in envs.items():
+                    if var_name in var_dict:
+                        self._var_locs[var_name] = (alg, segment_id)
+                        break
+                if self._var_locs[var_name]: break
+        return self._var_locs[var_name]
+
+    def value_column(self, var_name, n_search_steps):
+        """ Returns list of values of var_name, one for each dgram.
+
+        The value for a dgram comes from the closest dgram at or before it
+        (at most n_search_steps back) that has the variable's algorithm 
+        (None if not found). The list is extended as new dgrams are added.
+        """
+        key = (var_name, n_search_steps)
+        if key not in self._columns:
+            self._columns[key] = [[], -1]
+        column = self._columns[key]
+        values, last_pos = column
+        
+        alg, segment_id = self.locate_variable(var_name)
+        for p in range(len(values), self.n_items):
+            envs = getattr(self.dgrams[p], self.env_name, {}).get(segment_id) # e.g. BeginRun has no scan
+            if hasattr(envs, alg):
+                last_pos = p
+            if last_pos >= 0 and last_pos > p - n_search_steps:
+                envs = getattr(self.dgrams[last_pos], self.env_name)[segment_id]
+                values.append(getattr(getattr(envs, alg), var_name))
+            else:
+                values.append(None)
+        column[1] = last_pos
+        return values
 
 class EnvStore(object):
     """ Manages Env data 
@@ -142,35 +182,36 @@ class EnvStore(object):
         fast/slow) then for that env file, locate position of env dgram that
         has ts_env <= ts_evt. If the dgram at found position has the algorithm
         then returns the value, otherwise keeps searching backward until 
-        PS_N_env_SEARCH_STEPS is reached."""
+        PS_N_env_SEARCH_STEPS is reached.
+        
+        All events are located with one search per env file and values are
+        taken from the cached value column of the variable.
+        """
         
         PS_N_STEP_SEARCH_STEPS = int(os.environ.get("PS_N_STEP_SEARCH_STEPS", "10"))
-        env_values = []
-
-        for evt in events:
-            event_timestamp = np.array([evt.timestamp], dtype=np.uint64)
-
-            # For epics and scan detectors, locate variable and return its value
-            for i, env_man in enumerate(self.env_managers):
-                val = None
-                env_var_loc = env_man.locate_variable(env_variable) # check if this xtc has the variable
-                if env_var_loc:
-                    alg, segment_id = env_var_loc
-                    found_pos = np.searchsorted(env_man.timestamps, event_timestamp)[0]
-                    
-                    if found_pos == env_man.n_items: # this event is the last step or the events after
-                        found_pos -= 1
-                    
-                    for p in range(found_pos, found_pos - PS_N_STEP_SEARCH_STEPS, -1):
-                        if p < 0:
-                            break
-                        envs = getattr(env_man.dgrams[p], self.env_name)[segment_id]
-                        if hasattr(envs, alg):
-                            val = getattr(getattr(envs, alg), env_variable)
-                            break
-                    
-                    if val is not None: break # found the value from this env manager
-            env_values.append(val)
+        env_values = [None] * len(events)
+        event_timestamps = np.array([evt.timestamp for evt in events], dtype=np.uint64)
+        missing = np.arange(len(events))
+
+        # For epics and scan detectors, locate variable and return its value
+        for i, env_man in enumerate(self.env_managers):
+            if not missing.size: break
+            if not env_man.locate_variable(env_variable): continue # check if this xtc has the variable
+            if env_man.n_items == 0: continue
+            
+            values = env_man.value_column(env_variable, PS_N_STEP_SEARCH_STEPS)
+            found_pos = np.searchsorted(env_man.timestamps, event_timestamps[missing])
+            # this event is the last step or the events after
+            found_pos[found_pos == env_man.n_items] -= 1
+
+            still_missing = []
+            for i_evt, p in zip(missing, found_pos):
+                val = values[p]
+                if val is None:
+                    still_missing.append(i_evt)
+                else:
+                    env_values[i_evt] = val
+            missing = np.asarray(still_missing, dtype=np.int64)
 
         return env_values
 
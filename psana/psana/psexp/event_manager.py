@@ -1,9 +1,13 @@
 from psana       import dgram
 from psana.event import Event
-from psana.psexp import PacketFooter, TransitionId, PrometheusManager
+from psana.psexp import PacketFooter, TransitionId, PrometheusManager, SmdBatch
+from psana.psexp.tracer import tracer
 import numpy as np
 import os
 import time
+import atexit
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import logging
 logger = logging.getLogger(__name__)
@@ -12,6 +16,62 @@ s_bd_just_read = PrometheusManager.get_metric('psana_bd_just_read')
 s_bd_gen_smd_batch = PrometheusManager.get_metric('psana_bd_gen_smd_batch')
 s_bd_gen_evt = PrometheusManager.get_metric('psana_bd_gen_evt')
 
+# Filtered events: reads of the same file are merged when the gap between
+# them is at most PS_BD_COALESCE_GAP bytes (-1 reads one dgram at a time).
+# Reads of different files are done in parallel by PS_BD_READ_THREADS threads.
+PS_BD_COALESCE_GAP = int(os.environ.get('PS_BD_COALESCE_GAP', 0x10000))
+PS_BD_READ_THREADS = int(os.environ.get('PS_BD_READ_THREADS', 4))
+_read_pool = None
+_read_pool_lock = threading.Lock()
+
+def _get_read_pool():
+    """ Returns the pool of PS_BD_READ_THREADS threads (None if <= 1),
+    created on first use. """
+    global _read_pool
+    if PS_BD_READ_THREADS <= 1: return None
+    with _read_pool_lock:
+        if _read_pool is None:
+            _read_pool = ThreadPoolExecutor(max_workers=PS_BD_READ_THREADS)
+        return _read_pool
+
+def _shutdown_read_pool():
+    global _read_pool
+    with _read_pool_lock:
+        if _read_pool is not None:
+            _read_pool.shutdown(wait=True)
+            _read_pool = None
+
+def _reset_read_pool_in_child():
+    """ Threads of the pool don't exist in a forked process (e.g. local
+    mode workers) - the child creates its own pool when needed. """
+    global _read_pool, _read_pool_lock
+    _read_pool = None
+    _read_pool_lock = threading.Lock()
+
+atexit.register(_shutdown_read_pool)
+os.register_at_fork(after_in_child=_reset_read_pool_in_child)
+
+def plan_reads(offsets, sizes, max_gap):
+    """ Merges (offset, size) ranges of one file into fewer reads.
+
+    Ranges are merged when the gap between them is at most max_gap bytes.
+    Returns read offsets and sizes, and for each given range the index
+    of its read and its position in that read.
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    sizes = np.asarray(sizes, dtype=np.int64)
+    order = np.argsort(offsets, kind='stable')
+    st = offsets[order]
+    en = np.maximum.accumulate(st + sizes[order])
+    new_read = np.ones(st.shape, dtype=bool)
+    new_read[1:] = st[1:] - en[:-1] > max_gap
+    i_first = np.nonzero(new_read)[0]
+    read_offsets = st[i_first]
+    read_sizes = np.maximum.reduceat(en, i_first) - read_offsets
+    read_ids = np.empty(offsets.shape, dtype=np.int64)
+    read_ids[order] = np.cumsum(new_read) - 1
+    return read_offsets, read_sizes, read_ids, offsets - read_offsets[read_ids]
+
 class EventManager(object):
     """ Return an event from the received smalldata memoryview (view)
 
@@ -25,6 +85,9 @@ class EventManager(object):
     def __init__(self, view, smd_configs, dm,  
             filter_fn=0, prometheus_counter=None, 
             max_retries=0, use_smds=[]):
+        self.view = view
+        self.bigdata = []
+        self.bd_reads = []
         if view:
             pf = PacketFooter(view=view)
             self.smd_events = pf.split_packets()
@@ -42,10 +105,40 @@ class EventManager(object):
         self.max_retries = max_retries
         self.use_smds = use_smds
 
-        if not self.filter_fn and len(self.dm.xtc_files) > 0:
-            self._read_bigdata_in_chunk()
+        # Offsets, sizes, and services of all smd events are parsed 
+        # once here and reused (see SmdBatch).
+        self.smd_batch = None
+        if self.n_events and len(self.dm.xtc_files) > 0:
+            self.smd_batch = SmdBatch(view, self.smd_configs, use_smds=self.use_smds)
+
+        if len(self.dm.xtc_files) > 0:
+            if not self.filter_fn:
+                self._read_bigdata_in_chunk()
+            elif PS_BD_COALESCE_GAP >= 0:
+                self._read_bigdata_coalesced()
+
+    @property
+    def nbytes(self):
+        """ Size of smd and bigdata held by this batch """
+        nbytes = memoryview(self.view).nbytes if self.view else 0
+        nbytes += sum([memoryview(buf).nbytes for buf in self.bigdata])
+        nbytes += sum([memoryview(buf).nbytes for bufs in self.bd_reads for buf in bufs])
+        return nbytes
+
+    def _pread(self, fd, size, offset):
+        """ Reads size bytes at offset (retries on partial reads) """
+        chunk = bytearray()
+        for _ in range(self.max_retries+1):
+            chunk.extend(os.pread(fd, size, offset))
+            got = memoryview(chunk).nbytes
+            if got == size:
+                break
+            offset += got
+            size -= got
+        return chunk
 
     @s_bd_just_read.time()
+    @tracer.timed('bd_read')
     def _read_chunks_from_disk(self, fds, offsets, sizes):
         sum_read_nbytes = 0 # for prometheus counter
         st = time.time()
@@ -54,16 +147,7 @@ class EventManager(object):
         for i_smd in range(self.n_smd_files):
             if self.use_smds[i_smd]: continue # smd data were already copied
             
-            offset = offsets[i_smd]
-            size = sizes[i_smd]
-            chunk = bytearray()
-            for _ in range(self.max_retries+1):
-                chunk.extend(os.pread(fds[i_smd], size, offset))
-                got = memoryview(chunk).nbytes
-                if got == sizes[i_smd]:
-                    break
-                offset += got
-                size -= got
+            chunk = self._pread(fds[i_smd], int(sizes[i_smd]), int(offsets[i_smd]))
             self.bigdata[i_smd].extend(chunk)
             sum_read_nbytes += sizes[i_smd]
         en = time.time()
@@ -76,6 +160,54 @@ class EventManager(object):
         return 
     
     @s_bd_just_read.time()
+    @tracer.timed('bd_read')
+    def _read_bigdata_coalesced(self):
+        """ Reads bigdata of all L1Accept events in this batch (filtered)
+
+        Dgram ranges of each file are merged into larger reads (see 
+        plan_reads) and reads of different files are issued in parallel.
+        self.bd_locs keeps (read index, position in read) of each dgram.
+        """
+        st = time.time()
+        smd_batch = self.smd_batch
+        self.bd_reads = [[] for i in range(self.n_smd_files)]
+        self.bd_locs = np.zeros((self.n_events, self.n_smd_files, 2), dtype=np.int64)
+        is_L1 = smd_batch.services == TransitionId.L1Accept
+        
+        tasks = [] # (i_smd, read_offset, read_size)
+        used_nbytes = 0
+        for i_smd in range(self.n_smd_files):
+            if self.use_smds[i_smd]: continue
+            i_evts = np.nonzero(is_L1 & (smd_batch.dgram_sizes[:, i_smd] > 0))[0]
+            if not i_evts.size: continue
+            d_sizes = smd_batch.sizes[i_evts, i_smd]
+            read_offsets, read_sizes, read_ids, positions = plan_reads(
+                    smd_batch.offsets[i_evts, i_smd], d_sizes, PS_BD_COALESCE_GAP)
+            self.bd_locs[i_evts, i_smd, 0] = read_ids
+            self.bd_locs[i_evts, i_smd, 1] = positions
+            tasks += [(i_smd, int(offset), int(size)) for offset, size in zip(read_offsets, read_sizes)]
+            used_nbytes += np.sum(d_sizes)
+
+        read_pool = _get_read_pool() if len(tasks) > 1 else None
+        fds = self.dm.fds
+        read = lambda task: self._pread(fds[task[0]], task[2], task[1])
+        if read_pool is not None:
+            chunks = list(read_pool.map(read, tasks))
+        else:
+            chunks = [read(task) for task in tasks]
+        for (i_smd, _, _), chunk in zip(tasks, chunks):
+            self.bd_reads[i_smd].append(chunk)
+        
+        en = time.time()
+        read_nbytes = sum([size for _, _, size in tasks])
+        logger.debug(f"event_manager: bd reads {len(tasks)} coalesced chunks {read_nbytes/1e6:.5f} MB ({used_nbytes/1e6:.5f} MB used) took {en-st:.2f} s")
+        self._inc_prometheus_counter('MB', read_nbytes/1e6)
+        self._inc_prometheus_counter('MB_used', used_nbytes/1e6)
+        self._inc_prometheus_counter('reads', len(tasks))
+        self._inc_prometheus_counter('seconds', en-st)
+
+    @s_bd_just_read.time()
+    @tracer.timed('bd_read')
     def _read_dgram_from_disk(self, dgram_i, offset_and_size):
         offset = offset_and_size[0,0]
         size   = offset_and_size[0,1]
@@ -92,24 +224,28 @@ class EventManager(object):
 
     @s_bd_gen_smd_batch.time()
     def _calc_offset_and_size(self, first_L1_pos, offsets, sizes):
-        for i_evt, event_bytes in enumerate(self.smd_events[first_L1_pos:]):
-            j_evt = i_evt + first_L1_pos
-            if event_bytes:
-                smd_evt = Event._from_bytes(self.smd_configs, event_bytes, run=self.dm.get_run())
-                for i_smd, smd_dgram in enumerate(smd_evt._dgrams):
-                    if self.use_smds[i_smd]:
-                        d_size = smd_dgram._size
-                        self.bigdata[i_smd].extend(smd_dgram)
-                    else:
-                        d_size = smd_evt.get_offset_and_size(i_smd)[0,1] # only need size
-                    if j_evt > 0:
-                        prev_d_offset = self.ofsz_batch[j_evt-1, i_smd, 0]
-                        prev_d_size = self.ofsz_batch[j_evt-1, i_smd, 1]
-                        d_offset = prev_d_offset + prev_d_size
-                    else:
-                        d_offset = 0
-                    self.ofsz_batch[j_evt, i_smd] = [d_offset, d_size] 
-                    sizes[i_smd] += d_size
+        """ Computes where each dgram is in the bigdata buffers and how 
+        much to read from each file starting from the first L1Accept.
+        
+        Bigdata buffers are laid out as [transitions before the first L1]
+        [everything read from disk (or copied smd dgrams for use_smds)].
+        """
+        smd_batch = self.smd_batch
+        d_sizes = smd_batch.sizes.copy()
+        use_smds = np.asarray(self.use_smds, dtype=bool)
+        d_sizes[:, use_smds] = smd_batch.dgram_sizes[:, use_smds]
+
+        self.ofsz_batch[:,:,1] = d_sizes
+        self.ofsz_batch[1:,:,0] = np.cumsum(d_sizes[:-1], axis=0)
+        sizes[:] = np.sum(d_sizes[first_L1_pos:], axis=0)
+        offsets[:] = smd_batch.offsets[first_L1_pos]
+        offsets[use_smds] = first_L1_pos
+
+        # smd dgrams are used as bigdata for use_smds files
+        for i_smd in np.nonzero(use_smds)[0]:
+            for j_evt in range(first_L1_pos, self.n_events):
+                if smd_batch.dgram_sizes[j_evt, i_smd]:
+                    self.bigdata[i_smd].extend(smd_batch.dgram_view(j_evt, i_smd))
 
     def _read_bigdata_in_chunk(self):
         """ Read bigdata chunks of 'size' bytes and store them in views
@@ -117,49 +253,31 @@ class EventManager(object):
         All non L1 dgrams are copied from smd_events and prepend
         directly to bigdata chunks.
         """
-        st = time.time()
         self.bigdata = []
         for i in range(self.n_smd_files):
             self.bigdata.append(bytearray())
         
-        offsets = [0] * self.n_smd_files
-        sizes = [0] * self.n_smd_files
+        offsets = np.zeros(self.n_smd_files, dtype=np.int64)
+        sizes = np.zeros(self.n_smd_files, dtype=np.int64)
         self.ofsz_batch = np.zeros((self.n_events, self.n_smd_files, 2), dtype=np.intp)
+        if not self.n_events: return
         
         # Look for first L1 event - copy all non L1 to bigdata buffers
-        first_L1_pos = -1
-        for i_evt, event_bytes in enumerate(self.smd_events):
-            if event_bytes:
-                smd_evt = Event._from_bytes(self.smd_configs, event_bytes, run=self.dm.get_run())
-                ofsz = smd_evt.get_offsets_and_sizes() 
-                if smd_evt.service() == TransitionId.L1Accept:
-                    for i_smd, smd_dgram in enumerate(smd_evt._dgrams):
-                        if self.use_smds[i_smd]:
-                            # use smd_event, offset indicates index of the first event to be used
-                            offsets[i_smd] = i_evt 
-                        else:
-                            offsets[i_smd] = ofsz[i_smd, 0]
-                    first_L1_pos = i_evt
-                    break
-                else:
-                    for smd_id, d in enumerate(smd_evt._dgrams):
-                        if not d: continue
-                        self.bigdata[smd_id].extend(d)
-
-                if i_evt > 0:
-                    self.ofsz_batch[i_evt,:,0] = self.ofsz_batch[i_evt-1,:,0] + self.ofsz_batch[i_evt-1,:,1]
-                self.ofsz_batch[i_evt,:,1] = ofsz[:,1]
+        is_L1 = self.smd_batch.services == TransitionId.L1Accept
+        if not np.any(is_L1): return
+        first_L1_pos = int(np.argmax(is_L1))
         
-        if first_L1_pos == -1: return
+        for i_evt in range(first_L1_pos):
+            for i_smd in range(self.n_smd_files):
+                if self.smd_batch.dgram_sizes[i_evt, i_smd]:
+                    self.bigdata[i_smd].extend(self.smd_batch.dgram_view(i_evt, i_smd))
 
         self._calc_offset_and_size(first_L1_pos, offsets, sizes)
-        en_batch = time.time()
         # If no data were filtered, we can assume that all bigdata
         # dgrams starting from the first offset are stored consecutively
         # in the file. We read a chunk of sum(all dgram sizes) and
         # store in a view.
         self._read_chunks_from_disk(self.dm.fds, offsets, sizes)
-        en = time.time()
             
     def __iter__(self):
         return self
@@ -173,20 +291,45 @@ class EventManager(object):
         if self.cn_events == self.n_events: 
             raise StopIteration
         
-        smd_evt = Event._from_bytes(self.smd_configs, self.smd_events[self.cn_events], run=self.dm.get_run())
-        if len(self.dm.xtc_files)==0 or smd_evt.service() != TransitionId.L1Accept:
+        if len(self.dm.xtc_files)==0 or \
+                self.smd_batch.services[self.cn_events] != TransitionId.L1Accept:
+            smd_evt = Event._from_bytes(self.smd_configs, self.smd_events[self.cn_events], run=self.dm.get_run())
             self.cn_events += 1
             self._inc_prometheus_counter('evts')
             return smd_evt
         
+        if self.filter_fn and PS_BD_COALESCE_GAP >= 0:
+            bd_dgrams = []
+            for smd_i in range(self.n_smd_files):
+                if not self.smd_batch.dgram_sizes[self.cn_events, smd_i]:
+                    bd_dgrams.append(None)
+                elif self.use_smds[smd_i]:
+                    bd_dgrams.append(dgram.Dgram(config=self.smd_configs[smd_i], 
+                        view=self.smd_batch.dgram_view(self.cn_events, smd_i)))
+                else:
+                    read_id, pos = self.bd_locs[self.cn_events, smd_i]
+                    bd_dgrams.append(dgram.Dgram(view=self.bd_reads[smd_i][read_id], 
+                        config=self.dm.configs[smd_i], offset=int(pos)))
+            bd_evt = Event(dgrams=bd_dgrams, run=self.dm.get_run())
+            self.cn_events += 1
+            self._inc_prometheus_counter('evts')
+            return bd_evt
+        
         if self.filter_fn:
             bd_dgrams = []
             read_size = 0
-            for smd_i, smd_dgram in enumerate(smd_evt._dgrams):
+            for smd_i in range(self.n_smd_files):
                 if self.use_smds[smd_i]:
-                    bd_dgrams.append(smd_dgram)
+                    if self.smd_batch.dgram_sizes[self.cn_events, smd_i]:
+                        bd_dgrams.append(dgram.Dgram(config=self.smd_configs[smd_i], 
+                            view=self.smd_batch.dgram_view(self.cn_events, smd_i)))
+                    else:
+                        bd_dgrams.append(None)
                 else:
-                    offset_and_size = smd_evt.get_offset_and_size(smd_i)
+                    offset_and_size = np.array([[self.smd_batch.offsets[self.cn_events, smd_i], 
+                        self.smd_batch.sizes[self.cn_events, smd_i]]])
+                    if not self.smd_batch.dgram_sizes[self.cn_events, smd_i]:
+                        offset_and_size[:] = 0 # missing dgram
                     read_size += offset_and_size[0,1]
                     bd_dgrams.append(self._read_dgram_from_disk(smd_i, offset_and_size))
             bd_evt = Event(dgrams=bd_dgrams, run=self.dm.get_run())
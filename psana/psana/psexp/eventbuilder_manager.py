@@ -24,6 +24,8 @@ class EventBuilderManager(object):
                     destination         = self.destination,
                     prometheus_counter  = self.c_filter,
                     run                 = self.run) 
+            # timestamps of the first and last event of this build (not
+            # the smd chunk's min/max, see SmdReaderManager.max_ts)
             self.min_ts = self.eb.min_ts
             self.max_ts = self.eb.max_ts
             if self.eb.nevents==0 and self.eb.nsteps==0: break
@@ -1,11 +1,79 @@
 from psana.psexp import EventManager
 import types
+import os
+import time
+import queue
+import threading
+
+
+class BatchPrefetcher(object):
+    """ Creates EventManagers for upcoming batches in a background thread.
+
+    Creating an EventManager requests the next smd batch (get_smd) and reads
+    its bigdata, so both overlap with analysis of the current batch. At most
+    depth batches (including the one being created) are ahead of the 
+    consumer and no new batch is started while ready batches hold more 
+    than max_bytes.
+    """
+    def __init__(self, create_evt_man, depth, max_bytes):
+        self.create_evt_man = create_evt_man
+        self.depth          = depth
+        self.max_bytes      = max_bytes
+        self.held_bytes     = 0
+        self.n_ahead        = 0     # batches created or being created, not yet taken
+        self.stopped        = False
+        self.ready          = queue.Queue()
+        self.cv             = threading.Condition()
+        self.t              = threading.Thread(name='BatchPrefetcher', target=self._run, daemon=True)
+        self.t.start()
+
+    def _run(self):
+        try:
+            while True:
+                with self.cv:
+                    while not self.stopped and (self.n_ahead >= self.depth or self.held_bytes >= self.max_bytes):
+                        self.cv.wait()
+                    if self.stopped: return
+                    self.n_ahead += 1
+                evt_man = self.create_evt_man()
+                if evt_man is None:
+                    self.ready.put((None, 0))
+                    return
+                nbytes = evt_man.nbytes
+                with self.cv:
+                    self.held_bytes += nbytes
+                self.ready.put((evt_man, nbytes))
+        except Exception as e:
+            self.ready.put((e, 0))
+
+    def get(self):
+        """ Returns the next EventManager (None when there's no more data). """
+        evt_man, nbytes = self.ready.get()
+        if isinstance(evt_man, Exception):
+            raise evt_man
+        with self.cv:
+            self.held_bytes -= nbytes
+            self.n_ahead -= 1
+            self.cv.notify()
+        return evt_man
+
+    def close(self):
+        """ Stops prefetching (e.g. the user left the event loop early):
+        waits for the batch being created and drops the ready ones. """
+        with self.cv:
+            self.stopped = True
+            self.cv.notify()
+        self.t.join()
+        while not self.ready.empty():
+            self.ready.get()
+        self.held_bytes = self.n_ahead = 0
+
 
 class Events:
     """
     Needs prom_man, configs, dm, filter_callback
     """
-    def __init__(self, configs, dm, dsparms, filter_callback=None, get_smd=None, smdr_man=None):
+    def __init__(self, configs, dm, dsparms, filter_callback=None, get_smd=None, smdr_man=None, prefetch_depth=0):
         self.dm             = dm                   
         self.configs        = configs
         self.dsparms        = dsparms
@@ -19,6 +87,46 @@ class Events:
         self.c_read         = self.prom_man.get_metric('psana_bd_read')
         self.st_yield       = 0
         self.en_yield       = 0
+        self.c_ana          = self.prom_man.get_metric('psana_bd_ana')
+        
+        # Bigdata readahead (RunParallel) - prefetch_depth batches are
+        # requested and read in the background using up to PS_BD_PREFETCH_MB.
+        self.prefetcher     = None
+        if self.get_smd and prefetch_depth > 0:
+            max_bytes = float(os.environ.get('PS_BD_PREFETCH_MB', 1000)) * 1e6
+            self.prefetcher = BatchPrefetcher(self._create_evt_man, prefetch_depth, max_bytes)
+    
+    def _create_evt_man(self):
+        """ Returns EventManager of the next smd batch (None when done) """
+        smd_batch = self.get_smd()
+        if smd_batch == bytearray():
+            return None
+
+        return EventManager(smd_batch, 
+                self.configs, 
+                self.dm, 
+                filter_fn           = self.filter_callback,
+                prometheus_counter  = self.c_read,
+                max_retries         = self.max_retries,
+                use_smds            = self.dsparms.use_smds,
+                )
+
+    def close(self):
+        """ Stops the bigdata readahead thread (if any) """
+        if self.prefetcher:
+            self.prefetcher.close()
+            self.prefetcher = None
+
+    def _next_evt_man(self):
+        if not self.prefetcher:
+            return self._create_evt_man()
+        
+        # Only time spent blocked here is not overlapped with analysis
+        st = time.time()
+        evt_man = self.prefetcher.get()
+        en = time.time()
+        self.c_ana.labels('io_blocked_seconds', 'None').inc(en-st)
+        return evt_man
 
     def __iter__(self):
         return self
@@ -58,18 +166,11 @@ class Events:
                 if not any(evt._dgrams): return self.__next__()
                 return evt
             except StopIteration: 
-                smd_batch = self.get_smd()
-                if smd_batch == bytearray():
+                evt_man = self._next_evt_man()
+                if evt_man is None:
                     raise StopIteration
 
-                self._evt_man = EventManager(smd_batch, 
-                        self.configs, 
-                        self.dm, 
-                        filter_fn           = self.filter_callback,
-                        prometheus_counter  = self.c_read,
-                        max_retries         = self.max_retries,
-                        use_smds            = self.dsparms.use_smds,
-                        )
+                self._evt_man = evt_man
                 evt = next(self._evt_man)
                 if not any(evt._dgrams): return self.__next__()
                 
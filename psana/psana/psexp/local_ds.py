@@ -0,0 +1,222 @@
+import os
+import numpy as np
+from psana.psexp import *
+from psana.psexp.local_node import LocalCommunicators, LocalEventBuilder, LocalBigDataNode
+from psana.psexp.null_ds import NullRun
+from psana import dgram
+from psana.event import Event
+from psana.dgrammanager import DgramManager
+from psana.smalldata import SmallData
+from psana.psexp.tracer import tracer
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+# processes are forked once - later DataSources reuse them (see local_node.py)
+_comms = None
+
+def local_comms():
+    global _comms
+    if _comms is None:
+        n_workers = int(os.environ.get('PS_LOCAL_WORKERS', max(1, (os.cpu_count() or 2) - 1)))
+        n_srvs = int(os.environ.get('PS_SRV_NODES', 1))
+        slot_bytes = int(float(os.environ.get('PS_LOCAL_SLOT_MB', 64)) * 1e6)
+        if n_workers < 1:
+            raise ValueError(f'local_ds: PS_LOCAL_WORKERS must be at least 1 (got {n_workers})')
+        _comms = LocalCommunicators(n_workers, n_srvs, slot_bytes)
+    return _comms
+
+
+class RunLocal(Run):
+    """ Yields list of events from multiple smd/bigdata files using
+    local worker processes (see local_node.py). """
+
+    def __init__(self, ds, run_evt):
+        super(RunLocal, self).__init__(ds)
+        self.ds         = ds
+        self.comms      = ds.comms
+        self._evt       = run_evt
+        self.beginruns  = run_evt._dgrams
+        self.configs    = ds._configs
+
+        self._get_runinfo()
+        self.esm = EnvStoreManager(self.configs)
+        self.esm.update_by_event(self._evt)
+
+    def events(self):
+        evt_iter = self.start()
+        for evt in evt_iter:
+            if evt.service() != TransitionId.L1Accept:
+                self.esm.update_by_event(evt)
+                continue
+            st = time.monotonic()
+            yield evt
+            en = time.monotonic()
+            tracer.add('ana', st, en)
+            self.c_ana.labels('seconds','None').inc(en-st)
+            self.c_ana.labels('batches','None').inc()
+
+    def steps(self):
+        evt_iter = self.start()
+        for evt in evt_iter:
+            if evt.service() == TransitionId.BeginStep:
+                yield Step(evt, evt_iter, self.esm)
+
+    def start(self):
+        """ Request data for this run"""
+        nodetype = self.comms.node_type()
+        if nodetype == 'smd0':
+            self.ds.eb_node.start()
+        elif nodetype == 'bd':
+            for evt in self.ds.bd_node.start():
+                yield evt
+
+
+class LocalDataSource(DataSourceBase):
+    """ Runs smd0/EventBuilder in this process and bigdata cores in
+    forked worker processes on the same machine (PS_PARALLEL=local) -
+    the MPIDataSource roles without MPI. Like with mpirun, every process
+    runs the user script: only workers get events and, with
+    ds.smalldata(), are the clients of the smalldata servers.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(LocalDataSource, self).__init__(**kwargs)
+
+        self.comms = local_comms()
+        self.nodetype = self.comms.node_type()
+        self.smd_fds = None
+        self._worker_stats = {}   # rank 0: {rank: counters}, workers: own counters
+
+        if self.comms.n_srvs > 0:
+            self.smalldata_obj = SmallData(local_comms=self.comms)
+        else:
+            self.smalldata_obj = None
+
+        if self.nodetype == 'srv':
+            self.runnum_list = []
+        else:
+            if self.nodetype == 'smd0':
+                super()._setup_runnum_list()
+            else:
+                self.runnum_list = None
+                self.xtc_path    = None
+            self.runnum_list, self.xtc_path = self.comms.psana_comm.bcast(
+                    (self.runnum_list, self.xtc_path), root=0)
+        self.runnum_list_index = 0
+
+        self._start_prometheus_client(mpi_rank=self.comms.world_rank)
+        # rank 0 merges the traces after the other processes exited
+        tracer.start(self.comms.world_rank, self.nodetype, 
+                barrier=self.comms.join if self.nodetype == 'smd0' else None)
+        self._setup_run()
+
+    def __del__(self):
+        if self.nodetype == 'smd0':
+            super()._close_opened_smd_files()
+        self._end_prometheus_client(mpi_rank=self.comms.world_rank)
+
+    def worker_stats(self):
+        """ Returns {worker rank: counters} reported by the workers so far
+        (in rank 0, see LocalBigDataNode) or a worker's own counters. """
+        if self.nodetype == 'bd':
+            return {self.comms.bd_rank(): dict(self._worker_stats)}
+        return {rank: dict(stats) for rank, stats in self._worker_stats.items()}
+
+    def _setup_configs(self):
+        """ Creates and broadcasts configs
+        only called by _setup_run()
+        """
+        g_ts = self.prom_man.get_metric("psana_timestamp")
+        if self.nodetype == 'smd0':
+            super()._close_opened_smd_files()
+            self.smd_fds  = np.array([os.open(smd_file, os.O_RDONLY) for smd_file in self.smd_files], dtype=np.int32)
+            logger.debug(f'local_ds: smd0 opened smd_fds: {self.smd_fds}')
+            self.smdr_man = SmdReaderManager(self.smd_fds, self.dsparms)
+            self._configs = self.smdr_man.get_next_dgrams()
+            super()._setup_det_class_table()
+            super()._set_configinfo()
+            g_ts.labels("first_event").set(time.time())
+            self.comms.psana_comm.bcast([bytes(config) for config in self._configs], root=0)
+        else:
+            configs = self.comms.psana_comm.bcast(None, root=0)
+            self._configs = [dgram.Dgram(view=bytearray(config), offset=0) for config in configs]
+            g_ts.labels("first_event").set(time.time())
+            self._setup_det_class_table()
+            self._set_configinfo()
+
+    def _setup_run(self):
+        if self.runnum_list_index == len(self.runnum_list):
+            return False
+
+        runnum = self.runnum_list[self.runnum_list_index]
+        self.runnum_list_index += 1
+
+        files = None
+        if self.nodetype == 'smd0':
+            super()._setup_run_files(runnum)
+            super()._apply_detector_selection()
+            files = (self.xtc_files, self.smd_files, self.dsparms.use_smds)
+        self.xtc_files, self.smd_files, self.dsparms.use_smds = \
+                self.comms.psana_comm.bcast(files, root=0)
+
+        self._setup_configs()
+        self.dm = DgramManager(self.xtc_files, configs=self._configs)
+
+        if self.nodetype == 'smd0':
+            self.eb_node = LocalEventBuilder(self.comms, self._configs, self.smdr_man, 
+                    self.dsparms, self.dm, self._worker_stats)
+        else:
+            self.bd_node = LocalBigDataNode(self.comms, self._configs, self.dsparms, 
+                    self.dm, self._worker_stats)
+
+        return True
+
+    def _setup_beginruns(self):
+        """ Determines if there is a next run as
+        1) New run found in the same smalldata files
+        2) New run found in the new smalldata files
+        """
+        while True:
+            if self.nodetype == 'smd0':
+                dgrams = self.smdr_man.get_next_dgrams()
+                views = None if dgrams is None else [bytes(d) for d in dgrams]
+                self.comms.psana_comm.bcast(views, root=0)
+            else:
+                views = self.comms.psana_comm.bcast(None, root=0)
+                if views is not None:
+                    dgrams = [dgram.Dgram(view=bytearray(d), config=config, offset=0) \
+                            for d, config in zip(views, self._configs)]
+
+            if views is None: return False
+
+            if dgrams[0].service() == TransitionId.BeginRun:
+                self.beginruns = dgrams
+                return True
+        # end while True
+
+    def _setup_run_calibconst(self):
+        if self.nodetype == 'smd0':
+            super()._setup_run_calibconst()
+        else:
+            self.dsparms.calibconst = None
+
+        self.dsparms.calibconst = self.comms.psana_comm.bcast(self.dsparms.calibconst, root=0)
+
+    def _start_run(self):
+        if self._setup_beginruns():   # try to get next run from current files
+            self._setup_run_calibconst()
+            return True
+        elif self._setup_run():       # try to get next run from next files
+            if self._setup_beginruns():
+                self._setup_run_calibconst()
+                return True
+
+    def runs(self):
+        if self.nodetype == 'srv':
+            yield NullRun()
+            return
+        while self._start_run():
+            run = RunLocal(self, Event(dgrams=self.beginruns))
+            yield run
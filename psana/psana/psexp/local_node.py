@@ -0,0 +1,395 @@
+import os
+import sys
+import mmap
+import time
+import queue
+import atexit
+import signal
+import operator
+import multiprocessing
+import numpy as np
+from psana.psexp import *
+from psana.psexp.node import StepHistory, repack_for_bd
+from psana.psexp.tracer import tracer
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Local parallel mode (PS_PARALLEL=local) runs the MPI node types on one
+# machine without MPI. The processes are forked when the first DataSource
+# is created and, as with mpirun, all of them run the rest of the user script:
+#
+#   rank 0          smd0 and EventBuilder (this process)
+#   rank 1..n       bigdata workers (PS_LOCAL_WORKERS, default: no. of cores - 1)
+#   srv 0..m-1      smalldata servers (PS_SRV_NODES, default: 1)
+#
+# Workers ask rank 0 for batches of smd events. A batch is handed over in
+# a shared memory slot of the worker, only the request and the size of
+# the batch go through queues.
+
+ANY_SOURCE = -1
+UNDEFINED  = -32766     # rank of a process that is not in a comm (as MPI.UNDEFINED)
+
+TAG_DATA    = 0
+TAG_BCAST   = 1
+TAG_REDUCE  = 2
+TAG_BARRIER = 3
+
+
+class LocalComm(object):
+    """ Message passing between forked processes with the mpi4py
+    communicator methods that psana uses on pickled objects (send, recv,
+    bcast, reduce, barrier). Each member has a multiprocessing queue as
+    its inbox. A comm is created before the fork and each member process
+    sets its rank afterwards (see set_rank).
+    """
+    poll_seconds = 1
+
+    def __init__(self, size, ctx=None):
+        if ctx is None: ctx = multiprocessing.get_context('fork')
+        self.size       = size
+        self.rank       = UNDEFINED
+        self.inboxes    = [ctx.Queue() for i in range(size)]
+        self.pending    = []      # received messages not asked for yet
+        self.check_peers = None   # called while waiting, raises if peers are gone
+
+    def set_rank(self, rank):
+        self.rank = rank
+
+    def Get_rank(self):
+        return self.rank
+
+    def Get_size(self):
+        return self.size
+
+    def send(self, obj, dest, tag=TAG_DATA):
+        self.inboxes[dest].put((self.rank, tag, obj))
+
+    def _match(self, msg, source, tag):
+        return (source == ANY_SOURCE or msg[0] == source) and msg[1] == tag
+
+    def recv(self, source=ANY_SOURCE, tag=TAG_DATA):
+        for i, msg in enumerate(self.pending):
+            if self._match(msg, source, tag):
+                del self.pending[i]
+                return msg[2]
+
+        while True:
+            try:
+                msg = self.inboxes[self.rank].get(timeout=self.poll_seconds)
+            except queue.Empty:
+                if self.check_peers: self.check_peers()
+                continue
+            if self._match(msg, source, tag):
+                return msg[2]
+            self.pending.append(msg)
+
+    def bcast(self, obj, root=0):
+        if self.rank == root:
+            for rank in range(self.size):
+                if rank != root: self.send(obj, rank, tag=TAG_BCAST)
+            return obj
+        return self.recv(source=root, tag=TAG_BCAST)
+
+    def reduce(self, sendobj, op=operator.add, root=0):
+        if self.rank != root:
+            self.send(sendobj, root, tag=TAG_REDUCE)
+            return None
+        result = sendobj
+        for rank in range(self.size):
+            if rank != root: result = op(result, self.recv(source=rank, tag=TAG_REDUCE))
+        return result
+
+    def barrier(self):
+        if self.rank == 0:
+            for rank in range(1, self.size): self.recv(source=rank, tag=TAG_BARRIER)
+            for rank in range(1, self.size): self.send(None, rank, tag=TAG_BARRIER)
+        else:
+            self.send(None, 0, tag=TAG_BARRIER)
+            self.recv(source=0, tag=TAG_BARRIER)
+
+
+class LocalCommunicators(object):
+    """ Forks the processes of a local run and holds their comms, the
+    counterpart of node.Communicators (see the node types above).
+
+    Batches for a worker are written to its slot (shared anonymous mmap
+    of PS_LOCAL_SLOT_MB) - larger batches are sent through the queue.
+    """
+    def __init__(self, n_workers, n_srvs, slot_bytes):
+        self.n_workers  = n_workers
+        self.n_srvs     = n_srvs
+        ctx = multiprocessing.get_context('fork')
+
+        self.psana_comm     = LocalComm(n_workers + 1, ctx)
+        self.client_comm    = LocalComm(n_workers, ctx)
+        self.srv_group      = LocalComm(n_srvs, ctx) # only for ranks (no messages)
+        self.smalldata_comm = LocalComm(n_srvs + n_workers, ctx)
+        self.srv_comms      = [LocalComm(1 + len(range(i, n_workers, n_srvs)), ctx) for i in range(n_srvs)]
+        self.slots          = [mmap.mmap(-1, slot_bytes) for i in range(n_workers)]
+
+        self.parent_pid = os.getpid()
+        self.pids       = []
+        self.aborted    = False
+        self._nodetype  = 'smd0'
+        self.world_rank = 0
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for i in range(n_workers + n_srvs):
+            pid = os.fork()
+            if pid == 0:
+                self.pids = []
+                self.world_rank = i + 1
+                self._nodetype = 'bd' if i < n_workers else 'srv'
+                break
+            self.pids.append(pid)
+
+        self._set_ranks()
+        for comm in self._comms():
+            comm.check_peers = self.check_peers
+        if self._nodetype == 'smd0':
+            # like MPI_Abort for an exception in rank 0 (others could wait forever)
+            excepthook = sys.excepthook
+            def abort_on_exception(*args):
+                self.abort()
+                excepthook(*args)
+            sys.excepthook = abort_on_exception
+            atexit.register(self.join)
+        logger.debug(f'local_node: rank {self.world_rank} pid {os.getpid()} is {self._nodetype}')
+
+    def _comms(self):
+        return [self.psana_comm, self.client_comm, self.smalldata_comm] + self.srv_comms
+
+    def _set_ranks(self):
+        if self._nodetype == 'smd0':
+            self.psana_comm.set_rank(0)
+        elif self._nodetype == 'bd':
+            client_rank = self.world_rank - 1
+            self.psana_comm.set_rank(self.world_rank)
+            self.client_comm.set_rank(client_rank)
+            self.smalldata_comm.set_rank(self.n_srvs + client_rank)
+            if self.n_srvs:
+                self.srv_comms[client_rank % self.n_srvs].set_rank(1 + client_rank // self.n_srvs)
+        else:
+            srv_rank = self.world_rank - 1 - self.n_workers
+            self.srv_group.set_rank(srv_rank)
+            self.smalldata_comm.set_rank(srv_rank)
+            self.srv_comms[srv_rank].set_rank(0)
+
+    def node_type(self):
+        return self._nodetype
+
+    def bd_rank(self):
+        return self.psana_comm.Get_rank()
+
+    def smalldata_comms(self):
+        """ Returns smalldata process type, smalldata comm, client comm
+        and the comm with this process's server (see SmallData). """
+        if self._nodetype == 'bd' and self.n_srvs:
+            client_rank = self.client_comm.Get_rank()
+            return 'client', self.smalldata_comm, self.client_comm, self.srv_comms[client_rank % self.n_srvs]
+        elif self._nodetype == 'srv':
+            srv_rank = self.srv_group.Get_rank()
+            return 'server', self.smalldata_comm, self.client_comm, self.srv_comms[srv_rank]
+        return 'other', None, None, None
+
+    def check_peers(self):
+        """ Raises if the parent process is gone (workers and servers) or
+        a child exited with an error (rank 0) - this would block forever."""
+        if self._nodetype != 'smd0':
+            if os.getppid() != self.parent_pid:
+                raise RuntimeError(f'local_node: rank {self.world_rank} lost its parent process')
+            return
+        for pid in self.pids[:]:
+            done_pid, status = os.waitpid(pid, os.WNOHANG)
+            if done_pid == 0: continue
+            self.pids.remove(pid)
+            if status != 0:
+                raise RuntimeError(f'local_node: process {pid} exited with status {status}')
+
+    def abort(self):
+        """ Terminates the workers and servers (rank 0). """
+        self.aborted = True
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def join(self):
+        """ Waits for the workers and servers (at exit of rank 0). When one
+        of them fails, the others are terminated and rank 0 exits with 1."""
+        failed = self.aborted
+        while self.pids:
+            pid, status = os.wait()
+            if pid not in self.pids: continue
+            self.pids.remove(pid)
+            if status != 0 and not failed:
+                sys.stderr.write(f'local_node: process {pid} exited with status {status}\n')
+                failed = True
+                self.abort()
+        if failed:
+            sys.stderr.flush()
+            os._exit(1)
+
+    def send_batch(self, batch, dest):
+        """ Sends batch to worker dest, which asked for it (and is done with its slot). """
+        nbytes = memoryview(batch).nbytes
+        slot = self.slots[dest - 1]
+        if nbytes <= len(slot):
+            slot[:nbytes] = batch
+            self.psana_comm.send(nbytes, dest)
+        else:
+            self.psana_comm.send(bytes(batch), dest)
+
+    def recv_batch(self):
+        """ Returns batch from rank 0 (empty bytearray means stop). """
+        msg = self.psana_comm.recv(source=0)
+        if isinstance(msg, int):
+            with memoryview(self.slots[self.bd_rank() - 1]) as slot:
+                return bytearray(slot[:msg])
+        return bytearray(msg)
+
+
+class LocalEventBuilder(object):
+    """ Smd0 and EventBuilder of a local run. Reads smd chunks, builds
+    events and hands batches of them to the workers that ask for them
+    (same batches as EventBuilderNode sends to bigdata nodes). """
+    def __init__(self, comms, configs, smdr_man, dsparms, dm, worker_stats):
+        self.comms      = comms
+        self.configs    = configs
+        self.smdr_man   = smdr_man
+        self.dsparms    = dsparms
+        self.dm         = dm
+        self.n_workers  = comms.n_workers
+        self.step_hist  = StepHistory(self.n_workers + 1, len(self.configs))
+        self.waiting    = []      # workers that asked but got nothing yet
+        self.worker_stats = worker_stats # latest stats reported by each worker
+        self.c_sent     = dsparms.prom_man.get_metric('psana_eb_sent')
+
+    def _request_rank(self):
+        st_req = time.monotonic()
+        rank, stats = self.comms.psana_comm.recv(source=ANY_SOURCE)
+        en_req = time.monotonic()
+        tracer.add('wait', st_req, en_req, peer=rank)
+        self.worker_stats[rank] = stats
+        self.c_sent.labels('seconds', rank).inc(en_req - st_req)
+        return rank
+
+    def _send(self, dest, smd_batch, step_batch, eb_man):
+        missing_step_views = self.step_hist.get_buffer(dest)
+        batch = repack_for_bd(smd_batch, missing_step_views, self.configs, client=dest)
+        st_send = time.monotonic()
+        self.comms.send_batch(batch, dest)
+        tracer.add('send', st_send, time.monotonic(), peer=dest)
+
+        logger.debug(f'local_node: eb sent {eb_man.eb.nevents} events ({memoryview(batch).nbytes} bytes) to bd{dest}')
+        self.c_sent.labels('evts', dest).inc(eb_man.eb.nevents)
+        self.c_sent.labels('batches', dest).inc()
+        self.c_sent.labels('MB', dest).inc(memoryview(batch).nbytes/1e6)
+
+        if eb_man.eb.nsteps > 0 and memoryview(step_batch).nbytes > 0:
+            step_pf = PacketFooter(view=step_batch)
+            self.step_hist.extend_buffers(step_pf.split_packets(), dest, as_event=True)
+
+    def _send_batches(self, smd_batch_dict, step_batch_dict, eb_man):
+        # Batch for any worker (0) or batches for the destination workers
+        destinations = np.asarray(list(smd_batch_dict.keys()))
+        if any(destinations > self.n_workers):
+            logger.debug(f"Found invalid destination ({destinations}). Must be <= {self.n_workers} (#workers)")
+            return False
+
+        while smd_batch_dict:
+            if 0 in smd_batch_dict:
+                dest, key = (self.waiting.pop() if self.waiting else self._request_rank()), 0
+            else:
+                dest = next((rank for rank in self.waiting if rank in smd_batch_dict), None)
+                if dest is None:
+                    dest = self._request_rank()
+                    if dest not in smd_batch_dict:
+                        self.waiting.append(dest)
+                        continue
+                else:
+                    self.waiting.remove(dest)
+                key = dest
+            smd_batch, _ = smd_batch_dict.pop(key)
+            step_batch, _ = step_batch_dict.pop(key)
+            self._send(dest, smd_batch, step_batch, eb_man)
+        return True
+
+    def start(self):
+        st_read = time.monotonic()
+        for smd_chunk, step_chunk in self.smdr_man.chunks():
+            st_build = time.monotonic()
+            tracer.add('read', st_read, st_build)
+            if not (smd_chunk or step_chunk): break
+
+            # All chunks come to this EventBuilder so there are no missing
+            # steps to add (see Smd0) and step_chunk is not needed.
+            eb_man = EventBuilderManager(smd_chunk, self.configs, self.dsparms, self.dm.get_run())
+            valid = True
+            for smd_batch_dict, step_batch_dict in eb_man.batches():
+                tracer.add('build', st_build, time.monotonic())
+                valid = self._send_batches(smd_batch_dict, step_batch_dict, eb_man)
+                if not valid: break
+                st_build = time.monotonic()
+
+            if not valid or self.smdr_man.smdr.found_endrun():
+                logger.debug("local_node: eb found_endrun")
+                break
+            st_read = time.monotonic()
+
+        self._send_missing_steps_and_stop()
+        for rank, stats in sorted(self.worker_stats.items()):
+            logger.debug(f'local_node: bd{rank} {stats}')
+
+    def _send_missing_steps_and_stop(self):
+        n_stopped = 0
+        while n_stopped < self.n_workers:
+            dest = self.waiting.pop() if self.waiting else self._request_rank()
+            missing_step_views = self.step_hist.get_buffer(dest)
+            batch = repack_for_bd(bytearray(), missing_step_views, self.configs, client=dest)
+            if batch:
+                self.comms.send_batch(batch, dest)
+            else:
+                self.comms.send_batch(bytearray(), dest)
+                n_stopped += 1
+
+
+class LocalBigDataNode(object):
+    """ Worker of a local run: gets batches from rank 0 (LocalEventBuilder)
+    and reads their bigdata, like BigDataNode. """
+    def __init__(self, comms, configs, dsparms, dm, stats):
+        self.comms      = comms
+        self.configs    = configs
+        self.dsparms    = dsparms
+        self.dm         = dm
+        self.bd_wait_eb = PrometheusManager.get_metric('psana_bd_wait_eb')
+        # counters of this worker - reported to rank 0 with each request
+        self.stats      = stats
+        for key in ('batches', 'events', 'MB', 'wait_seconds'):
+            self.stats.setdefault(key, 0)
+
+    def start(self):
+        rank = self.comms.bd_rank()
+
+        def get_smd():
+            st_req = time.monotonic()
+            self.comms.psana_comm.send((rank, dict(self.stats)), 0)
+            batch = self.comms.recv_batch()
+            en_req = time.monotonic()
+            tracer.add('wait', st_req, en_req, peer=0)
+            self.bd_wait_eb.labels('seconds', rank).inc(en_req - st_req)
+            self.stats['wait_seconds'] += en_req - st_req
+            if batch:
+                self.stats['batches'] += 1
+                self.stats['events'] += PacketFooter(view=batch).n_packets
+                self.stats['MB'] += memoryview(batch).nbytes / 1e6
+            return batch
+
+        events = Events(self.configs, self.dm, self.dsparms,
+                filter_callback=self.dsparms.filter, get_smd=get_smd)
+
+        for evt in events:
+            yield evt
@@ -6,6 +6,8 @@ from psana import dgram
 from psana.event import Event
 from psana.dgrammanager import DgramManager
 from psana.smalldata import SmallData
+from psana.psexp.tracer import tracer
+from psana.psexp.prometheus_manager import MetricsAggregator, PS_PROMETHEUS_AGGREGATE
 import time
 
 import logging
@@ -40,9 +42,10 @@ class RunParallel(Run):
             if evt.service() != TransitionId.L1Accept:
                 self.esm.update_by_event(evt)
                 continue
-            st = time.time()
+            st = time.monotonic()
             yield evt
-            en = time.time()
+            en = time.monotonic()
+            tracer.add('ana', st, en)
             self.c_ana.labels('seconds','None').inc(en-st)
             self.c_ana.labels('batches','None').inc()
         
@@ -114,7 +117,11 @@ class MPIDataSource(DataSourceBase):
         self.xtc_path    = comm.bcast(self.xtc_path, root=0)
         self.runnum_list_index = 0
 
-        self._start_prometheus_client(mpi_rank=rank)
+        aggregator = None
+        if PS_PROMETHEUS_AGGREGATE and nodetype != 'srv': # servers push their own
+            aggregator = MetricsAggregator(nodetype, rank)
+        self._start_prometheus_client(mpi_rank=rank, aggregator=aggregator)
+        tracer.start(self.comms.world_rank, nodetype, n_ranks=self.comms.world_size)
         self._setup_run()
 
     def __del__(self):
@@ -5,6 +5,8 @@ from psana.dgram import Dgram
 import os
 
 from psana.psexp.tools import mode
+from psana.psexp.tracer import tracer
+from psana.psexp.prometheus_manager import PS_PROMETHEUS_AGGREGATE
 if mode == 'mpi':
     from mpi4py import MPI
 
@@ -52,6 +54,8 @@ class Communicators(object):
     color = 0
     _nodetype = None
     bd_comm = None
+    bd_metrics_comm = None
+    smd_metrics_comm = None
 
 
     def __init__(self):
@@ -105,6 +109,13 @@ class Communicators(object):
             self._nodetype = 'smd0'
         elif self.world_rank>=self.psana_group.Get_size():
             self._nodetype = 'srv'
+
+        # Separate comms for metrics sent to group leaders (see MetricsAggregator)
+        if PS_PROMETHEUS_AGGREGATE:
+            if self.bd_comm is not None:
+                self.bd_metrics_comm = self.bd_comm.Dup()
+            if self.smd_comm != MPI.COMM_NULL:
+                self.smd_metrics_comm = self.smd_comm.Dup()
     
 
     def bd_group(self):
@@ -201,6 +212,47 @@ def repack_for_eb(smd_chunk, step_views, configs):
 
 
 
+def repack_segments_for_eb(smd_segments, step_views, configs):
+    """ Same as repack_for_eb but for an smd chunk given as a list of 
+    segments ([smd0, smd1, ..., footer]). Step views are placed in front 
+    of each smd view by adding them as segments - no data are copied.
+    """
+    if step_views:
+        if smd_segments:
+            smd_views = smd_segments[:-1]
+        else:
+            smd_views = [bytearray() for i in range(len(step_views))]
+        
+        new_chunk_pf = PacketFooter(n_packets=len(step_views))
+        new_segments = []
+        for i, (smd_view, step_view) in enumerate(zip(smd_views, step_views)):
+            new_segments.extend([step_view, smd_view])
+            new_chunk_pf.set_size(i, memoryview(step_view).nbytes + memoryview(smd_view).nbytes)
+        new_segments.append(new_chunk_pf.footer)
+        return new_segments
+    else:
+        return smd_segments
+
+
+
+def send_segments(comm, segments, dest):
+    """ Sends a list of buffers as one message using an hindexed 
+    datatype over their addresses (no copy to a contiguous buffer).
+    The receiver sees a plain byte message.
+    """
+    segments = [segment for segment in segments if memoryview(segment).nbytes > 0]
+    if not segments:
+        comm.Send(bytearray(), dest=dest)
+        return
+    blocklengths = [memoryview(segment).nbytes for segment in segments]
+    displacements = [MPI.Get_address(segment) for segment in segments]
+    dtype = MPI.BYTE.Create_hindexed(blocklengths, displacements)
+    dtype.Commit()
+    comm.Send([MPI.BOTTOM, 1, dtype], dest=dest)
+    dtype.Free()
+
+
+
 def repack_for_bd(smd_batch, step_views, configs, client=-1):
     """ EventBuilder Node uses this to prepend missing step views 
     to the smd_batch. Unlike repack_for_eb (used by Smd0), this output 
@@ -229,12 +281,7 @@ def repack_for_bd(smd_batch, step_views, configs, client=-1):
             n_steps += 1
         
         # Create new batch with total_events = smd_batch_events + step_events 
-        new_batch_pf = PacketFooter(n_packets = batch_pf.n_packets + n_steps)
-        for i in range(n_steps):
-            new_batch_pf.set_size(i, step_sizes[i])
-        
-        for i in range(n_steps, new_batch_pf.n_packets):
-            new_batch_pf.set_size(i, batch_pf.get_size(i-n_steps))
+        new_batch_pf = PacketFooter.from_sizes(np.concatenate([step_sizes, batch_pf.sizes]))
 
         new_batch = bytearray()
         new_batch.extend(steps)
@@ -258,13 +305,26 @@ class Smd0(object):
         self.step_hist = StepHistory(self.comms.smd_size, len(self.configs))
         
         # Collecting Smd0 performance using prometheus
+        self.prom_man = dsparms.prom_man
         self.c_sent = dsparms.prom_man.get_metric('psana_smd0_sent')
+        self.aggregator = dsparms.prom_man.aggregator
+
+        # Max. no. of outstanding Isends in pipelined mode (0 = blocking mode)
+        self.pipeline_depth = int(os.environ.get('PS_SMD_PIPELINE_DEPTH', 0))
+        # Send smd data straight from SmdReader buffers (blocking mode only)
+        self.zerocopy = int(os.environ.get('PS_SMD_ZEROCOPY', 0)) > 0
+        self.read_seconds = 0
+        self.overlap_seconds = 0
         
     def start(self):
-        rankreq = np.empty(1, dtype='i')
-        waiting_ebs = []
+        if self.pipeline_depth > 0:
+            self._start_pipelined()
+            return
 
-        for (smd_chunk, step_chunk) in self.smdr_man.chunks():
+        rankreq = np.empty(2, dtype='i') # [eb rank, eb wait time (us)]
+
+        st_read = time.monotonic()
+        for (smd_chunk, step_chunk) in self.smdr_man.chunks(copy=not self.zerocopy):
             # Creates a chunk from smd and epics data to send to SmdNode
             # Anatomy of a chunk (pf=packet_footer):
             # [ [smd0][smd1][smd2][pf] ][ [epics0][epics1][epics2][pf] ][ pf ]
@@ -280,10 +340,14 @@ class Smd0(object):
             
             st_req = time.monotonic()
             logger.debug(f'node.py:RANK{self.comms.world_rank} 1. SMD0GOTCHUNK {st_req}')
+            tracer.add('read', st_read, st_req)
 
             self.comms.smd_comm.Recv(rankreq, source=MPI.ANY_SOURCE)
             en_req = time.monotonic()
             logger.debug(f'node.py:RANK{self.comms.world_rank} 2. SMD0GOTEB{rankreq[0]} {en_req}')
+            tracer.add('wait', st_req, en_req, peer=rankreq[0])
+            if self.aggregator:
+                self.aggregator.recv(self.comms.smd_metrics_comm)
             
             # Check missing steps for the current client
             missing_step_views = self.step_hist.get_buffer(rankreq[0], smd0=True)
@@ -293,23 +357,30 @@ class Smd0(object):
             step_views = step_pf.split_packets()
             self.step_hist.extend_buffers(step_views, rankreq[0])
 
-            smd_extended = repack_for_eb(smd_chunk, missing_step_views, self.configs)
-            
             logger.debug(f'node.py:RANK{self.comms.world_rank} 3. SMD0SENDTOEB{rankreq[0]} {time.monotonic()}')
             
+            if self.zerocopy:
+                smd_extended = repack_segments_for_eb(smd_chunk, missing_step_views, self.configs)
+                send_segments(self.comms.smd_comm, smd_extended, rankreq[0])
+                sent_nbytes = sum([memoryview(segment).nbytes for segment in smd_extended])
+            else:
+                smd_extended = repack_for_eb(smd_chunk, missing_step_views, self.configs)
+                self.comms.smd_comm.Send(smd_extended, dest=rankreq[0])
+                sent_nbytes = memoryview(smd_extended).nbytes
             
-            self.comms.smd_comm.Send(smd_extended, dest=rankreq[0])
-            
-            
-            logger.debug(f'node.py:RANK{self.comms.world_rank} 4. SMD0DONEWITHEB{rankreq[0]} {time.monotonic()}')
+            st_read = time.monotonic()
+            logger.debug(f'node.py:RANK{self.comms.world_rank} 4. SMD0DONEWITHEB{rankreq[0]} {st_read}')
+            tracer.add('send', en_req, st_read, peer=rankreq[0])
         
             # sending data to prometheus
             self.c_sent.labels('evts', rankreq[0]).inc(self.smdr_man.got_events)
             self.c_sent.labels('batches', rankreq[0]).inc()
-            self.c_sent.labels('MB', rankreq[0]).inc(memoryview(smd_extended).nbytes/1e6)
+            self.c_sent.labels('MB', rankreq[0]).inc(sent_nbytes/1e6)
             self.c_sent.labels('seconds', rankreq[0]).inc(en_req - st_req)
             logger.debug(f'node: smd0 sent {self.smdr_man.got_events} events to {rankreq[0]} (waiting for this rank took {en_req-st_req:.5f} seconds)')
             
+            self.smdr_man.adapt_n_events(self.smdr_man.got_events, sent_nbytes, en_req - st_req, rankreq[1]/1e6)
+            
             found_endrun = self.smdr_man.smdr.found_endrun()
             if found_endrun: 
                 logger.debug("node: smd0 found_endrun")
@@ -317,6 +388,119 @@ class Smd0(object):
         
         # end for (smd_chunk, step_chunk)
 
+        self._send_missing_steps_and_stop(rankreq)
+
+    def _start_pipelined(self):
+        """ Pipelined version of start (PS_SMD_PIPELINE_DEPTH > 0)
+
+        The next chunk is read from disk while Smd0 waits for an EventBuilder
+        request and while previous chunks are still in flight. Chunks are
+        sent with Isend and at most pipeline_depth sends are outstanding.
+        The first chunk, and chunks already requested when they are ready,
+        are sent right away and the next chunk is read after the send.
+        """
+        rankreq = np.empty(2, dtype='i') # [eb rank, eb wait time (us)]
+        pending_sends = [] # [(request, buffer), ...] buffers must live until sent
+
+        chunk_iter = self.smdr_man.chunks()
+        next_chunk = next(chunk_iter, None)
+        first_chunk = True
+        while next_chunk is not None:
+            smd_chunk, step_chunk = next_chunk
+            next_chunk = None
+            if not (smd_chunk or step_chunk): break
+            got_events = self.smdr_man.got_events
+            found_endrun = self.smdr_man.smdr.found_endrun()
+            
+            st_req = time.monotonic()
+            logger.debug(f'node.py:RANK{self.comms.world_rank} 1. SMD0GOTCHUNK {st_req}')
+            req_rank = self.comms.smd_comm.Irecv(rankreq, source=MPI.ANY_SOURCE)
+
+            # Prefetch the next chunk while waiting for a request (not when
+            # an EventBuilder is already waiting for this one).
+            en_read = st_req
+            read_next = not found_endrun
+            if read_next and not first_chunk and not req_rank.Test():
+                next_chunk = self._read_next_chunk(chunk_iter, req_rank)
+                en_read = time.monotonic()
+                read_next = False
+            first_chunk = False
+            
+            req_rank.Wait()
+            en_req = time.monotonic()
+            logger.debug(f'node.py:RANK{self.comms.world_rank} 2. SMD0GOTEB{rankreq[0]} {en_req}')
+            tracer.add('wait', en_read, en_req, peer=rankreq[0]) # the read overlaps the request
+            if self.aggregator:
+                self.aggregator.recv(self.comms.smd_metrics_comm)
+            
+            missing_step_views = self.step_hist.get_buffer(rankreq[0], smd0=True)
+            step_pf = PacketFooter(view=step_chunk)
+            step_views = step_pf.split_packets()
+            self.step_hist.extend_buffers(step_views, rankreq[0])
+
+            smd_extended = repack_for_eb(smd_chunk, missing_step_views, self.configs)
+            
+            logger.debug(f'node.py:RANK{self.comms.world_rank} 3. SMD0SENDTOEB{rankreq[0]} {time.monotonic()}')
+            pending_sends.append((self.comms.smd_comm.Isend(smd_extended, dest=rankreq[0]), smd_extended))
+            
+            # Bound the no. of in-flight chunks (and the memory they hold)
+            while len(pending_sends) > self.pipeline_depth:
+                req_send, _ = pending_sends.pop(0)
+                req_send.Wait()
+            pending_sends = [(req_send, buf) for req_send, buf in pending_sends if not req_send.Test()]
+            en_send = time.monotonic()
+            logger.debug(f'node.py:RANK{self.comms.world_rank} 4. SMD0DONEWITHEB{rankreq[0]} {en_send}')
+            tracer.add('send', en_req, en_send, peer=rankreq[0])
+            
+            self.c_sent.labels('evts', rankreq[0]).inc(got_events)
+            self.c_sent.labels('batches', rankreq[0]).inc()
+            self.c_sent.labels('MB', rankreq[0]).inc(memoryview(smd_extended).nbytes/1e6)
+            self.c_sent.labels('seconds', rankreq[0]).inc(en_req - st_req)
+            logger.debug(f'node: smd0 sent {got_events} events to {rankreq[0]} (waiting for this rank took {en_req-st_req:.5f} seconds)')
+            
+            self.smdr_man.adapt_n_events(got_events, memoryview(smd_extended).nbytes, en_req - st_req, rankreq[1]/1e6)
+            
+            if found_endrun: 
+                logger.debug("node: smd0 found_endrun")
+                break
+
+            if read_next: # overlaps the send
+                next_chunk = self._read_next_chunk(chunk_iter)
+        
+        # end while next_chunk
+
+        MPI.Request.Waitall([req_send for req_send, _ in pending_sends])
+        pending_sends.clear()
+        logger.debug(f'node: smd0 pipelined read/request overlap ratio: {self.overlap_ratio():.2f}')
+        
+        self._send_missing_steps_and_stop(rankreq)
+
+    def _read_next_chunk(self, chunk_iter, req_rank=None):
+        """ Reads the next chunk. The read is hidden if req_rank (request
+        of an EventBuilder) is still pending after the read. """
+        st_read = time.monotonic()
+        next_chunk = next(chunk_iter, None)
+        en_read = time.monotonic()
+        tracer.add('read', st_read, en_read)
+        self.read_seconds += en_read - st_read
+        self.c_sent.labels('read_seconds', 'None').inc(en_read - st_read)
+        if req_rank is not None and not req_rank.Test():
+            self.overlap_seconds += en_read - st_read
+            self.c_sent.labels('overlap_seconds', 'None').inc(en_read - st_read)
+        return next_chunk
+
+    def overlap_ratio(self):
+        """ Returns fraction of prefetch read time hidden behind waiting
+        for EventBuilder requests (pipelined mode only)."""
+        if self.read_seconds == 0: return 0
+        return self.overlap_seconds / self.read_seconds
+
+    def _send_missing_steps_and_stop(self, rankreq):
+        waiting_ebs = []
+
+        if self.smdr_man.batch_ctrl:
+            self.smdr_man.batch_ctrl.dump()
+
         # check if there are missing steps to be sent 
         for i in range(self.comms.n_smd_nodes):
             self.comms.smd_comm.Recv(rankreq, source=MPI.ANY_SOURCE)
@@ -334,6 +518,11 @@ class Smd0(object):
         for i in range(self.comms.n_smd_nodes-len(waiting_ebs)):
             self.comms.smd_comm.Recv(rankreq, source=MPI.ANY_SOURCE)
             self.comms.smd_comm.Send(bytearray(), dest=rankreq[0])
+
+        # export metrics of the run once all EventBuilders sent theirs
+        if self.aggregator:
+            self.aggregator.recv(self.comms.smd_metrics_comm, n_final=self.comms.n_smd_nodes)
+            self.prom_man.export(self.aggregator.registry(), 'aggregate')
     
 
 class EventBuilderNode(object):
@@ -349,13 +538,25 @@ class EventBuilderNode(object):
         self.step_hist  = StepHistory(self.comms.bd_size, len(self.configs))
         # Collecting Smd0 performance using prometheus
         self.c_sent     = dsparms.prom_man.get_metric('psana_eb_sent')
+        self.aggregator = dsparms.prom_man.aggregator
+
+        # Chunks from Smd0 are received into two reusable buffers (one is
+        # being built while the other receives). In pipelined mode, the next
+        # chunk is requested as soon as the current one arrives.
+        self.pipelined      = int(os.environ.get('PS_SMD_PIPELINE_DEPTH', 0)) > 0
+        self.requested      = False     # a request to Smd0 is outstanding
+        self.recv_bufs      = [bytearray(), bytearray()]
+        self.i_recv_buf     = 0
+        self.req_recv       = None      # posted receive for the next chunk
+        self.next_chunk     = None
+        self.count_recv     = 0
+        self.eb_wait        = 0         # last wait (s) for Smd0, reported back with requests
 
 
     def pack(self, *args):
-        pf = PacketFooter(len(args))
+        pf = PacketFooter.from_sizes([memoryview(arg).nbytes for arg in args])
         batch = bytearray()
-        for i, arg in enumerate(args):
-            pf.set_size(i, memoryview(arg).shape[0])
+        for arg in args:
             batch += arg
         batch += pf.footer
         return batch
@@ -366,7 +567,9 @@ class EventBuilderNode(object):
         smd_batch, _ = smd_batch_dict[dest_rank]
         missing_step_views = self.step_hist.get_buffer(dest_rank)
         batch = repack_for_bd(smd_batch, missing_step_views, self.configs, client=dest_rank)
+        st_send = time.monotonic()
         bd_comm.Send(batch, dest=dest_rank)
+        tracer.add('send', st_send, time.monotonic(), peer=dest_rank)
         del smd_batch_dict[dest_rank] # done sending
         
         step_batch, _ = step_batch_dict[dest_rank]
@@ -379,19 +582,84 @@ class EventBuilderNode(object):
         st_req = time.monotonic()
         self.comms.bd_comm.Recv(rankreq, source=MPI.ANY_SOURCE)
         en_req = time.monotonic()
+        tracer.add('wait', st_req, en_req, peer=rankreq[0])
+        if self.aggregator:
+            self.aggregator.recv(self.comms.bd_metrics_comm)
+            self.aggregator.send(self.comms.smd_metrics_comm)
         self.c_sent.labels('seconds',rankreq[0]).inc(en_req-st_req)
         logger.debug("node: eb%d got bd %d (request took %.5f seconds)"%(self.comms.smd_rank, rankreq[0], (en_req-st_req)))
 
+    def _smd0_request(self):
+        """ Request message to Smd0: this rank and how long it waited for
+        the previous chunk (us) - used by Smd0 for adapting batch sizes."""
+        return np.array([self.comms.smd_rank, min(int(self.eb_wait * 1e6), 2**31-1)], dtype='i')
+
+    def _get_recv_buf(self, count):
+        """ Returns the next of the two receive buffers with at least count bytes.
+        A buffer is only replaced (never resized) so that views of the chunk
+        being built are never invalidated."""
+        self.i_recv_buf = (self.i_recv_buf + 1) % 2
+        if len(self.recv_bufs[self.i_recv_buf]) < count:
+            self.recv_bufs[self.i_recv_buf] = bytearray(count)
+        return memoryview(self.recv_bufs[self.i_recv_buf])[:count]
+
+    def _post_recv(self, smd_comm):
+        """ Posts a receive for the next chunk if it has been announced
+        by Smd0 (pipelined mode only)."""
+        if not self.requested or self.req_recv is not None:
+            return
+        info = MPI.Status()
+        msg = smd_comm.improbe(source=0, status=info)
+        if msg is not None:
+            self.count_recv = info.Get_elements(MPI.BYTE)
+            self.next_chunk = self._get_recv_buf(self.count_recv)
+            self.req_recv = msg.Irecv(self.next_chunk)
+
+    def _request_data_pipelined(self, smd_comm):
+        st_wait = time.monotonic()
+        if not self.requested:
+            smd_comm.Send(self._smd0_request(), dest=0)
+            self.requested = True
+        
+        if self.req_recv is None:
+            info = MPI.Status()
+            msg = smd_comm.Mprobe(source=0, status=info)
+            count = info.Get_elements(MPI.BYTE)
+            smd_chunk = self._get_recv_buf(count)
+            msg.Recv(smd_chunk)
+        else:
+            self.req_recv.Wait()
+            smd_chunk, count = self.next_chunk, self.count_recv
+            self.req_recv, self.next_chunk = None, None
+        self.requested = False
+        self.eb_wait = time.monotonic() - st_wait
+        tracer.add('wait', st_wait, st_wait + self.eb_wait, peer=0)
+        logger.debug(f'node.py:RANK{self.comms.world_rank} 7. EB{self.comms.world_rank}RECVDATA {time.monotonic()}')
+        logger.debug(f"node: eb{self.comms.smd_rank} received {count/1e6:.5f} MB from smd0")
+        
+        # Ask for the next chunk right away so that Smd0 can send it
+        # while this one is being built (empty chunk means no more data).
+        if count > 0:
+            smd_comm.Send(self._smd0_request(), dest=0)
+            self.requested = True
+        return smd_chunk
+
     @s_eb_wait_smd0.time()
     def _request_data(self, smd_comm):
+        if self.pipelined:
+            return self._request_data_pipelined(smd_comm)
+
+        st_wait = time.monotonic()
         logger.debug(f'node.py:RANK{self.comms.world_rank} 5. EB{self.comms.world_rank}SENDREQTOSMD0 {time.monotonic()}')
-        smd_comm.Send(np.array([self.comms.smd_rank], dtype='i'), dest=0)
+        smd_comm.Send(self._smd0_request(), dest=0)
         logger.debug(f'node.py:RANK{self.comms.world_rank} 6. EB{self.comms.world_rank}DONESENDREQ {time.monotonic()}')
         info = MPI.Status()
         smd_comm.Probe(source=0, status=info)
         count = info.Get_elements(MPI.BYTE)
-        smd_chunk = bytearray(count)
+        smd_chunk = self._get_recv_buf(count)
         smd_comm.Recv(smd_chunk, source=0)
+        self.eb_wait = time.monotonic() - st_wait
+        tracer.add('wait', st_wait, st_wait + self.eb_wait, peer=0)
         logger.debug(f'node.py:RANK{self.comms.world_rank} 7. EB{self.comms.world_rank}RECVDATA {time.monotonic()}')
         logger.debug(f"node: eb{self.comms.smd_rank} received {count/1e6:.5f} MB from smd0")
         return smd_chunk
@@ -409,11 +677,15 @@ class EventBuilderNode(object):
             if not smd_chunk:
                 break
            
+            st_build = time.monotonic()
             eb_man = EventBuilderManager(smd_chunk, self.configs, self.dsparms, self.dm.get_run())
             logger.debug(f'node.py:RANK{self.comms.world_rank} 8. EB{self.comms.world_rank}DONEBUILDINGEVENTS {time.monotonic()}')
         
             # Build batch of events
             for smd_batch_dict, step_batch_dict  in eb_man.batches():
+                tracer.add('build', st_build, time.monotonic())
+                if self.pipelined: 
+                    self._post_recv(smd_comm)
                 
                 # If single item and dest_rank=0, send to any bigdata nodes.
                 if 0 in smd_batch_dict.keys():
@@ -432,9 +704,12 @@ class EventBuilderNode(object):
                     
                     missing_step_views = self.step_hist.get_buffer(rankreq[0])
                     batch = repack_for_bd(smd_batch, missing_step_views, self.configs, client=rankreq[0])
-                    logger.debug(f'node.py:RANK{self.comms.world_rank} 11. EB{self.comms.world_rank}SENDDATATOBD{rankreq[0]+1} {time.monotonic()}')
+                    st_send = time.monotonic()
+                    logger.debug(f'node.py:RANK{self.comms.world_rank} 11. EB{self.comms.world_rank}SENDDATATOBD{rankreq[0]+1} {st_send}')
                     bd_comm.Send(batch, dest=rankreq[0])
-                    logger.debug(f'node.py:RANK{self.comms.world_rank} 12. EB{self.comms.world_rank}DONESENDDATATOBD{rankreq[0]+1} {time.monotonic()}')
+                    en_send = time.monotonic()
+                    logger.debug(f'node.py:RANK{self.comms.world_rank} 12. EB{self.comms.world_rank}DONESENDDATATOBD{rankreq[0]+1} {en_send}')
+                    tracer.add('send', st_send, en_send, peer=rankreq[0])
                     
                     # sending data to prometheus
                     logger.debug(f'node: eb{self.comms.smd_rank} sent {eb_man.eb.nevents} events ({memoryview(smd_batch).nbytes} bytes) to bd{rankreq[0]}')
@@ -474,6 +749,7 @@ class EventBuilderNode(object):
                                 waiting_bds.append(dest_rank)
                
                 # end else -> if 0 in smd_batch_dict.keys() 
+                st_build = time.monotonic()
             
             # end for smd_batch_dict in ...
             logger.debug(f'node.py:RANK{self.comms.world_rank} 12.1 EB{self.comms.world_rank}DONEALLBATCHES {time.monotonic()}')
@@ -519,6 +795,11 @@ class EventBuilderNode(object):
             self._request_rank(rankreq)
             bd_comm.Send(bytearray(), dest=rankreq[0])
             logger.debug(f"node: eb{self.comms.smd_rank} send null byte to bd{rankreq[0]}")
+
+        # forward metrics of the run to smd0 once all bigdata nodes sent theirs
+        if self.aggregator:
+            self.aggregator.recv(self.comms.bd_metrics_comm, n_final=n_bd_nodes)
+            self.aggregator.send(self.comms.smd_metrics_comm, final=True)
         
 
 
@@ -530,13 +811,22 @@ class BigDataNode(object):
         self.dsparms    = dsparms
         self.dm         = dm
         self.bd_wait_eb = PrometheusManager.get_metric('psana_bd_wait_eb')
+        self.aggregator = dsparms.prom_man.aggregator
+        
+        # Background request/read of the next batches (see BatchPrefetcher).
+        # get_smd then runs outside the main thread, which needs MPI_THREAD_MULTIPLE.
+        self.prefetch_depth = int(os.environ.get('PS_BD_PREFETCH_DEPTH', 0))
+        if self.prefetch_depth > 0 and MPI.Query_thread() != MPI.THREAD_MULTIPLE:
+            logger.warning('node: bigdata prefetch disabled (MPI_THREAD_MULTIPLE is not available)')
+            self.prefetch_depth = 0
 
     def start(self):
         
         def get_smd():
             bd_comm = self.comms.bd_comm
             bd_rank = self.comms.bd_rank
-            logger.debug(f'node.py:RANK{self.comms.world_rank} 13. BD{self.comms.world_rank}SENDREQTOEB {time.monotonic()}')
+            st_wait = time.monotonic()
+            logger.debug(f'node.py:RANK{self.comms.world_rank} 13. BD{self.comms.world_rank}SENDREQTOEB {st_wait}')
             bd_comm.Send(np.array([bd_rank], dtype='i'), dest=0)
             logger.debug(f'node.py:RANK{self.comms.world_rank} 14. BD{self.comms.world_rank}DONESENDREQTOEB {time.monotonic()}')
             info = MPI.Status()
@@ -547,11 +837,21 @@ class BigDataNode(object):
             bd_comm.Recv(chunk, source=0)
             logger.debug(f'node.py:RANK{self.comms.world_rank} 15. BD{self.comms.world_rank}RECVDATA {time.monotonic()}')
             en_req = time.monotonic()
+            tracer.add('wait', st_wait, en_req, peer=0)
             self.bd_wait_eb.labels('seconds', self.comms.world_rank).inc(en_req - st_req)
             return chunk
         
         events = Events(self.configs, self.dm, self.dsparms, 
-                filter_callback=self.dsparms.filter, get_smd=get_smd)
-
-        for evt in events:
-            yield evt
+                filter_callback=self.dsparms.filter, get_smd=get_smd, 
+                prefetch_depth=self.prefetch_depth)
+
+        # Metrics are sent from here, not get_smd (see MetricsAggregator)
+        try:
+            for evt in events:
+                if self.aggregator:
+                    self.aggregator.send(self.comms.bd_metrics_comm)
+                yield evt
+            if self.aggregator: # end of run
+                self.aggregator.send(self.comms.bd_metrics_comm, final=True)
+        finally: # also when the user leaves the event loop early
+            events.close()
@@ -1,9 +1,9 @@
-import struct
 import numpy as np
 
 class PacketFooter(object):
 
     n_bytes = 4
+    dtype   = np.uint32
 
     def __init__(self, n_packets=0, view=None):
         """ Creates footer for packets
@@ -11,45 +11,84 @@ class PacketFooter(object):
         Each footer element has n_bytes.
         If n_packets is given, creates an empty footer with n_packets .
         If footer is given, sets footer that's available for packet size access.
-        """
 
+        Packet sizes are kept in a uint32 numpy array (self.sizes). For a
+        footer read from a view, this array is on the footer bytes
+        of the view (a copy if the view is a bytearray or bytes).
+        """
+        self.view = None
+        self._split = None # cached split_packets() result
+        self._footer = None # cached footer bytes
         if n_packets:
             self.n_packets = n_packets
-            self.footer = bytearray((n_packets + 1) * self.n_bytes)
-            self.footer[-self.n_bytes:] = struct.pack("I", self.n_packets)
+            self._sizes = np.zeros(n_packets, dtype=self.dtype)
         elif view:
-            self.n_packets = struct.unpack("I", view[-self.n_bytes:])[0]
-            self.footer = view[-(self.n_packets + 1)*self.n_bytes:]
+            self.n_packets = int(np.frombuffer(view[-self.n_bytes:], dtype=self.dtype)[0])
+            footer = view[-(self.n_packets + 1)*self.n_bytes:]
+            self._sizes = np.frombuffer(footer, dtype=self.dtype, count=self.n_packets)
             self.view = view
         else:
             self.n_packets = 0
-            self.footer = bytearray()
+            self._sizes = np.zeros(0, dtype=self.dtype)
+
+    @classmethod
+    def from_sizes(cls, sizes):
+        """ Builds a footer for packets of the given sizes in one call. """
+        sizes = np.asarray(sizes, dtype=cls.dtype)
+        pf = cls(n_packets=sizes.shape[0])
+        pf._sizes[:] = sizes
+        pf._footer = None
+        return pf
+
+    @property
+    def sizes(self):
+        """ uint32 array of packet sizes (read-only use, change sizes
+        with set_size/add_packet) """
+        return self._sizes[:self.n_packets]
+
+    @property
+    def footer(self):
+        """ Footer bytes. Built once and cached until a packet size
+        changes (immutable, so the cached copy can be shared). Footer of
+        PacketFooter() with no packets is empty."""
+        if self._footer is None:
+            if self.n_packets == 0 and self.view is None:
+                self._footer = b''
+            else:
+                footer = np.empty(self.n_packets + 1, dtype=self.dtype)
+                footer[:-1] = self.sizes
+                footer[-1] = self.n_packets
+                self._footer = footer.tobytes()
+        return self._footer
 
     def set_size(self, idx, size):
         """ Set size of the given packet index. """
         assert idx < self.n_packets
-        st = idx * self.n_bytes
-        self.footer[st: st+self.n_bytes] = struct.pack("I", size)
+        self._sizes[idx] = size
+        self._split = None
+        self._footer = None
 
     def get_size(self, idx):
         """ Return size of the given packet index. """
         assert idx < self.n_packets
-        st = idx * self.n_bytes
-        return struct.unpack("I", self.footer[st: st+self.n_bytes])[0]
+        return int(self._sizes[idx])
 
     def split_packets(self):
         """ Return list of memoryviews to packets """
-        # generate list of offsets and sizes for the packets
-        sizes = np.asarray([self.get_size(idx) for idx in range(self.n_packets)])
-        offsets = np.asarray([np.sum(sizes[:idx]) for idx in range(self.n_packets)])
-
-        memviews = [memoryview(self.view[offsets[idx]: offsets[idx]+sizes[idx]]) for idx in range(self.n_packets)]
-        return memviews
+        if self._split is None:
+            # generate list of offsets and sizes for the packets
+            sizes = self.sizes.astype(np.int64)
+            offsets = np.cumsum(sizes) - sizes
+            self._split = [memoryview(self.view[st: st+size]) for st, size in zip(offsets.tolist(), sizes.tolist())]
+        return list(self._split)
 
     def add_packet(self, packet_size):
         """ Appends the packet_size to the footer and upates n_packets."""
+        if self.n_packets == self._sizes.shape[0]:
+            sizes = np.zeros(max(1, 2 * self.n_packets), dtype=self.dtype)
+            sizes[:self.n_packets] = self.sizes
+            self._sizes = sizes
+        self._sizes[self.n_packets] = packet_size
         self.n_packets += 1
-        self.footer[-self.n_bytes:-self.n_bytes] = bytearray(struct.pack("I", packet_size))
-        self.footer[-self.n_bytes:] = struct.pack("I", self.n_packets)
-
-
+        self._split = None
+        self._footer = None
@@ -1,5 +1,10 @@
+import os
 import time
-from prometheus_client import CollectorRegistry, Counter, push_to_gateway, Summary, Gauge
+import math
+import threading
+import numpy as np
+from prometheus_client import CollectorRegistry, Counter, push_to_gateway, write_to_textfile, Summary, Gauge
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, SummaryMetricFamily
 
 import logging
 logger = logging.getLogger(__name__)
@@ -7,11 +12,20 @@ logger = logging.getLogger(__name__)
 PUSH_INTERVAL_SECS  = 5
 PUSH_GATEWAY        = 'psdm03:9091'
 
+# PS_PROMETHEUS_AGGREGATE=1: in MPI mode, only smd0 exports metrics, 
+# aggregated per role (see MetricsAggregator) instead of every rank pushing.
+# PS_PROMETHEUS_DIR=<dir>: metrics are written to <dir> (text format) 
+# instead of being pushed to the gateway.
+PS_PROMETHEUS_AGGREGATE = int(os.environ.get('PS_PROMETHEUS_AGGREGATE', 0)) > 0
+PS_PROMETHEUS_DIR       = os.environ.get('PS_PROMETHEUS_DIR')
+
 registry = CollectorRegistry()
 metrics ={
         'psana_smd0_read'       : ('Counter', 'Counting no. of events/batches/MB read by Smd0'), 
         'psana_smd0_sent'       : ('Counter', 'Counting no. of events/batches/MB and wait time  \
                                     communicating with EventBuilder cores'), 
+        'psana_smd0_batch_size' : ('Gauge',   'no. of events per chunk chosen by Smd0           \
+                                    (PS_SMD_ADAPTIVE)'),
         'psana_eb_sent'         : ('Counter', 'Counting no. of events/batches/MB and wait time  \
                                     communicating with BigData cores'),
         'psana_eb_filter'       : ('Counter', 'Counting no. of batches and wait time            \
@@ -24,28 +38,97 @@ metrics ={
         'psana_bd_wait_eb'      : ('Counter', 'time spent (s) waiting for EventBuilder cores'),
         'psana_bd_ana'          : ('Counter', 'time spent (s) in analysis fn on                 \
                                     BigData core'),
+        'psana_srv'             : ('Counter', 'Counting no. of batches received and time (s)    \
+                                    SmallData servers spend blocked on receiving,     \
+                                    queueing and writing'),
         'psana_timestamp'       : ('Gauge',   'Uses different labels (e.g. python_init,         \
                                     first_event) to set the timestamp of that stage'),
         }
 
+
+class MergeableHistogram(object):
+    """ Counts of observations in log2 buckets: bucket i holds values in
+    [2**(i-21), 2**(i-20)) seconds (first and last bucket are open). 
+    Histograms of different ranks are merged by adding the counts. 
+    Observations may come from several threads (e.g. the bigdata
+    prefetcher), so counts are updated and copied under a lock. """
+    n_buckets   = 32
+    min_exp     = -20
+    quantiles   = (0.5, 0.9, 0.99)
+
+    def __init__(self, counts=None):
+        self.counts = np.zeros(self.n_buckets, dtype=np.int64) if counts is None else counts
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = math.frexp(value)[1] - self.min_exp if value > 0 else 0
+        with self._lock:
+            self.counts[min(max(i, 0), self.n_buckets - 1)] += 1
+
+    def merge(self, other):
+        counts = other.snapshot()
+        with self._lock:
+            self.counts += counts
+
+    def snapshot(self):
+        """ Returns a copy of the counts """
+        with self._lock:
+            return self.counts.copy()
+
+    def quantile(self, q):
+        """ Returns value below which q of the observations are (linear in the bucket) """
+        total = self.counts.sum()
+        if total == 0: return 0.
+        cumsum = np.cumsum(self.counts)
+        i = int(np.searchsorted(cumsum, q * total))
+        lo = 0. if i == 0 else 2. ** (i - 1 + self.min_exp)
+        hi = 2. ** (i + self.min_exp)
+        below = cumsum[i] - self.counts[i]
+        return lo + (hi - lo) * (q * total - below) / self.counts[i]
+
+
+class HistogramSummary(Summary):
+    """ Summary that also keeps a MergeableHistogram of the observations
+    (percentiles of the aggregated metrics). Only for summaries without 
+    labels - it extends the public constructor and observe only. """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.histogram = MergeableHistogram()
+
+    def observe(self, amount):
+        super().observe(amount)
+        self.histogram.observe(amount)
+
+
 for metric_name, (metric_type, desc) in metrics.items():
     if metric_type == 'Counter':
         registry.register(Counter(metric_name, desc, ['unit', 'endpoint']))
     elif metric_type == 'Summary':
-        registry.register(Summary(metric_name, desc))
+        registry.register(HistogramSummary(metric_name, desc))
     elif metric_type == 'Gauge':
         registry.register(Gauge(metric_name, desc, ['checkpoint']))
 
 class PrometheusManager(object):
     def __init__(self, jobid):
         self.jobid = jobid
-        pass
+        self.aggregator = None  # set on all ranks in aggregation mode
 
     def push_metrics(self, e, from_whom=''):
         while not e.isSet():
-            push_to_gateway(PUSH_GATEWAY, job='psana_pushgateway', grouping_key={'jobid': self.jobid, 'rank': from_whom}, registry=registry, timeout=None)
+            if self.aggregator:
+                self.export(self.aggregator.registry(), 'aggregate')
+            else:
+                self.export(registry, from_whom)
             logger.debug('TS: %s PUSHED JOBID: %s RANK: %s e.isSet():%s'%(time.time(), self.jobid, from_whom, e.isSet()))
-            time.sleep(PUSH_INTERVAL_SECS)
+            e.wait(PUSH_INTERVAL_SECS)
+
+    def export(self, metrics_registry, from_whom):
+        """ Pushes the metrics to the gateway or writes them to 
+        PS_PROMETHEUS_DIR/psana-<jobid>-<from_whom>.prom """
+        if PS_PROMETHEUS_DIR:
+            write_to_textfile(os.path.join(PS_PROMETHEUS_DIR, f'psana-{self.jobid}-{from_whom}.prom'), metrics_registry)
+        else:
+            push_to_gateway(PUSH_GATEWAY, job='psana_pushgateway', grouping_key={'jobid': self.jobid, 'rank': from_whom}, registry=metrics_registry, timeout=None)
         
     @staticmethod
     def get_metric(metric_name):
@@ -59,3 +142,152 @@ class PrometheusManager(object):
         
         
 
+
+
+def snapshot():
+    """ Returns this rank's metrics: {'counters': {(name, unit): value},
+    'gauges': {(name, checkpoint): value}, 'summaries': {name: [count, 
+    sum, histogram counts]}} - counters are summed over endpoints. """
+    snap = {'counters': {}, 'gauges': {}, 'summaries': {}}
+    for metric_name, (metric_type, _) in metrics.items():
+        collector = PrometheusManager.get_metric(metric_name)
+        if metric_type == 'Summary':
+            snap['summaries'][metric_name] = [0, 0., collector.histogram.snapshot()]
+        for family in collector.collect():
+            for sample in family.samples:
+                if metric_type == 'Counter' and sample.name.endswith('_total'):
+                    key = (metric_name, sample.labels['unit'])
+                    snap['counters'][key] = snap['counters'].get(key, 0) + sample.value
+                elif metric_type == 'Gauge':
+                    snap['gauges'][(metric_name, sample.labels['checkpoint'])] = sample.value
+                elif metric_type == 'Summary' and sample.name.endswith('_count'):
+                    snap['summaries'][metric_name][0] = sample.value
+                elif metric_type == 'Summary' and sample.name.endswith('_sum'):
+                    snap['summaries'][metric_name][1] = sample.value
+    snap['ranks'] = 1
+    return snap
+
+def merge_snapshots(snaps):
+    """ Returns one snapshot of all snaps: counters and summaries are added,
+    gauges are the max (latest timestamp, largest batch size) """
+    merged = {'counters': {}, 'gauges': {}, 'summaries': {}, 'ranks': 0}
+    for snap in snaps:
+        merged['ranks'] += snap['ranks']
+        for key, value in snap['counters'].items():
+            merged['counters'][key] = merged['counters'].get(key, 0) + value
+        for key, value in snap['gauges'].items():
+            merged['gauges'][key] = max(merged['gauges'].get(key, value), value)
+        for key, (count, total, counts) in snap['summaries'].items():
+            if key in merged['summaries']:
+                merged_count, merged_total, merged_counts = merged['summaries'][key]
+                merged['summaries'][key] = [merged_count + count, merged_total + total, merged_counts + counts]
+            else:
+                merged['summaries'][key] = [count, total, counts.copy()]
+    return merged
+
+
+class MetricsAggregator(object):
+    """ Aggregates metrics of the ranks of a group at its leader (MPI mode,
+    PS_PROMETHEUS_AGGREGATE=1) so that only smd0 exports them.
+
+    Bigdata ranks send snapshots of their metrics to their EventBuilder 
+    (dup of bd_comm) and EventBuilders send per-role aggregates of their
+    group (eb and bd) to smd0 (dup of smd_comm), at most every 
+    PUSH_INTERVAL_SECS and once more at the end of each run (final). The
+    leaders keep the latest message from each member, so nothing is 
+    counted twice.
+
+    send and recv are called from the main thread of each rank (node 
+    loops and, on bigdata ranks, the event loop - not get_smd, which runs
+    on the prefetch thread with PS_BD_PREFETCH_DEPTH>0). With prefetching,
+    that thread talks to the EventBuilder on bd_comm at the same time,
+    which BigDataNode only enables with MPI_THREAD_MULTIPLE. On smd0 the
+    push thread reads the aggregates while the main thread receives, so
+    the latest messages are guarded by a lock.
+    """
+    TAG = 77
+
+    def __init__(self, role, rank):
+        self.role = role
+        self.rank = rank
+        self.latest = {}    # member rank: {role: snapshot}
+        self.n_final = 0    # no. of final messages received (this run)
+        self.t_sent = 0
+        self.req = None
+        self._lock = threading.Lock()
+
+    def aggregates(self):
+        """ Returns {role: merged snapshot} of this rank and its members """
+        by_role = {self.role: [snapshot()]}
+        with self._lock: # also called by the push thread
+            members = list(self.latest.values())
+        for member in members:
+            for role, snap in member.items():
+                by_role.setdefault(role, []).append(snap)
+        return {role: merge_snapshots(snaps) for role, snaps in by_role.items()}
+
+    def send(self, comm, final=False):
+        """ Sends aggregates to the leader (rank 0 of comm) if it's time """
+        now = time.monotonic()
+        if not final and now - self.t_sent < PUSH_INTERVAL_SECS: return
+        self.t_sent = now
+        if self.req is not None:
+            self.req.wait()
+        msg = (self.rank, final, self.aggregates())
+        if final:
+            comm.send(msg, dest=0, tag=self.TAG)
+            self.req = None
+        else:
+            self.req = comm.isend(msg, dest=0, tag=self.TAG)
+
+    def recv(self, comm, n_final=0):
+        """ Receives the pending messages of the members and, with n_final,
+        waits for final messages of n_final members (end of run). """
+        while comm.iprobe(tag=self.TAG) or self.n_final < n_final:
+            rank, final, aggregates = comm.recv(tag=self.TAG)
+            with self._lock:
+                self.latest[rank] = aggregates
+            self.n_final += final
+        if n_final: self.n_final = 0
+
+    def registry(self):
+        """ Returns registry with the aggregated metrics labeled by role """
+        aggregated = CollectorRegistry()
+        aggregated.register(_AggregateCollector(self.aggregates()))
+        return aggregated
+
+
+class _AggregateCollector(object):
+    def __init__(self, aggregates):
+        self.aggregates = aggregates
+
+    def collect(self):
+        ranks = GaugeMetricFamily('psana_ranks', 'no. of ranks of each role', labels=['role'])
+        for role, snap in self.aggregates.items():
+            ranks.add_metric([role], snap['ranks'])
+        yield ranks
+        for metric_name, (metric_type, desc) in metrics.items():
+            if metric_type == 'Counter':
+                family = CounterMetricFamily(metric_name, desc, labels=['role', 'unit'])
+                for role, snap in self.aggregates.items():
+                    for (name, unit), value in snap['counters'].items():
+                        if name == metric_name: family.add_metric([role, unit], value)
+                yield family
+            elif metric_type == 'Gauge':
+                family = GaugeMetricFamily(metric_name, desc, labels=['role', 'checkpoint'])
+                for role, snap in self.aggregates.items():
+                    for (name, checkpoint), value in snap['gauges'].items():
+                        if name == metric_name: family.add_metric([role, checkpoint], value)
+                yield family
+            elif metric_type == 'Summary':
+                family = SummaryMetricFamily(metric_name, desc, labels=['role'])
+                quantiles = GaugeMetricFamily(f'{metric_name}_quantile', f'{desc} (quantiles)', labels=['role', 'quantile'])
+                for role, snap in self.aggregates.items():
+                    if metric_name not in snap['summaries']: continue
+                    count, total, counts = snap['summaries'][metric_name]
+                    family.add_metric([role], count, total)
+                    histogram = MergeableHistogram(counts)
+                    for q in MergeableHistogram.quantiles:
+                        quantiles.add_metric([role, str(q)], histogram.quantile(q))
+                yield family
+                yield quantiles
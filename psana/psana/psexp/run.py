@@ -11,6 +11,9 @@ from psana.detector.detector_impl import MissingDet
 from psana.event import Event
 from psana.psexp import *
 
+import logging
+logger = logging.getLogger(__name__)
+
 
 class DetectorNameError(Exception): pass
 
@@ -61,6 +64,9 @@ class Run(object):
     nfiles  = 0
     scan    = False # True when looping over steps
     smd_fds = None
+    _det_dgram_index_map = None
+    _ts_index = None
+    _ts_index_env_pos = 0   # index rows before this position were added to EnvStores
     
     def __init__(self, ds):
         self.dsparms = ds.dsparms
@@ -70,6 +76,23 @@ class Run(object):
         RunHelper(self)
         self._dets   = {}
 
+    @property
+    def _det_dgram_indices(self):
+        """ Maps detector name to indices of the dgrams (one per file,
+        same order as configs) that can have that detector. Built once
+        per run from configs and used by events to find detector 
+        segments without visiting all dgrams."""
+        if self._det_dgram_index_map is None:
+            if not self.configs:
+                return {}
+            index_map = {}
+            for i, config in enumerate(self.configs):
+                for det_name in config.__dict__:
+                    if det_name.startswith('_'): continue
+                    index_map.setdefault(det_name, []).append(i)
+            self._det_dgram_index_map = index_map
+        return self._det_dgram_index_map
+
     def run(self):
         """ Returns integer representaion of run no.
         default: (when no run is given) is set to -1"""
@@ -190,6 +213,88 @@ class Run(object):
     def step(self, evt):
         step_dgrams = self.esm.stores['scan'].get_step_dgrams_of_event(evt)
         return Event(dgrams=step_dgrams, run=self)
+
+    def _ts_index_files(self):
+        """ Returns (files, smd, fds) used for timestamp_index - overridden
+        by the file-backed runs (RunSerial and RunSingleFile)."""
+        raise RuntimeError(f"{self.__class__.__name__} does not support random access by timestamp "
+                "(timestamp_index, event, events_at, events_between): it needs a run read from "
+                "xtc2 files in a single process (PS_PARALLEL=none or one MPI rank), not shmem, "
+                "MPI or local parallel modes")
+
+    def timestamp_index(self, index_dir=None):
+        """ Returns TimestampIndex of the run files. The index is built and
+        saved on the first use (or by ts_index command) and memory-mapped."""
+        if self._ts_index is None:
+            files, smd, _ = self._ts_index_files()
+            self._ts_index = TimestampIndex.open(files, smd=smd, index_dir=index_dir)
+            self._ts_index_env_pos = int(np.searchsorted(self._ts_index.timestamps, 
+                self._evt.timestamp, side='right'))
+        return self._ts_index
+
+    def _indexed_event(self, rows):
+        """ Reads dgrams of the index rows of an event. """
+        _, smd, fds = self._ts_index_files()
+        use_smds = self.dsparms.use_smds
+        dgrams = [None] * len(self.configs)
+        for row in rows:
+            i = int(row['ifile'])
+            if smd and row['service'] == TransitionId.L1Accept and len(self.dm.xtc_files) > 0 \
+                    and not use_smds[i]:
+                dgrams[i] = self.dm.jumps(i, int(row['bd_offset']), int(row['bd_size']))
+            else:
+                dgrams[i] = dgram.Dgram(file_descriptor=fds[i], config=self.configs[i],
+                        offset=int(row['smd_offset']), size=int(row['smd_size']),
+                        max_retries=self.dsparms.max_retries)
+        return Event(dgrams, run=self)
+
+    def _update_env_from_index(self, timestamp):
+        """ Adds transitions up to timestamp (not added yet) to EnvStores """
+        idx = self.timestamp_index()
+        en = int(np.searchsorted(idx.timestamps, timestamp, side='right'))
+        for rows in idx.events(self._ts_index_env_pos, en, transitions_only=True):
+            self.esm.update_by_event(self._indexed_event(rows))
+        self._ts_index_env_pos = max(self._ts_index_env_pos, en)
+
+    def event(self, timestamp):
+        """ Returns the event with this timestamp (None if not found)
+        without reading earlier smd data (see timestamp_index)."""
+        for evt in self.events_at([timestamp]):
+            return evt
+        return None
+
+    def events_at(self, timestamps):
+        """ Generates events with the given timestamps (in the given order,
+        missing timestamps are skipped) using timestamp_index.
+        
+        Epics and scan values of the events are available. Do not mix with
+        events() or steps() of the same run (transitions would be added
+        to EnvStores twice)."""
+        idx = self.timestamp_index()
+        timestamps = np.asarray(timestamps, dtype=np.uint64).reshape(-1)
+        if timestamps.shape[0]:
+            self._update_env_from_index(timestamps.max())
+        for timestamp in timestamps:
+            rows = idx.find(timestamp)
+            if not rows.shape[0]:
+                logger.debug(f'run: timestamp {timestamp} not found in timestamp index')
+                continue
+            yield self._indexed_event(rows)
+
+    def events_between(self, begin=None, end=None):
+        """ Generates L1Accept events with begin <= timestamp < end using
+        timestamp_index (default: from BeginRun to EndRun of this run)."""
+        idx = self.timestamp_index()
+        if begin is None: begin = self._evt.timestamp
+        self._update_env_from_index(begin)
+        st, en = idx.positions(begin, end)
+        for rows in idx.events(st, en):
+            service = rows['service'][0]
+            if service == TransitionId.L1Accept:
+                yield self._indexed_event(rows)
+                continue
+            if service == TransitionId.EndRun: return
+            self._update_env_from_index(rows['timestamp'][0])
     
 class RunShmem(Run):
     """ Yields list of events from a shared memory client (no event building routine). """
@@ -236,7 +341,12 @@ class RunSingleFile(Run):
         self.esm.update_by_event(self._evt)
         self._evt_iter = Events(self.configs, ds.dm, ds.dsparms, 
                 filter_callback=ds.dsparms.filter)
+        self.dm        = ds.dm
+        self._ds       = ds # keeps ds.dm files open for random access
     
+    def _ts_index_files(self):
+        return self.dm.xtc_files, False, self.dm.fds
+
     def events(self):
         for evt in self._evt_iter:
             if evt.service() != TransitionId.L1Accept:
@@ -268,7 +378,14 @@ class RunSerial(Run):
         self.esm.update_by_event(self._evt)
         self._evt_iter = Events(self.configs, ds.dm, ds.dsparms, 
                 filter_callback=ds.dsparms.filter, smdr_man=ds.smdr_man)
+        self.dm        = ds.dm
+        self.smd_files = ds.smd_files
+        self.smd_fds   = ds.smd_fds
+        self._ds       = ds # smd_fds are closed when ds is deleted
     
+    def _ts_index_files(self):
+        return self.smd_files, True, self.smd_fds
+
     def events(self):
         for evt in self._evt_iter:
             if evt.service() != TransitionId.L1Accept:
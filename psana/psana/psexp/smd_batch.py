@@ -0,0 +1,88 @@
+import numpy as np
+from psana import dgram
+from . import TransitionId
+
+
+def _gather(u8, positions, itemsize):
+    """ Returns values of itemsize bytes (unsigned, native byte order)
+    found at the given byte positions of a uint8 array."""
+    positions = np.asarray(positions, dtype=np.int64)
+    idx = positions.reshape(-1, 1) + np.arange(itemsize)
+    dtype = np.uint32 if itemsize == 4 else np.uint64
+    return np.ascontiguousarray(u8[idx]).view(dtype).reshape(positions.shape)
+
+
+class SmdBatch(object):
+    """ Parses a batch of smd events into numpy arrays in one pass.
+
+    Anatomy of a batch (pf=packet_footer):
+    [ [dg0][dg1]...[pf] ][ [dg0][dg1]...[pf] ] ... [ pf ]
+      ----- event 0 -----  ----- event 1 -----
+
+    No Dgram or Event objects are created. Fields are read straight
+    from the bytes:
+    - dgram_starts, dgram_sizes (n_events, n_smds): location of each
+      dgram in the view (size 0 for missing dgrams)
+    - services (n_events,): service of the first dgram of each event
+    - offsets, sizes (n_events, n_smds): bigdata offset and size stored
+      in smdinfo of L1Accept dgrams. Other dgrams have offset 0 and size
+      of the dgram itself (same as Event.get_offset_and_size).
+    """
+    # (uint32 word, extent) of Dgram.xtc, ShapesData, Shapes, and Data xtcs
+    # of an L1Accept dgram created by Smd::generate (xtcdata/xtc/src/Smd.cc).
+    # The two uint64 values (intOffset, intDgramSize) follow at byte 60.
+    smdinfo_extents = ((5, 64), (8, 52), (11, 12), (14, 28))
+    smdinfo_payload = 60
+    smdinfo_size    = 76
+
+    def __init__(self, view, configs, use_smds=None):
+        self.view = view
+        self.n_smds = len(configs)
+        u8 = np.frombuffer(view, dtype=np.uint8)
+        n_bytes = u8.shape[0]
+
+        # Batch footer -> event locations
+        self.n_events = int(_gather(u8, [n_bytes - 4], 4)[0])
+        evt_sizes = _gather(u8, n_bytes - 4 * (self.n_events + 1) + 4 * np.arange(self.n_events), 4).astype(np.int64)
+        evt_ends = np.cumsum(evt_sizes)
+        evt_starts = evt_ends - evt_sizes
+
+        # Event footers -> dgram locations (an event can be empty)
+        has_evt = evt_sizes > 0
+        ft_starts = evt_ends[has_evt] - 4 * (self.n_smds + 1)
+        assert np.all(_gather(u8, evt_ends[has_evt] - 4, 4) == self.n_smds)
+        self.dgram_sizes = np.zeros((self.n_events, self.n_smds), dtype=np.int64)
+        self.dgram_sizes[has_evt] = _gather(u8, ft_starts.reshape(-1, 1) + 4 * np.arange(self.n_smds), 4)
+        self.dgram_starts = evt_starts.reshape(-1, 1) + np.cumsum(self.dgram_sizes, axis=1) - self.dgram_sizes
+        found = self.dgram_sizes > 0
+
+        # Services (env is word 2 of the dgram)
+        dgram_services = np.zeros(self.dgram_sizes.shape, dtype=np.uint32)
+        dgram_services[found] = (_gather(u8, self.dgram_starts[found] + 8, 4) >> 24) & 0x0f
+        i_first = np.argmax(found, axis=1)
+        self.services = dgram_services[np.arange(self.n_events), i_first]
+
+        # Offsets and sizes
+        self.offsets = np.zeros(self.dgram_sizes.shape, dtype=np.int64)
+        self.sizes = self.dgram_sizes.copy()
+        is_l1 = found & (dgram_services == TransitionId.L1Accept)
+        if use_smds is not None:
+            is_l1 &= ~np.asarray(use_smds, dtype=bool).reshape(1, -1)
+        has_smdinfo = is_l1 & (self.dgram_sizes == self.smdinfo_size)
+        for word, extent in self.smdinfo_extents:
+            has_smdinfo[has_smdinfo] = _gather(u8, self.dgram_starts[has_smdinfo] + 4 * word, 4) == extent
+        starts = self.dgram_starts[has_smdinfo] + self.smdinfo_payload
+        self.offsets[has_smdinfo] = _gather(u8, starts, 8)
+        self.sizes[has_smdinfo] = _gather(u8, starts + 8, 8)
+
+        # L1Accept dgrams with a different layout are parsed the usual way
+        for i_evt, i_smd in zip(*np.nonzero(is_l1 & ~has_smdinfo)):
+            d = dgram.Dgram(config=configs[i_smd], view=self.dgram_view(i_evt, i_smd))
+            if hasattr(d, "smdinfo"):
+                self.offsets[i_evt, i_smd] = d.smdinfo[0].offsetAlg.intOffset
+                self.sizes[i_evt, i_smd] = d.smdinfo[0].offsetAlg.intDgramSize
+
+    def dgram_view(self, i_evt, i_smd):
+        """ Returns memoryview of a dgram in the batch. """
+        st = self.dgram_starts[i_evt, i_smd]
+        return memoryview(self.view)[st: st + self.dgram_sizes[i_evt, i_smd]]
@@ -1,6 +1,7 @@
 from psana.smdreader import SmdReader
 from psana.eventbuilder import EventBuilder
 from psana.psexp import *
+from psana.psexp.batch_size_controller import BatchSizeController
 import os, time
 from psana import dgram
 from psana.event import Event
@@ -64,6 +65,14 @@ class SmdReaderManager(object):
                 self.smd0_n_events = self.dsparms.max_events
         
         self.chunksize = int(os.environ.get('PS_SMD_CHUNKSIZE', 0x1000000))
+        
+        # Let Smd0 adjust smd0_n_events per chunk (see BatchSizeController)
+        self.batch_ctrl = None
+        if int(os.environ.get('PS_SMD_ADAPTIVE', 0)):
+            self.batch_ctrl = BatchSizeController(self.smd0_n_events, 
+                    self.chunksize * self.n_files, 
+                    max_events=self.dsparms.max_events)
+            self.smd0_n_events = self.batch_ctrl.n_events
         self.smdr = SmdReader(smd_fds, self.chunksize, self.dsparms.max_retries)
         self.processed_events = 0
         self.got_events = -1
@@ -71,6 +80,14 @@ class SmdReaderManager(object):
         
         # Collecting Smd0 performance using prometheus
         self.c_read = self.dsparms.prom_man.get_metric('psana_smd0_read')
+        self.g_batch_size = self.dsparms.prom_man.get_metric('psana_smd0_batch_size')
+
+    def adapt_n_events(self, n_events, nbytes, smd0_wait, eb_wait):
+        """ Updates no. of events for the next chunk from the measurements
+        of the chunk just sent (no-op unless PS_SMD_ADAPTIVE is set)."""
+        if not self.batch_ctrl: return
+        self.smd0_n_events = self.batch_ctrl.update(n_events, nbytes, smd0_wait, eb_wait)
+        self.g_batch_size.labels('n_events').set(self.smd0_n_events)
 
     def _get(self):
         st = time.time()
@@ -142,8 +159,14 @@ class SmdReaderManager(object):
         return batch_iter
         
 
-    def chunks(self):
-        """ Generates a tuple of smd and step dgrams """
+    def chunks(self, copy=True):
+        """ Generates a tuple of smd and step dgrams 
+        
+        With copy=False, smd data are not copied out of SmdReader buffers.
+        The smd chunk is a list of segments instead: one memoryview per
+        smd file followed by the packet footer. These views are only valid 
+        until the next chunk is generated.
+        """
         is_done = False
         while not is_done:
             if self.smdr.is_complete():
@@ -159,21 +182,32 @@ class SmdReaderManager(object):
                     is_done = True
                 
                 smd_view = bytearray()
+                smd_segments = []
                 smd_pf = PacketFooter(n_packets=self.n_files)
                 step_view = bytearray()
                 step_pf = PacketFooter(n_packets=self.n_files)
                 
                 for i, (mmrv_buf, mmrv_step_buf) in enumerate(zip(mmrv_bufs, mmrv_step_bufs)):
                     if mmrv_buf != 0:
-                        smd_view.extend(mmrv_buf)
+                        if copy:
+                            smd_view.extend(mmrv_buf)
+                        smd_segments.append(mmrv_buf)
                         smd_pf.set_size(i, memoryview(mmrv_buf).nbytes)
+                    else:
+                        smd_segments.append(bytearray())
                     
                     if mmrv_step_buf != 0:
                         step_view.extend(mmrv_step_buf)
                         step_pf.set_size(i, memoryview(mmrv_step_buf).nbytes)
 
+                if not copy:
+                    if any(memoryview(segment).nbytes for segment in smd_segments):
+                        smd_view = smd_segments + [smd_pf.footer]
+                    else:
+                        smd_view = []
+
                 if smd_view or step_view:
-                    if smd_view:
+                    if smd_view and copy:
                         smd_view.extend(smd_pf.footer)
                     if step_view:
                         step_view.extend(step_pf.footer)
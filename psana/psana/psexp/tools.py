@@ -2,7 +2,8 @@ import weakref
 import os
 import logging
 
-# mode can be 'mpi' or 'legion' or 'none' for non parallel 
+# mode can be 'mpi' or 'legion' or 'local' (worker processes on one
+# machine without MPI, see local_node.py) or 'none' for non parallel 
 mode = os.environ.get('PS_PARALLEL', 'mpi')
 
 
@@ -0,0 +1,272 @@
+import numpy as np
+import os
+import sys
+import json
+import time
+import socket
+import atexit
+import functools
+import itertools
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Span names - 'wait' is time a rank is blocked on its peers (idle),
+# everything else is counted as busy time of the rank.
+SPANS = ('read',            # smd0: reading smd chunks
+         'wait',            # blocked on a request/data from another rank
+         'send',            # sending a chunk/batch to another rank
+         'build',           # eb: building events and batches from a chunk
+         'bd_read',         # bd: reading bigdata
+         'ana',             # bd: user analysis (time between yielded events)
+         'smalldata_send',  # bd: shipping a smalldata batch to a server
+         )
+SPAN_IDS = {name: i for i, name in enumerate(SPANS)}
+ROLES = ('smd0', 'eb', 'bd', 'srv')
+
+
+class Tracer(object):
+    """ Per-rank ring buffer of span events (PS_TRACE=<directory>).
+
+    A span is (span id, thread, start, end) with time.monotonic() start
+    and end. Only the last capacity (PS_TRACE_BUFFER) spans are kept. When
+    tracing is off, add() returns right away so the calls can stay in
+    the node loops.
+
+    At exit, each rank saves its spans to <directory>/rank<N>.npz and
+    the first rank, after the others have done so (see start), merges
+    them into a Chrome/Perfetto trace (trace.json) and a summary of busy,
+    idle, and critical-path time per role (summary.txt). The trace_merge
+    app does the same merge offline (e.g. when rank 0 was killed or some
+    ranks were missing from the merge).
+    """
+    dtype = np.dtype([('span', 'u1'), ('tid', 'u1'), ('start', '<f8'), ('end', '<f8'), ('peer', '<i4')])
+
+    def __init__(self):
+        self.enabled = False
+        self.rank = 0
+        self.role = None
+
+    def start(self, rank, role, trace_dir=None, capacity=None, barrier=None, n_ranks=None):
+        """ Starts recording if PS_TRACE (or trace_dir) is set. Before
+        merging at exit, rank 0 calls barrier (returns when the other
+        ranks have saved their spans, e.g. they exited) and/or waits for
+        the saved spans of n_ranks ranks, at most PS_TRACE_MERGE_TIMEOUT
+        seconds. The latter is not a collective call, so ranks that died
+        don't hang the others at exit."""
+        trace_dir = trace_dir or os.environ.get('PS_TRACE')
+        if not trace_dir or self.enabled: return
+        if capacity is None:
+            capacity = int(os.environ.get('PS_TRACE_BUFFER', 0x40000))
+        self.trace_dir = trace_dir
+        self.rank = rank
+        self.role = role
+        self.barrier = barrier
+        self.n_ranks = n_ranks
+        self.jobid = os.environ.get('PS_PROMETHEUS_JOBID', str(os.getpid())) # same on all ranks
+        self.records = np.zeros(capacity, dtype=self.dtype)
+        self.counter = itertools.count()
+        self.main_ident = threading.get_ident()
+        # monotonic clocks of different nodes are aligned with wall time
+        self.clock_offset = time.time() - time.monotonic()
+        os.makedirs(trace_dir, exist_ok=True)
+        self.enabled = True
+        atexit.register(self.finish)
+        logger.debug(f'tracer: rank {rank} ({role}) tracing to {trace_dir}')
+
+    def add(self, span, st, en, peer=-1):
+        """ Records a span (name from SPANS) from st to en (time.monotonic()) """
+        if not self.enabled: return
+        i = next(self.counter) # atomic with the GIL (spans from reader threads)
+        rec = self.records[i % self.records.shape[0]]
+        rec['span'] = SPAN_IDS[span]
+        rec['tid'] = threading.get_ident() != self.main_ident
+        rec['start'] = st
+        rec['end'] = en
+        rec['peer'] = peer
+
+    def timed(self, span):
+        """ Decorator recording each call of the function as a span """
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled: return fn(*args, **kwargs)
+                st = time.monotonic()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.add(span, st, time.monotonic())
+            return wrapper
+        return decorator
+
+    def spans(self):
+        """ Returns recorded spans (oldest first) and the no. of dropped
+        spans. Only called once recording is done (see finish). """
+        n = next(self.counter)
+        capacity = self.records.shape[0]
+        if n <= capacity:
+            return self.records[:n].copy(), 0
+        return np.roll(self.records, -(n % capacity)), n - capacity
+
+    def save(self):
+        spans, dropped = self.spans()
+        meta = {'jobid': self.jobid, 'rank': self.rank, 'role': self.role, 'host': socket.gethostname(),
+                'pid': os.getpid(), 'clock_offset': self.clock_offset, 'dropped': dropped}
+        path = rank_path(self.trace_dir, self.rank)
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, spans=spans, meta=json.dumps(meta))
+        os.replace(path + '.tmp', path)
+        if dropped:
+            logger.warning(f'tracer: rank {self.rank} dropped {dropped} oldest spans (PS_TRACE_BUFFER={self.records.shape[0]})')
+        return path
+
+    def finish(self):
+        """ Saves spans of this rank and, on rank 0, merges all of them """
+        if not self.enabled: return
+        self.enabled = False
+        self.save()
+        if self.rank != 0: return
+        if hasattr(sys, 'last_value'):
+            # unwinding from an uncaught exception - the other ranks may never finish
+            logger.warning('tracer: exiting on an exception, merging the spans saved so far (see trace_merge)')
+        else:
+            if self.barrier is not None:
+                self.barrier()
+            if self.n_ranks:
+                self._wait_for_ranks(float(os.environ.get('PS_TRACE_MERGE_TIMEOUT', 60)))
+        summary = write_trace(self.trace_dir, jobid=self.jobid)
+        logger.info(f'tracer: wrote {os.path.join(self.trace_dir, "trace.json")}\n{summary}')
+
+    def _wait_for_ranks(self, timeout):
+        """ Waits until all n_ranks ranks saved their spans of this job
+        or timeout (seconds) is over. """
+        deadline = time.monotonic() + timeout
+        pending = set(range(self.n_ranks)) - {self.rank}
+        while True:
+            pending = {rank for rank in pending
+                    if _saved_jobid(rank_path(self.trace_dir, rank)) != self.jobid}
+            if not pending or time.monotonic() > deadline: break
+            time.sleep(0.1)
+        if pending:
+            logger.warning(f'tracer: no spans from {len(pending)} ranks after {timeout}s, '
+                    f'merging without them (e.g. rank {min(pending)})')
+
+
+tracer = Tracer()
+
+
+def rank_path(trace_dir, rank):
+    return os.path.join(trace_dir, f'rank{rank}.npz')
+
+def _saved_jobid(path):
+    """ Returns jobid of the spans saved in path (None if there are none) """
+    try:
+        with np.load(path) as f:
+            return json.loads(str(f['meta']))['jobid']
+    except (OSError, ValueError, KeyError):
+        return None
+
+def load_traces(trace_dir, jobid=None):
+    """ Returns [(meta, spans)] of all ranks of the job saved in trace_dir.
+    Without jobid, the job of the latest saved rank is used. """
+    traces = []
+    paths = [os.path.join(trace_dir, name) for name in os.listdir(trace_dir)
+            if name.startswith('rank') and name.endswith('.npz')]
+    for path in sorted(paths, key=os.path.getmtime, reverse=True):
+        with np.load(path) as f:
+            meta = json.loads(str(f['meta']))
+            if jobid is None: jobid = meta['jobid']
+            if meta['jobid'] == jobid:
+                traces.append((meta, f['spans']))
+    traces.sort(key=lambda trace: trace[0]['rank'])
+    return traces
+
+def chrome_trace(traces):
+    """ Returns Chrome/Perfetto trace (JSON object format) with one process
+    per rank. Times are in microseconds from the earliest span. """
+    t0 = min([spans['start'].min() + meta['clock_offset'] for meta, spans in traces if spans.shape[0]], default=0)
+    events = []
+    for meta, spans in traces:
+        rank = meta['rank']
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': rank,
+            'args': {'name': f"rank {rank} ({meta['role']}) {meta['host']}"}})
+        events.append({'name': 'process_sort_index', 'ph': 'M', 'pid': rank, 'args': {'sort_index': rank}})
+        ts = np.round((spans['start'] + meta['clock_offset'] - t0) * 1e6, 3)
+        dur = np.round((spans['end'] - spans['start']) * 1e6, 3)
+        for span, tid, st, d, peer in zip(spans['span'].tolist(), spans['tid'].tolist(),
+                ts.tolist(), dur.tolist(), spans['peer'].tolist()):
+            event = {'name': SPANS[span], 'cat': meta['role'], 'ph': 'X', 'pid': rank, 'tid': tid, 'ts': st, 'dur': d}
+            if peer >= 0: event['args'] = {'peer': peer}
+            events.append(event)
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+def summarize(traces):
+    """ Returns {role: stats} with mean seconds per rank of each span
+    of the main thread, busy and idle (wait) fraction of the rank's
+    lifetime, and critical path: the busy time of the busiest rank of
+    the role. The role with the longest critical path is the bottleneck
+    of the pipeline.
+
+    Spans of other threads (e.g. bd wait and bd_read of the batch 
+    prefetcher and read pool) overlap with the main thread, so they are 
+    reported separately (thread_spans, mean seconds per rank) and are 
+    not part of busy, idle, or critical time. """
+    by_role = {}
+    thread_totals = {}
+    for meta, spans in traces:
+        by_role.setdefault(meta['role'], []).append(spans[spans['tid'] == 0])
+        thread_spans = spans[spans['tid'] != 0]
+        thread_totals[meta['role']] = thread_totals.get(meta['role'], 0.) + np.bincount(thread_spans['span'],
+                weights=thread_spans['end'] - thread_spans['start'], minlength=len(SPANS))
+    wait = SPAN_IDS['wait']
+    nested = SPAN_IDS['smalldata_send'] # sent from the user loop (within ana)
+    summary = {}
+    for role in sorted(by_role, key=lambda r: ROLES.index(r) if r in ROLES else len(ROLES)):
+        ranks = by_role[role]
+        walls, busys, idles = [], [], []
+        totals = np.zeros(len(SPANS))
+        for spans in ranks:
+            dur = spans['end'] - spans['start']
+            totals += np.bincount(spans['span'], weights=dur, minlength=len(SPANS))
+            walls.append(spans['end'].max() - spans['start'].min() if spans.shape[0] else 0.)
+            idles.append(dur[spans['span'] == wait].sum())
+            busys.append(dur.sum() - idles[-1] - dur[spans['span'] == nested].sum())
+        wall = max(walls)
+        thread_total = thread_totals[role]
+        summary[role] = {'ranks': len(ranks), 'wall': wall,
+                'spans': {name: totals[i] / len(ranks) for i, name in enumerate(SPANS) if totals[i] > 0},
+                'thread_spans': {name: thread_total[i] / len(ranks) for i, name in enumerate(SPANS) if thread_total[i] > 0},
+                'busy': np.mean(busys) / wall if wall else 0.,
+                'idle': np.mean(idles) / wall if wall else 0.,
+                'critical': max(busys)}
+    return summary
+
+def format_summary(summary):
+    """ Returns the summary as a text table (* marks the bottleneck role) """
+    bottleneck = max(summary, key=lambda role: summary[role]['critical'], default=None)
+    header = f"{'role':6s} {'ranks':>5s} {'wall(s)':>9s} {'busy':>6s} {'idle':>6s} {'critical(s)':>11s}  "
+    lines = [header + 'mean seconds per rank']
+    for role, s in summary.items():
+        spans = ' '.join(f'{name}={seconds:.3f}' for name, seconds in s['spans'].items())
+        name = role + '*' if role == bottleneck else role
+        lines.append(f"{name:6s} {s['ranks']:5d} {s['wall']:9.3f} "
+                f"{s['busy']:6.1%} {s['idle']:6.1%} {s['critical']:11.3f}  {spans}")
+        if s.get('thread_spans'):
+            spans = ' '.join(f'{name}={seconds:.3f}' for name, seconds in s['thread_spans'].items())
+            lines.append(' ' * len(header) + f'other threads: {spans}')
+    return '\n'.join(lines)
+
+def write_trace(trace_dir, jobid=None):
+    """ Merges the per-rank spans in trace_dir (see load_traces) into 
+    trace.json and summary.txt and returns the summary table. """
+    traces = load_traces(trace_dir, jobid=jobid)
+    with open(os.path.join(trace_dir, 'trace.json'), 'w') as f:
+        json.dump(chrome_trace(traces), f)
+    summary = format_summary(summarize(traces))
+    dropped = sum(meta['dropped'] for meta, _ in traces)
+    if dropped:
+        summary += f'\n(ring buffers dropped {dropped} oldest spans - increase PS_TRACE_BUFFER)'
+    with open(os.path.join(trace_dir, 'summary.txt'), 'w') as f:
+        f.write(summary + '\n')
+    return summary
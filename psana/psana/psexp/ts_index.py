@@ -0,0 +1,238 @@
+import numpy as np
+import os
+import re
+import json
+import struct
+import hashlib
+import tempfile
+from psana import dgram
+from . import TransitionId
+from .smd_batch import SmdBatch, _gather
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class TimestampIndex(object):
+    """ Timestamp -> file offsets index of the dgrams of a run.
+
+    The index has one row per dgram of each file sorted by (timestamp, 
+    ifile) so rows of one event are next to each other:
+    - timestamp, service: of the dgram
+    - ifile: index of the file in the given list of files
+    - smd_offset, smd_size: location of the dgram in the indexed file
+    - bd_offset, bd_size: location of the dgram in the bigdata file.
+      These come from smdinfo of L1Accept smd dgrams. For bigdata files
+      (smd=False) and for dgrams without smdinfo (transitions), they are 
+      the same as smd_offset and smd_size.
+
+    The rows are saved once by columns (uint64 array of shape (7, n)) as
+    .npy file next to the indexed files (or in PS_TS_INDEX_DIR or 
+    ~/.cache/psana/tsidx when that directory is not writable) and are
+    memory-mapped on open, so a timestamp lookup only touches a few pages
+    of the timestamp column. The index is rebuilt when any of the indexed
+    files changed its size (e.g. a live run).
+    """
+    dtype = np.dtype([('timestamp', '<u8'), ('service', 'u1'), ('ifile', '<u2'),
+        ('smd_offset', '<i8'), ('smd_size', '<i8'), ('bd_offset', '<i8'), ('bd_size', '<i8')])
+    version = 1
+    chunksize = 0x4000000
+
+    def __init__(self, columns, files):
+        self.columns = columns
+        self.files = files
+        self.timestamps = columns[0]
+
+    def __len__(self):
+        return self.columns.shape[1]
+
+    def rows(self, sel):
+        """ Returns rows selected by a slice or positions as a structured array (see dtype). """
+        rows = np.zeros(self.columns[0, sel].shape[0], dtype=self.dtype)
+        for i, name in enumerate(self.dtype.names):
+            rows[name] = self.columns[i, sel]
+        return rows
+
+    @classmethod
+    def open(cls, files, smd=True, index_dir=None, build=True):
+        """ Returns memory-mapped index of smd (or bigdata with smd=False) files.
+
+        The index is built and saved when it doesn't exist or it's stale.
+        With build=False, returns None instead.
+        """
+        files = [os.path.abspath(f) for f in files]
+        sizes = [os.path.getsize(f) for f in files]
+
+        for path in cls._index_paths(files, index_dir):
+            columns = cls._load(path, cls._meta(files, sizes, smd))
+            if columns is not None:
+                logger.debug(f'ts_index: loaded {path} ({columns.shape[1]} dgrams)')
+                return cls(columns, files)
+
+        if not build: return None
+
+        table = cls.build(files, smd=smd)
+        columns = np.stack([table[name].astype(np.uint64) for name in cls.dtype.names])
+        meta = cls._meta(files, sizes, smd)
+        for path in cls._index_paths(files, index_dir):
+            if cls._save(path, columns, meta):
+                logger.debug(f'ts_index: saved {path} ({columns.shape[1]} dgrams)')
+                return cls(cls._load(path, meta), files)
+        return cls(columns, files)
+
+    @classmethod
+    def _index_paths(cls, files, index_dir):
+        """ Returns candidate index file paths: the given index_dir or
+        directory of the files, PS_TS_INDEX_DIR, and ~/.cache/psana/tsidx."""
+        basenames = [os.path.basename(f) for f in files]
+        prefix = re.sub(r'-s\d+.*$', '', basenames[0]) if len(files) > 1 else basenames[0]
+        key = hashlib.sha1('\0'.join(sorted(basenames)).encode()).hexdigest()[:8]
+        name = f'{prefix}-{key}.tsidx.npy'
+        dirs = [index_dir] if index_dir else [os.path.dirname(files[0])]
+        if os.environ.get('PS_TS_INDEX_DIR'): dirs.append(os.environ['PS_TS_INDEX_DIR'])
+        dirs.append(os.path.join(os.path.expanduser('~'), '.cache', 'psana', 'tsidx'))
+        return [os.path.join(d, name) for d in dirs]
+
+    @classmethod
+    def _load(cls, path, meta):
+        try:
+            with open(path[:-4] + '.json', 'r') as f:
+                saved_meta = json.load(f)
+            if saved_meta != meta:
+                logger.debug(f'ts_index: {path} is stale')
+                return None
+            columns = np.load(path, mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+        if columns.dtype != np.uint64 or columns.shape[:1] != (len(cls.dtype.names),): return None
+        return columns
+
+    @classmethod
+    def _meta(cls, files, sizes, smd):
+        return {'version': cls.version, 'smd': smd, 'files': [os.path.basename(f) for f in files], 'sizes': sizes}
+
+    @classmethod
+    def _save(cls, path, columns, meta):
+        """ Writes the columns and metadata (.json) atomically.
+        Returns False if the directory is not writable."""
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            for suffix, write in (('.npy', lambda f: np.save(f, columns)),
+                    ('.json', lambda f: f.write(json.dumps(meta).encode()))):
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+                try:
+                    with os.fdopen(fd, 'wb') as f: write(f)
+                    os.replace(tmp, path[:-4] + suffix)
+                except BaseException:
+                    os.unlink(tmp)
+                    raise
+        except OSError as e:
+            logger.debug(f'ts_index: cannot write {path}: {e}')
+            return False
+        return True
+
+    @classmethod
+    def build(cls, files, smd=True):
+        """ Scans the files and returns the index rows (not saved). """
+        tables = [cls._scan(f, ifile, smd) for ifile, f in enumerate(files)]
+        table = np.concatenate(tables) if tables else np.zeros(0, dtype=cls.dtype)
+        return table[np.lexsort((table['ifile'], table['timestamp']))]
+
+    @classmethod
+    def _scan(cls, filename, ifile, smd):
+        """ Returns index rows of all complete dgrams in the file. """
+        tables = []
+        config_view = None
+        file_offset = 0
+        file_size = os.path.getsize(filename)
+        with open(filename, 'rb') as f:
+            while True:
+                buf = f.read(cls.chunksize)
+                starts, sizes = cls._walk(buf)
+                if not starts:
+                    # only the header of a dgram larger than the chunk is needed
+                    if len(buf) < 24: break
+                    size = 12 + struct.unpack_from('<I', buf, 20)[0]
+                    if file_offset + size > file_size: break
+                    starts, sizes = [0], [size]
+                if smd and config_view is None:
+                    config_view = bytearray(buf[:sizes[0]]) # Configure is the first dgram
+                tables.append(cls._scan_rows(buf, np.asarray(starts, dtype=np.int64),
+                    np.asarray(sizes, dtype=np.int64), file_offset, ifile, config_view))
+                file_offset += starts[-1] + sizes[-1]
+                f.seek(file_offset)
+        return np.concatenate(tables) if tables else np.zeros(0, dtype=cls.dtype)
+
+    @staticmethod
+    def _walk(buf):
+        """ Returns start positions and sizes of the complete dgrams in buf. """
+        starts, sizes = [], []
+        pos, n = 0, len(buf)
+        unpack_from = struct.Struct('<I').unpack_from
+        while pos + 24 <= n:
+            size = 12 + unpack_from(buf, pos + 20)[0] # sizeof(TransitionBase) + xtc extent
+            if pos + size > n: break
+            starts.append(pos)
+            sizes.append(size)
+            pos += size
+        return starts, sizes
+
+    @classmethod
+    def _scan_rows(cls, buf, starts, sizes, file_offset, ifile, config_view):
+        u8 = np.frombuffer(buf, dtype=np.uint8)
+        rows = np.zeros(starts.shape[0], dtype=cls.dtype)
+        rows['timestamp'] = _gather(u8, starts, 8)
+        rows['service'] = (_gather(u8, starts + 8, 4) >> 24) & 0x0f
+        rows['ifile'] = ifile
+        rows['smd_offset'] = rows['bd_offset'] = file_offset + starts
+        rows['smd_size'] = rows['bd_size'] = sizes
+
+        if config_view is None: return rows # bigdata file
+
+        # smd L1Accepts point to their bigdata dgrams (see SmdBatch)
+        is_l1 = rows['service'] == TransitionId.L1Accept
+        has_smdinfo = is_l1 & (sizes == SmdBatch.smdinfo_size)
+        for word, extent in SmdBatch.smdinfo_extents:
+            has_smdinfo[has_smdinfo] = _gather(u8, starts[has_smdinfo] + 4 * word, 4) == extent
+        rows['bd_offset'][has_smdinfo] = _gather(u8, starts[has_smdinfo] + SmdBatch.smdinfo_payload, 8)
+        rows['bd_size'][has_smdinfo] = _gather(u8, starts[has_smdinfo] + SmdBatch.smdinfo_payload + 8, 8)
+
+        config = None
+        for i in np.nonzero(is_l1 & ~has_smdinfo & (starts + sizes <= u8.shape[0]))[0]:
+            if config is None: config = dgram.Dgram(view=config_view, offset=0)
+            d = dgram.Dgram(config=config, view=memoryview(buf)[starts[i]: starts[i] + sizes[i]])
+            if hasattr(d, "smdinfo"):
+                rows['bd_offset'][i] = d.smdinfo[0].offsetAlg.intOffset
+                rows['bd_size'][i] = d.smdinfo[0].offsetAlg.intDgramSize
+        return rows
+
+    def find(self, timestamp):
+        """ Returns rows (one per file) of the event with this timestamp. """
+        st = int(np.searchsorted(self.timestamps, timestamp, side='left'))
+        en = int(np.searchsorted(self.timestamps, timestamp, side='right'))
+        return self.rows(slice(st, en))
+
+    def positions(self, begin=None, end=None):
+        """ Returns start, stop positions of rows with begin <= timestamp < end. """
+        st = 0 if begin is None else int(np.searchsorted(self.timestamps, begin, side='left'))
+        en = len(self) if end is None else int(np.searchsorted(self.timestamps, end, side='left'))
+        return st, max(st, en)
+
+    def events(self, st, en, transitions_only=False, chunk=0x10000):
+        """ Generates rows of each event (rows with the same timestamp) in 
+        st:en. Rows are read from the memory-mapped columns in chunks."""
+        while st < en:
+            stop = min(st + chunk, en)
+            if stop < en: # keep rows of an event in one chunk
+                stop = int(np.searchsorted(self.timestamps, self.timestamps[stop], side='left'))
+                if stop == st:
+                    stop = int(np.searchsorted(self.timestamps, self.timestamps[st], side='right'))
+            if transitions_only:
+                rows = self.rows(st + np.flatnonzero(self.columns[1, st:stop] != TransitionId.L1Accept))
+            else:
+                rows = self.rows(slice(st, stop))
+            st = stop
+            if not rows.shape[0]: continue
+            bounds = np.concatenate(([0], np.flatnonzero(np.diff(rows['timestamp'])) + 1, [rows.shape[0]]))
+            for i_st, i_en in zip(bounds[:-1], bounds[1:]):
+                yield rows[i_st:i_en]
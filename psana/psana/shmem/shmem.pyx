@@ -1,10 +1,27 @@
 
+from cpython.buffer cimport PyBuffer_FillInfo
+
 cdef extern from "psalg/shmem/ShmemClient.hh" namespace "psalg::shmem":
     cdef cppclass ShmemClient:
         int connect(const char* tag, int tr_index)
         void *get(int& ev_index, size_t& buf_size)
         void free(int ev_index, size_t buf_size)
 
+cdef class ShmemBuffer:
+    """ Read-only buffer of a dgram in shared memory. Views and arrays
+    made from it keep it alive so it can be freed (see 
+    psana.dgrammanager.ShmemBuffers) when it's garbage-collected.
+    """
+    cdef char* buf
+    cdef Py_ssize_t size
+    cdef object __weakref__
+
+    def __getbuffer__(self, Py_buffer *buffer, int flags):
+        PyBuffer_FillInfo(buffer, self, self.buf, self.size, 1, flags)
+
+    def __releasebuffer__(self, Py_buffer *buffer):
+        pass
+
 cdef class PyShmemClient:
     """ Python wrapper for C++ class.
     """
@@ -47,3 +64,22 @@ cdef class PyShmemClient:
 
     def freeByIndex(self, index, size):
         self.client.free(index, size)
+
+    def get_buffer(self,args):
+        cdef char* buf
+        cdef int ev_index = -1
+        cdef size_t buf_size = 0
+        cdef ShmemBuffer shmem_buf
+
+        buf = <char*>self.client.get(ev_index,buf_size)
+        if buf == NULL:
+          return
+
+        args['index'] = ev_index
+        args['size'] = buf_size
+        args['cli_cptr'] = self.pclient
+
+        shmem_buf = ShmemBuffer()
+        shmem_buf.buf = buf
+        shmem_buf.size = buf_size
+        return shmem_buf
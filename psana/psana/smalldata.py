@@ -60,6 +60,11 @@ Some Notes:
 """                          
 
 import os
+import time
+import queue
+import fnmatch
+import threading
+import operator
 import numpy as np
 import h5py
 from collections.abc import MutableMapping
@@ -67,14 +72,20 @@ from collections.abc import MutableMapping
 # -----------------------------------------------------------------------------
 
 from psana.psexp.tools import mode
+from psana.psexp.prometheus_manager import PrometheusManager
+from psana.psexp.tracer import tracer
 
 if mode == 'mpi':
     from mpi4py import MPI
     COMM = MPI.COMM_WORLD
     RANK = COMM.Get_rank()
     SIZE = COMM.Get_size()
+    ANY_SOURCE = MPI.ANY_SOURCE
+    SUM  = MPI.SUM
 else:
     SIZE = 1
+    ANY_SOURCE = -1         # see psexp/local_node.py LocalComm
+    SUM  = operator.add
 
 if SIZE > 1:
     MODE = 'PARALLEL'
@@ -96,6 +107,21 @@ UNALIGED_PREFIX = 'unaligned_'
 def is_unaligned(dset_name):
     return dset_name.split('/')[-1].startswith(UNALIGED_PREFIX)
 
+# HDF5 storage policy of a dataset (see SmallData.setup_parms)
+#   compression      : None, 'gzip', 'lzf' or the id of a registered filter
+#   compression_opts : passed to h5py along with compression
+#   shuffle          : byte shuffle filter (helps compression)
+#   chunk_bytes      : target chunk size in bytes, None for chunks of
+#                      cache_size events
+DEFAULT_STORAGE_POLICY = {'compression'      : None,
+                          'compression_opts' : None,
+                          'shuffle'          : False,
+                          'chunk_bytes'      : None}
+
+# Datasets are grown geometrically by this factor (and trimmed when the
+# server is done) so that they are not resized on every write
+DSET_GROWTH_FACTOR = 2
+
 # -----------------------------------------------------------------------------
 
 
@@ -128,6 +154,78 @@ def _get_missing_value(dtype):
     return missing_value
 
 
+def _chunk_shape(shape, dtype, cache_size, chunk_bytes):
+    """
+    Returns the chunk shape for a dataset of (n_events,) + shape.
+
+    Without chunk_bytes, a chunk holds cache_size events. Otherwise,
+    the no. of events is picked so that a chunk is about chunk_bytes
+    (and at most cache_size events). Events larger than chunk_bytes are
+    split by halving their largest dimension.
+    """
+    if chunk_bytes is None:
+        return (cache_size,) + shape
+
+    itemsize = np.dtype(dtype).itemsize
+    event_shape = list(shape)
+    while itemsize * int(np.prod(event_shape)) > chunk_bytes and max(event_shape) > 1:
+        i_max = int(np.argmax(event_shape))
+        event_shape[i_max] = (event_shape[i_max] + 1) // 2
+    event_nbytes = itemsize * int(np.prod(event_shape))
+
+    n_events = min(cache_size, max(1, chunk_bytes // max(1, event_nbytes)))
+    return (n_events,) + tuple(event_shape)
+
+
+def _stack_values(values):
+    """
+    Returns (values, kind) of the values of a dataset in a batch:
+    - 'array': ndarrays (or numpy scalars) of the same shape and dtype,
+      stacked into one array
+    - 'scalar': Python ints or Python floats (not mixed), as an i8/f8 array
+    - 'rows': anything else (e.g. ragged arrays, mixed int/float), the 
+      list of values itself - the server writes these event by event
+    """
+    first = values[0]
+    if isinstance(first, (np.ndarray, np.generic)):
+        if all(type(value) is type(first) and value.shape == first.shape 
+               and value.dtype == first.dtype for value in values):
+            return np.stack(values) if isinstance(first, np.ndarray) \
+                    else np.array(values, dtype=first.dtype), 'array'
+    elif type(first) in (int, float):
+        if all(type(value) is type(first) for value in values):
+            return np.array(values, dtype='i8' if type(first) is int else 'f8'), 'scalar'
+    return values, 'rows'
+
+
+def _batch_to_columns(batch):
+    """
+    Converts a batch (list of event dicts) to a columnar batch:
+
+    {'n_events': N, 'columns': {dataset_name: (presence, values, kind)}}
+
+    where presence is a packed bitmap (np.packbits) of the events that
+    have the dataset and values are the present values only, stacked
+    into an array when possible (see _stack_values for kind).
+    """
+    n_events = len(batch)
+    rows = {}
+    for i_evt, event_data_dict in enumerate(batch):
+        for dataset_name, data in event_data_dict.items():
+            if dataset_name not in rows:
+                rows[dataset_name] = ([], [])
+            rows[dataset_name][0].append(i_evt)
+            rows[dataset_name][1].append(data)
+
+    columns = {}
+    for dataset_name, (i_evts, values) in rows.items():
+        presence = np.zeros(n_events, dtype=bool)
+        presence[i_evts] = True
+        columns[dataset_name] = (np.packbits(presence),) + _stack_values(values)
+
+    return {'n_events': n_events, 'columns': columns}
+
+
 def _format_srv_filename(dirname, basename, rank):
     srv_basename = '%s_part%d.h5' % (basename.strip('.h5'), rank)
     srv_fn = os.path.join(dirname, srv_basename)
@@ -161,20 +259,95 @@ class CacheArray:
         self.n_events += 1
         return
 
+    def extend(self, data):
+        n = data.shape[0]
+        self.data[self.n_events:self.n_events+n,...] = data
+        self.n_events += n
+        return
+
     def reset(self):
         self.n_events = 0
         return
 
 
+class CacheWriter:
+    """
+    Writes full caches to file in a background thread, so that a
+    server keeps receiving from its clients while h5py is busy.
+
+    There is one thread and a FIFO queue, so caches of a dataset are 
+    written in the order they were filled. The queue holds at most
+    `depth` caches: put() blocks when the writer falls behind
+    (backpressure on the server and, in turn, its clients).
+
+    The file handle is shared: the writer thread resizes and writes
+    datasets while the main thread creates new ones (new_dset). This
+    relies on h5py serializing all calls into the HDF5 library with its
+    global lock (the library itself is not built thread-safe) - so the
+    thread overlaps receiving/caching with writing, not writes with
+    each other. Datasets are only resized on this thread (the final trim
+    in done() runs after close()).
+    """
+
+    def __init__(self, write_fn, done_fn, depth):
+        self.write_fn = write_fn # write_fn(dataset_name, cache)
+        self.done_fn  = done_fn  # done_fn(dataset_name, cache) after writing
+        self.queue    = queue.Queue(maxsize=depth)
+        self.error    = None
+        self.thread   = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            dataset_name, cache = item
+            if self.error is None:
+                try:
+                    self.write_fn(dataset_name, cache)
+                except Exception as e:
+                    self.error = e
+            self.done_fn(dataset_name, cache)
+        return
+
+    def _check_error(self):
+        if self.error is not None:
+            raise RuntimeError('SmallData writer thread failed') from self.error
+        return
+
+    def put(self, dataset_name, cache):
+        """
+        Queues a full cache, returns the time (s) blocked on a full queue
+        """
+        self._check_error()
+        st = time.monotonic()
+        self.queue.put((dataset_name, cache))
+        return time.monotonic() - st
+
+    def close(self):
+        """
+        Waits for all queued caches to be written
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self._check_error()
+        return
+
+
 class Server: # (hdf5 handling)
 
     def __init__(self, filename=None, smdcomm=None, cache_size=10000,
-                 callbacks=[]):
+                 callbacks=[], storage_policy={}, dset_storage_policies={},
+                 write_queue_depth=0):
 
         self.filename   = filename
         self.smdcomm    = smdcomm
         self.cache_size = cache_size
         self.callbacks  = callbacks
+        self.storage_policy        = storage_policy
+        self.dset_storage_policies = dset_storage_policies
 
         # maps dataset_name --> (dtype, shape)
         self._dsets = {}
@@ -182,6 +355,20 @@ class Server: # (hdf5 handling)
         # maps dataset_name --> CacheArray()
         self._cache = {}
 
+        # maps dataset_name --> no. of events written to file
+        # (datasets are presized, so this can be smaller than dset.shape[0])
+        self._n_written = {}
+
+        # with write_queue_depth > 0, full caches are written by a
+        # CacheWriter and the server continues with a spare CacheArray 
+        # maps dataset_name --> list of CacheArray() already written
+        self._spares = {}
+        self._writer = None
+        if self.filename is not None and write_queue_depth > 0:
+            self._writer = CacheWriter(self.write_to_file, self._return_spare, write_queue_depth)
+
+        self.c_srv = PrometheusManager.get_metric('psana_srv')
+
         self.num_events_seen = 0
 
         if (self.filename is not None):
@@ -194,9 +381,15 @@ class Server: # (hdf5 handling)
         num_clients_done = 0
         num_clients = self.smdcomm.Get_size() - 1
         while num_clients_done < num_clients:
-            msg = self.smdcomm.recv(source=MPI.ANY_SOURCE)
+            st = time.monotonic()
+            msg = self.smdcomm.recv(source=ANY_SOURCE)
+            self.c_srv.labels('recv_wait_seconds', 'None').inc(time.monotonic() - st)
+            if type(msg) is list or type(msg) is dict:
+                self.c_srv.labels('batches', 'None').inc()
             if type(msg) is list:
                 self.handle(msg)
+            elif type(msg) is dict:
+                self.handle_columns(msg)
             elif msg == 'done':
                 num_clients_done += 1
 
@@ -212,17 +405,17 @@ class Server: # (hdf5 handling)
 
             if self.filename is not None:
 
-                # to_backfill: list of keys we have seen previously
+                # to_backfill: set of keys we have seen previously
                 #              we want to be sure to backfill if we
                 #              dont see them
-                to_backfill = list(self._dsets.keys())
+                to_backfill = set(self._dsets.keys())
 
                 for dataset_name, data in event_data_dict.items():
 
-                    if dataset_name not in self._dsets.keys():
+                    if dataset_name not in self._dsets:
                         self.new_dset(dataset_name, data)
                     else:
-                        to_backfill.remove(dataset_name)
+                        to_backfill.discard(dataset_name)
                     self.append_to_cache(dataset_name, data)
 
                 for dataset_name in to_backfill:
@@ -234,6 +427,83 @@ class Server: # (hdf5 handling)
         return
 
 
+    def handle_columns(self, batch):
+        """
+        Same as handle but for a columnar batch (see _batch_to_columns).
+        Each dataset is written to its cache with slice assignment and
+        missing events are filled in bulk.
+        """
+
+        n_events = batch['n_events']
+        columns = {}
+        for dataset_name, (presence, values, kind) in batch['columns'].items():
+            presence = np.unpackbits(presence, count=n_events).astype(bool)
+            columns[dataset_name] = (presence, values, kind)
+
+        if self.callbacks:
+            # callbacks get the same values as with handle (Python scalars)
+            positions = {dataset_name: np.cumsum(presence) - 1 
+                         for dataset_name, (presence, _, _) in columns.items()}
+            cb_values = {dataset_name: values.tolist() if kind == 'scalar' else values
+                         for dataset_name, (_, values, kind) in columns.items()}
+            for i_evt in range(n_events):
+                event_data_dict = {dataset_name: cb_values[dataset_name][positions[dataset_name][i_evt]]
+                                   for dataset_name, (presence, _, _) in columns.items()
+                                   if presence[i_evt]}
+                for cb in self.callbacks:
+                    cb(event_data_dict)
+
+        if self.filename is not None:
+
+            for dataset_name, (presence, values, kind) in columns.items():
+
+                if kind == 'rows':
+                    self._extend_rows(dataset_name, presence, values)
+                    continue
+
+                if dataset_name not in self._dsets:
+                    self.new_dset(dataset_name, values[0].item() if kind == 'scalar' else values[0])
+
+                if is_unaligned(dataset_name) or presence.all():
+                    self.extend_cache(dataset_name, values)
+                else:
+                    dtype, shape = self._dsets[dataset_name]
+                    column = np.empty((n_events,) + shape, dtype=dtype)
+                    column.fill(_get_missing_value(dtype))
+                    column[presence] = values
+                    self.extend_cache(dataset_name, column)
+
+            for dataset_name in self._dsets:
+                if dataset_name not in columns and not is_unaligned(dataset_name):
+                    self.backfill(dataset_name, n_events)
+
+        self.num_events_seen += n_events
+
+        return
+
+
+    def _extend_rows(self, dataset_name, presence, values):
+        """
+        Writes values of a dataset that could not be stacked (see 
+        _stack_values) one event at a time, as handle does.
+        """
+
+        aligned = not is_unaligned(dataset_name)
+        next_evt = 0 # events of this batch done so far
+        for i_evt, data in zip(np.flatnonzero(presence), values):
+            if dataset_name not in self._dsets:
+                self.new_dset(dataset_name, data) # backfills previous batches
+            if aligned and i_evt > next_evt:
+                self.backfill(dataset_name, i_evt - next_evt)
+            self.append_to_cache(dataset_name, data)
+            next_evt = i_evt + 1
+
+        if aligned and presence.shape[0] > next_evt:
+            self.backfill(dataset_name, presence.shape[0] - next_evt)
+
+        return
+
+
     def new_dset(self, dataset_name, data):
 
         if type(data) == int:
@@ -253,11 +523,17 @@ class Server: # (hdf5 handling)
 
         self._dsets[dataset_name] = (dtype, shape)
 
+        policy = self.get_storage_policy(dataset_name)
         dset = self.file_handle.create_dataset(dataset_name,
                                                (0,) + shape, # (0,) -> expand dim
                                                maxshape=maxshape,
                                                dtype=dtype,
-                                               chunks=(self.cache_size,) + shape)
+                                               chunks=_chunk_shape(shape, dtype,
+                                                                   self.cache_size,
+                                                                   policy['chunk_bytes']),
+                                               compression=policy['compression'],
+                                               compression_opts=policy['compression_opts'],
+                                               shuffle=policy['shuffle'])
 
         if not is_unaligned(dataset_name):
             self.backfill(dataset_name, self.num_events_seen)
@@ -265,30 +541,111 @@ class Server: # (hdf5 handling)
         return
 
 
-    def append_to_cache(self, dataset_name, data):
+    def get_storage_policy(self, dataset_name):
+        """
+        Returns the storage policy of a dataset: the defaults updated by
+        the server-wide policy and then by the first entry of
+        dset_storage_policies whose key (fnmatch pattern) matches the
+        dataset name.
+        """
+
+        policy = dict(DEFAULT_STORAGE_POLICY)
+        policy.update(self.storage_policy)
+        for pattern, dset_policy in self.dset_storage_policies.items():
+            if fnmatch.fnmatchcase(dataset_name, pattern):
+                policy.update(dset_policy)
+                break
+
+        return policy
+
 
-        if dataset_name not in self._cache.keys():
+    def _get_cache(self, dataset_name):
+
+        if dataset_name not in self._cache:
             dtype, shape = self._dsets[dataset_name]
             cache = CacheArray(shape, dtype, self.cache_size)
             self._cache[dataset_name] = cache
         else:
             cache = self._cache[dataset_name]
 
+        return cache
+
+
+    def append_to_cache(self, dataset_name, data):
+
+        cache = self._get_cache(dataset_name)
         cache.append(data)
 
         if cache.n_events == self.cache_size:
+            self._flush_cache(dataset_name, cache)
+
+        return
+
+
+    def extend_cache(self, dataset_name, data):
+        """
+        Appends many events (first axis of data) to the cache, 
+        writing to file each time the cache fills up.
+        """
+
+        cache = self._get_cache(dataset_name)
+        n_events = data.shape[0]
+        i_evt = 0
+        while i_evt < n_events:
+            n_copy = min(n_events - i_evt, self.cache_size - cache.n_events)
+            cache.extend(data[i_evt:i_evt+n_copy])
+            i_evt += n_copy
+
+            if cache.n_events == self.cache_size:
+                cache = self._flush_cache(dataset_name, cache)
+
+        return
+
+
+    def _flush_cache(self, dataset_name, cache):
+        """
+        Writes a full cache to file (directly or through the writer
+        thread) and returns the cache to continue filling.
+        """
+
+        if self._writer is None:
             self.write_to_file(dataset_name, cache)
+            return cache
+
+        spares = self._spares.setdefault(dataset_name, [])
+        if spares:
+            new_cache = spares.pop()
+        else:
+            dtype, shape = self._dsets[dataset_name]
+            new_cache = CacheArray(shape, dtype, self.cache_size)
+        self._cache[dataset_name] = new_cache
+
+        blocked = self._writer.put(dataset_name, cache)
+        self.c_srv.labels('queue_wait_seconds', 'None').inc(blocked)
+
+        return new_cache
 
+
+    def _return_spare(self, dataset_name, cache):
+        # called by the writer thread once a cache is written
+        cache.reset()
+        self._spares[dataset_name].append(cache)
         return
 
 
     def write_to_file(self, dataset_name, cache):
+        st = time.monotonic()
         dset = self.file_handle.get(dataset_name)
-        new_size = (dset.shape[0] + cache.n_events,) + dset.shape[1:]
-        dset.resize(new_size)
+        n_written = self._n_written.get(dataset_name, 0)
+        n_total = n_written + cache.n_events
+        if n_total > dset.shape[0]:
+            new_size = (max(n_total, int(dset.shape[0] * DSET_GROWTH_FACTOR)),) + dset.shape[1:]
+            dset.resize(new_size)
         # remember: data beyond n_events in the cache may be OLD
-        dset[-cache.n_events:,...] = cache.data[:cache.n_events,...] 
+        dset[n_written:n_total,...] = cache.data[:cache.n_events,...] 
+        self._n_written[dataset_name] = n_total
         cache.reset()
+        self.c_srv.labels('write_seconds', 'None').inc(time.monotonic() - st)
         return
 
 
@@ -297,11 +654,10 @@ class Server: # (hdf5 handling)
         dtype, shape = self._dsets[dataset_name]
 
         missing_value = _get_missing_value(dtype) 
-        fill_data = np.empty(shape, dtype=dtype)
+        fill_data = np.empty((num_to_backfill,) + shape, dtype=dtype)
         fill_data.fill(missing_value)
     
-        for i in range(num_to_backfill):
-            self.append_to_cache(dataset_name, fill_data)
+        self.extend_cache(dataset_name, fill_data)
         
         return
 
@@ -309,9 +665,18 @@ class Server: # (hdf5 handling)
     def done(self):
         if (self.filename is not None):
             # flush the data caches (in case did not hit cache_size yet)
-            for dset, cache in self._cache.items():
+            for dset, cache in list(self._cache.items()):
                 if cache.n_events > 0:
-                    self.write_to_file(dset, cache)
+                    self._flush_cache(dset, cache)
+            if self._writer is not None:
+                self._writer.close()
+
+            # trim presized datasets to the no. of events written
+            for dataset_name, n_written in self._n_written.items():
+                dset = self.file_handle.get(dataset_name)
+                if dset.shape[0] != n_written:
+                    dset.resize((n_written,) + dset.shape[1:])
+
             self.file_handle.close()
         return
 
@@ -319,7 +684,7 @@ class Server: # (hdf5 handling)
 
 class SmallData: # (client)
 
-    def __init__(self, server_group=None, client_group=None):
+    def __init__(self, server_group=None, client_group=None, local_comms=None):
         """
         Parameters
         ----------
@@ -328,8 +693,19 @@ class SmallData: # (client)
 
         client_group : MPI.Group
             The MPI group to allocate to client processes
+
+        local_comms : psexp.local_node.LocalCommunicators
+            Comms of a local parallel run (PS_PARALLEL=local) used
+            instead of the MPI groups
         """
-        if MODE == 'PARALLEL':
+        self._mode = MODE
+        if local_comms is not None:
+            self._mode = 'PARALLEL'
+            self._server_group = local_comms.srv_group
+            self._type, self._smalldata_comm, self._client_comm, self._srvcomm = \
+                    local_comms.smalldata_comms()
+
+        elif self._mode == 'PARALLEL':
 
             self._server_group = server_group
             self._client_group = client_group
@@ -337,7 +713,9 @@ class SmallData: # (client)
             self._comm_partition()
 
     def setup_parms(self, filename=None, batch_size=10000, cache_size=None,
-                 callbacks=[]):
+                 callbacks=[], columnar=False, compression=None,
+                 compression_opts=None, shuffle=False, chunk_bytes=None,
+                 storage={}, write_queue_depth=0):
         """
         Parameters
         ----------
@@ -359,9 +737,40 @@ class SmallData: # (client)
             names and the values are the data themselves. Each event
             processed will have it's own dictionary of this form
             containing the data saved for that event.
+
+        columnar : bool
+            Send each batch as per-dataset columns with a presence
+            bitmap instead of a list of event dictionaries (faster
+            for servers with many datasets and large batches)
+
+        compression : str or int
+            HDF5 compression of all datasets: 'gzip', 'lzf' or the id
+            of a registered filter (None for no compression)
+
+        compression_opts : 
+            Options of the compression filter (e.g. gzip level)
+
+        shuffle : bool
+            Apply the byte shuffle filter before compression
+
+        chunk_bytes : int
+            Target size in bytes of a dataset chunk. By default a chunk
+            holds `cache_size` events.
+
+        storage : dict
+            Per-dataset overrides of the above settings, e.g.
+            {'ragged_*': {'compression': 'lzf', 'chunk_bytes': 1<<20}}.
+            Keys are fnmatch patterns of dataset names; the first
+            matching pattern is used.
+
+        write_queue_depth : int
+            No. of full caches each server can hand to a background
+            writer thread (it keeps receiving from clients meanwhile).
+            0 writes caches synchronously.
         """
 
         self.batch_size = batch_size
+        self._columnar = columnar
         self._batch = []
         self._previous_timestamp = -1
 
@@ -378,7 +787,12 @@ class SmallData: # (client)
             self._dirname  = os.path.dirname(filename)
         self._first_open = True # filename has not been opened yet
 
-        if MODE == 'PARALLEL':
+        storage_policy = {'compression'      : compression,
+                          'compression_opts' : compression_opts,
+                          'shuffle'          : shuffle,
+                          'chunk_bytes'      : chunk_bytes}
+
+        if self._mode == 'PARALLEL':
 
             # hide intermediate files -- join later via VDS
             if filename is not None:
@@ -392,15 +806,21 @@ class SmallData: # (client)
                 self._server = Server(filename=self._srv_filename, 
                                       smdcomm=self._srvcomm, 
                                       cache_size=cache_size,
-                                      callbacks=callbacks)
+                                      callbacks=callbacks,
+                                      storage_policy=storage_policy,
+                                      dset_storage_policies=storage,
+                                      write_queue_depth=write_queue_depth)
                 self._server.recv_loop()
 
-        elif MODE == 'SERIAL':
+        elif self._mode == 'SERIAL':
             self._srv_filename = self._full_filename # dont hide file
             self._type = 'serial'
             self._server = Server(filename=self._srv_filename,
                                   cache_size=cache_size,
-                                  callbacks=callbacks)
+                                  callbacks=callbacks,
+                                  storage_policy=storage_policy,
+                                  dset_storage_policies=storage,
+                                  write_queue_depth=write_queue_depth)
 
         return
 
@@ -442,14 +862,14 @@ class SmallData: # (client)
         makes sure we overwrite on first open, but not after that
         """
 
-        if MODE == 'PARALLEL':
+        if self._mode == 'PARALLEL':
             if self._first_open == True and self._full_filename is not None:
                 fh = h5py.File(self._full_filename, 'w', libver='latest')
                 self._first_open = False
             else:
                 fh = h5py.File(self._full_filename, 'r+', libver='latest')
 
-        elif MODE == 'SERIAL':
+        elif self._mode == 'SERIAL':
             fh = self._server.file_handle
 
         return fh
@@ -487,11 +907,7 @@ class SmallData: # (client)
             # (this avoids splitting events if we have multiple
             #  calls to self.event)
             if len(self._batch) >= self.batch_size:
-                if MODE == 'SERIAL':
-                    self._server.handle(self._batch)
-                elif MODE == 'PARALLEL':
-                    self._srvcomm.send(self._batch, dest=0)
-                self._batch = []           
+                self._ship_batch()
 
             event_data_dict['timestamp'] = timestamp
             self._previous_timestamp = timestamp
@@ -514,6 +930,29 @@ class SmallData: # (client)
         return
 
 
+    def _ship_batch(self):
+        """
+        Hands the current batch to the server
+        """
+
+        batch = self._batch
+        if self._columnar:
+            batch = _batch_to_columns(batch)
+
+        if self._mode == 'SERIAL':
+            if self._columnar:
+                self._server.handle_columns(batch)
+            else:
+                self._server.handle(batch)
+        elif self._mode == 'PARALLEL':
+            st = time.monotonic()
+            self._srvcomm.send(batch, dest=0)
+            tracer.add('smalldata_send', st, time.monotonic())
+        self._batch = []
+
+        return
+
+
     @property
     def summary(self):
         """
@@ -525,10 +964,10 @@ class SmallData: # (client)
         >>     SmallData.save_summary(mysum=whole)
         """
         r = False
-        if MODE == 'PARALLEL':
+        if self._mode == 'PARALLEL':
             if self._type == 'client':
                 r = True
-        elif MODE == 'SERIAL':
+        elif self._mode == 'SERIAL':
             r = True
         else:
             raise RuntimeError()
@@ -536,7 +975,7 @@ class SmallData: # (client)
 
 
     def sum(self, value):
-        return self._reduction(value, MPI.SUM)
+        return self._reduction(value, SUM)
 
 
     def _reduction(self, value, op):
@@ -549,13 +988,13 @@ class SmallData: # (client)
         # rank 0 -- later, we need to remember this client
         # is the one who needs to WRITE the summary data to disk!
 
-        if MODE == 'PARALLEL':
+        if self._mode == 'PARALLEL':
             red_val = None
 
             if self._type == 'client':
                 red_val = self._client_comm.reduce(value, op)
 
-        elif MODE == 'SERIAL':
+        elif self._mode == 'SERIAL':
             red_val = value # just pass it through...
 
         return red_val
@@ -575,7 +1014,7 @@ class SmallData: # (client)
             return
 
         # in parallel mode, only client rank 0 writes to file
-        if MODE == 'PARALLEL':
+        if self._mode == 'PARALLEL':
             if self._client_comm.Get_rank() != 0:
                 return
 
@@ -596,7 +1035,7 @@ class SmallData: # (client)
 
         # we don't want to close the file in serial mode
         # this file is the server's main (only) file
-        if MODE == 'PARALLEL':
+        if self._mode == 'PARALLEL':
             fh.close()
 
         return
@@ -612,18 +1051,18 @@ class SmallData: # (client)
         if self._type == 'client':
             # we want to send the finish signal to the server
             if len(self._batch) > 0:
-                self._srvcomm.send(self._batch, dest=0)
+                self._ship_batch()
             self._srvcomm.send('done', dest=0)
 
         elif self._type == 'server':
             self._server.done()
 
         elif self._type == 'serial':
-            self._server.handle(self._batch)
+            self._ship_batch()
             self._server.done()
 
         # stuff only one process should do in parallel mode
-        if MODE == 'PARALLEL':
+        if self._mode == 'PARALLEL':
             if self._type != 'other': # other = not smalldata (Mona)
                 self._smalldata_comm.barrier()
 
@@ -0,0 +1,62 @@
+# Benchmark of masked median common mode correction (ms/frame) for a
+# 16-segment epix10ka-like frame: np.ma.median per segment/panel half
+# (reference) vs UtilsCommonMode functions on all segments at once.
+# Checks that corrected frames are identical to the reference.
+#     python bench_common_mode.py [n_frames] [n_segments]
+import sys
+import time
+import numpy as np
+import psana.detector.UtilsCommonMode as ucm
+
+SEG_SHAPE = (352, 384)
+HROWS = 176
+NBANKS = 8
+
+def ma_select(cmode, npix, cormax, npix_min):
+    cmode = np.select((npix>npix_min,), (cmode,), default=0)
+    return np.select((np.fabs(cmode) < cormax,), (cmode,), default=0)
+
+def ref_rows(arr, mask, cormax, npix_min):
+    """ np.ma reference of common_mode_rows_hsplit_nbanks for one segment """
+    for b, m in zip(np.hsplit(arr, NBANKS), np.hsplit(mask, NBANKS)):
+        cmode = ma_select(np.ma.median(np.ma.array(b, mask=m<1), axis=1), m.sum(axis=1), cormax, npix_min)
+        b[m>0] -= np.repeat(cmode[:,None], b.shape[1], axis=1)[m>0]
+
+def ref_cols(arr, mask, cormax, npix_min):
+    """ np.ma reference of common_mode_cols for one panel half """
+    cmode = ma_select(np.ma.median(np.ma.array(arr, mask=mask<1), axis=0), mask.sum(axis=0), cormax, npix_min)
+    arr[mask>0] -= np.repeat(cmode[None,:], arr.shape[0], axis=0)[mask>0]
+
+def reference(frame, mask, cormax, npix_min):
+    for s in range(frame.shape[0]):
+        ref_rows(frame[s], mask[s], cormax, npix_min)
+        ref_cols(frame[s,:HROWS], mask[s,:HROWS], cormax, npix_min)
+        ref_cols(frame[s,HROWS:], mask[s,HROWS:], cormax, npix_min)
+
+def vectorized(frame, mask, cormax, npix_min):
+    nsegs = frame.shape[0]
+    ucm.common_mode_rows_hsplit_nbanks(frame, mask, nbanks=NBANKS, cormax=cormax, npix_min=npix_min)
+    ucm.common_mode_cols(frame.reshape(nsegs, 2, HROWS, -1), mask.reshape(nsegs, 2, HROWS, -1), cormax=cormax, npix_min=npix_min)
+
+def bench(fn, frames, mask):
+    frames = frames.copy()
+    st = time.monotonic()
+    for frame in frames:
+        fn(frame, mask, 100, 10)
+    return frames, 1e3 * (time.monotonic() - st) / len(frames)
+
+if __name__ == "__main__":
+    n_frames   = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    n_segments = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+
+    rng = np.random.default_rng(0)
+    frames = rng.normal(0, 10, size=(n_frames, n_segments) + SEG_SHAPE).astype(np.float32)
+    # common mode offsets per bank row plus ~15% masked pixels (e.g. pixels in low gain)
+    frames += rng.normal(0, 20, size=(n_frames, n_segments, SEG_SHAPE[0], NBANKS, 1)).astype(np.float32).repeat(SEG_SHAPE[1]//NBANKS, axis=-1).reshape(frames.shape)
+    mask = (rng.random((n_segments,) + SEG_SHAPE) > 0.15).astype(np.uint8)
+
+    print(f'n_frames={n_frames} n_segments={n_segments}')
+    ref, t_ref = bench(reference, frames, mask)
+    vec, t_vec = bench(vectorized, frames, mask)
+    assert np.array_equal(ref, vec), 'results differ from np.ma reference'
+    print(f'np.ma per segment: {t_ref:8.2f} ms/frame  vectorized: {t_vec:8.2f} ms/frame  speedup: {t_ref/t_vec:5.1f}')
@@ -0,0 +1,66 @@
+# Benchmark of epix10ka calibration (ms/frame) for a 16-segment detector
+# with synthetic constants and raw data (no xtc2 file/calib db needed).
+#     python bench_epix10ka_calib.py [n_frames] [n_segments]
+import sys
+import time
+import numpy as np
+from psana.detector.UtilsEpix10ka import Epix10kaCalib, calib_epix10ka_any
+from psana.pyalgos.generic.NDArrUtils import divide_protected
+
+SEG_SHAPE = (352, 384)
+
+class FakeConfig:
+    def __init__(self, rng):
+        self.trbit = np.array([1, 1, 1, 1])
+        # mix of auto-ranging (0) and fixed (12, 8) gain pixel configs
+        self.asicPixelConfig = rng.choice(np.array([0, 0, 0, 12, 8], dtype=np.uint8), size=(4, 178, 192))
+
+class FakeSegment:
+    def __init__(self, rng):
+        self.config = FakeConfig(rng)
+
+class FakeDetRaw:
+    """ Stands in for det.raw with what the calibration uses. """
+    def __init__(self, n_segments, seed=0):
+        rng = np.random.default_rng(seed)
+        shape = (7, n_segments) + SEG_SHAPE
+        self.peds = rng.normal(1500, 20, size=shape)
+        self.gain = rng.normal(1, 0.05, size=shape) * np.array([16.4, 5.47, 0.164, 16.4, 5.47, 0.164, 0.164]).reshape(7, 1, 1, 1)
+        self.dcfg = {i: FakeSegment(rng) for i in range(n_segments)}
+        self.gfac = divide_protected(np.ones_like(self.gain), self.gain)
+        self.cmpars = (7, 2, 100, 10)
+    def _gain(self):             return self.gain
+    def _gain_factor(self):      return self.gfac
+    def _pedestals(self):        return self.peds
+    def _common_mode(self):      return self.cmpars
+    def _mask_comb(self, **kwa): return None
+    def _seg_configs(self):      return self.dcfg
+
+def make_raws(n_frames, n_segments, seed=1):
+    rng = np.random.default_rng(seed)
+    raws = rng.normal(1600, 30, size=(n_frames, n_segments) + SEG_SHAPE).astype(np.uint16)
+    # switch some pixels to low gain (data bit 14)
+    raws[rng.random(raws.shape) < 0.01] |= (1 << 14)
+    return raws
+
+def bench(fn, n_frames):
+    st = time.monotonic()
+    fn()
+    return 1e3 * (time.monotonic() - st) / n_frames
+
+if __name__ == "__main__":
+    n_frames   = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    n_segments = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+
+    raws = make_raws(n_frames, n_segments)
+    print(f'n_frames={n_frames} n_segments={n_segments}')
+    for cmpars in ((7, 0, 100), (7, 2, 100, 10)):
+        det_raw = FakeDetRaw(n_segments)
+        calib_epix10ka_any(det_raw, None, cmpars=cmpars, nda_raw=raws[0]) # constants
+        per_frame = bench(lambda: [calib_epix10ka_any(det_raw, None, cmpars=cmpars, nda_raw=raw) for raw in raws], n_frames)
+
+        o = Epix10kaCalib(det_raw)
+        out = np.empty(raws.shape, dtype=np.float64)
+        o.calib_raw(raws[0], cmpars=cmpars)
+        batched = bench(lambda: o.calib_raw(raws, cmpars=cmpars, out=out), n_frames)
+        print(f'cmpars={str(cmpars):16s} per frame: {per_frame:8.2f} ms/frame  batched: {batched:8.2f} ms/frame')
@@ -0,0 +1,63 @@
+# Microbenchmark for the Cython EventBuilder: builds all events from
+# synthetic smd streams and reports events/s against no. of streams.
+#     python bench_eventbuilder.py [n_events] [batch_size] [missing_fraction]
+import sys
+import time
+import numpy as np
+
+DGRAM_SIZE = 24 # seq (8) + env (4) + xtc (12)
+L1ACCEPT   = 12
+
+def make_stream(timestamps, services, payload_words):
+    """ Returns smd stream (bytearray) of dgrams with the given timestamps,
+    services and payload sizes (in 4-byte words). Only dgram headers are
+    filled in (the EventBuilder doesn't look at the payload)."""
+    sizes = DGRAM_SIZE + 4 * payload_words
+    starts = np.cumsum(sizes) - sizes
+    stream = np.zeros(int(sizes.sum()) // 4, dtype=np.uint32)
+    words = starts // 4
+    stream[words + 0] = timestamps & 0xffffffff
+    stream[words + 1] = timestamps >> 32
+    stream[words + 2] = services << 24
+    stream[words + 5] = 12 + 4 * payload_words
+    return bytearray(stream.tobytes())
+
+def make_streams(n_streams, n_events, missing_fraction=0, seed=0):
+    """ Stream 0 has all events, other streams miss L1Accepts at random.
+    A transition (service 0) every 1000 events is in all streams. """
+    rng = np.random.default_rng(seed)
+    timestamps = np.arange(1, n_events + 1, dtype=np.uint64) + (1 << 32)
+    services = np.full(n_events, L1ACCEPT, dtype=np.uint32)
+    services[::1000] = 0
+    views = []
+    for i_stream in range(n_streams):
+        keep = np.ones(n_events, dtype=bool)
+        if i_stream > 0:
+            keep = (rng.random(n_events) >= missing_fraction) | (services != L1ACCEPT)
+        payload_words = rng.integers(0, 8, size=n_events, dtype=np.uint64)
+        views.append(memoryview(make_stream(timestamps[keep], services[keep].astype(np.uint64), payload_words[keep])))
+    return views
+
+def run(EventBuilder, views, batch_size):
+    eb = EventBuilder(views, [None] * len(views))
+    n_events = 0
+    st = time.monotonic()
+    while True:
+        batch_dict, step_dict = eb.build(batch_size=batch_size)
+        if eb.nevents == 0 and eb.nsteps == 0: break
+        n_events += eb.nevents
+    return n_events, time.monotonic() - st
+
+if __name__ == "__main__":
+    from psana.eventbuilder import EventBuilder
+    n_events         = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    batch_size       = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    missing_fraction = float(sys.argv[3]) if len(sys.argv) > 3 else 0.1
+
+    print(f'n_events={n_events} batch_size={batch_size} missing_fraction={missing_fraction}')
+    print(f'{"n_streams":>10s} {"events/s":>14s}')
+    for n_streams in (1, 2, 4, 8, 16, 32, 64):
+        views = make_streams(n_streams, n_events, missing_fraction)
+        n_built, seconds = run(EventBuilder, views, batch_size)
+        assert n_built == n_events
+        print(f'{n_streams:10d} {n_built/seconds:14.1f}')
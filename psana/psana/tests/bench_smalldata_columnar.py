@@ -0,0 +1,56 @@
+# Compares SmallData server throughput (events/s) for batches sent as a
+# list of event dicts (Server.handle) and as columns (Server.handle_columns).
+# Runs without MPI:
+#     python bench_smalldata_columnar.py [n_events] [n_keys] [batch_size]
+import os
+os.environ['PS_PARALLEL'] = 'none'
+
+import sys
+import time
+import tempfile
+import numpy as np
+from psana.smalldata import Server, _batch_to_columns
+
+def make_batches(n_events, n_keys, batch_size):
+    batches = []
+    for i_batch in range(n_events // batch_size):
+        batch = []
+        for i in range(batch_size):
+            i_evt = i_batch * batch_size + i
+            evt = {'timestamp': i_evt}
+            for i_key in range(n_keys):
+                if (i_evt + i_key) % 5 == 0: continue # some missing data
+                evt['scalar%d' % i_key] = float(i_evt)
+            evt['array'] = np.full(8, i_evt, dtype=np.float32)
+            if i_evt % 2 == 0:
+                evt['unaligned_every_other'] = i_evt
+            batch.append(evt)
+        batches.append(batch)
+    return batches
+
+def run(batches, columnar, tmpdir):
+    fname = os.path.join(tmpdir, 'columnar.h5' if columnar else 'dicts.h5')
+    srv = Server(filename=fname, cache_size=10000)
+    n_events = 0
+    st = time.monotonic()
+    for batch in batches:
+        if columnar:
+            srv.handle_columns(_batch_to_columns(batch))
+        else:
+            srv.handle(batch)
+        n_events += len(batch)
+    srv.done()
+    return n_events / (time.monotonic() - st)
+
+if __name__ == "__main__":
+    n_events   = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    n_keys     = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    batch_size = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+
+    batches = make_batches(n_events, n_keys, batch_size)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        rate_dicts    = run(batches, False, tmpdir)
+        rate_columnar = run(batches, True, tmpdir)
+    print(f'n_events={n_events} n_keys={n_keys} batch_size={batch_size}')
+    print(f'dicts:    {rate_dicts:12.1f} evt/s')
+    print(f'columnar: {rate_columnar:12.1f} evt/s ({rate_columnar/rate_dicts:.1f}x, incl. client-side conversion)')
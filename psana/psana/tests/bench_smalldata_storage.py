@@ -0,0 +1,61 @@
+# Reports SmallData server write throughput (MB/s) and file size for
+# different HDF5 storage policies (see SmallData.setup_parms).
+# Runs without MPI:
+#     python bench_smalldata_storage.py [n_events] [image_size]
+import os
+os.environ['PS_PARALLEL'] = 'none'
+
+import sys
+import time
+import tempfile
+import numpy as np
+from psana.smalldata import Server, _batch_to_columns
+
+POLICIES = {
+    'default'             : {},
+    'chunk_1MB'           : {'chunk_bytes': 1<<20},
+    'lzf_chunk_1MB'       : {'compression': 'lzf', 'chunk_bytes': 1<<20},
+    'gzip1_shuffle_1MB'   : {'compression': 'gzip', 'compression_opts': 1,
+                             'shuffle': True, 'chunk_bytes': 1<<20},
+}
+
+def make_batches(n_events, image_size, batch_size=100):
+    rng = np.random.default_rng(0)
+    # detector-like image: pedestal + noise + a few hot pixels
+    base = np.full((image_size, image_size), 1000, dtype=np.uint16)
+    batches = []
+    for i_batch in range(n_events // batch_size):
+        batch = []
+        for i in range(batch_size):
+            i_evt = i_batch * batch_size + i
+            img = base + rng.poisson(3, size=base.shape).astype(np.uint16)
+            batch.append({'timestamp': i_evt,
+                          'intensity': float(img.sum()),
+                          'image': img})
+        batches.append(batch)
+    return batches
+
+def run(batches, policy, fname, cache_size=1000):
+    srv = Server(filename=fname, cache_size=cache_size, storage_policy=policy)
+    nbytes = 0
+    st = time.monotonic()
+    for batch in batches:
+        columns = _batch_to_columns(batch)
+        nbytes += sum([values.nbytes for _, values, _ in columns['columns'].values()])
+        srv.handle_columns(columns)
+    srv.done()
+    return nbytes, time.monotonic() - st
+
+if __name__ == "__main__":
+    n_events   = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    image_size = int(sys.argv[2]) if len(sys.argv) > 2 else 128
+
+    batches = make_batches(n_events, image_size)
+    print(f'n_events={n_events} image={image_size}x{image_size} uint16')
+    print(f'{"policy":20s} {"MB/s":>10s} {"file MB":>10s} {"ratio":>8s}')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, policy in POLICIES.items():
+            fname = os.path.join(tmpdir, name + '.h5')
+            nbytes, seconds = run(batches, policy, fname)
+            fsize = os.path.getsize(fname)
+            print(f'{name:20s} {nbytes/seconds/1e6:10.1f} {fsize/1e6:10.1f} {nbytes/fsize:8.2f}')
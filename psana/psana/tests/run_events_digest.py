@@ -0,0 +1,41 @@
+# Writes (timestamp, sum of xppcspad raw, epics value) of all events
+# to a .npy file given as the argument - used to compare events of
+# parallel modes (e.g. PS_SMD_PIPELINE_DEPTH, PS_SMD_ZEROCOPY) with
+# serial ones.
+
+# cpo found this on the web as a way to get mpirun to exit when
+# one of the ranks has an exception
+import sys
+# Global error handler
+def global_except_hook(exctype, value, traceback):
+    sys.stderr.write("except_hook. Calling MPI_Abort().\n")
+    # NOTE: mpi4py must be imported inside exception handler, not globally.
+    # In chainermn, mpi4py import is carefully delayed, because
+    # mpi4py automatically call MPI_Init() and cause a crash on Infiniband environment.
+    import mpi4py.MPI
+    mpi4py.MPI.COMM_WORLD.Abort(1)
+    sys.__excepthook__(exctype, value, traceback)
+sys.excepthook = global_except_hook
+
+import os
+import numpy as np
+from psana import DataSource
+from mpi4py import MPI
+comm = MPI.COMM_WORLD
+rank = comm.Get_rank()
+
+xtc_dir = os.path.join(os.environ.get('TEST_XTC_DIR', os.getcwd()),'.tmp')
+ds = DataSource(exp='xpptut13', run=1, dir=xtc_dir, batch_size=1)
+
+digest = []
+for run in ds.runs():
+    det = run.Detector('xppcspad')
+    edet = run.Detector('HX2:DVD:GCC:01:PMON')
+    for evt in run.events():
+        epics = edet(evt)
+        digest.append((evt.timestamp, det.raw.raw(evt).sum(), np.nan if epics is None else epics))
+
+all_digests = comm.gather(digest, root=0)
+if rank == 0:
+    digest = sorted(d for rank_digest in all_digests for d in rank_digest)
+    np.save(sys.argv[1], np.array(digest, dtype=np.float64))
@@ -0,0 +1,35 @@
+from psana.psexp.events import BatchPrefetcher
+import threading
+import time
+import unittest
+
+class EvtMan(object):
+    nbytes = 10
+
+class TestBatchPrefetcher(unittest.TestCase) :
+
+    def test_depth(self):
+        created = []
+        def create():
+            if len(created) == 5: return None
+            created.append(EvtMan())
+            return created[-1]
+        prefetcher = BatchPrefetcher(create, 2, 1e6)
+        time.sleep(0.1)
+        assert len(created) == 2 # depth batches ahead, not depth + 1
+        got = [prefetcher.get() for i in range(6)]
+        assert got[:5] == created and got[5] is None
+
+    def test_close(self):
+        n_created = [0]
+        def create():
+            n_created[0] += 1
+            return EvtMan()
+        prefetcher = BatchPrefetcher(create, 3, 1e6)
+        prefetcher.get()
+        prefetcher.close() # user left the loop early
+        assert not prefetcher.t.is_alive() and prefetcher.ready.empty()
+        assert n_created[0] <= 4
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,27 @@
+from psana.psexp.batch_size_controller import BatchSizeController
+import unittest
+
+class TestBatchSizeController(unittest.TestCase) :
+
+    def test_grow_and_shrink(self):
+        ctrl = BatchSizeController(1000, 0x1000000)
+        # EventBuilder waits on Smd0: grow
+        assert ctrl.update(1000, 1000*100, 0, 0.5) == 2000
+        # Smd0 waits on EventBuilders: shrink
+        assert ctrl.update(2000, 2000*100, 0.5, 0) == 1000
+        # Neither waits: keep
+        assert ctrl.update(1000, 1000*100, 0, 0) == 1000
+
+    def test_bounds(self):
+        ctrl = BatchSizeController(1000, 1000*100, max_events=5000)
+        # Limited by bytes per event (max_chunk_bytes / 100 bytes)
+        assert ctrl.update(1000, 1000*100, 0, 0.5) == 1000
+        ctrl = BatchSizeController(4000, 0x1000000, max_events=5000)
+        assert ctrl.update(4000, 4000, 0, 0.5) == 5000
+        for i in range(20):
+            ctrl.update(100, 100, 0.5, 0)
+        assert ctrl.n_events == ctrl.min_n_events
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+from psana.detector.areadetector import AreaDetector
+from types import SimpleNamespace
+import numpy as np
+import unittest
+
+def make_det(calibconst):
+    configinfo = SimpleNamespace(configs=[], sorted_segment_ids=[], uniqueid='det_0', dettype='area')
+    return AreaDetector('det', 'raw', configinfo, calibconst)
+
+class TestCalibCache(unittest.TestCase) :
+
+    def setUp(self):
+        shape = (2, 4, 6)
+        self.calibconst = {
+            'pedestals'   : (np.full(shape, 10, dtype=np.float64), {}),
+            'pixel_gain'  : (np.array([0, 2, 4, 8] * 12, dtype=np.float64).reshape(shape), {}),
+            'pixel_status': (np.zeros(shape, dtype=np.uint64), {}),
+        }
+        self.det = make_det(self.calibconst)
+
+    def test_hits_and_misses(self):
+        det = self.det
+        peds = det._pedestals()
+        assert det._pedestals() is peds
+        assert det._calib_cache_stats()['misses'] == 1
+        assert det._calib_cache_stats()['hits'] == 1
+        assert det._rms() is None
+        assert det._rms() is None
+        assert det._calib_cache_stats()['misses'] == 2
+
+    def test_derived_read_only(self):
+        det = self.det
+        gfac = det._gain_factor()
+        assert gfac is det._gain_factor()
+        assert np.array_equal(gfac[0,0], [0, 0.5, 0.25, 0.125, 0, 0.5])
+        assert det._pedestals_float32().dtype == np.float32
+        mask = det._mask_comb(mbits=2)
+        assert mask is det._mask_comb(mbits=2)
+        assert mask.all()
+        for a in (gfac, det._pedestals_float32(), mask):
+            with self.assertRaises(ValueError):
+                a[0,0,0] = 0
+
+    def test_invalidation(self):
+        det = self.det
+        mask = det._mask_comb(mbits=2)
+        peds32 = det._pedestals_float32()
+        status = np.zeros_like(self.calibconst['pixel_status'][0])
+        status[0,0,0] = 1
+        self.calibconst['pixel_status'] = (status, {})
+        mask2 = det._mask_comb(mbits=2)
+        assert mask2 is not mask
+        assert mask2[0,0,0] == 0 and mask2.sum() == mask2.size - 1
+        assert det._pedestals_float32() is peds32
+
+        # calibconst of the next run
+        det._calibconst = dict(self.calibconst, pedestals=(np.ones((2, 4, 6)), {}))
+        assert det._pedestals_float32() is not peds32
+        assert (det._pedestals_float32() == 1).all()
+
+if __name__ == "__main__":
+    unittest.main()
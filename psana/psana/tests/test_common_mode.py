@@ -0,0 +1,135 @@
+import numpy as np
+import unittest
+import psana.detector.UtilsCommonMode as ucm
+from bench_common_mode import reference, vectorized, SEG_SHAPE
+
+# np.ma/np.median reference: common mode functions of 2-d arrays as they
+# were before all groups (banks, rows, segments) were done at once
+
+def ref_rows(arr, mask=None, cormax=None, npix_min=10):
+    if mask is None:
+        cmode = np.median(arr, axis=1)
+    else:
+        cmode = np.ma.median(np.ma.array(arr, mask=mask<1), axis=1)
+        cmode = np.select((mask.sum(axis=1)>npix_min,), (cmode,), default=0)
+    if cormax is not None:
+        cmode = np.select((np.fabs(cmode) < cormax,), (cmode,), default=0)
+    _, m2 = np.meshgrid(np.zeros(arr.shape[1], dtype=np.int16), cmode)
+    if mask is None:
+        arr -= m2
+    else:
+        arr[mask>0] -= m2[mask>0]
+
+def ref_cols(arr, mask=None, cormax=None, npix_min=10):
+    ref_rows(arr.T, None if mask is None else mask.T, cormax, npix_min)
+
+def ref_2d(arr, mask=None, cormax=None, npix_min=10):
+    if mask is None:
+        cmode = np.median(arr)
+        if cormax is None or abs(cmode) < cormax:
+            arr -= cmode
+    else:
+        bmask = mask>0
+        if bmask.sum() < npix_min: return
+        if not bmask.any(): return # nothing to correct (median of no pixels is nan)
+        cmode = np.median(arr[bmask])
+        if cormax is None or abs(cmode) < cormax:
+            arr[bmask] -= cmode
+
+def ref_hsplit(fn_bank, data, mask=None, nbanks=4, cormax=None, npix_min=10):
+    for i, b in enumerate(np.hsplit(data, nbanks)):
+        fn_bank(b, None if mask is None else np.hsplit(mask, nbanks)[i], cormax, npix_min)
+
+def ref_rows_hsplit_nbanks(data, mask=None, nbanks=4, cormax=None, npix_min=10):
+    ref_hsplit(ref_rows, data, mask, nbanks, cormax, npix_min)
+
+def ref_2d_hsplit_nbanks(data, mask=None, nbanks=4, cormax=None, npix_min=10):
+    ref_hsplit(ref_rows if mask is None else ref_2d, data, mask, nbanks, cormax, npix_min)
+
+def for_each_2d(ref_fn, arr, mask, **kwargs):
+    """ Applies reference of a 2-d array to each of the leading dimensions """
+    for i in np.ndindex(arr.shape[:-2]):
+        ref_fn(arr[i], None if mask is None else mask[i], **kwargs)
+
+FUNCTIONS = (
+    (ucm.common_mode_rows, ref_rows, {}),
+    (ucm.common_mode_cols, ref_cols, {}),
+    (ucm.common_mode_2d, ref_2d, {}),
+    (ucm.common_mode_rows_hsplit_nbanks, ref_rows_hsplit_nbanks, {'nbanks': 4}),
+    (ucm.common_mode_2d_hsplit_nbanks, ref_2d_hsplit_nbanks, {'nbanks': 4}),
+)
+
+class TestCommonMode(unittest.TestCase) :
+
+    def setUp(self):
+        self.rng = np.random.default_rng(5)
+
+    def data(self, shape, dtype):
+        arr = self.rng.normal(0, 10, size=shape) + self.rng.normal(0, 20, size=shape[:-1] + (1,))
+        return arr.astype(dtype)
+
+    def masks(self, shape):
+        """ Returns masks of good/bad = 1/0 pixels (and None) """
+        rng = self.rng
+        sparse = (rng.random(shape) > 0.97).astype(np.uint8)
+        sparse[..., 0, :] = 0 # rows without good pixels
+        sparse[..., :, 1] = 0 # columns without good pixels
+        return {'none': None,
+                'all': np.ones(shape, dtype=np.uint8),
+                'empty': np.zeros(shape, dtype=np.uint8),
+                'dense': (rng.random(shape) > 0.15).astype(np.uint8),
+                'sparse': sparse,
+                'int': rng.integers(0, 3, size=shape).astype(np.int32)}
+
+    def check(self, shape):
+        for dtype in (np.float32, np.float64):
+            arr = self.data(shape, dtype)
+            for mask_name, mask in self.masks(shape).items():
+                for cormax in (None, 25):
+                    for npix_min in (0, 2, 10):
+                        for fn, ref_fn, kwargs in FUNCTIONS:
+                            kwargs = dict(kwargs, cormax=cormax, npix_min=npix_min)
+                            expected, got = arr.copy(), arr.copy()
+                            for_each_2d(ref_fn, expected, mask, **kwargs)
+                            fn(got, mask, **kwargs)
+                            assert got.dtype == dtype
+                            assert np.array_equal(got, expected), (fn.__name__, dtype, mask_name, cormax, npix_min)
+
+    def test_2d(self):
+        self.check((16, 24))
+
+    def test_leading_dims(self):
+        self.check((2, 3, 8, 12))
+
+    def test_odd_sizes(self):
+        self.check((3, 7, 20))
+
+    def test_masked_median(self):
+        for dtype in (np.float32, np.float64):
+            arr = self.data((4, 9, 10), dtype)
+            for mask_name, mask in self.masks(arr.shape).items():
+                good = None if mask is None else mask>0
+                for axes in (-1, -2, 0, (-2, -1), (0, 2)):
+                    cmode, npix = ucm.masked_median(arr, good, axes=axes)
+                    if good is None:
+                        expected = np.median(arr, axis=axes)
+                        expected_npix = np.full(expected.shape, arr.size // expected.size)
+                    else:
+                        expected = np.ma.median(np.ma.array(arr, mask=~good), axis=axes).filled(0)
+                        expected_npix = good.sum(axis=axes)
+                    assert cmode.dtype == dtype
+                    assert np.array_equal(cmode, expected), (dtype, mask_name, axes)
+                    assert np.array_equal(npix, expected_npix), (dtype, mask_name, axes)
+
+    def test_bench_reference(self):
+        # epix10ka-like frame of the benchmark
+        frame = self.data((2,) + SEG_SHAPE, np.float32)
+        mask = (self.rng.random(frame.shape) > 0.15).astype(np.uint8)
+        for cormax in (100, 10):
+            expected, got = frame.copy(), frame.copy()
+            reference(expected, mask, cormax, 10)
+            vectorized(got, mask, cormax, 10)
+            assert np.array_equal(got, expected)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+from psana.psexp.envstore import EnvStore
+from types import SimpleNamespace as NS
+from unittest import mock
+import numpy as np
+import os
+import unittest
+
+# Two xtc files: file 0 has epics variables pv0, pv1 (algorithm raw),
+# file 1 has pv2 (algorithm fast).
+VARS = {0: ('raw', ['pv0', 'pv1']), 1: ('fast', ['pv2'])}
+
+def make_configs():
+    configs = []
+    for i in range(2):
+        alg, var_names = VARS[i]
+        alg_vars = NS(version=1, software=None, **{v: NS(_type=9, _rank=0) for v in var_names})
+        epics = {0: NS(dettype='epics', detid='detid', **{alg: alg_vars})}
+        configs.append(NS(software=NS(epics=epics)))
+    return configs
+
+def make_dgram(i_file, ts, value=None):
+    """ Returns SlowUpdate stand-in of i_file with all its variables set
+    to value (no algorithm when value is None). """
+    alg, var_names = VARS[i_file]
+    envs = NS(**{alg: NS(**{v: value + j for j, v in enumerate(var_names)})}) if value is not None else NS()
+    return NS(timestamp=lambda: ts, epics={0: envs})
+
+def ref_values(store, events, env_variable, n_search_steps):
+    """ Per-event lookup of EnvStore.values before the timestamp index and
+    value columns were added. """
+    env_values = []
+    for evt in events:
+        event_timestamp = np.array([evt.timestamp], dtype=np.uint64)
+        for i, env_man in enumerate(store.env_managers):
+            val = None
+            env_var_loc = env_man.locate_variable(env_variable)
+            if env_var_loc:
+                alg, segment_id = env_var_loc
+                found_pos = np.searchsorted(env_man.timestamps, event_timestamp)[0]
+                if found_pos == env_man.n_items:
+                    found_pos -= 1
+                for p in range(found_pos, found_pos - n_search_steps, -1):
+                    if p < 0:
+                        break
+                    envs = getattr(env_man.dgrams[p], store.env_name)[segment_id]
+                    if hasattr(envs, alg):
+                        val = getattr(getattr(envs, alg), env_variable)
+                        break
+                if val is not None: break
+        env_values.append(val)
+    return env_values
+
+class TestEnvStore(unittest.TestCase) :
+
+    def setUp(self):
+        self.store = EnvStore(make_configs(), 'epics')
+
+    def add(self, i_file, ts, value=None):
+        self.store.add_to(make_dgram(i_file, ts, value), i_file)
+
+    def check(self, timestamps, n_search_steps=10):
+        events = [NS(timestamp=ts) for ts in timestamps]
+        with mock.patch.dict(os.environ, {'PS_N_STEP_SEARCH_STEPS': str(n_search_steps)}):
+            for var_name in ('pv0', 'pv1', 'pv2', 'nosuchpv'):
+                expected = ref_values(self.store, events, var_name, n_search_steps)
+                assert self.store.values(events, var_name) == expected
+                # one event at a time as the epics detector asks for them
+                assert [self.store.values([evt], var_name)[0] for evt in events] == expected
+
+    def test_lookup(self):
+        self.add(0, 10, 1.)
+        self.add(0, 20)          # no raw algorithm in this update
+        self.add(0, 30, 3.)
+        self.add(1, 15, 100.)
+        timestamps = [5, 10, 11, 20, 25, 30, 31, 1000, 15, 14]
+        self.check(timestamps)
+        store = self.store
+        events = [NS(timestamp=ts) for ts in timestamps]
+        assert store.values(events, 'pv0') == [1., 1., 1., 1., 3., 3., 3., 3., 1., 1.]
+        assert store.values(events, 'pv1') == [2., 2., 2., 2., 4., 4., 4., 4., 2., 2.]
+        assert store.values(events, 'pv2') == [100.] * len(events)
+        assert store.values(events, 'nosuchpv') == [None] * len(events)
+
+    def test_before_first_update(self):
+        assert self.store.values([NS(timestamp=5)], 'pv0') == [None] # no updates yet
+        self.add(1, 10, 100.)
+        self.check([5]) # pv0 missing, pv2 from the first update after the event
+        self.add(0, 10)
+        self.add(0, 20, 1.)
+        self.check([5, 10, 15, 20, 21])
+
+    def test_search_steps(self):
+        self.add(0, 10, 1.)
+        for ts in range(20, 80, 10):
+            self.add(0, ts) # 6 updates without the algorithm
+        timestamps = [10, 15, 20, 35, 40, 45, 70, 75]
+        for n_search_steps in (1, 2, 3, 5, 6, 7, 10):
+            self.check(timestamps, n_search_steps=n_search_steps)
+        with mock.patch.dict(os.environ, {'PS_N_STEP_SEARCH_STEPS': '3'}):
+            assert self.store.values([NS(timestamp=ts) for ts in (20, 30, 40)], 'pv0') == [1., 1., None]
+
+    def test_growing_store(self):
+        rng = np.random.default_rng(7)
+        ts = 0
+        for i in range(50):
+            ts += int(rng.integers(1, 4))
+            i_file = int(rng.integers(2))
+            self.add(i_file, ts, float(i) if rng.random() < 0.6 else None)
+            if i % 7 == 0:
+                # value columns are extended as updates arrive
+                for n_search_steps in (1, 4):
+                    self.check(rng.integers(0, ts + 5, size=20).tolist(), n_search_steps=n_search_steps)
+
+    def test_update_without_env(self):
+        # BeginRun dgrams in the scan store have no scan data
+        self.store.add_to(NS(timestamp=lambda: 5), 0)
+        self.add(0, 10, 1.)
+        events = [NS(timestamp=ts) for ts in (5, 10, 20)]
+        assert self.store.values(events, 'pv0') == [None, 1., 1.]
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import numpy as np
+import unittest
+from unittest import mock
+import psana.detector.UtilsEpix10ka as ue
+from bench_epix10ka_calib import FakeDetRaw, make_raws, SEG_SHAPE
+
+def all_cbits(n_segments):
+    """ Returns control bits (<nsegs>, 352, 384) with all 64 values in each
+    segment: bits 0-4 are set by the config, bit 5 by data bit 14. """
+    return np.arange(n_segments * SEG_SHAPE[0] * SEG_SHAPE[1]).reshape((n_segments,) + SEG_SHAPE) % 64
+
+class TestEpix10kaCalib(unittest.TestCase) :
+
+    def setUp(self):
+        self.cbits = all_cbits(2)
+        self.det_raw = FakeDetRaw(2)
+        raw = make_raws(1, 2)[0] & ue.M14
+        self.raw = raw | ((self.cbits >> 5) << 14).astype(np.uint16) # data bit 14
+        # config control bits with test and mask bits, not only gain bits and trbit
+        patcher = mock.patch.object(ue, 'cbits_config_epix10ka_any', lambda dcfg: self.cbits & 31)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_lut(self):
+        gmaps = ue.gain_maps_epix10ka_any(None, self.raw)
+        assert np.array_equal(ue.GAIN_RANGE_INDEX_LUT[self.cbits], np.select(gmaps, range(7), default=7))
+        # each value of control bits is in one gain range at most
+        assert np.all(np.sum(gmaps, axis=0) <= 1)
+        assert set(ue.GAIN_RANGE_INDEX_LUT.tolist()) == set(range(8))
+        o = ue.Epix10kaCalib(self.det_raw)
+        assert np.array_equal(o.gain_range_index(self.raw), ue.GAIN_RANGE_INDEX_LUT[self.cbits])
+        assert np.array_equal(ue.map_gain_range_index(self.det_raw, None, nda_raw=self.raw),
+                              np.select(gmaps, (0, 1, 2, 3, 4, 5, 6), default=10))
+
+    def test_constants(self):
+        # pedestal and gain factor of each pixel as selected with gain maps
+        gmaps = ue.gain_maps_epix10ka_any(None, self.raw)
+        peds, gfac = self.det_raw._pedestals(), self.det_raw._gain_factor()
+        pedest = np.select(gmaps, tuple(peds[i] for i in range(7)), default=0)
+        factor = np.select(gmaps, tuple(gfac[i] for i in range(7)), default=1)
+        o = ue.Epix10kaCalib(self.det_raw)
+        calib = o.calib_raw(self.raw, cmpars=(7, 0, 100))
+        ind = o.gain_range_index(self.raw)
+        assert np.array_equal(np.take(o.peds_tab, ind.astype(np.intp) * o.npix + o.pix_index), pedest)
+        assert np.array_equal(np.take(o.gfac_tab, ind.astype(np.intp) * o.npix + o.pix_index), factor)
+        expected = (np.array(self.raw & ue.M14, dtype=np.float32) - pedest) * factor
+        assert np.array_equal(calib, expected)
+        undefined = ind == 7
+        assert np.any(undefined)
+        assert np.array_equal(calib[undefined], (self.raw & ue.M14)[undefined]) # pedestal 0, gain 1
+
+    def test_frames(self):
+        raws = make_raws(5, 2, seed=2)
+        raws[1] = self.raw
+        for cmpars in ((7, 0, 100), (7, 1, 100), (7, 2, 100, 10), (7, 7, 10, 10), (0, 2, 100)):
+            o = ue.Epix10kaCalib(self.det_raw)
+            expected = np.stack([o.calib_raw(raw, cmpars=cmpars) for raw in raws])
+            assert np.array_equal(ue.Epix10kaCalib(self.det_raw).calib_raw(raws, cmpars=cmpars), expected), cmpars
+            out = np.empty(raws.shape, dtype=expected.dtype)
+            assert o.calib_raw(raws, cmpars=cmpars, out=out) is out
+            assert np.array_equal(out, expected), cmpars
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+from psana import dgram
+from psana.event import Event
+from psana.psexp import PacketFooter, SmdBatch, TransitionId
+from psana.psexp.event_manager import plan_reads
+from setup_input_files import setup_input_files
+from unittest import mock
+import numpy as np
+import os
+import pathlib
+import shutil
+import tempfile
+import unittest
+
+def read_dgrams(filename):
+    """ Returns config and bytes of all other dgrams of an xtc2 file. """
+    fd = os.open(filename, os.O_RDONLY)
+    config = dgram.Dgram(file_descriptor=fd)
+    views = []
+    while True:
+        try:
+            views.append(bytes(dgram.Dgram(config=config)))
+        except StopIteration:
+            break
+    return config, views, fd
+
+def make_batch(events):
+    """ Returns batch bytes of events (lists of dgram bytes, b'' for missing
+    dgrams) with the packet footers smd0 and EventBuilder use. """
+    evt_bytes = []
+    for views in events:
+        if any(views):
+            evt_bytes.append(b''.join(views) + bytes(PacketFooter.from_sizes([len(v) for v in views]).footer))
+        else:
+            evt_bytes.append(b'')
+    return bytearray(b''.join(evt_bytes) + bytes(PacketFooter.from_sizes([len(b) for b in evt_bytes]).footer)), evt_bytes
+
+class TestSmdBatch(unittest.TestCase) :
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        setup_input_files(pathlib.Path(cls.tmp_dir), n_motor_steps=2, gen_run2=False)
+        xtc_dir = os.path.join(cls.tmp_dir, '.tmp')
+        cls.files = {}
+        for kind, pattern in (('smd', 'smalldata/data-r0001-s%02d.smd.xtc2'), ('bd', 'data-r0001-s%02d.xtc2')):
+            cls.files[kind] = [read_dgrams(os.path.join(xtc_dir, pattern % i)) for i in range(2)]
+
+    @classmethod
+    def tearDownClass(cls):
+        for kind in cls.files:
+            for _, _, fd in cls.files[kind]:
+                os.close(fd)
+        shutil.rmtree(cls.tmp_dir)
+
+    def events(self, kind, missing=()):
+        """ Returns events (dgram bytes per file) of both files, dgrams of
+        (i_evt, i_file) in missing are left out. """
+        views = [v for _, v, _ in self.files[kind]]
+        n_events = min(len(v) for v in views)
+        return [[b'' if (i_evt, i) in missing else views[i][i_evt] for i in range(len(views))]
+                for i_evt in range(n_events)]
+
+    def check(self, kind, events, use_smds=None):
+        configs = [config for config, _, _ in self.files[kind]]
+        view, evt_bytes = make_batch(events)
+        smd_batch = SmdBatch(view, configs, use_smds=use_smds)
+        assert smd_batch.n_events == len(events)
+        assert smd_batch.dgram_sizes.tolist() == [[len(v) for v in views] for views in events]
+        for i_evt, views in enumerate(events):
+            if not evt_bytes[i_evt]: continue
+            evt = Event._from_bytes(configs, evt_bytes[i_evt])
+            assert smd_batch.services[i_evt] == evt.service()
+            for i, v in enumerate(views):
+                assert bytes(smd_batch.dgram_view(i_evt, i)) == v
+                if use_smds is not None and use_smds[i]:
+                    expected = [0, len(v)] # smdinfo is not used
+                else:
+                    expected = evt.get_offset_and_size(i)[0].tolist()
+                assert [smd_batch.offsets[i_evt, i], smd_batch.sizes[i_evt, i]] == expected
+        return smd_batch
+
+    def test_smd(self):
+        smd_batch = self.check('smd', self.events('smd'))
+        is_l1 = smd_batch.services == TransitionId.L1Accept
+        assert np.any(is_l1) and np.all(smd_batch.offsets[is_l1] > 0)
+
+    def test_missing_dgrams(self):
+        events = self.events('smd', missing=((3, 0), (4, 1), (6, 0), (6, 1)))
+        self.check('smd', events + [[b'', b'']] + events[:2])
+
+    def test_use_smds(self):
+        self.check('smd', self.events('smd'), use_smds=[False, True])
+
+    def test_smdinfo_fallback(self):
+        # L1Accept dgrams without the smdinfo layout of smdwriter are parsed
+        self.check('bd', self.events('bd'))
+        with mock.patch.object(SmdBatch, 'smdinfo_size', 0):
+            self.check('smd', self.events('smd', missing=((5, 1),)))
+
+class TestPlanReads(unittest.TestCase) :
+
+    def check(self, offsets, sizes, max_gap):
+        read_offsets, read_sizes, read_ids, positions = plan_reads(offsets, sizes, max_gap)
+        for offset, size, i_read, pos in zip(offsets, sizes, read_ids, positions):
+            assert read_offsets[i_read] + pos == offset
+            assert 0 <= pos and pos + size <= read_sizes[i_read]
+        assert np.all(np.diff(read_offsets) > 0)
+        gaps = read_offsets[1:] - (read_offsets[:-1] + read_sizes[:-1])
+        assert np.all(gaps > max_gap)
+        return read_offsets.tolist(), read_sizes.tolist(), read_ids.tolist()
+
+    def test_coalesce(self):
+        offsets, sizes = [0, 120, 100, 400, 500], [100, 30, 10, 50, 10]
+        assert self.check(offsets, sizes, 10) == ([0, 400, 500], [150, 50, 10], [0, 0, 0, 1, 2])
+        assert self.check(offsets, sizes, 50) == ([0, 400], [150, 110], [0, 0, 0, 1, 1])
+        assert self.check(offsets, sizes, 1000) == ([0], [510], [0, 0, 0, 0, 0])
+
+    def test_adjacent(self):
+        offsets, sizes = [0, 10, 20], [10, 10, 10]
+        assert self.check(offsets, sizes, 0) == ([0], [30], [0, 0, 0])
+        # no coalescing (gap < 0): one read for each range
+        assert self.check(offsets, sizes, -1) == ([0, 10, 20], [10, 10, 10], [0, 1, 2])
+
+    def test_overlap(self):
+        assert self.check([0, 5, 8], [10, 2, 1], 0) == ([0], [10], [0, 0, 0])
+        assert self.check([0, 5], [10, 10], -1) == ([0], [15], [0, 0])
+
+    def test_zero_size(self):
+        offsets, sizes = [0, 100, 105, 110], [100, 0, 0, 100]
+        assert self.check(offsets, sizes, 0) == ([0, 105, 110], [100, 0, 100], [0, 0, 1, 2])
+        assert self.check(offsets, sizes, 5) == ([0], [210], [0, 0, 0, 0])
+        assert self.check([50], [0], 0) == ([50], [0], [0])
+
+    def test_random(self):
+        rng = np.random.default_rng(3)
+        for max_gap in (-1, 0, 16, 1000):
+            sizes = rng.integers(0, 64, size=200)
+            offsets = rng.permutation(np.cumsum(sizes + rng.integers(0, 32, size=200)) - sizes)
+            read_offsets, read_sizes, _ = self.check(offsets, sizes, max_gap)
+            assert sum(read_sizes) <= sizes.sum() + (max_gap * (len(sizes) - 1) if max_gap > 0 else 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+from psana.event import Event
+from psana.psexp import Run
+from types import SimpleNamespace as NS
+import itertools
+import unittest
+
+def make_dgram(dets):
+    """ Returns dgram stand-in with {det_name: {segment: {drp_class_name: value}}} """
+    return NS(_size=0, **{det_name: {segment: NS(**drp_classes) for segment, drp_classes in segs.items()}
+            for det_name, segs in dets.items()})
+
+def make_run(config_dets):
+    """ Returns Run with configs that have the given detector names. """
+    run = Run.__new__(Run)
+    run.configs = [NS(_xtc=None, **{det_name: {} for det_name in det_names}) for det_names in config_dets]
+    return run
+
+def all_keys(dgrams):
+    keys = set()
+    for d in dgrams:
+        if not d: continue
+        for det_name, segs in vars(d).items():
+            if det_name.startswith('_'): continue
+            for det in segs.values():
+                keys.update((det_name, drp_class_name) for drp_class_name in vars(det))
+    return keys | {('nosuchdet', 'raw'), ('xppcspad', 'nosuchclass')}
+
+class TestEventSegments(unittest.TestCase) :
+
+    def check(self, dgrams, run):
+        """ Compares segments of each key with the ones of all detectors
+        built at once by _assign_det_segments. """
+        evt = Event(dgrams, run=run)
+        expected = Event(dgrams, run=run)._det_segments
+        for key in sorted(all_keys(dgrams)):
+            segs = evt._get_det_segments(*key)
+            assert segs == expected.get(key), key
+            assert evt._get_det_segments(*key) is segs # cached
+        return evt
+
+    def setUp(self):
+        self.dgrams = [
+            make_dgram({'xppcspad': {0: {'raw': 'cspad0'}, 1: {'raw': 'cspad1', 'fex': 'fex1'}},
+                        'smdinfo': {0: {'offsetAlg': 'ofs0'}}}),
+            make_dgram({'xppcspad': {2: {'raw': 'cspad2'}}, 'xpphsd': {0: {'raw': 'hsd0'}},
+                        'smdinfo': {0: {'offsetAlg': 'ofs1'}}}),
+            make_dgram({'andor': {0: {'raw': 'andor0'}}}),
+        ]
+        self.run = make_run([['xppcspad', 'smdinfo'], ['xppcspad', 'xpphsd', 'smdinfo'], ['andor']])
+
+    def test_segments(self):
+        evt = self.check(self.dgrams, self.run)
+        assert evt._get_det_segments('xppcspad', 'raw') == {0: 'cspad0', 1: 'cspad1', 2: 'cspad2'}
+        assert evt._get_det_segments('xppcspad', 'fex') == {1: 'fex1'}
+        assert evt._get_det_segments('smdinfo', 'offsetAlg') == {0: 'ofs1'} # duplicates allowed
+        assert evt._get_det_segments('nosuchdet', 'raw') is None
+        assert self.run._det_dgram_indices == {'xppcspad': [0, 1], 'smdinfo': [0, 1], 'xpphsd': [1], 'andor': [2]}
+
+    def test_missing_dgrams(self):
+        for missing in itertools.product([False, True], repeat=3):
+            dgrams = [None if m else d for m, d in zip(missing, self.dgrams)]
+            self.check(dgrams, self.run)
+        evt = self.check([None, None, None], self.run)
+        assert evt._get_det_segments('xppcspad', 'raw') is None
+
+    def test_without_run(self):
+        self.check(self.dgrams, None)
+        self.check(self.dgrams, make_run([]))
+
+    def test_size_differs_from_configs(self):
+        # events with more or fewer dgrams than run.configs (e.g. step
+        # events) look at all of their dgrams
+        self.check(self.dgrams[:2], self.run)
+        self.check(self.dgrams + [make_dgram({'andor': {1: {'raw': 'andor1'}}})], self.run)
+        evt = self.check(self.dgrams[::-1], make_run([['andor'], ['xppcspad'], ['xpphsd'], ['x']]))
+        assert evt._get_det_segments('xppcspad', 'raw') == {0: 'cspad0', 1: 'cspad1', 2: 'cspad2'}
+        assert evt._get_det_segments('andor', 'raw') == {0: 'andor0'}
+
+    def test_replace(self):
+        evt = Event(list(self.dgrams), run=self.run)
+        assert evt._get_det_segments('xpphsd', 'raw') == {0: 'hsd0'}
+        evt._replace(1, make_dgram({'xpphsd': {3: {'raw': 'hsd3'}}}))
+        assert evt._get_det_segments('xpphsd', 'raw') == {3: 'hsd3'}
+        assert evt._get_det_segments('xppcspad', 'raw') == {0: 'cspad0', 1: 'cspad1'}
+
+    def test_duplicate_segment(self):
+        dgrams = self.dgrams + [make_dgram({'xppcspad': {1: {'raw': 'dup1'}}})]
+        run = make_run([['xppcspad', 'smdinfo'], ['xppcspad', 'xpphsd', 'smdinfo'], ['andor'], ['xppcspad']])
+        evt = Event(dgrams, run=run)
+        with self.assertRaises(AssertionError):
+            Event(dgrams, run=run)._det_segments
+        with self.assertRaises(AssertionError):
+            evt._get_det_segments('xppcspad', 'raw')
+        assert evt._get_det_segments('xppcspad', 'fex') == {1: 'fex1'}
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+from psana.eventbuilder import EventBuilder
+from psana.psexp import PacketFooter
+from bench_eventbuilder import make_stream, make_streams, DGRAM_SIZE, L1ACCEPT
+import numpy as np
+import unittest
+
+def streams(*timestamps):
+    """ Returns views of L1Accept streams with the given timestamps,
+    payload of the j-th dgram of stream i is 10*i+j words. """
+    views = []
+    for i, ts in enumerate(timestamps):
+        n = len(ts)
+        views.append(memoryview(make_stream(np.array(ts, dtype=np.uint64), np.full(n, L1ACCEPT, dtype=np.uint64),
+                                            np.arange(n, dtype=np.uint64) + 10 * i)))
+    return views
+
+def build_all(views, batch_size=3):
+    """ Returns events as lists of (timestamp, size) of each dgram, None for missing dgrams """
+    eb = EventBuilder(views, [None] * len(views))
+    events = []
+    while True:
+        batch_dict, _ = eb.build(batch_size=batch_size)
+        if eb.nevents == 0: break
+        for evt in PacketFooter(view=batch_dict[0][0]).split_packets():
+            pf = PacketFooter(view=evt)
+            dgrams, offset = [], 0
+            for i in range(pf.n_packets):
+                size = pf.get_size(i)
+                dgram = np.frombuffer(evt[offset:offset + size], dtype=np.uint32)
+                dgrams.append((int(dgram[1]) << 32 | int(dgram[0]), size) if size else None)
+                offset += size
+            events.append(dgrams)
+    return events
+
+def ref_events(views):
+    """ Returns events (as build_all) of a merge that takes the next dgram of
+    each stream with the smallest timestamp, at most one per stream. """
+    heads = []
+    for view in views:
+        words = np.frombuffer(view, dtype=np.uint32)
+        dgrams, offset = [], 0
+        while offset < len(words):
+            size = DGRAM_SIZE + int(words[offset + 5]) - 12
+            dgrams.append((int(words[offset + 1]) << 32 | int(words[offset]), size))
+            offset += size // 4
+        heads.append(dgrams)
+    events = []
+    while any(heads):
+        ts = min(dgrams[0][0] for dgrams in heads if dgrams)
+        events.append([dgrams.pop(0) if dgrams and dgrams[0][0] == ts else None for dgrams in heads])
+    return events
+
+class TestEventBuilder(unittest.TestCase) :
+
+    def test_merge(self):
+        events = build_all(streams([1, 2, 4, 5], [2, 3, 5], [5]))
+        assert [[d and d[0] for d in evt] for evt in events] == \
+                [[1, None, None], [2, 2, None], [None, 3, None], [4, None, None], [5, 5, 5]]
+        for n_streams in (1, 3, 8):
+            views = make_streams(n_streams, 500, missing_fraction=0.3, seed=n_streams)
+            assert build_all(views, batch_size=7) == ref_events(views)
+
+    def test_same_timestamp(self):
+        # a stream with more dgrams with the same timestamp: one event for
+        # each of them, no dgram is dropped
+        size = lambda i, j: DGRAM_SIZE + 4 * (10 * i + j)
+        events = build_all(streams([1, 2, 2, 3], [1, 2, 3]))
+        assert events == [[(1, size(0, 0)), (1, size(1, 0))],
+                          [(2, size(0, 1)), (2, size(1, 1))],
+                          [(2, size(0, 2)), None],
+                          [(3, size(0, 3)), (3, size(1, 2))]]
+        events = build_all(streams([1, 2, 3], [1, 2, 2, 2, 3]))
+        assert [[d and d[0] for d in evt] for evt in events] == \
+                [[1, 1], [2, 2], [None, 2], [None, 2], [3, 3]]
+        assert [evt[1][1] for evt in events] == [size(1, j) for j in range(5)]
+        rng = np.random.default_rng(1)
+        for batch_size in (1, 2, 5):
+            views = streams(*[np.sort(rng.integers(1, 30, size=40)) for _ in range(4)])
+            events = build_all(views, batch_size=batch_size)
+            assert events == ref_events(views)
+            n_dgrams = sum(d is not None for evt in events for d in evt)
+            assert n_dgrams == 4 * 40
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+from psana.detector.UtilsAreaDetector import ImagePlan
+import numpy as np
+import unittest
+
+class TestImagePlan(unittest.TestCase) :
+
+    def setUp(self):
+        # 2 segments of 4x5 pixels side by side, pixel (0,1,1) is moved onto (0,0,0)
+        ir, ic = np.meshgrid(np.arange(4), np.arange(5), indexing='ij')
+        self.rows = np.array([ir, ir])
+        self.cols = np.array([ic, ic + 5])
+        self.rows[0,1,1] = 0
+        self.cols[0,1,1] = 0
+        self.data = np.arange(40, dtype=np.float32).reshape(2, 4, 5)
+        self.plan = ImagePlan(self.rows, self.cols)
+
+    def test_modes(self):
+        p, data = self.plan, self.data
+        assert p.img_shape == (4, 10)
+        assert p.image(None, mapmode=0)[0,0] == 2
+        assert p.image(data, mapmode=1, fillholes=False)[0,0] == data[0,1,1]
+        assert p.image(data, mapmode=2, fillholes=False)[0,0] == max(data[0,0,0], data[0,1,1])
+        assert p.image(data, mapmode=3, fillholes=False)[0,0] == (data[0,0,0] + data[0,1,1]) / 2
+        img = p.image(data, mapmode=1, fillholes=False, vbase=-1)
+        assert img[1,1] == -1
+        assert img[3,9] == data[1,3,4]
+
+    def test_holes(self):
+        p, data = self.plan, self.data
+        img = p.image(data, mapmode=1)
+        assert img[1,1] == min(data[0,0,1], data[0,2,1], data[0,1,0], data[0,1,2])
+        img = p.image(data, mapmode=4)
+        assert img[1,1] == (data[0,0,1] + data[0,2,1] + data[0,1,0] + data[0,1,2]) / 4
+
+    def test_batch(self):
+        p = self.plan
+        stack = np.stack([self.data, 2 * self.data, -self.data])
+        out = np.empty((3,) + p.img_shape, dtype=np.float32)
+        imgs = p.images(stack, mapmode=3, out=out)
+        assert imgs is out
+        for img, data in zip(imgs, stack):
+            assert np.array_equal(img, p.image(data, mapmode=3))
+
+if __name__ == "__main__":
+    unittest.main()
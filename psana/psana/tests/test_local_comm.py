@@ -0,0 +1,35 @@
+from psana.psexp.local_node import LocalComm
+import numpy as np
+import os
+import unittest
+
+class TestLocalComm(unittest.TestCase) :
+
+    def test_comm(self):
+        comm = LocalComm(3)
+        pids = []
+        for rank in (1, 2):
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    comm.set_rank(rank)
+                    value = comm.bcast(None, root=0)
+                    comm.send(rank * 10, dest=0)
+                    comm.reduce(np.full(2, value + rank), root=0)
+                    comm.barrier()
+                    status = 0
+                finally:
+                    os._exit(status)
+            pids.append(pid)
+
+        comm.set_rank(0)
+        assert comm.bcast(5, root=0) == 5
+        assert comm.recv(source=2) == 20 and comm.recv() == 10
+        assert list(comm.reduce(np.full(2, 5), root=0)) == [18, 18]
+        comm.barrier()
+        for pid in pids:
+            assert os.waitpid(pid, 0)[1] == 0
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,174 @@
+import psana.pscalib.calib.MDBWebUtils as wu
+import psana.pscalib.calib.MDBWebCache as wc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import threading
+import socket
+import tempfile
+import shutil
+import json
+import numpy as np
+import unittest
+
+EXP, DET = 'testexper', 'testdet_1234'
+PEDS = np.arange(12, dtype=np.float32).reshape(3,4)
+
+def make_db():
+    """Returns ({(dbname, colname): [docs]}, {(dbname, dataid): bytes}) of calib db stand-in"""
+    docs, data = {}, {}
+    def add(dbname, i, ctype, run, payload, **kwa):
+        doc = {'_id': '%s_doc%02d' % (dbname, i), 'id_data': '%s_data%02d' % (dbname, i), 'detector': DET,
+               'ctype': ctype, 'run': run, 'time_sec': 1600000000 + run, 'time_stamp': '2020-09-13T12:26:%02d' % run}
+        doc.update(kwa)
+        docs.setdefault((dbname, DET), []).append(doc)
+        data[(dbname, doc['id_data'])] = payload
+    add('cdb_'+EXP, 0, 'pedestals', 1, PEDS.tobytes(), data_type='ndarray', data_dtype='float32', data_shape='(3, 4)')
+    add('cdb_'+EXP, 1, 'pedestals', 5, (PEDS+1).tobytes(), data_type='ndarray', data_dtype='float32', data_shape='(3, 4)')
+    add('cdb_'+EXP, 2, 'geometry', 1, b'geometry text', data_type='str')
+    add('cdb_'+DET, 3, 'pixel_status', 1, b'status text', data_type='str')
+    return docs, data
+
+class CalibDBHandler(BaseHTTPRequestHandler):
+    """Serves find_docs, get_doc_for_docid and gridfs requests of the calib web service"""
+
+    def do_GET(self):
+        srv = self.server
+        srv.nrequests += 1
+        if srv.fail:
+            self.send_response(503)
+            self.end_headers()
+            return
+        u = urlparse(self.path)
+        parts = u.path.strip('/').split('/')
+        body = None
+        if len(parts) == 3 and parts[1] == 'gridfs':
+            srv.ngridfs += 1
+            body = srv.data.get((parts[0], parts[2]), None)
+        elif len(parts) == 2:
+            query = json.loads(parse_qs(u.query)['query_string'][0])
+            docs = srv.docs.get((parts[0], parts[1]), [])
+            runq = query.get('run', {}).get('$lte', None)
+            body = json.dumps([d for d in docs if (runq is None or d['run'] <= runq)\
+                                                   and query.get('ctype', d['ctype']) == d['ctype']]).encode()
+        elif len(parts) == 3:
+            doc = [d for d in srv.docs.get((parts[0], parts[1]), []) if d['_id'] == parts[2]]
+            body = json.dumps(doc[0]).encode() if doc else None
+        self.send_response(200 if body is not None else 404)
+        self.end_headers()
+        if body is not None: self.wfile.write(body)
+
+    def log_message(self, *args): pass
+
+class TestMDBWebCache(unittest.TestCase) :
+
+    def setUp(self):
+        self.srv = ThreadingHTTPServer(('127.0.0.1', 0), CalibDBHandler)
+        self.srv.docs, self.srv.data = make_db()
+        self.srv.nrequests = self.srv.ngridfs = 0
+        self.srv.fail = False
+        threading.Thread(target=self.srv.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:%d' % self.srv.server_address[1]
+        self.cachedir = tempfile.mkdtemp()
+        self.cache = wc.CalibCache(self.cachedir)
+        wc.set_calib_cache(self.cache)
+
+    def tearDown(self):
+        wc.set_calib_cache(None)
+        self.srv.shutdown()
+        self.srv.server_close()
+        shutil.rmtree(self.cachedir)
+
+    def get(self, run=10):
+        return wu.calib_constants_all_types(DET, exp=EXP, run=run, url=self.url)
+
+    def test_cached_data(self):
+        d = self.get()
+        assert sorted(d.keys()) == ['geometry', 'pedestals', 'pixel_status']
+        assert np.array_equal(d['pedestals'][0], PEDS+1)
+        assert d['geometry'][0] == 'geometry text'
+        assert self.srv.ngridfs == 3
+
+        d2 = self.get()
+        assert self.srv.ngridfs == 3 # data from cache
+        assert np.array_equal(d2['pedestals'][0], PEDS+1)
+        assert d2['pixel_status'][0] == 'status text'
+
+    def test_changed_doc(self):
+        self.get()
+        doc = self.srv.docs[('cdb_'+EXP, DET)][1]
+        doc['time_stamp'] = '2021-01-01T00:00:00'
+        self.srv.data[('cdb_'+EXP, doc['id_data'])] = (PEDS+2).tobytes()
+        d = self.get()
+        assert self.srv.ngridfs == 4
+        assert np.array_equal(d['pedestals'][0], PEDS+2)
+
+    def test_offline(self):
+        self.get(run=3)
+        self.cache.offline = True
+        nrequests = self.srv.nrequests
+        d = self.get(run=3)
+        assert self.srv.nrequests == nrequests
+        assert np.array_equal(d['pedestals'][0], PEDS)
+        assert self.get(run=4) is None # query is not cached
+
+    def test_server_failure(self):
+        self.get()
+        self.srv.fail = True
+        d = self.get()
+        assert np.array_equal(d['pedestals'][0], PEDS+1)
+
+    def test_server_down(self):
+        self.get()
+        self.srv.shutdown()
+        self.srv.server_close() # connection refused
+        wu.request_stats(reset=True)
+        d = self.get()
+        assert np.array_equal(d['pedestals'][0], PEDS+1)
+        assert d['geometry'][0] == 'geometry text'
+        stats = wu.request_stats()
+        assert stats['nrequests'] > 0
+        assert stats['nfailed'] == stats['nrequests']
+
+    def test_timeout(self):
+        with socket.socket() as sock: # accepts connections and never responds
+            sock.bind(('127.0.0.1', 0))
+            sock.listen()
+            wu.request_stats(reset=True)
+            assert wu.request('http://127.0.0.1:%d/cdb_%s' % (sock.getsockname()[1], EXP), timeout=0.2) is None
+        assert wu.request_stats()['nfailed'] == 1
+
+    def test_eviction(self):
+        # size of all cache entries (queries, docs and data) of one run
+        probe = wc.CalibCache(tempfile.mkdtemp())
+        wc.set_calib_cache(probe)
+        self.get(run=10)
+        nbytes = probe.stats()['nbytes']
+        shutil.rmtree(probe.cachedir)
+        wc.set_calib_cache(self.cache)
+
+        self.cache.max_bytes = nbytes # entries of one run fit
+        self.get(run=3)
+        self.get(run=10)
+        assert self.cache.stats()['nbytes'] <= nbytes
+        assert self.cache.stats()['nbytes'] == sum(size for _, size, _ in self.cache._cache_files())
+        ngridfs = self.srv.ngridfs
+        d = self.get(run=10) # old pedestals are evicted, recently used data are cached
+        assert self.srv.ngridfs == ngridfs
+        assert np.array_equal(d['pedestals'][0], PEDS+1)
+
+    def test_all_dets(self):
+        wu.request_stats(reset=True)
+        d = wu.calib_constants_all_dets({'det': ['nosuchdet', DET]}, exp=EXP, run=10, url=self.url)
+        assert wu.request_stats()['nrequests'] == self.srv.nrequests
+        assert sorted(d['det'].keys()) == ['geometry', 'pedestals', 'pixel_status']
+        assert np.array_equal(d['det']['pedestals'][0], PEDS+1)
+        wc.set_calib_cache(None)
+        nthreads, wu.PS_CALIB_FETCH_THREADS = wu.PS_CALIB_FETCH_THREADS, 1
+        try:
+            d1 = self.get(run=10)
+        finally:
+            wu.PS_CALIB_FETCH_THREADS = nthreads
+        assert {k: v[1] for k, v in d['det'].items()} == {k: v[1] for k, v in d1.items()}
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,4 +1,6 @@
 from psana.psexp.packet_footer import PacketFooter
+import numpy as np
+import struct
 import unittest
 
 class TestPacketFooter(unittest.TestCase) :
@@ -19,6 +21,47 @@ class TestPacketFooter(unittest.TestCase) :
         assert memoryview(views[0]).shape[0] == 7
         assert memoryview(views[1]).shape[0] == 7
 
+    def test_wire_format(self):
+        # footer = | size0 | size1 | ... | n_packets | as native uint32
+        msgs = [b'a', b'', b'packet2', b'x' * 1000]
+        sizes = [len(msg) for msg in msgs]
+        expected = struct.pack('%dI' % (len(sizes) + 1), *sizes, len(sizes))
+
+        pf = PacketFooter(len(msgs))
+        for i, size in enumerate(sizes):
+            pf.set_size(i, size)
+        assert bytes(pf.footer) == expected
+        assert bytes(PacketFooter.from_sizes(sizes).footer) == expected
+
+        pf = PacketFooter(1)
+        pf.set_size(0, sizes[0])
+        for size in sizes[1:]:
+            pf.add_packet(size)
+        assert bytes(pf.footer) == expected
+
+        # reading a footer written the old way (struct)
+        view = b''.join(msgs) + expected
+        for v in (view, bytearray(view), memoryview(view)):
+            pf = PacketFooter(view=v)
+            assert pf.n_packets == len(msgs)
+            assert [pf.get_size(i) for i in range(pf.n_packets)] == sizes
+            assert np.array_equal(pf.sizes, sizes)
+            assert [bytes(packet) for packet in pf.split_packets()] == msgs
+            assert bytes(pf.footer) == expected
+
+        assert PacketFooter().footer == bytearray()
+        assert PacketFooter.from_sizes([]).footer == bytearray()
+
+    def test_footer_cache(self):
+        pf = PacketFooter.from_sizes([1, 2])
+        footer = pf.footer
+        assert pf.footer is footer
+        pf.set_size(1, 3)
+        assert bytes(pf.footer) == struct.pack('3I', 1, 3, 2)
+        pf.add_packet(4)
+        assert bytes(pf.footer) == struct.pack('4I', 1, 3, 4, 3)
+        assert pf.footer is pf.footer
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,82 @@
+from psana.psexp.prometheus_manager import PrometheusManager, MergeableHistogram, MetricsAggregator, \
+        merge_snapshots, snapshot
+from prometheus_client import generate_latest
+import numpy as np
+import threading
+import unittest
+
+class Comm(object):
+    """ In-process stand-in for the leader end of a metrics comm """
+    def __init__(self):
+        self.msgs = []
+    class Request(object):
+        def wait(self): pass
+    def isend(self, obj, dest, tag):
+        self.msgs.append(obj)
+        return self.Request()
+    def send(self, obj, dest, tag):
+        self.msgs.append(obj)
+    def iprobe(self, tag):
+        return len(self.msgs) > 0
+    def recv(self, tag):
+        return self.msgs.pop(0)
+
+class TestPrometheusAggregate(unittest.TestCase) :
+
+    def test_histogram(self):
+        hist = MergeableHistogram()
+        for value in np.linspace(0.001, 0.1, 100): hist.observe(value)
+        other = MergeableHistogram()
+        other.observe(10.)
+        hist.merge(other)
+        assert hist.counts.sum() == 101
+        assert 0.03 < hist.quantile(0.5) < 0.07
+        assert 8. <= hist.quantile(1.) <= 16.
+
+    def test_threads(self):
+        summary = PrometheusManager.get_metric('psana_bd_gen_smd_batch')
+        n_before = summary.histogram.snapshot().sum()
+        aggregator = MetricsAggregator('eb', 1)
+        comm = Comm()
+        def observe():
+            for _ in range(2000): summary.observe(0.001)
+        def receive(): # members report while the push thread reads aggregates
+            for rank in range(2, 200):
+                comm.send((rank, False, {'bd': snapshot()}), dest=0, tag=MetricsAggregator.TAG)
+                aggregator.recv(comm)
+        threads = [threading.Thread(target=observe) for _ in range(4)] + [threading.Thread(target=receive)]
+        for t in threads: t.start()
+        for _ in range(50): aggregator.aggregates()
+        for t in threads: t.join()
+        assert summary.histogram.snapshot().sum() == n_before + 8000
+        assert aggregator.aggregates()['bd']['ranks'] == 198
+
+    def test_aggregate(self):
+        PrometheusManager.get_metric('psana_bd_read').labels('evts', 1).inc(5)
+        PrometheusManager.get_metric('psana_bd_just_read').observe(0.01)
+        snap = snapshot()
+        assert snap['counters'][('psana_bd_read', 'evts')] >= 5
+        assert snap['summaries']['psana_bd_just_read'][0] >= 1
+
+        # two bigdata ranks send to their EventBuilder, which sends to smd0
+        smd_comm, bd_comm = Comm(), Comm()
+        bds = [MetricsAggregator('bd', rank) for rank in (1, 2)]
+        eb, smd0 = MetricsAggregator('eb', 0), MetricsAggregator('smd0', 0)
+        bds[0].send(bd_comm)
+        bds[0].send(bd_comm) # not sent (PUSH_INTERVAL_SECS)
+        for bd in bds: bd.send(bd_comm, final=True)
+        eb.recv(bd_comm, n_final=2)
+        eb.send(smd_comm, final=True)
+        smd0.recv(smd_comm, n_final=1)
+
+        aggregates = smd0.aggregates()
+        assert {role: agg['ranks'] for role, agg in aggregates.items()} == {'smd0': 1, 'eb': 1, 'bd': 2}
+        assert aggregates['bd']['counters'][('psana_bd_read', 'evts')] == 2 * snap['counters'][('psana_bd_read', 'evts')]
+        assert merge_snapshots([snap, snap])['summaries']['psana_bd_just_read'][0] == 2 * snap['summaries']['psana_bd_just_read'][0]
+
+        text = generate_latest(smd0.registry()).decode()
+        assert 'psana_bd_read_total{role="bd",unit="evts"}' in text
+        assert 'psana_bd_just_read_quantile{quantile="0.99",role="bd"}' in text
+
+if __name__ == "__main__":
+    unittest.main()
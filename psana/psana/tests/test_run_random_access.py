@@ -0,0 +1,88 @@
+import os
+os.environ['PS_PARALLEL'] = 'none'
+
+from psana import DataSource
+from psana.psexp import Run
+import tempfile
+import shutil
+import unittest
+
+# Mixed rate test run: 100 events in two files, epics variable is
+# available from the first SlowUpdate (timestamp 30) on.
+xtc_mixedrate_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'test_data', 'mixed_rate')
+EPICS_VAR = 'HX2:DVD:GCC:01:PMON'
+SLOWUPDATE_TS = 30
+
+def open_run():
+    # the run keeps its DataSource (and smd files) open
+    ds = DataSource(exp='xpptut15', run=1, dir=xtc_mixedrate_dir)
+    return next(ds.runs())
+
+class TestRunRandomAccess(unittest.TestCase) :
+
+    @classmethod
+    def setUpClass(cls):
+        run = open_run()
+        edet = run.Detector(EPICS_VAR)
+        cls.timestamps, cls.epics = [], []
+        for evt in run.events():
+            cls.timestamps.append(evt.timestamp)
+            cls.epics.append(edet(evt))
+        assert len(cls.timestamps) == 100
+
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp()
+        self.run = open_run()
+        self.run.timestamp_index(index_dir=self.index_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.index_dir)
+
+    def test_event(self):
+        for i in (50, 3, 99, 0):
+            evt = self.run.event(self.timestamps[i])
+            assert evt.timestamp == self.timestamps[i]
+            assert evt._size == 2 # both test files have xppcspad
+
+    def test_missing_timestamp(self):
+        missing = self.timestamps[-1] + 1000 # after EndRun (timestamps of the run are consecutive)
+        assert self.run.event(missing) is None
+        events = list(self.run.events_at([missing, self.timestamps[20], self.timestamps[10]]))
+        assert [evt.timestamp for evt in events] == [self.timestamps[20], self.timestamps[10]]
+
+    def test_events_between(self):
+        events = list(self.run.events_between(self.timestamps[10], self.timestamps[20]))
+        assert [evt.timestamp for evt in events] == self.timestamps[10:20] # end is excluded
+        events = list(self.run.events_between(self.timestamps[95]))
+        assert [evt.timestamp for evt in events] == self.timestamps[95:] # stops at EndRun
+        assert [evt.timestamp for evt in self.run.events_between()] == self.timestamps
+
+    def test_env_after_jump(self):
+        edet = self.run.Detector(EPICS_VAR)
+        i_after = next(i for i, evt_ts in enumerate(self.timestamps) if evt_ts & 0xffffffff >= SLOWUPDATE_TS)
+        assert i_after > 0
+        # SlowUpdate before the event is replayed from the index
+        evt = self.run.event(self.timestamps[-1])
+        assert edet(evt) == self.epics[-1] == 41.0
+
+        run = open_run()
+        run.timestamp_index(index_dir=self.index_dir)
+        edet = run.Detector(EPICS_VAR)
+        assert edet(run.event(self.timestamps[i_after - 1])) is None
+        assert edet(run.event(self.timestamps[i_after])) == self.epics[i_after]
+
+        # SlowUpdate between the events is added when events_between passes it
+        run = open_run()
+        run.timestamp_index(index_dir=self.index_dir)
+        edet = run.Detector(EPICS_VAR)
+        events = run.events_between(self.timestamps[i_after - 2])
+        for evt, value in zip(events, self.epics[i_after - 2:]):
+            assert edet(evt) == value
+
+    def test_not_file_backed(self):
+        run = Run.__new__(Run)
+        with self.assertRaises(RuntimeError):
+            run.event(self.timestamps[0])
+
+if __name__ == "__main__":
+    unittest.main()
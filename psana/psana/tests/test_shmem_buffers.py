@@ -0,0 +1,114 @@
+from psana.dgrammanager import ShmemBuffers
+from psana.psexp import TransitionId
+from psana.event import Event
+from psana import dgram
+from types import SimpleNamespace
+import numpy as np
+import gc
+import os
+import threading
+import unittest
+
+SMD_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+        'test_data', 'mixed_rate', 'smalldata', 'data-r0001-s00.smd.xtc2')
+
+def dgram_buffer(service, payload_size=64):
+    """ Returns shmem-like buffer (larger than the dgram) with dgram header """
+    buf = np.zeros(24 + payload_size + 100, dtype=np.uint8)
+    buf[:24].view(np.uint32)[:] = [1, 2, service << 24, 0, 0, 12 + payload_size]
+    return buf
+
+class ShmemClient(object):
+    def __init__(self):
+        self.freed = []
+
+    def freeByIndex(self, index, size):
+        self.freed.append(index)
+
+class TestShmemBuffers(unittest.TestCase) :
+
+    def test_copy(self):
+        cli = ShmemClient()
+        buffers = ShmemBuffers(cli, zerocopy=False)
+        buf = dgram_buffer(TransitionId.L1Accept)
+        view, release = buffers.view(buf, 3, buf.shape[0])
+        assert release is None and cli.freed == [3]
+        assert view.nbytes == 88 and not np.shares_memory(np.frombuffer(view, dtype=np.uint8), buf)
+
+    def test_zerocopy(self):
+        cli = ShmemClient()
+        buffers = ShmemBuffers(cli, zerocopy=True, max_held=2)
+        views = [buffers.view(dgram_buffer(TransitionId.L1Accept, 64 + 4 * i), i, 200) for i in range(3)]
+        assert views[0][1] is not None and views[1][1] is not None
+        assert views[2][1] is None # over the cap - copied
+        assert cli.freed == [2] and buffers.n_held == 2
+
+        arr = np.frombuffer(views[0][0], dtype=np.uint32)
+        assert arr[5] == 12 + 64
+        del views[0]
+        gc.collect()
+        assert cli.freed == [2] # the array still references the buffer
+        del arr
+        gc.collect()
+        assert cli.freed == [2, 0] and buffers.n_held == 1
+
+        views[0][1]() # explicit release
+        views[0][1]()
+        assert cli.freed == [2, 0, 1] and buffers.n_held == 0
+        del views
+        gc.collect()
+        assert cli.freed == [2, 0, 1]
+
+        buf = dgram_buffer(TransitionId.BeginRun)
+        view, release = buffers.view(buf, 5, buf.shape[0])
+        assert release is None and cli.freed[-1] == 5
+        assert buffers.stats() == {'held': 0, 'held_max': 2, 'zerocopy': 2, 'copied': 2, 'released': 2}
+
+    def test_threads(self):
+        cli = ShmemClient()
+        buffers = ShmemBuffers(cli, zerocopy=True, max_held=1000)
+        views = [buffers.view(dgram_buffer(TransitionId.L1Accept), i, 200) for i in range(1000)]
+        releases = [release for _, release in views]
+        del views
+        threads = [threading.Thread(target=lambda rs: [release() for release in rs], args=(releases[i::4],))
+                for i in range(4)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        assert sorted(cli.freed) == list(range(1000))
+        assert buffers.stats()['held'] == 0 and buffers.stats()['released'] == 1000
+
+    def test_event_release_copy(self):
+        fd = os.open(SMD_FILE, os.O_RDONLY)
+        config = dgram.Dgram(file_descriptor=fd)
+        d = dgram.Dgram(config=config)
+        while d.service() != TransitionId.L1Accept:
+            d = dgram.Dgram(config=config)
+        raw, timestamp = bytes(d), d.timestamp()
+        os.close(fd)
+
+        cli = ShmemClient()
+        buffers = ShmemBuffers(cli, zerocopy=True, max_held=1)
+        buf = np.zeros(len(raw) + 100, dtype=np.uint8)
+        buf[:len(raw)] = np.frombuffer(raw, dtype=np.uint8)
+        view, release = buffers.view(buf, 7, buf.shape[0])
+        evt = Event([dgram.Dgram(config=config, view=view)], run=SimpleNamespace(configs=[config]))
+        evt._shmem_release = release
+        del view, buf
+        gc.collect()
+        assert cli.freed == [] and buffers.n_held == 1 # the event holds the buffer
+
+        evt_copy = evt.copy()
+        assert evt_copy is not evt and evt_copy.copy() is evt_copy
+        evt.release()
+        assert cli.freed == [7] and buffers.n_held == 0
+        evt.release()
+        del evt
+        gc.collect()
+        assert cli.freed == [7]
+
+        # the copy outlives the buffer
+        assert evt_copy.timestamp == timestamp
+        assert bytes(evt_copy._dgrams[0]) == raw
+
+if __name__ == "__main__":
+    unittest.main()
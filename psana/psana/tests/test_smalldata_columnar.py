@@ -0,0 +1,64 @@
+import os
+os.environ['PS_PARALLEL'] = 'none'
+
+import tempfile
+import unittest
+import numpy as np
+import h5py
+from psana.smalldata import Server, _batch_to_columns
+
+def write(batches, columnar, fname):
+    srv = Server(filename=fname, cache_size=4)
+    for batch in batches:
+        if columnar:
+            srv.handle_columns(_batch_to_columns(batch))
+        else:
+            srv.handle(batch)
+    srv.done()
+    with h5py.File(fname, 'r') as f:
+        return {name: f[name][:] for name in f}
+
+def received(batch, columnar):
+    got = []
+    srv = Server(callbacks=[got.append])
+    if columnar:
+        srv.handle_columns(_batch_to_columns(batch))
+    else:
+        srv.handle(batch)
+    return got
+
+class TestSmallDataColumnar(unittest.TestCase) :
+
+    def test_ragged(self):
+        batch = [{'unaligned_peaks': np.arange(n, dtype=np.float32)} for n in (1, 2, 3)]
+        columns = _batch_to_columns(batch)
+        assert columns['columns']['unaligned_peaks'][2] == 'rows'
+        for evt, got in zip(batch, received(batch, True)):
+            assert np.array_equal(got['unaligned_peaks'], evt['unaligned_peaks'])
+
+    def test_mixed_types(self):
+        batches = [[{'x': 1, 'y': 0.5}, {'x': 2.5}, {'y': 1.5, 'unaligned_z': 1}],
+                   [{'x': 3, 'y': 2.5, 'a': np.ones(2, dtype=np.float32)}, {'x': 4}, {'unaligned_z': 2.5}]]
+        kinds = {name: kind for name, (_, _, kind) in _batch_to_columns(batches[0])['columns'].items()}
+        assert kinds == {'x': 'rows', 'y': 'scalar', 'unaligned_z': 'scalar'}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            rows = write(batches, False, os.path.join(tmpdir, 'rows.h5'))
+            cols = write(batches, True, os.path.join(tmpdir, 'cols.h5'))
+        assert sorted(rows) == sorted(cols) == ['a', 'unaligned_z', 'x', 'y']
+        for name in rows:
+            assert rows[name].dtype == cols[name].dtype, name
+            assert np.array_equal(rows[name], cols[name], equal_nan=True), name
+        assert cols['x'].dtype == np.int64 and list(cols['x'][:2]) == [1, 2]
+
+    def test_callback_types(self):
+        batch = [{'i': 1, 'f': 0.5, 'n': np.float32(1), 'a': np.zeros(2)}, {'i': 2, 'f': 1.5, 'n': np.float32(2)}]
+        rows, cols = received(batch, False), received(batch, True)
+        assert len(rows) == len(cols) == 2
+        for evt_rows, evt_cols in zip(rows, cols):
+            assert sorted(evt_rows) == sorted(evt_cols)
+            for name in evt_rows:
+                assert type(evt_rows[name]) is type(evt_cols[name]), name
+                assert np.array_equal(evt_rows[name], evt_cols[name]), name
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+import os
+os.environ['PS_PARALLEL'] = 'none'
+
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+import numpy as np
+import h5py
+from psana.smalldata import Server, CacheWriter, _batch_to_columns
+
+def make_batches(n_batches, batch_size, seed=0):
+    """ Returns batches of events with datasets that come and go (backfilled) """
+    rng = np.random.default_rng(seed)
+    batches = []
+    i_evt = 0
+    for _ in range(n_batches):
+        batch = []
+        for _ in range(batch_size):
+            evt = {'evt': i_evt}
+            if rng.random() < 0.7: evt['x'] = float(i_evt)
+            if rng.random() < 0.5: evt['img'] = np.full((2, 3), i_evt, dtype=np.float32)
+            if i_evt > 10 and rng.random() < 0.3: evt['late'] = np.int32(i_evt) # new dataset
+            if rng.random() < 0.2: evt['unaligned_u'] = i_evt
+            batch.append(evt)
+            i_evt += 1
+        batches.append(batch)
+    return batches
+
+def write(batches, fname, columnar=False, **kwargs):
+    srv = Server(filename=fname, cache_size=4, **kwargs)
+    for batch in batches:
+        if columnar:
+            srv.handle_columns(_batch_to_columns(batch))
+        else:
+            srv.handle(batch)
+    srv.done()
+    with h5py.File(fname, 'r') as f:
+        return {name: f[name][:] for name in f}
+
+class TestSmallDataWriter(unittest.TestCase) :
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def fname(self, name):
+        return os.path.join(self.tmpdir.name, name)
+
+    def test_same_file(self):
+        batches = make_batches(12, 5)
+        expected = write(batches, self.fname('sync.h5'))
+        assert np.array_equal(expected['evt'], np.arange(60))
+        for columnar in (False, True):
+            for depth in (1, 3):
+                got = write(batches, self.fname('q%d_%d.h5' % (depth, columnar)),
+                            columnar=columnar, write_queue_depth=depth)
+                assert sorted(got) == sorted(expected)
+                for name in expected:
+                    assert got[name].dtype == expected[name].dtype, name
+                    assert np.array_equal(got[name], expected[name], equal_nan=True), (name, depth, columnar)
+
+    def test_slow_writer(self):
+        # caches of all datasets queue up behind a slow write
+        batches = make_batches(6, 7, seed=1)
+        expected = write(batches, self.fname('sync.h5'))
+        write_to_file = Server.write_to_file
+        def slow_write(srv, dataset_name, cache):
+            time.sleep(0.002)
+            write_to_file(srv, dataset_name, cache)
+        with mock.patch.object(Server, 'write_to_file', slow_write):
+            got = write(batches, self.fname('slow.h5'), write_queue_depth=1)
+        for name in expected:
+            assert np.array_equal(got[name], expected[name], equal_nan=True), name
+
+    def test_writer_error(self):
+        batches = make_batches(4, 5)
+        srv = Server(filename=self.fname('err.h5'), cache_size=4, write_queue_depth=1)
+        def failing_write(dataset_name, cache):
+            if dataset_name == 'img':
+                raise OSError('disk full')
+            srv.write_to_file(dataset_name, cache)
+        srv._writer.write_fn = failing_write
+        with self.assertRaises(RuntimeError) as cm:
+            for batch in batches:
+                srv.handle(batch)
+            srv.done()
+        assert isinstance(cm.exception.__cause__, OSError)
+        srv.file_handle.close()
+
+    def test_error_at_close(self):
+        # the last caches are only written by done()
+        srv = Server(filename=self.fname('err.h5'), cache_size=4, write_queue_depth=1)
+        srv.handle([{'x': 1.}])
+        srv._writer.write_fn = mock.Mock(side_effect=OSError('disk full'))
+        with self.assertRaises(RuntimeError) as cm:
+            srv.done()
+        assert isinstance(cm.exception.__cause__, OSError)
+        srv.file_handle.close()
+
+class TestCacheWriter(unittest.TestCase) :
+
+    def test_order(self):
+        written, returned = [], []
+        release = threading.Event()
+        def write_fn(dataset_name, cache):
+            release.wait()
+            written.append((dataset_name, cache))
+        writer = CacheWriter(write_fn, lambda *item: returned.append(item), 1)
+        items = [('a', 0), ('b', 1), ('a', 2), ('c', 3), ('a', 4)]
+        blocked = [writer.put(*items[0])]
+        threading.Timer(0.1, release.set).start()
+        blocked += [writer.put(*item) for item in items[1:]]
+        writer.close()
+        assert written == returned == items
+        assert sum(blocked) > 0.05 # put waits while the queue is full
+
+    def test_error(self):
+        def write_fn(dataset_name, cache):
+            if cache == 2: raise ValueError(cache)
+        returned = []
+        writer = CacheWriter(write_fn, lambda *item: returned.append(item), 1)
+        writer.put('a', 0)
+        writer.put('a', 1)
+        writer.put('a', 2)
+        with self.assertRaises(RuntimeError) as cm:
+            writer.close()
+        assert isinstance(cm.exception.__cause__, ValueError)
+        assert returned == [('a', 0), ('a', 1), ('a', 2)] # failed caches are returned too
+        with self.assertRaises(RuntimeError):
+            writer.put('a', 3)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+from psana.detector.timetool import timeToolParser, EventBuilderFrameLayout, TimeToolFrame
+import numpy as np
+import unittest
+
+def subframe(payload, tdest):
+    """Returns payload followed by 16-byte size trailer"""
+    trailer = np.zeros(16, dtype=np.uint8)
+    trailer[0], trailer[1], trailer[4] = len(payload) & 0xff, len(payload) >> 8, tdest
+    return np.concatenate((np.asarray(payload, dtype=np.uint8), trailer))
+
+def frame(seq, subframes):
+    """Returns event builder frame of 16-byte header and subframes"""
+    header = np.zeros(16, dtype=np.uint8)
+    header[0], header[1] = 0x31, seq
+    return np.concatenate([header] + list(subframes))
+
+def timetool_frame(seq=7, edge=1234, background=True, prescaled=True, seed=0):
+    rng = np.random.default_rng(seed)
+    fex = [subframe([edge & 0xff, edge >> 8] + [0]*14, 0)]
+    if background: fex.append(subframe(rng.integers(0, 256, 2048), 1))
+    subs = [subframe(rng.integers(0, 256, 16), 0), subframe(frame(seq, fex), 1)]
+    if prescaled: subs.append(subframe(rng.integers(0, 256, 2048), 2))
+    return frame(seq, subs)
+
+def same(x, y):
+    if x is None or y is None: return x is None and y is None
+    return bytes(x) == bytes(y)
+
+class TestTimeToolParser(unittest.TestCase) :
+
+    def check(self, data, layout):
+        ref = timeToolParser()
+        ref._parseData(data.tobytes())
+        f = TimeToolFrame(data, layout)
+        assert f.edge_position == ref.edge_position
+        assert f.sequence_count == ref.sequence_count
+        assert f._tdest == ref._tdest
+        assert same(f._timing_bus, ref._timing_bus)
+        assert same(f.background_frame, ref.background_frame)
+        assert same(f.prescaled_frame, ref.prescaled_frame)
+        if f.prescaled_frame is not None:
+            assert f.prescaled_frame.dtype == np.int8
+            assert np.shares_memory(f.prescaled_frame, data)
+
+    def test_parser(self):
+        for kwa in ({}, {'background': False}, {'prescaled': False}, {'background': False, 'prescaled': False}):
+            data = timetool_frame(**kwa)
+            self.check(data, EventBuilderFrameLayout(data))
+
+    def test_layout_reuse(self):
+        data = timetool_frame(seq=1, edge=5)
+        layout = EventBuilderFrameLayout(data)
+        data2 = timetool_frame(seq=2, edge=2047, seed=1)
+        assert layout.matches(data2)
+        self.check(data2, layout)
+        assert TimeToolFrame(data2, layout).sequence_count == 2
+        assert not layout.matches(timetool_frame(prescaled=False))
+        data3 = data2.copy()
+        data3[2176:2178] = data3[0:2] # first bytes of prescaled frame look like frame header
+        assert not layout.matches(data3)
+        with self.assertRaises(ValueError):
+            EventBuilderFrameLayout(data[:100])
+
+if __name__ == "__main__":
+    unittest.main()
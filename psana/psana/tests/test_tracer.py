@@ -0,0 +1,79 @@
+from psana.psexp.tracer import Tracer, load_traces, summarize
+import tempfile
+import shutil
+import json
+import os
+import time
+import threading
+import unittest
+
+class TestTracer(unittest.TestCase) :
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_trace(self):
+        smd0, bd = Tracer(), Tracer()
+        smd0.start(0, 'smd0', trace_dir=self.tmpdir)
+        bd.start(1, 'bd', trace_dir=self.tmpdir, capacity=4)
+        smd0.add('read', 10., 11.)
+        smd0.add('wait', 11., 15., peer=1)
+        smd0.add('send', 15., 16., peer=1)
+        for i in range(6): # the ring buffer keeps the last 4
+            bd.add('wait' if i % 2 else 'ana', 10. + i, 11. + i, peer=0 if i % 2 else -1)
+        bd.finish()
+        smd0.finish() # rank 0 merges
+
+        traces = load_traces(self.tmpdir)
+        assert [meta['rank'] for meta, _ in traces] == [0, 1]
+        assert traces[1][0]['dropped'] == 2 and list(traces[1][1]['start']) == [12., 13., 14., 15.]
+
+        with open(os.path.join(self.tmpdir, 'trace.json')) as f:
+            events = [e for e in json.load(f)['traceEvents'] if e['ph'] == 'X']
+        assert [(e['pid'], e['name'], e['ts'], e['dur']) for e in events[:3]] == \
+                [(0, 'read', 0., 1e6), (0, 'wait', 1e6, 4e6), (0, 'send', 5e6, 1e6)]
+        assert events[1]['args'] == {'peer': 1} and len(events) == 7
+
+        summary = summarize(traces)
+        assert summary['smd0']['wall'] == 6. and summary['smd0']['critical'] == 2.
+        assert summary['bd']['idle'] == 0.5 and summary['bd']['spans'] == {'wait': 2., 'ana': 2.}
+        with open(os.path.join(self.tmpdir, 'summary.txt')) as f:
+            assert f.readline().startswith('role') and f.readline().startswith('smd0*')
+
+    def test_thread_spans(self):
+        bd = Tracer()
+        bd.start(0, 'bd', trace_dir=self.tmpdir)
+        bd.add('ana', 10., 14.)
+        prefetcher = threading.Thread(target=lambda: [bd.add('wait', 10., 13., peer=1), bd.add('bd_read', 13., 14.)])
+        prefetcher.start()
+        prefetcher.join()
+        bd.finish()
+
+        summary = summarize(load_traces(self.tmpdir))['bd']
+        assert summary['spans'] == {'ana': 4.} and summary['idle'] == 0. # overlaps with the main thread
+        assert summary['thread_spans'] == {'wait': 3., 'bd_read': 1.}
+        with open(os.path.join(self.tmpdir, 'summary.txt')) as f:
+            assert 'other threads: wait=3.000 bd_read=1.000' in f.read()
+
+    def test_missing_rank(self):
+        os.environ['PS_TRACE_MERGE_TIMEOUT'] = '0.5'
+        try:
+            smd0, eb = Tracer(), Tracer()
+            smd0.start(0, 'smd0', trace_dir=self.tmpdir, n_ranks=3)
+            eb.start(1, 'eb', trace_dir=self.tmpdir, n_ranks=3)
+            smd0.add('read', 10., 11.)
+            eb.add('build', 10., 11.)
+            eb.finish()
+            st = time.monotonic()
+            smd0.finish() # rank 2 never saves its spans
+            assert time.monotonic() - st < 5
+        finally:
+            del os.environ['PS_TRACE_MERGE_TIMEOUT']
+        assert [meta['rank'] for meta, _ in load_traces(self.tmpdir)] == [0, 1]
+        assert os.path.exists(os.path.join(self.tmpdir, 'trace.json'))
+
+if __name__ == "__main__":
+    unittest.main()
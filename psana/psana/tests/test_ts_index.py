@@ -0,0 +1,78 @@
+from psana.psexp.ts_index import TimestampIndex
+from psana.psexp import TransitionId
+import numpy as np
+import tempfile
+import shutil
+import os
+import unittest
+
+def dgram_bytes(timestamp, service, payload=b''):
+    """ Returns dgram header (time, env, xtc) followed by payload """
+    header = np.array([timestamp & 0xffffffff, timestamp >> 32, service << 24, 0, 0, 12 + len(payload)], dtype=np.uint32)
+    return header.tobytes() + payload
+
+def smd_l1_bytes(timestamp, bd_offset, bd_size):
+    """ Returns smd L1Accept dgram with smdinfo (see SmdBatch) """
+    words = np.zeros(15, dtype=np.uint32)
+    for word, extent in ((5, 64), (8, 52), (11, 12), (14, 28)):
+        words[word] = extent
+    words[:2] = timestamp & 0xffffffff, timestamp >> 32
+    words[2] = TransitionId.L1Accept << 24
+    return words.tobytes() + np.array([bd_offset, bd_size], dtype=np.uint64).tobytes()
+
+class TestTimestampIndex(unittest.TestCase) :
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.ts = [(1 << 32) + 10 * i for i in range(20)]
+        self.files = []
+        for ifile in range(2):
+            dgrams = [dgram_bytes(self.ts[0], TransitionId.Configure, b'config'),
+                    dgram_bytes(self.ts[1], TransitionId.BeginRun)]
+            for i, ts in enumerate(self.ts[2:-1]):
+                if ifile == 1 and i % 3: continue # the second file has fewer events
+                dgrams.append(smd_l1_bytes(ts, 1000 * i + ifile, 100 + i))
+            dgrams.append(dgram_bytes(self.ts[-1], TransitionId.EndRun))
+            fname = os.path.join(self.tmpdir, f'xpptut15-r0001-s00{ifile}-c000.smd.xtc2')
+            with open(fname, 'wb') as f: f.write(b''.join(dgrams))
+            self.files.append(fname)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_index(self):
+        idx = TimestampIndex.open(self.files)
+        assert len(idx) == 2 * 3 + 17 + 6
+        assert np.all(np.diff(idx.timestamps.astype(np.int64)) >= 0)
+
+        rows = idx.find(self.ts[2])
+        assert list(rows['ifile']) == [0, 1]
+        assert list(rows['bd_offset']) == [0, 1] and list(rows['bd_size']) == [100, 100]
+        assert rows['smd_size'][0] == 76
+        rows = idx.find(self.ts[3])
+        assert rows.shape[0] == 1 and rows['bd_offset'][0] == 1000
+        assert idx.find(self.ts[3] + 1).shape[0] == 0
+
+        st, en = idx.positions(self.ts[2], self.ts[8])
+        events = list(idx.events(st, en, chunk=3))
+        assert [evt['timestamp'][0] for evt in events] == self.ts[2:8]
+        assert [evt.shape[0] for evt in events] == [2, 1, 1, 2, 1, 1]
+        transitions = list(idx.events(0, len(idx), transitions_only=True))
+        assert [evt['service'][0] for evt in transitions] == \
+                [TransitionId.Configure, TransitionId.BeginRun, TransitionId.EndRun]
+
+    def test_saved_index(self):
+        idx = TimestampIndex.open(self.files)
+        assert isinstance(idx.columns, np.memmap)
+        assert TimestampIndex.open(self.files, build=False) is not None
+        with open(self.files[1], 'ab') as f: # the file grew - the index is stale
+            f.write(dgram_bytes(self.ts[-1] + 1, TransitionId.BeginRun))
+        assert TimestampIndex.open(self.files, build=False) is None
+        assert len(TimestampIndex.open(self.files)) == len(idx) + 1
+
+        idx = TimestampIndex.open(self.files[:1], smd=False, index_dir=os.path.join(self.tmpdir, 'idx'))
+        rows = idx.find(self.ts[3])
+        assert rows['bd_offset'][0] == rows['smd_offset'][0] and rows['bd_size'][0] == 76
+
+if __name__ == "__main__":
+    unittest.main()
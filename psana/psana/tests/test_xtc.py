@@ -7,6 +7,7 @@ from xtc import xtc
 from det import det, detnames, det_container
 
 import hashlib
+import numpy as np
 from psana import DataSource
 import dgramCreate as dc
 from setup_input_files import setup_input_files
@@ -63,6 +64,55 @@ class Test:
         loop_based_exhausted = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'ds.py')
         subprocess.check_call(['python',loop_based_exhausted], env=env)
 
+    def test_local(self, tmp_path):
+        setup_input_files(tmp_path)
+
+        env = dict(list(os.environ.items()) + [
+            ('TEST_XTC_DIR', str(tmp_path)),
+            ('PS_PARALLEL', 'local'),
+            ('PS_LOCAL_WORKERS', '2'),
+        ])
+
+        loop_based = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'user_loops.py')
+        subprocess.check_call(['python',loop_based], env=env)
+
+    def run_events_digest(self, tmp_path, name, n_ranks=1, **env_vars):
+        """ Returns (timestamp, raw sum, epics) of events read with
+        n_ranks (mpirun if > 1) and the given environment variables."""
+        env = dict(list(os.environ.items()) + [
+            ('TEST_XTC_DIR', str(tmp_path)),
+            ('PS_PARALLEL', 'mpi'), # other test modules set 'none'
+            ('PS_SRV_NODES', '0'),
+            ('PS_EB_NODES', '1'),
+            ('PS_SMD_N_EVENTS', '2'), # several smd chunks
+        ] + list(env_vars.items()))
+        digest_file = str(tmp_path / (name + '.npy'))
+        events_digest = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'run_events_digest.py')
+        cmd = ['python', events_digest, digest_file]
+        if n_ranks > 1:
+            cmd = ['mpirun', '-n', str(n_ranks)] + cmd
+        subprocess.check_call(cmd, env=env)
+        return np.load(digest_file)
+
+    def test_smd_pipeline(self, tmp_path):
+        setup_input_files(tmp_path, n_motor_steps=3, n_events_per_step=10)
+        serial = self.run_events_digest(tmp_path, 'serial')
+        assert serial.shape == (30, 3)
+        for depth in ('1', '2'):
+            pipelined = self.run_events_digest(tmp_path, 'pipelined'+depth, n_ranks=4,
+                    PS_SMD_PIPELINE_DEPTH=depth)
+            assert np.array_equal(pipelined, serial, equal_nan=True)
+
+    def test_smd_zerocopy(self, tmp_path):
+        setup_input_files(tmp_path, n_motor_steps=3, n_events_per_step=10)
+        copied = self.run_events_digest(tmp_path, 'copy', n_ranks=4)
+        assert copied.shape == (30, 3)
+        zerocopy = self.run_events_digest(tmp_path, 'zerocopy', n_ranks=4, PS_SMD_ZEROCOPY='1')
+        assert np.array_equal(zerocopy, copied, equal_nan=True)
+        zerocopy = self.run_events_digest(tmp_path, 'zerocopy_pipelined', n_ranks=4, PS_SMD_ZEROCOPY='1',
+                PS_SMD_PIPELINE_DEPTH='2')
+        assert np.array_equal(zerocopy, copied, equal_nan=True)
+
     def test_detnames(self, xtc_file):
         # for now just check that the various detnames don't crash
         for flag in ['-r','-e','-s','-i']:
@@ -110,11 +110,14 @@ if 'PSANA' in BUILD_LIST :
             'proc_info           = psana.pscalib.app.proc_info:do_main',
             'proc_control        = psana.pscalib.app.proc_control:do_main',
             'proc_new_datasets   = psana.pscalib.app.proc_new_datasets:do_main',
+            'calib_prefetch      = psana.pscalib.app.calib_prefetch:do_main',
             'timeconverter       = psana.graphqt.app.timeconverter:timeconverter',
             'calibman            = psana.graphqt.app.calibman:calibman_gui',
             'hdf5explorer        = psana.graphqt.app.hdf5explorer:hdf5explorer_gui',
             'screengrabber       = psana.graphqt.ScreenGrabberQt5:run_GUIScreenGrabber',
             'detnames            = psana.app.detnames:detnames',
+            'ts_index            = psana.app.ts_index:main',
+            'trace_merge         = psana.app.trace_merge:main',
             'xtcavDark           = psana.xtcav.app.xtcavDark:__main__',
             'xtcavLasingOff      = psana.xtcav.app.xtcavLasingOff:__main__',
             'xtcavLasingOn       = psana.xtcav.app.xtcavLasingOn:__main__',